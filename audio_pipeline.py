@@ -0,0 +1,862 @@
+"""Decoder process: tracks decoded apart from the GUI and fed to the mixer.
+
+Opt-in (MUSIC_PLAYER_DECODER=1; see PlaybackEngine): instead of
+pygame.mixer.music, the engine then plays through a DecodedMusic, which
+has the same methods:
+
+    decoder     a child process decodes the current track, and the queued
+                one after it for gapless playback, on a core of its own;
+                MP3s are decoded a second at a time, each piece with a few
+                frames of context on both sides so that the pieces join
+                sample-exactly
+    ring        decoded PCM goes into a ring buffer in shared memory with a
+                single producer (the decoder moves its write counter) and a
+                single consumer (the player moves its read counter), so
+                neither side ever takes a lock or waits on the other
+    feeder      a thread of the player copies blocks of about buffer_ms
+                from the ring into two pygame Sounds, queued in turn on a
+                reserved mixer Channel; at least buffer_ms is always
+                waiting in the mixer, so a GUI thread busy for less than
+                that cannot interrupt the audio. pygame takes the GIL on
+                SDL's audio thread when a block ends, though: one C call
+                holding the GIL throughout (Qt calls release it) delays
+                the audio where a block ends, until it returns
+    underruns   the channel running dry while playing is counted
+                (DecodedMusic.underruns and the audio_underruns metric)
+    dsp         the feeder runs each block through the equalizer and the
+                limiter (set_equalizer), and the decoder crossfades
+                consecutive tracks (set_crossfade); see dsp
+
+Track boundaries, seeks and ends travel over a pipe beside the ring: each
+run of frames of a track (a segment) is announced, with where it starts
+in the ring, before its frames are written.
+"""
+import io
+import os
+import math
+import time
+import wave
+import threading
+import multiprocessing
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import dsp
+import metrics
+import http_stream
+from seek_index import SCAN_STRIDE, build_seek_index, parse_frame_header
+
+# Audio handed to the mixer ahead of what plays, by default
+DEFAULT_BUFFER_MS = 500
+# Decoded audio the ring holds ahead of the mixer
+RING_SECONDS = 4.0
+# MPEG frames decoded at once (about a second), and the frames decoded
+# before and after them and dropped: the bit reservoir and the filter bank
+# need the frames before, and the mixer's resampler cuts off the end of
+# what it converts
+DECODE_FRAMES = SCAN_STRIDE
+PRIMING_FRAMES = 3
+TRAILING_FRAMES = 4
+# WAV frames converted with each second when the file's format is not the
+# mixer's, for the same reasons
+WAV_CONTEXT = 4096
+# How often a decoder with a full ring looks for room again, as a
+# fraction of the ring
+ROOM_WAIT = 1 / 16
+# Feeder polls while a track starts, or when the decoder falls behind
+DATA_WAIT = 0.005
+# And while a block plays, as a fraction of the buffer: the sound card's
+# clock is not perf_counter's, so block starts are re-anchored when the
+# queued block is seen to take over
+BLOCK_POLL = 1 / 8
+
+
+class PcmRing:
+    """Single-producer, single-consumer ring of PCM frames in shared memory.
+
+    The write and read counters only grow (frames written and read so
+    far) and sit on separate cache lines; each is stored by one process
+    only, after the frames it covers were copied, as one aligned 8-byte
+    store.
+    """
+
+    HEADER = 128
+
+    def __init__(self, frames, channels, dtype, name=None):
+        self.frames = frames
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        size = self.HEADER + frames * channels * self.dtype.itemsize
+        self._memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self._memory.name
+        self._counters = np.ndarray((self.HEADER // 8,), np.int64, buffer=self._memory.buf)
+        self._data = np.ndarray((frames, channels), self.dtype, buffer=self._memory.buf,
+                                offset=self.HEADER)
+        if name is None:
+            self._counters[:] = 0
+
+    @property
+    def written(self):
+        return int(self._counters[0])
+
+    @property
+    def read(self):
+        return int(self._counters[8])
+
+    # Producer
+
+    def write(self, samples):
+        # Copy as many frames as there is room for; returns how many
+        position = self.written
+        count = min(len(samples), self.frames - (position - self.read))
+        if count <= 0:
+            return 0
+        first = position % self.frames
+        part = min(count, self.frames - first)
+        self._data[first:first + part] = samples[:part]
+        self._data[:count - part] = samples[part:count]
+        self._counters[0] = position + count
+        return count
+
+    # Consumer
+
+    def read_into(self, position, out):
+        # Copy len(out) frames from `position` (which must be written) and
+        # release everything before their end
+        count = len(out)
+        first = position % self.frames
+        part = min(count, self.frames - first)
+        out[:part] = self._data[first:first + part]
+        out[part:] = self._data[:count - part]
+        self._counters[8] = position + count
+
+    def release(self, position):
+        # Frames before `position` are not wanted (skipped or stale)
+        self._counters[8] = position
+
+    def close(self, unlink=False):
+        del self._counters, self._data
+        self._memory.close()
+        if unlink:
+            self._memory.unlink()
+
+
+# The decoder process
+
+def _decode(data):
+    # PCM of a piece of an encoded file, in the mixer's format
+    import pygame
+    return pygame.sndarray.array(pygame.mixer.Sound(file=io.BytesIO(data)))
+
+
+class _Pieces:
+    """Cuts what belongs to each decoded piece out of its window (the
+    piece with its context), so the pieces join without gaps or overlaps
+    at the mixer's rate; drops the first `skip` frames."""
+
+    def __init__(self, ratio, skip=0):
+        self.ratio = ratio
+        self.skip = skip
+        self.decoded = 0
+        self.emitted = 0
+
+    def cut(self, pcm, before, body):
+        # `before` and `body`: source frames of context and of the piece
+        self.decoded += body
+        count = round(self.decoded * self.ratio) - self.emitted
+        self.emitted += count
+        first = round(before * self.ratio)
+        piece = pcm[first:first + count]
+        if len(piece) < count:
+            piece = np.concatenate((piece, np.zeros((count - len(piece),) + pcm.shape[1:],
+                                                    pcm.dtype)))
+        if self.skip:
+            dropped = min(self.skip, count)
+            self.skip -= dropped
+            piece = piece[dropped:]
+        return piece
+
+
+@lru_cache(maxsize=8)
+def _seek_index(path):
+    # Frame-exact for files; URLs are not scanned (see build_seek_index)
+    return build_seek_index(path, scan=not http_stream.is_url(path))
+
+
+def _mpeg_frames(f, position, end):
+    # Yield the bytes of each MPEG frame from `position` until the data ends
+    # or sync is lost
+    buffer = b''
+    buffer_start = position
+    while position + 4 <= end:
+        relative = position - buffer_start
+        if relative + 4 > len(buffer):
+            f.seek(position)
+            buffer = f.read(256 * 1024)
+            buffer_start = position
+            relative = 0
+        info = parse_frame_header(buffer[relative:relative + 4])
+        if info is None:
+            return
+        if relative + info[0] > len(buffer):
+            f.seek(position)
+            buffer = f.read(max(256 * 1024, info[0]))
+            buffer_start = position
+            relative = 0
+        frame = buffer[relative:relative + info[0]]
+        if len(frame) < info[0]:
+            return
+        yield frame
+        position += info[0]
+
+
+def _mp3_pcm(f, index, start, rate):
+    # Start from an indexed frame a stride before `start`: the frames in
+    # between prime the decoder and are dropped. Xing and estimated indexes
+    # only know about where `start` is
+    position, skip = index.data_start, start
+    if start > 0 and index.offsets:
+        point = max(min(int(start / index.frame_duration) // index.stride,
+                        len(index.offsets) - 1) - 1, 0)
+        position = index.offsets[point]
+        skip = start - point * index.stride * index.frame_duration
+    elif start > 0:
+        position, skip = index.byte_offset(start), 0.0
+        f.seek(position)
+        probe = f.read(64 * 1024)
+        for i in range(len(probe) - 3):
+            if probe[i] == 0xFF and parse_frame_header(probe[i:i + 4]) is not None:
+                position += i
+                break
+
+    pieces = _Pieces(rate / index.sample_rate, round(skip * rate))
+    frames = _mpeg_frames(f, position, index.data_end)
+    ahead = list(islice(frames, DECODE_FRAMES + TRAILING_FRAMES))
+    before = []
+    while ahead:
+        body, after = ahead[:DECODE_FRAMES], ahead[DECODE_FRAMES:]
+        # At the end, the last frame stands in for the context after it
+        after = after + body[-1:] * (TRAILING_FRAMES - len(after))
+        pcm = _decode(b''.join(before + body + after))
+        yield pieces.cut(pcm, len(before) * index.frame_samples, len(body) * index.frame_samples)
+        before = body[-PRIMING_FRAMES:]
+        ahead = ahead[DECODE_FRAMES:] + list(islice(frames, DECODE_FRAMES))
+
+
+def _wav_header(params, data):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setparams(params)
+        w.writeframes(data)
+    return buffer.getvalue()
+
+
+def _wav_pcm(f, start, rate, channels, dtype):
+    with wave.open(f, 'rb') as w:
+        params = w.getparams()
+        w.setpos(min(int(start * params.framerate), params.nframes))
+        step = params.framerate
+        if (params.framerate, params.nchannels, params.sampwidth) == \
+                (rate, channels, dtype.itemsize) and dtype == np.dtype('<i2'):
+            # Already in the mixer's format
+            while True:
+                data = w.readframes(step)
+                if not data:
+                    return
+                yield np.frombuffer(data, dtype).reshape(-1, channels)
+
+        frame_bytes = params.sampwidth * params.nchannels
+        pieces = _Pieces(rate / params.framerate)
+        # Whole periods of the rate conversion, so that the context before
+        # a piece does not shift its samples by a fraction
+        period = params.framerate // math.gcd(params.framerate, rate)
+        context = max(WAV_CONTEXT // period, 1) * period
+        before = b''
+        ahead = w.readframes(step + context)
+        while ahead:
+            body, after = ahead[:step * frame_bytes], ahead[step * frame_bytes:]
+            pcm = _decode(_wav_header(params, before + body + after))
+            yield pieces.cut(pcm, len(before) // frame_bytes, len(body) // frame_bytes)
+            before = body[-context * frame_bytes:]
+            ahead = after + w.readframes(step)
+
+
+def _track_pcm(path, start, rate, channels, dtype):
+    """Yield the PCM of a track from `start` seconds, about a second at a
+    time, in the mixer's format."""
+    name = http_stream.name_hint(path) if http_stream.is_url(path) else path
+    with http_stream.open_file(path, stream=http_stream.is_url(path)) as f:
+        if name.lower().endswith('.mp3'):
+            index = _seek_index(path)
+            if index is not None:
+                yield from _mp3_pcm(f, index, start, rate)
+                return
+        elif name.lower().endswith('.wav'):
+            yield from _wav_pcm(f, start, rate, channels, dtype)
+            return
+        # Anything else is decoded whole by the mixer
+        import pygame
+        f.seek(0)
+        pcm = pygame.sndarray.array(pygame.mixer.Sound(file=f))
+    for first in range(int(start * rate), len(pcm), rate):
+        yield pcm[first:first + rate]
+
+
+def _init_decoder(mixer):
+    # The decoder decodes through its own mixer, on the dummy driver
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    import pygame
+    frequency, size, channels = mixer
+    pygame.mixer.init(frequency=frequency, size=size, channels=channels)
+    # URLs are read through a cache of the decoder's own: the player's is
+    # not shared between processes
+    from metadata_cache import CACHE_DIR
+    http_stream.configure(os.path.join(CACHE_DIR, 'streams', 'decoder'))
+
+
+def _decoder_main(ring_name, frames, channels, dtype, mixer, crossfade, commands, events):
+    # Runs in the decoder process until the player closes it. Commands:
+    #     ('play', epoch, token, path, start)   drop everything, play a track
+    #     ('queue', epoch, after, token, path)  play this after track `after`
+    #     ('stop', epoch)                       drop everything
+    #     ('crossfade', seconds)                from the next track on
+    # Events: ('segment', epoch, token, start, void_from) before a track's
+    # frames (the frames from void_from to start are not to be played), and
+    # ('end', epoch, position) when nothing more follows. With a crossfade,
+    # a track's segment starts where it fades in over the end of the last
+    _init_decoder(mixer)
+    ring = PcmRing(frames, channels, dtype, name=ring_name)
+    rate = mixer[0]
+    room_wait = RING_SECONDS * ROOM_WAIT
+    fade = dsp.Crossfade(rate, crossfade)
+    epoch = 0
+    current = previous = path = None
+    current_start = 0
+    pcm = pending = queued = None
+
+    def start(token, track_path, position=0.0, void_from=None):
+        nonlocal current, current_start, path, pcm, pending
+        current, path, current_start = token, track_path, ring.written
+        events.send(('segment', epoch, token, current_start, void_from))
+        pcm = _track_pcm(track_path, position, rate, channels, ring.dtype)
+        pending = None
+
+    try:
+        timeout = None
+        while True:
+            if commands.poll(timeout):
+                command = commands.recv()
+                kind = command[0]
+                if kind == 'close':
+                    return
+                if kind == 'crossfade':
+                    fade.set_seconds(command[1])
+                elif kind in ('play', 'stop'):
+                    epoch = command[1]
+                    current = previous = pcm = pending = queued = None
+                    fade.reset()
+                    if kind == 'play':
+                        start(*command[2:])
+                elif kind == 'queue' and command[1] == epoch:
+                    _, _, after, token, track_path = command
+                    if current == after:
+                        queued = (token, track_path)
+                        if pcm is None:
+                            # The track already ended: carry on with this one
+                            previous = current
+                            start(*queued)
+                            queued = None
+                    elif previous == after:
+                        # The track queued before is being decoded already:
+                        # it is replaced, and its frames are void
+                        fade.replace_next()
+                        start(token, track_path, void_from=current_start)
+                timeout = 0
+                continue
+
+            if pcm is None:
+                timeout = None
+                continue
+            if pending is None:
+                try:
+                    pending = next(pcm, None)
+                except Exception as e:
+                    print(f"Error decoding {path}: {e}")
+                    pending = None
+                if pending is None:
+                    if queued is not None:
+                        fade.next_track()
+                        previous = current
+                        start(*queued)
+                        queued = None
+                    elif fade.holding and ring.written - ring.read > ring.frames // 4:
+                        # The end held back for a crossfade waits for a
+                        # track to be queued until the player nears it (a
+                        # quarter of the ring is a block or more)
+                        timeout = room_wait
+                        continue
+                    else:
+                        # With nothing to fade into, it goes out as it is
+                        pending = fade.flush()
+                        if pending is not None and len(pending):
+                            pcm = iter(())
+                        else:
+                            events.send(('end', epoch, ring.written))
+                            pcm = pending = None
+                    timeout = 0
+                    continue
+                pending = fade.feed(pending)
+                if not len(pending):
+                    pending = None
+                    continue
+            written = ring.write(pending)
+            pending = pending[written:] if written < len(pending) else None
+            # A full ring: wait for room, or for a command
+            timeout = room_wait if pending is not None else 0
+    except (EOFError, BrokenPipeError, KeyboardInterrupt):
+        # The player went away
+        pass
+    finally:
+        ring.close()
+
+
+# The player's side
+
+class _Block:
+    # A Sound handed to the channel: when it starts playing (estimated) and
+    # which ring frames it holds, as (offset in the block, ring position,
+    # count) pieces
+    __slots__ = ('sound', 'start', 'pieces', 'frames')
+
+    def __init__(self, sound, pieces, frames):
+        self.sound = sound
+        self.start = 0.0
+        self.pieces = pieces
+        self.frames = frames
+
+    def position(self, elapsed):
+        # Ring position played `elapsed` frames into the block
+        position = self.pieces[0][1]
+        for offset, start, count in self.pieces:
+            if elapsed < offset:
+                break
+            position = start + min(elapsed - offset, count)
+        return position
+
+    def time_of(self, position, rate):
+        # When the ring frame at `position` plays, if it is in this block
+        for offset, start, count in self.pieces:
+            if start <= position < start + count:
+                return self.start + (offset + position - start) / rate
+        return None
+
+
+class DecodedMusic:
+    """pygame.mixer.music's interface, played through a decoder process
+    (see the module docstring): load, play, pause, unpause, stop, set_pos,
+    get_pos, get_busy, queue, set_volume and set_endevent, plus close().
+
+    Needs an initialized mixer; buffer_ms is the audio always waiting in
+    the mixer, which is also the longest GIL stall played through.
+    """
+
+    def __init__(self, buffer_ms=DEFAULT_BUFFER_MS):
+        import pygame
+
+        self._pygame = pygame
+        self.rate, size, self.channels = pygame.mixer.get_init()
+        self._mixer = (self.rate, size, self.channels)
+        self.buffer_ms = buffer_ms
+        # Two blocks: one playing and one queued behind it, refilled in turn.
+        # A block takes over before the feeder sees it and queues the next:
+        # blocks are longer than the buffer by that
+        self._poll = buffer_ms / 1000 * BLOCK_POLL
+        block_frames = max(1, int(self.rate * (buffer_ms / 1000 + self._poll)))
+        # Whole DSP blocks
+        block_frames = -(-block_frames // dsp.BLOCK_FRAMES) * dsp.BLOCK_FRAMES
+        pygame.mixer.set_reserved(1)
+        self._channel = pygame.mixer.Channel(0)
+        dtype = pygame.sndarray.samples(pygame.mixer.Sound(buffer=bytes(64))).dtype
+        self._sounds = []
+        self._arrays = []
+        for _ in range(2):
+            sound = pygame.mixer.Sound(buffer=bytes(block_frames * self.channels * dtype.itemsize))
+            self._sounds.append(sound)
+            self._arrays.append(pygame.sndarray.samples(sound))
+        self._next_sound = 0
+        self.block_frames = block_frames
+        ring_frames = max(int(self.rate * RING_SECONDS), 4 * block_frames)
+        self._ring = PcmRing(ring_frames, self.channels, dtype)
+        self._dsp = dsp.DspChain(self.rate, self.channels, dtype)
+        self._crossfade = 0.0
+
+        self.underruns = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._endevent = None
+        self._volume = 1.0
+        self._epoch = 0
+        self._tokens = 0
+        self._paths = {}
+        self._loaded = None
+        self._current = None
+        self._queued = None
+        self._reset()
+        self._process = None
+        self._start_decoder()
+        self._thread = threading.Thread(target=self._feed, name='audio-feeder', daemon=True)
+        self._thread.start()
+
+    def _start_decoder(self):
+        context = multiprocessing.get_context('spawn')
+        commands, self._commands = context.Pipe(duplex=False)
+        self._events, events = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_decoder_main, name='audio-decoder', daemon=True,
+            args=(self._ring.name, self._ring.frames, self.channels, self._ring.dtype.str,
+                  self._mixer, self._crossfade, commands, events))
+        self._process.start()
+        # The child holds its own ends now
+        commands.close()
+        events.close()
+
+    def _reset(self, state='stopped'):
+        # Called with the condition held: forget the blocks and segments of
+        # the epoch that ended
+        self._state = state
+        self._paused_at = None
+        self._started = False
+        self._read = 0
+        self._blocks = deque()
+        self._segments = deque()
+        self._jumps = deque()
+        self._end = None
+        self._played = 0
+        self._checked = 0.0
+        self._dry = False
+        self._count_base = 0.0
+        self._count_from = None
+        self._dsp.reset()
+
+    # pygame.mixer.music's methods
+
+    def load(self, file_path, namehint=''):
+        if not http_stream.is_url(file_path) and not os.path.exists(file_path):
+            raise self._pygame.error(f"No file '{file_path}' found")
+        with self._condition:
+            self._flush('stopped')
+            self._loaded = self._new_token(file_path)
+            self._current = self._queued = None
+
+    def play(self, loops=0, start=0.0):
+        with self._condition:
+            if self._loaded is None:
+                raise self._pygame.error("music not loaded")
+            self._start(self._loaded, start)
+
+    def set_pos(self, position):
+        with self._condition:
+            if self._current is None:
+                raise self._pygame.error("music not playing")
+            # The counter goes on from where it was, as pygame's does
+            count = self._count_ms(time.perf_counter())
+            paused = self._paused_at is not None
+            queued = self._queued
+            self._start(self._current, position)
+            self._count_base = count
+            if paused:
+                self._paused_at = time.perf_counter()
+            if queued is not None:
+                self._queued = None
+                self.queue(self._paths[queued])
+
+    def queue(self, file_path, namehint='', loops=0):
+        with self._condition:
+            if self._current is None:
+                # Nothing plays: queueing loads, as pygame does
+                self.load(file_path)
+                return
+            self._queued = self._new_token(file_path)
+            self._send(('queue', self._epoch, self._current, self._queued, file_path))
+
+    def pause(self):
+        with self._condition:
+            if self._state == 'playing' and self._paused_at is None:
+                self._channel.pause()
+                self._paused_at = time.perf_counter()
+
+    def unpause(self):
+        with self._condition:
+            if self._paused_at is not None:
+                # The blocks start later by the time spent paused
+                shift = time.perf_counter() - self._paused_at
+                for block in self._blocks:
+                    block.start += shift
+                self._paused_at = None
+                self._channel.unpause()
+                self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._flush('stopped')
+            self._current = self._queued = None
+
+    def get_busy(self):
+        with self._condition:
+            return self._state == 'playing' and self._paused_at is None
+
+    def get_pos(self):
+        with self._condition:
+            if self._state == 'stopped':
+                return -1
+            return int(self._count_ms(self._paused_at or time.perf_counter()))
+
+    def set_volume(self, volume):
+        self._volume = volume
+        self._channel.set_volume(volume)
+
+    def get_volume(self):
+        return self._volume
+
+    def set_endevent(self, event_type=None):
+        self._endevent = event_type
+
+    # Beyond pygame.mixer.music
+
+    def set_equalizer(self, bands):
+        # dsp.Band values; none turn the equalizer and the limiter off
+        with self._condition:
+            self._dsp.set_bands(bands)
+
+    def set_crossfade(self, seconds):
+        # Seconds the end of a track and the start of the queued one overlap
+        with self._condition:
+            self._crossfade = seconds
+            self._send(('crossfade', seconds))
+
+    def close(self):
+        with self._condition:
+            self._epoch += 1
+            self._channel.stop()
+            self._closed = True
+            self._condition.notify_all()
+            try:
+                self._commands.send(('close',))
+            except OSError:
+                pass
+        self._thread.join()
+        self._process.join(timeout=2)
+        if self._process.is_alive():
+            self._process.kill()
+        self._ring.close(unlink=True)
+
+    # Commands to the decoder
+
+    def _new_token(self, file_path):
+        self._tokens += 1
+        self._paths[self._tokens] = file_path
+        return self._tokens
+
+    def _flush(self, state):
+        # Drop what the mixer and the ring hold; the decoder starts over
+        self._epoch += 1
+        self._channel.stop()
+        self._reset(state)
+        self._paths = {token: path for token, path in self._paths.items()
+                       if token in (self._loaded, self._current, self._queued)}
+        if state == 'stopped':
+            self._send(('stop', self._epoch))
+
+    def _send(self, command):
+        try:
+            self._commands.send(command)
+        except OSError as e:
+            # The decoder died since the last command: a new one takes it
+            print(f"Error in the audio decoder: {e}")
+            self._process.join(timeout=1)
+            self._start_decoder()
+            self._commands.send(command)
+
+    def _start(self, token, position):
+        self._flush('playing')
+        self._loaded = self._current = token
+        self._queued = None
+        self._send(('play', self._epoch, token, self._paths[token], position))
+        self._condition.notify_all()
+
+    # The feeder thread
+
+    def _count_ms(self, now):
+        # get_pos(): milliseconds played since play(), or since the
+        # queued track took over
+        if self._count_from is None:
+            return self._count_base
+        return self._count_base + (self._position(now) - self._count_from) * 1000 / self.rate
+
+    def _position(self, now):
+        # Ring position playing now, per the blocks' start times
+        for block in reversed(self._blocks):
+            if now >= block.start:
+                self._played = block.position(min(int((now - block.start) * self.rate),
+                                                  block.frames))
+                break
+        return self._played
+
+    def _feed(self):
+        with self._condition:
+            while not self._closed:
+                if self._state != 'playing' or self._paused_at is not None:
+                    self._condition.wait()
+                    continue
+                try:
+                    delay = self._step()
+                except (EOFError, OSError) as e:
+                    print(f"Error in the audio decoder: {e}")
+                    self._decoder_died()
+                    continue
+                self._condition.wait(delay)
+
+    def _step(self):
+        # Move the playback forward; returns how long to wait before the
+        # next step (None: until something changes)
+        now = time.perf_counter()
+        # Read the write counter before the events: every frame written
+        # below it was announced by then
+        written = self._ring.written
+        while self._events.poll():
+            self._event(self._events.recv())
+        if not self._started:
+            return DATA_WAIT
+
+        position = self._position(now)
+        while self._segments and self._segments[0][0] <= position:
+            # The queued track took over
+            start, token = self._segments.popleft()
+            self._current = token
+            self._queued = None
+            self._count_base, self._count_from = 0.0, start
+            self._post_endevent()
+        busy = self._channel.get_busy()
+        if not busy and self._blocks and not self._dry:
+            # The channel is not busy for a moment while its queued block
+            # takes over: look again before believing it ran dry
+            self._dry = True
+            return DATA_WAIT
+        self._dry = False
+        if self._end is not None and (position >= self._end or
+                                      (not busy and self._read >= self._end)):
+            self._channel.stop()
+            self._reset('ended')
+            self._post_endevent()
+            return None
+
+        if self._blocks and not busy:
+            # Everything handed to the mixer has played
+            self.underruns += 1
+            metrics.count('audio_underruns')
+            self._blocks.clear()
+        elif len(self._blocks) == 2 and self._channel.get_queue() is None:
+            # The queued block took over, since the last step
+            self._blocks.popleft()
+            self._blocks[0].start = max(min(self._blocks[0].start, now), self._checked)
+        self._checked = now
+
+        if len(self._blocks) < 2:
+            block = self._fill(written)
+            if block is None:
+                return DATA_WAIT
+            if self._blocks:
+                last = self._blocks[-1]
+                block.start = last.start + last.frames / self.rate
+            else:
+                block.start = now
+            self._channel.queue(block.sound)
+            self._blocks.append(block)
+
+        # Wake when the queued block starts, or at the next track change
+        wake = now + (self._poll if len(self._blocks) == 2 else DATA_WAIT)
+        if len(self._blocks) == 2:
+            wake = min(wake, self._blocks[-1].start)
+        for position in ([self._segments[0][0]] if self._segments else []) + \
+                ([self._end] if self._end is not None else []):
+            for block in self._blocks:
+                at = block.time_of(position, self.rate)
+                if at is not None:
+                    wake = min(wake, at)
+        return max(wake - now, 0.0) + 0.001
+
+    def _event(self, event):
+        kind, epoch = event[0], event[1]
+        if epoch != self._epoch:
+            return
+        if kind == 'segment':
+            _, _, token, start, void_from = event
+            if not self._started:
+                # The first frames of this epoch: what is before is stale
+                self._started = True
+                self._read = start
+                self._ring.release(start)
+                self._played = self._count_from = start
+                return
+            self._end = None
+            if void_from is not None:
+                # A queued track was replaced while it was decoded
+                self._segments = deque(s for s in self._segments if s[0] < void_from)
+                if self._read <= void_from:
+                    self._jumps.append((void_from, start))
+                else:
+                    self._read = max(self._read, start)
+            self._segments.append((start, token))
+        elif kind == 'end':
+            self._end = event[2]
+
+    def _fill(self, written):
+        # The next block from the ring, or None until there is a whole one
+        # (or the rest of the last track)
+        pieces = []
+        filled = 0
+        read = self._read
+        limit = self._end if self._end is not None else written
+        while filled < self.block_frames:
+            if self._jumps and read >= self._jumps[0][0]:
+                read = max(read, self._jumps.popleft()[1])
+                continue
+            stop = min(limit, self._jumps[0][0]) if self._jumps else limit
+            count = min(self.block_frames - filled, stop - read)
+            if count <= 0:
+                break
+            pieces.append((filled, read, count))
+            filled += count
+            read += count
+        if filled < self.block_frames and self._end is None:
+            return None
+        if not filled:
+            return None
+        index = self._next_sound
+        self._next_sound ^= 1
+        array = self._arrays[index]
+        for offset, start, count in pieces:
+            self._ring.read_into(start, array[offset:offset + count])
+        # The end of the last track: silence after it
+        array[filled:] = 0
+        self._dsp.process(array)
+        self._read = read
+        metrics.count('audio_blocks')
+        return _Block(self._sounds[index], pieces, filled)
+
+    def _post_endevent(self):
+        if self._endevent is not None:
+            self._pygame.event.post(self._pygame.event.Event(self._endevent))
+
+    def _decoder_died(self):
+        # A decoder that died (a crash on a corrupt file) ends the track;
+        # the next one plays through a new decoder
+        self._process.join(timeout=1)
+        self._start_decoder()
+        self._flush('ended')
+        self._post_endevent()
@@ -0,0 +1,256 @@
+"""Decoder process and ring buffer under GUI-thread stalls.
+
+Plays generated WAVs through DecodedMusic (audio_pipeline.py) on the dummy
+SDL driver. Checks that the decoder's pieces join into what the mixer
+decodes from the whole file (WAVs at the mixer's rate, at half of it and
+at 48 kHz, and pygame's house_lo.mp3 example when it is installed), that
+a queued track follows with an end event for each and that get_pos()
+goes on across set_pos(); then reports:
+
+    stalls   for each --buffers size and kind of stall, the underruns and
+             how late the audio ends, with the main thread (the GUI's)
+             stalled for --fraction of the buffer at random moments over
+             --seconds of audio; must be zero underruns:
+                 python  the thread runs Python code (the GIL changes
+                         hands every few milliseconds)
+                 gil     one C call holds the GIL throughout (a sum over
+                         a range); the feeder cannot run, and neither can
+                         the mixer where a block ends, as pygame takes the
+                         GIL there: the audio ends late by that much
+             pygame.mixer.music is played under the same stalls for
+             comparison: it decodes on SDL's audio thread, without the GIL;
+             and both without stalls ("none"), as how late the audio ends
+             varies with the dummy driver and, on one core, with the CPU
+             the stalls take from SDL's thread
+    cpu      CPU time of the decoder process and of the player's process
+             against the audio played, for each --buffers size, without
+             stalls
+
+The dummy driver does not play at exactly real-time speed, so how late the
+audio ends is measured against a plain Sound of the same length.
+
+Run from the repository root:
+
+    python benchmarks/bench_audio_pipeline.py --buffers 100 250 500 --seconds 20
+"""
+import os
+import sys
+import time
+import wave
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+
+
+# Kinds of stall, after a run without (None)
+KINDS = (None, 'python', 'gil')
+
+
+def write_tone(path, seconds, sample_rate=44100, channels=2):
+    # A rising tone: pieces joined at the wrong place do not match it
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = (np.sin(2 * np.pi * (220 + 200 * t) * t) * 12000).astype('<i2')
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(np.repeat(samples[:, None], channels, axis=1).tobytes())
+    return path
+
+
+def check_decode(tmp):
+    import pygame
+    from audio_pipeline import _track_pcm
+
+    rate, _, channels = pygame.mixer.get_init()
+    tracks = [write_tone(os.path.join(tmp, f'tone{r}.wav'), 5, r, c)
+              for r, c in ((rate, channels), (rate // 2, 1), (48000, 2))]
+    example = os.path.join(os.path.dirname(pygame.__file__), 'examples', 'data', 'house_lo.mp3')
+    if os.path.exists(example):
+        tracks.append(example)
+    for path in tracks:
+        whole = pygame.sndarray.array(pygame.mixer.Sound(file=path))
+        for start in (0.0, 2.0):
+            pcm = np.concatenate(list(_track_pcm(path, start, rate, channels, whole.dtype)))
+            expected = whole[int(start * rate):]
+            assert len(pcm) == len(expected), f"{path} from {start} s: as long as decoded whole"
+            # A seek starts the resampler over: the first samples differ
+            skip = 0 if start == 0 else 16
+            error = np.abs(pcm[skip:].astype(int) - expected[skip:]).max()
+            # mpg123 rounds differently with less context before a frame
+            assert error <= (1 if path.endswith('.mp3') else 0), \
+                f"{path} from {start} s: pieces join as decoded whole ({error})"
+
+
+def calibrate(seconds):
+    # Wall-clock time the dummy driver takes to play `seconds` of audio
+    import pygame
+
+    rate, _, channels = pygame.mixer.get_init()
+    sound = pygame.mixer.Sound(buffer=bytes(int(seconds * rate) * channels * 2))
+    channel = sound.play()
+    start = time.perf_counter()
+    while channel.get_busy():
+        time.sleep(0.001)
+    return (time.perf_counter() - start) / seconds
+
+
+def check_playback(path, seconds, clock):
+    import pygame
+    from audio_pipeline import DecodedMusic
+
+    music = DecodedMusic(250)
+    try:
+        time.sleep(1)
+        music.set_endevent(pygame.USEREVENT)
+        pygame.event.clear()
+        music.load(path)
+        start = time.perf_counter()
+        music.play()
+        music.queue(path)
+        ends = []
+        while len(ends) < 2 and time.perf_counter() - start < 4 * seconds:
+            ends += [time.perf_counter() - start for _ in pygame.event.get(pygame.USEREVENT)]
+            time.sleep(0.002)
+        assert len(ends) == 2, "an end event when the queued track takes over and at the end"
+        # Within a block: the dummy driver's speed varies from run to run
+        for end, expected in zip(ends, (seconds, 2 * seconds)):
+            assert abs(end - expected * clock) < 0.25, \
+                f"tracks end on time ({end:.3f} s against {expected * clock:.3f} s)"
+        assert not music.get_busy()
+
+        music.play()
+        time.sleep(0.5)
+        music.set_pos(seconds / 2)
+        time.sleep(0.5)
+        position = music.get_pos()
+        assert abs(position - 1000 * clock ** -1) < 100, \
+            f"get_pos() goes on across set_pos() ({position} ms)"
+        music.stop()
+        assert music.underruns == 0, f"{music.underruns} underruns"
+    finally:
+        music.close()
+
+
+def gil_rate():
+    # Numbers summed per second by sum(range(n)), which holds the GIL
+    n = 2_000_000
+    best = min(_timed(sum, range(n)) for _ in range(3))
+    return n / best
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def stall(kind, seconds, per_second):
+    if kind == 'gil':
+        sum(range(int(seconds * per_second)))
+    else:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+
+def play_stalled(music, path, seconds, clock, kind, stall_seconds, per_second):
+    # Play the track with stalls at random moments until its last second;
+    # returns how late it ended
+    music.load(path)
+    start = time.perf_counter()
+    music.play()
+    while time.perf_counter() - start < (seconds - 1) * clock - stall_seconds - 0.2:
+        time.sleep(random.uniform(0.0, 0.2))
+        if kind is not None:
+            stall(kind, stall_seconds, per_second)
+    while music.get_busy():
+        time.sleep(0.001)
+    return time.perf_counter() - start - seconds * clock
+
+
+def cpu_seconds(pid=None):
+    # User and system CPU seconds of a process
+    with open(f'/proc/{pid or "self"}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the decoder process under GUI stalls")
+    parser.add_argument('--buffers', type=int, nargs='+', default=[100, 250, 500],
+                        help="buffer_ms values")
+    parser.add_argument('--seconds', type=float, default=20, help="audio played per run")
+    parser.add_argument('--fraction', type=float, default=0.8,
+                        help="stall length, as a fraction of the buffer")
+    args = parser.parse_args()
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import metrics
+    from audio_pipeline import DecodedMusic
+
+    metrics.enable()
+    pygame.mixer.init()
+    # The end events are posted to pygame's event queue
+    pygame.display.init()
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        check_decode(tmp)
+        short = write_tone(os.path.join(tmp, 'short.wav'), 3)
+        clock = calibrate(3)
+        check_playback(short, 3, clock)
+        print("checks passed\n")
+
+        path = write_tone(os.path.join(tmp, 'long.wav'), args.seconds)
+        clock = calibrate(args.seconds)
+        per_second = gil_rate()
+        print(f"{args.seconds:g} s of audio per run, stalls of {args.fraction:g} of the "
+              f"buffer, dummy driver at {1 / clock:.3f}x real time\n")
+        print(f"{'player':<20} {'buffer ms':>9} {'stall':>7} {'stall ms':>9} "
+              f"{'underruns':>9} {'late ms':>8}")
+
+        def run(name, music, buffer_ms, kind):
+            stall_seconds = buffer_ms * args.fraction / 1000 if kind else 0.0
+            before = getattr(music, 'underruns', 0)
+            late = play_stalled(music, path, args.seconds, clock, kind, stall_seconds, per_second)
+            underruns = getattr(music, 'underruns', 0) - before
+            print(f"{name:<20} {buffer_ms:9d} {kind or 'none':>7} {stall_seconds * 1000:9.0f} "
+                  f"{underruns if name == 'DecodedMusic' else '':>9} {late * 1000:8.0f}")
+            if underruns:
+                failures.append(f"{underruns} underruns at {buffer_ms} ms, {kind} stalls")
+
+        failures = []
+        cpu = []
+        for buffer_ms in args.buffers:
+            music = DecodedMusic(buffer_ms)
+            time.sleep(1)
+            try:
+                metrics.reset()
+                decoder, player = cpu_seconds(music._process.pid), cpu_seconds()
+                run('DecodedMusic', music, buffer_ms, None)
+                cpu.append((buffer_ms, (cpu_seconds(music._process.pid) - decoder) / args.seconds,
+                            (cpu_seconds() - player) / args.seconds,
+                            metrics.snapshot()['counters'].get('audio_blocks', 0)))
+                for kind in KINDS[1:]:
+                    run('DecodedMusic', music, buffer_ms, kind)
+            finally:
+                music.close()
+        for kind in KINDS:
+            run('pygame.mixer.music', pygame.mixer.music, max(args.buffers), kind)
+
+        print()
+        for buffer_ms, decoder, player, blocks in cpu:
+            print(f"cpu at {buffer_ms:4d} ms  decoder {decoder * 100:4.1f}% of a core, "
+                  f"player {player * 100:4.1f}% ({blocks} blocks fed)")
+    assert not failures, "; ".join(failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Equalizer, limiter and crossfade (dsp.py).
+
+Checks that the equalizer matches the bands' biquads run a sample at a
+time, whatever the block size, that the limiter keeps peaks under its
+ceiling, that processing a block allocates nothing, that a crossfade
+overlaps the tracks by its length with equal-power fades, and that
+DecodedMusic (audio_pipeline.py, on the dummy SDL driver) posts the end
+event of a track where the crossfade into the queued one starts; then
+reports, for each --blocks size at 44.1 and 48 kHz stereo, the time per
+block, the realtime factor (seconds of audio processed per second) and
+the share of one core that playing takes.
+
+Run from the repository root:
+
+    python benchmarks/bench_dsp.py --blocks 64 256 1024 4096 --seconds 10
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+
+import dsp
+
+BANDS = 'low_shelf:100:6,peak:400:-3:1.2,peak:2500:4:2,high_shelf:8000:5'
+
+
+def noise(frames, rng, level=0.25):
+    return rng.standard_normal((frames, 2)) * level
+
+
+def sequential(samples, bands, rate):
+    # The biquads in cascade, a sample at a time (transposed direct form II)
+    out = samples.copy()
+    for band in bands:
+        (b0, b1, b2), (_, a1, a2) = dsp.biquad(band, rate)
+        for channel in out.T:
+            z1 = z2 = 0.0
+            for n, x in enumerate(channel):
+                y = b0 * x + z1
+                z1 = b1 * x - a1 * y + z2
+                z2 = b2 * x - a2 * y
+                channel[n] = y
+    return out
+
+
+def check_equalizer(rng):
+    bands = dsp.parse_bands(BANDS)
+    for rate in (44100, 48000):
+        samples = noise(8192, rng)
+        expected = sequential(samples, bands, rate)
+        for block_frames in (32, 64, 1024, 4096):
+            equalizer = dsp.Equalizer(rate, 2, block_frames, bands)
+            out = samples.copy()
+            for first in range(0, len(out), block_frames):
+                equalizer.process(out[first:first + block_frames])
+            error = np.abs(out - expected).max()
+            assert error < 1e-9, f"equalizer at {rate} Hz, blocks of {block_frames}: {error}"
+
+
+def check_limiter(rng):
+    chain = dsp.DspChain(44100, 2, np.int16, bands=dsp.parse_bands('peak:1000:12:0.5'))
+    pcm = (np.clip(noise(44100 // 1024 * 1024 * 4, rng, 0.5), -1, 1) * 32767).astype(np.int16)
+    chain.process(pcm)
+    peak = 20 * np.log10(np.abs(pcm.astype(int)).max() / 32768)
+    assert peak <= dsp.LIMITER_CEILING + 0.01, f"limiter lets peaks through ({peak:.2f} dB)"
+    # Quiet audio goes through as the bands shape it, later by the lookahead
+    quiet = noise(8192, rng, 0.01)
+    expected = quiet.copy()
+    equalizer = dsp.Equalizer(44100, 2, len(quiet), chain.equalizer.bands)
+    equalizer.process(expected)
+    chain = dsp.DspChain(44100, 2, np.float64, bands=chain.equalizer.bands)
+    out = quiet.copy()
+    chain.process(out)
+    lookahead = dsp.SUBBLOCK_FRAMES
+    assert np.allclose(out[lookahead:], expected[:-lookahead]), "limiter changes quiet audio"
+
+
+def check_allocations(rng):
+    chain = dsp.DspChain(48000, 2, np.int16, bands=dsp.parse_bands(BANDS))
+    block = (noise(dsp.BLOCK_FRAMES, rng) * 32767).astype(np.int16)
+    chain.process(block.copy())
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(100):
+        chain.process(block)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    # A float block alone would take 16 KB
+    assert peak < 4096, f"processing a block allocates ({peak} bytes at most)"
+
+
+def crossfaded(first, second, frames, rng):
+    # Both tracks through a Crossfade, in pieces of random sizes
+    fade = dsp.Crossfade(1000, frames / 1000)
+    out = []
+    for track in (first, second):
+        if out:
+            fade.next_track()
+        cuts = np.sort(rng.integers(0, len(track), 5))
+        out += [fade.feed(piece) for piece in np.split(track, cuts)]
+    out.append(fade.flush())
+    return np.concatenate(out)
+
+
+def check_crossfade(rng):
+    frames = 500
+    first = np.full((3000, 2), 10000, np.int16)
+    second = np.full((2000, 2), -8000, np.int16)
+    out = crossfaded(first, second, frames, rng)
+    assert len(out) == len(first) + len(second) - frames, "tracks overlap by the crossfade"
+    t = (np.arange(frames) + 0.5) / frames * (np.pi / 2)
+    mixed = np.rint(10000 * np.cos(t) - 8000 * np.sin(t))
+    start = len(first) - frames
+    assert (out[:start] == 10000).all() and (out[start + frames:] == -8000).all()
+    assert (out[start:start + frames, 0] == mixed).all(), "equal-power fades"
+    # A track shorter than the crossfade: the first one fades out to its end
+    out = crossfaded(first, second[:200], frames, rng)
+    assert len(out) == len(first), "the fade out goes on after a short track"
+
+
+def check_playback(tmp, seconds=3, crossfade=1.0):
+    import pygame
+    from bench_audio_pipeline import write_tone, calibrate
+    from audio_pipeline import DecodedMusic
+
+    path = write_tone(os.path.join(tmp, 'tone.wav'), seconds)
+    clock = calibrate(seconds)
+    music = DecodedMusic(250)
+    try:
+        time.sleep(1)
+        music.set_equalizer(dsp.parse_bands(BANDS))
+        music.set_crossfade(crossfade)
+        music.set_endevent(pygame.USEREVENT)
+        pygame.event.clear()
+        music.load(path)
+        start = time.perf_counter()
+        music.play()
+        music.queue(path)
+        ends = []
+        while len(ends) < 2 and time.perf_counter() - start < 4 * seconds:
+            ends += [time.perf_counter() - start for _ in pygame.event.get(pygame.USEREVENT)]
+            time.sleep(0.002)
+        assert len(ends) == 2, "an end event when the crossfade starts and at the end"
+        for end, expected in zip(ends, (seconds - crossfade, 2 * seconds - crossfade)):
+            assert abs(end - expected * clock) < 0.25, \
+                f"tracks end on time ({end:.3f} s against {expected * clock:.3f} s)"
+        assert music.underruns == 0, f"{music.underruns} underruns"
+    finally:
+        music.close()
+
+
+def realtime(rate, block_frames, seconds, rng):
+    # Seconds of audio processed per second, best of three runs
+    chain = dsp.DspChain(rate, 2, np.int16, block_frames, dsp.parse_bands(BANDS))
+    blocks = max(int(seconds * rate) // block_frames, 1)
+    pcm = (np.clip(noise(blocks * block_frames, rng), -1, 1) * 32767).astype(np.int16)
+    best = float('inf')
+    for _ in range(3):
+        work = pcm.copy()
+        start = time.perf_counter()
+        for first in range(0, len(work), block_frames):
+            chain.process(work[first:first + block_frames])
+        best = min(best, time.perf_counter() - start)
+    return blocks * block_frames / rate / best, best / blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the equalizer and the limiter")
+    parser.add_argument('--blocks', type=int, nargs='+', default=[64, 256, 1024, 4096],
+                        help="block sizes in frames")
+    parser.add_argument('--seconds', type=float, default=10, help="audio processed per run")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    check_equalizer(rng)
+    check_limiter(rng)
+    check_allocations(rng)
+    check_crossfade(rng)
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    pygame.mixer.init()
+    # The end events are posted to pygame's event queue
+    pygame.display.init()
+    with tempfile.TemporaryDirectory() as tmp:
+        check_playback(tmp)
+    print("checks passed\n")
+
+    print(f"{len(dsp.parse_bands(BANDS))} bands and the limiter, stereo 16-bit\n")
+    print(f"{'rate':>6} {'block':>6} {'us/block':>9} {'realtime x':>10} {'% of a core':>11}")
+    for rate in (44100, 48000):
+        for block_frames in args.blocks:
+            factor, per_block = realtime(rate, block_frames, args.seconds, rng)
+            print(f"{rate:6d} {block_frames:6d} {per_block * 1e6:9.1f} {factor:10.1f} "
+                  f"{100 / factor:11.2f}")
+            if block_frames == dsp.BLOCK_FRAMES:
+                assert factor > 20, f"the pipeline's blocks take {100 / factor:.1f}% of a core"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Duplicate detection throughput and I/O.
+
+Generates a library in a temporary directory: recordings of distinct
+lengths, tagged copies of some of them (other ID3v2 tags, plus ID3v1 and
+APE tags on some), and same-length files whose audio differs by a byte.
+Then reports, and checks against the expected groups:
+
+    cold        no cached ranges or hashes
+    warm        the same library again; nothing is read
+    +new        10% more files; only those are opened
+
+with the files whose payload range was read, the files and megabytes
+hashed, and files per second. The page cache is not dropped, so cold
+numbers are a lower bound on disk-bound storage.
+
+Run from the repository root:
+
+    python benchmarks/bench_duplicates.py --files 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import write_mp3, tag_file
+from metadata_cache import MetadataCache
+from duplicates import find_duplicates
+import metrics
+
+
+def add_ape_tag(path, title):
+    from mutagen.apev2 import APEv2
+
+    tags = APEv2()
+    tags['Title'] = title
+    tags.save(path)
+
+
+def add_id3v1_tag(path, title):
+    with open(path, 'ab') as f:
+        f.write(b'TAG' + title.encode('latin-1')[:30].ljust(30, b'\0') + b'\0' * 95)
+
+
+def flip_byte(path):
+    # Same length, different audio
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) // 2)
+        byte = f.read(1)
+        f.seek(-1, 1)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def write_recording(path, seconds, recording):
+    # Trailing bytes give every recording its own payload length, as real
+    # recordings almost always have
+    write_mp3(path, seconds)
+    with open(path, 'ab') as f:
+        f.write(b'\0' * recording)
+
+
+def make_library(root, count, seconds, first=0, seed=0):
+    """Write about `count` files; returns (paths, expected groups, next
+    recording number)."""
+    rng = random.Random(seed)
+    paths, groups = [], []
+    recording = first
+    while len(paths) < count:
+        original = os.path.join(root, f"rec{recording:06d}.mp3")
+        write_recording(original, seconds, recording)
+        tag_file(original, f"Recording {recording}")
+        paths.append(original)
+        kind = rng.random()
+        if kind < 0.2:
+            # A tagged copy elsewhere in the library
+            copy = os.path.join(root, f"copy{recording:06d}.mp3")
+            write_recording(copy, seconds, recording)
+            tag_file(copy, f"Copy of {recording}", artist='Other Artist', padding=rng.randrange(4096))
+            if rng.random() < 0.5:
+                add_ape_tag(copy, f"Copy of {recording}")
+            if rng.random() < 0.5:
+                add_id3v1_tag(copy, f"Copy of {recording}")
+            paths.append(copy)
+            groups.append(sorted((original, copy)))
+        elif kind < 0.3:
+            # Same payload length, different audio
+            other = os.path.join(root, f"other{recording:06d}.mp3")
+            write_recording(other, seconds, recording)
+            flip_byte(other)
+            tag_file(other, f"Recording {recording}")
+            paths.append(other)
+        recording += 1
+    return paths, groups, recording
+
+
+def run(label, paths, cache, expected):
+    metrics.reset()
+    start = time.perf_counter()
+    groups = find_duplicates(paths, cache)
+    elapsed = time.perf_counter() - start
+    assert groups == sorted(expected), f"{label}: wrong groups"
+    counters = metrics.snapshot()['counters']
+    print(f"{label:<6} {len(paths):7d} {elapsed:8.2f} {len(paths) / elapsed:9.0f} "
+          f"{counters.get('duplicate_ranges_read', 0):7d} "
+          f"{counters.get('duplicate_files_hashed', 0):7d} "
+          f"{counters.get('duplicate_bytes_hashed', 0) / 1e6:9.1f} {len(groups):7d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure duplicate detection")
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--seconds', type=float, default=10, help="length of each recording")
+    args = parser.parse_args()
+
+    metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        library = os.path.join(tmp, 'library')
+        os.makedirs(library)
+        paths, expected, next_recording = make_library(library, args.files, args.seconds)
+        size = sum(os.path.getsize(path) for path in paths)
+        print(f"{len(paths)} files, {size / 1e6:.0f} MB, {len(expected)} duplicate pairs\n")
+        print(f"{'run':<6} {'files':>7} {'seconds':>8} {'files/s':>9} {'read':>7} "
+              f"{'hashed':>7} {'MB hashed':>9} {'groups':>7}")
+
+        cache = MetadataCache(os.path.join(tmp, 'cache'))
+        run('cold', paths, cache, expected)
+        run('warm', paths, cache, expected)
+        more, more_expected, _ = make_library(library, args.files // 10, args.seconds,
+                                              first=next_recording, seed=1)
+        run('+new', paths + more, cache, expected + more_expected)
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Headless PlaybackEngine benchmark: state transition latency.
+
+Drives the engine without Qt (dummy SDL audio driver) over synthetic
+tracks and reports the latency of each command, plus the process RSS to
+show what a headless player costs without the GUI.
+
+Run from the repository root:
+    python benchmarks/bench_engine.py [--iterations 200]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from fixtures import write_mp3
+from metadata_cache import MetadataCache
+from playback_engine import PlaybackEngine, PathList
+
+
+def rss_mib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def timed(samples, name, action):
+    start = time.perf_counter()
+    action()
+    samples.setdefault(name, []).append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--tracks', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(args.tracks):
+            path = os.path.join(tmp, f"track{i:03d}.mp3")
+            write_mp3(path, 30.0)
+            paths.append(path)
+
+        engine = PlaybackEngine(PathList(paths), MetadataCache(os.path.join(tmp, 'cache')))
+        engine.ensure_audio()
+        # Warm the metadata and seek index caches, like repeat plays would
+        for index in range(len(paths)):
+            engine.play_index(index)
+            engine.seek_index(paths[index])
+
+        samples = {}
+        for i in range(args.iterations):
+            timed(samples, 'play_index', lambda: engine.play_index(i % len(paths)))
+            timed(samples, 'pause', engine.pause)
+            timed(samples, 'resume', engine.play)
+            timed(samples, 'seek', lambda: engine.seek(10.0 + i % 15))
+            timed(samples, 'next', engine.next)
+            timed(samples, 'previous', engine.previous)
+            timed(samples, 'poll', engine.poll)
+            timed(samples, 'stop', engine.stop)
+        engine.shutdown()
+
+    print(f"{'command':<12} {'mean':>10} {'p50':>10} {'p95':>10}")
+    for name, values in samples.items():
+        values.sort()
+        mean = sum(values) / len(values)
+        p50 = values[len(values) // 2]
+        p95 = values[int(len(values) * 0.95)]
+        print(f"{name:<12} {mean * 1e6:8.0f}us {p50 * 1e6:8.0f}us {p95 * 1e6:8.0f}us")
+    print(f"Qt loaded: {any(name.startswith('PyQt6') for name in sys.modules)}; "
+          f"RSS {rss_mib():.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Measure the silence between consecutive tracks.
+
+Plays two short tracks through the real MusicPlayer window (offscreen Qt,
+dummy SDL audio driver), once with gapless mode and once without, and
+reports the gap between the end of the first track and the start of the
+second one.
+
+The dummy driver does not consume audio at exactly real-time speed, so
+the wall-clock length of the first track is calibrated with a plain
+pygame playback first.
+
+Run from the repository root:
+    python benchmarks/bench_gapless.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import QTimer
+import pygame
+
+from fixtures import write_mp3
+
+
+def calibrate(path):
+    # Wall-clock time the dummy driver takes to play one track
+    pygame.mixer.music.load(path)
+    start = time.perf_counter()
+    pygame.mixer.music.play()
+    while pygame.mixer.music.get_busy():
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def measure_gap(app, player_class, files, wall_length, gapless):
+    player = player_class()
+    player.set_gapless(gapless)
+    player.playlist_model.append_tracks([(path, None, None, None, 0.0) for path in files])
+
+    second_start = []
+    last_pos = [0]
+
+    def probe():
+        # The second track resets get_pos(); back-date its start by the position.
+        # get_pos() jitters by a millisecond or so, hence the threshold
+        pos = pygame.mixer.music.get_pos()
+        if 0 <= pos < last_pos[0] - 500 and not second_start:
+            second_start.append(time.perf_counter() - pos / 1000)
+            app.quit()
+        last_pos[0] = max(pos, 0) if pos >= 0 else last_pos[0]
+
+    probe_timer = QTimer()
+    probe_timer.setInterval(2)
+    probe_timer.timeout.connect(probe)
+    probe_timer.start()
+
+    QTimer.singleShot(int((wall_length + 5) * 1000), app.quit)
+    first_start = time.perf_counter()
+    player.play_pause()
+    app.exec()
+    probe_timer.stop()
+    player.stop_music()
+    player.close()
+
+    if not second_start:
+        return None
+    return second_start[0] - first_start - wall_length
+
+
+def main():
+    app = QApplication(sys.argv)
+    from music_player import MusicPlayer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [os.path.join(tmp, f"track{i}.mp3") for i in range(2)]
+        for path in files:
+            write_mp3(path, 3.0)
+
+        pygame.mixer.init()
+        wall_length = calibrate(files[0])
+
+        for gapless in (False, True):
+            gap = measure_gap(app, MusicPlayer, files, wall_length, gapless)
+            label = "gapless" if gapless else "polled"
+            if gap is None:
+                print(f"{label:<8} second track never started")
+            else:
+                print(f"{label:<8} inter-track gap {gap * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
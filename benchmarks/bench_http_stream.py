@@ -0,0 +1,359 @@
+"""HTTP streaming against a loopback file server.
+
+Serves tagged MP3s (each with a --cover byte cover) over HTTP/1.1 from a
+thread of this process, --bandwidth MB/s per connection and --rtt ms
+added to every request standing in for a network. Checks that bytes read
+through the cache match the files, in order and at random, and that a
+changed file is fetched again; then reports:
+
+    tags         bytes, requests and time to read a track's tags, duration
+                 and cover location, against downloading it; and tracks/s
+                 of an import with default_workers() reads in flight
+    first audio  time from play_index() on a URL until the mixer plays:
+                 cold (nothing cached), after downloading the whole file
+                 first, and warm (cached); the mixer reads the whole ID3
+                 tag before it plays, so a bigger cover delays it
+    throughput   a full download through the cache against plain requests
+                 (no --bandwidth limit)
+    connections  TCP connections the server accepted, against requests
+    cache        bytes read from the cache against fetched, and evictions,
+                 over --plays plays of tracks picked with a skewed (Zipf)
+                 popularity and a cache holding a quarter of the library
+
+Run from the repository root:
+
+    python benchmarks/bench_http_stream.py --tracks 20 --bandwidth 4 --rtt 20
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import metrics
+import http_stream
+from fixtures import write_mp3, tag_file
+from library_scanner import default_workers
+from metadata_cache import MetadataCache, read_metadata
+from playback_engine import PlaybackEngine, PathList
+
+
+class FileServer(ThreadingHTTPServer):
+    """Files of `root` with Range, HEAD and ETag support, counting what
+    it sends."""
+    daemon_threads = True
+
+    def __init__(self, root):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.root = root
+        self.bandwidth = None
+        self.rtt = 0.0
+        self.lock = threading.Lock()
+        self.connections = self.requests = self.bytes_sent = 0
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+    def sent(self):
+        with self.lock:
+            return self.requests, self.bytes_sent
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, body=True):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.rtt)
+        path = os.path.join(server.root, os.path.basename(self.path))
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.send_error(404)
+            return
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start, end, status = 0, st.st_size, 200
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes='):
+            first, _, last = requested[6:].partition('-')
+            start = int(first)
+            end = min(int(last) + 1, st.st_size) if last else st.st_size
+            if start >= st.st_size:
+                self.send_error(416)
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end - 1}/{st.st_size}")
+        self.end_headers()
+        if body:
+            self.send_body(path, start, end)
+
+    def send_body(self, path, start, end):
+        bandwidth = self.server.bandwidth
+        began = time.perf_counter()
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while sent < end - start:
+                chunk = f.read(min(64 * 1024, end - start - sent))
+                try:
+                    self.wfile.write(chunk)
+                except OSError:
+                    # The client stopped reading (a download that moved)
+                    break
+                sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        with self.server.lock:
+            self.server.bytes_sent += sent
+
+
+def make_tracks(root, count, seconds, cover_bytes):
+    names = []
+    for i in range(count):
+        name = f"track{i:03d}.mp3"
+        path = os.path.join(root, name)
+        write_mp3(path, seconds, vbr=i % 2 == 1, seed=i)
+        tag_file(path, f"Track {i}", cover=random.Random(i).randbytes(cover_bytes))
+        names.append(name)
+    return names
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def check(server, root, cache_dir):
+    streams = http_stream.configure(cache_dir)
+    name = 'track000.mp3'
+    path = os.path.join(root, name)
+    with open(path, 'rb') as f:
+        expected = f.read()
+
+    with http_stream.open_file(server.url(name), stream=True) as f:
+        assert f.read() == expected, "a streamed read returns the file"
+    rng = random.Random(0)
+    with http_stream.open_file(server.url('track001.mp3')) as f, \
+            open(os.path.join(root, 'track001.mp3'), 'rb') as local:
+        for _ in range(200):
+            offset, size = rng.randrange(f.size), rng.randrange(1, 100000)
+            f.seek(offset)
+            local.seek(offset)
+            assert f.read(size) == local.read(size), "random reads return the file"
+    url = server.url('track002.mp3')
+    # Covers are keyed by where they are, so only their art_ref differs
+    remote = read_metadata(url, cache_dir)._replace(path=None, art_ref=None)
+    on_disk = read_metadata(os.path.join(root, 'track002.mp3'), cache_dir)
+    assert remote == on_disk._replace(path=None, art_ref=None), "tags match"
+
+    # A file that changes on the server is fetched again once checked
+    before = http_stream.stat(server.url(name))
+    tag_file(path, "Retitled")
+    validate, http_stream.VALIDATE_SECONDS = http_stream.VALIDATE_SECONDS, 0
+    try:
+        after = http_stream.stat(server.url(name))
+        assert after != before, "a changed file gets a new stat"
+        with http_stream.open_file(server.url(name)) as f:
+            assert hashlib.sha1(f.read()).hexdigest() == file_digest(path), \
+                "a changed file is read again"
+    finally:
+        http_stream.VALIDATE_SECONDS = validate
+    assert streams.cached_bytes(server.url(name)) == os.path.getsize(path)
+    http_stream.close()
+
+
+def measure_tags(server, root, names, cache_dir):
+    http_stream.configure(cache_dir)
+    requests_before, bytes_before = server.sent()
+    start = time.perf_counter()
+    for name in names:
+        read_metadata(server.url(name), cache_dir)
+    elapsed = time.perf_counter() - start
+    requests_after, bytes_after = server.sent()
+    total = sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    count = len(names)
+    print(f"{'tags':<12} {(bytes_after - bytes_before) / count / 1024:8.0f} KiB "
+          f"{(requests_after - requests_before) / count:5.1f} requests "
+          f"{elapsed / count * 1e3:8.1f} ms per track "
+          f"(the file: {total / count / 1024:.0f} KiB)")
+
+    # The import keeps default_workers() reads in flight
+    http_stream.configure(cache_dir + '-import')
+    urls = [server.url(name) for name in names]
+    workers = default_workers(urls[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda url: read_metadata(url, cache_dir), urls))
+    elapsed = time.perf_counter() - start
+    print(f"{'import':<12} {count / elapsed:8.1f} tracks/s with {workers} in flight")
+    http_stream.close()
+
+
+def first_audio(engine, index):
+    import pygame
+
+    start = time.perf_counter()
+    engine.play_index(index)
+    while pygame.mixer.music.get_pos() <= 0:
+        if time.perf_counter() - start > 30:
+            raise TimeoutError("the mixer did not start")
+        time.sleep(0.0005)
+    return time.perf_counter() - start
+
+
+def measure_first_audio(server, root, names, tmp):
+    import requests
+
+    http_stream.configure(os.path.join(tmp, 'first-audio'))
+    count = min(len(names), 5)
+    urls = [server.url(name) for name in names[:count]]
+    downloads = os.path.join(tmp, 'downloads')
+    os.makedirs(downloads)
+    local = [os.path.join(downloads, name) for name in names[:count]]
+    engine = PlaybackEngine(PathList(urls + local), MetadataCache(os.path.join(tmp, 'engine')))
+    engine.ensure_audio()
+    # Only the track itself: no next track queued in the meantime
+    engine.gapless = False
+
+    cold = [first_audio(engine, i) for i in range(count)]
+    warm = [first_audio(engine, i) for i in range(count)]
+    engine.stop()
+    whole = []
+    with requests.Session() as session:
+        for i, url in enumerate(urls):
+            start = time.perf_counter()
+            with open(local[i], 'wb') as f:
+                f.write(session.get(url).content)
+            whole.append(time.perf_counter() - start + first_audio(engine, count + i))
+    engine.shutdown()
+
+    def ms(values):
+        return f"{sum(values) / len(values) * 1e3:8.0f} ms"
+    print(f"{'first audio':<12} {ms(cold)} streamed (cold), {ms(whole).strip()} "
+          f"downloading first, {ms(warm).strip()} cached")
+
+
+def measure_throughput(server, root, tmp):
+    import requests
+
+    name = 'large.mp3'
+    write_mp3(os.path.join(root, name), 1800)
+    size = os.path.getsize(os.path.join(root, name))
+    bandwidth, server.bandwidth = server.bandwidth, None
+    try:
+        http_stream.configure(os.path.join(tmp, 'throughput'))
+        start = time.perf_counter()
+        with http_stream.open_file(server.url(name), stream=True) as f:
+            while f.read(http_stream.CHUNK_SIZE):
+                pass
+        streamed = time.perf_counter() - start
+        http_stream.close()
+
+        start = time.perf_counter()
+        with requests.get(server.url(name), stream=True) as response:
+            for _ in response.iter_content(http_stream.CHUNK_SIZE):
+                pass
+        plain = time.perf_counter() - start
+    finally:
+        server.bandwidth = bandwidth
+    print(f"{'throughput':<12} {size / streamed / 2**20:8.0f} MB/s through the cache, "
+          f"{size / plain / 2**20:.0f} MB/s plain requests ({size / 2**20:.0f} MB)")
+
+
+def measure_cache(server, root, names, tmp, plays):
+    library = sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    http_stream.configure(os.path.join(tmp, 'lru'), max_bytes=library // 4)
+    metrics.reset()
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    for name in rng.choices(names, weights, k=plays):
+        # Played to the end, as the mixer would
+        with http_stream.open_file(server.url(name), stream=True) as f:
+            while f.read(http_stream.CHUNK_SIZE):
+                pass
+    counters = metrics.snapshot()['counters']
+    cached = counters.get('stream_bytes_cached', 0)
+    fetched = counters.get('stream_bytes_fetched', 0)
+    streams = http_stream.streams()
+    print(f"{'cache':<12} {cached / (cached + fetched):8.0%} of bytes read were cached, "
+          f"{counters.get('stream_cache_evictions', 0)} evictions over {plays} plays "
+          f"(holds {streams._held / 2**20:.1f} of {streams.max_bytes / 2**20:.1f} MiB)")
+    assert streams._held <= streams.max_bytes, "the cache stays within its limit"
+    http_stream.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure HTTP streaming")
+    parser.add_argument('--tracks', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=120, help="length of each track")
+    parser.add_argument('--cover', type=int, default=2**20, help="cover size in bytes")
+    parser.add_argument('--bandwidth', type=float, default=4, help="MB/s per connection")
+    parser.add_argument('--rtt', type=float, default=20, help="ms added to each request")
+    parser.add_argument('--plays', type=int, default=100)
+    args = parser.parse_args()
+
+    metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'server')
+        os.makedirs(root)
+        names = make_tracks(root, args.tracks, args.seconds, args.cover)
+        server = FileServer(root)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        check(server, root, os.path.join(tmp, 'check'))
+        print("checks passed\n")
+
+        server.bandwidth = args.bandwidth * 2**20
+        server.rtt = args.rtt / 1000
+        print(f"{args.tracks} tracks of {args.seconds:g} s with a "
+              f"{args.cover / 2**20:.1f} MiB cover, {args.bandwidth:g} MB/s, "
+              f"{args.rtt:g} ms per request\n")
+        measure_tags(server, root, names, os.path.join(tmp, 'tags'))
+        measure_first_audio(server, root, names, tmp)
+        measure_throughput(server, root, tmp)
+        connections_before = server.connections
+        requests_before = server.requests
+        measure_cache(server, root, names, tmp, args.plays)
+        print(f"{'connections':<12} {server.connections - connections_before:8d} "
+              f"for {server.requests - requests_before} requests in the cache replay")
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Wakeups and CPU time of the player per idle hour.
+
+Each scenario runs the real MusicPlayer window (offscreen Qt, dummy SDL
+audio driver) in a fresh process for a fixed time and reports, scaled to
+one hour:
+
+    refreshes   position refresh ticks (the ui_tick span)
+    timers      Qt timer events delivered to the process
+    wakeups     voluntary context switches of the whole process
+    cpu         user + system CPU seconds
+
+Process-wide numbers include the audio driver's own thread, which runs
+whenever the device is open. Run from the repository root:
+
+    python benchmarks/bench_idle.py --seconds 20
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('stopped', 'paused', 'playing', 'playing-inactive', 'playing-minimized')
+
+CHILD = r'''
+import os, sys, json, resource
+sys.path.insert(0, {root!r})
+sys.path.insert(0, os.path.join({root!r}, 'benchmarks'))
+from PyQt6.QtWidgets import QApplication, QWidget
+from PyQt6.QtCore import QObject, QEvent, QTimer
+import metrics
+
+scenario, seconds, track = {scenario!r}, {seconds!r}, {track!r}
+app = QApplication(sys.argv)
+metrics.enable()
+from music_player import MusicPlayer
+
+
+class TimerCounter(QObject):
+    count = 0
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Timer:
+            TimerCounter.count += 1
+        return False
+
+
+player = MusicPlayer()
+player.playlist_model.append_tracks([(track, None, None, None, 0.0)])
+if scenario == 'playing-minimized':
+    player.showMinimized()
+else:
+    player.show()
+if scenario == 'playing-inactive':
+    # Another window takes the focus
+    other = QWidget()
+    other.show()
+    other.activateWindow()
+else:
+    player.activateWindow()
+player.engine.ensure_audio()
+if scenario != 'stopped':
+    player.play_pause()
+if scenario == 'paused':
+    player.play_pause()
+
+counter = TimerCounter()
+result = {{}}
+
+
+def begin():
+    metrics.reset()
+    app.installEventFilter(counter)
+    result['start'] = resource.getrusage(resource.RUSAGE_SELF)
+    QTimer.singleShot(int(seconds * 1000), finish)
+
+
+def finish():
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    start = result.pop('start')
+    scale = 3600.0 / seconds
+    ticks = metrics.snapshot()['spans'].get('ui_tick', {{}}).get('count', 0)
+    print(json.dumps({{
+        'refreshes': ticks * scale,
+        'timers': TimerCounter.count * scale,
+        'wakeups': (end.ru_nvcsw - start.ru_nvcsw) * scale,
+        'cpu': (end.ru_utime - start.ru_utime + end.ru_stime - start.ru_stime) * scale,
+    }}))
+    player.stop_music()
+    app.quit()
+
+
+# Let startup work settle before measuring
+QTimer.singleShot(1000, begin)
+app.exec()
+'''
+
+
+def run(scenario, seconds, track):
+    code = CHILD.format(root=ROOT, scenario=scenario, seconds=seconds, track=track)
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', SDL_AUDIODRIVER='dummy')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            env=env, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure idle wakeups and CPU per hour")
+    parser.add_argument('--seconds', type=float, default=20.0)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    from fixtures import write_mp3
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        track = os.path.join(tmp, 'long.mp3')
+        write_mp3(track, 60 * 60)
+        print(f"{'scenario':<20} {'refreshes/h':>12} {'timers/h':>10} {'wakeups/h':>10} {'cpu s/h':>8}")
+        for scenario in args.scenarios:
+            result = results[scenario] = run(scenario, args.seconds, track)
+            print(f"{scenario:<20} {result['refreshes']:12.0f} {result['timers']:10.0f} "
+                  f"{result['wakeups']:10.0f} {result['cpu']:8.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Loudness analysis throughput and accuracy.
+
+Generates fixtures in a temporary directory and reports, per kind of
+file, how many tracks a minute one worker process analyzes (and how many
+times faster than real time), then the throughput of the whole process
+pool. Also checks the meter against the EBU reference: a 997 Hz sine at
+-23 dBFS on both channels must read -23.0 LUFS.
+
+    mp3         silent MP3 frames: decoding plus measurement
+    wav         PCM noise: measurement only, no decoding
+    tagged      MP3 with ReplayGain tags: read from the tags, never decoded
+
+Run from the repository root:
+
+    python benchmarks/bench_loudness.py --tracks 8 --seconds 180
+"""
+import os
+import sys
+import math
+import time
+import wave
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import write_mp3, tag_file
+from metadata_cache import MetadataCache
+from loudness import LoudnessAnalyzer, analyze_file, ANALYSIS_RATE
+
+
+def write_pcm(path, samples, rate=ANALYSIS_RATE):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(samples.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def write_noise(path, seconds, seed):
+    rng = np.random.default_rng(seed)
+    write_pcm(path, rng.standard_normal((int(seconds * ANALYSIS_RATE), 2)) * 0.1)
+
+
+def write_replaygain_tags(path):
+    from mutagen.id3 import ID3, TXXX
+
+    tags = ID3(path)
+    tags.add(TXXX(encoding=3, desc='REPLAYGAIN_TRACK_GAIN', text='-6.50 dB'))
+    tags.add(TXXX(encoding=3, desc='REPLAYGAIN_TRACK_PEAK', text='0.988'))
+    tags.save(path)
+
+
+def make_fixtures(root, count, seconds):
+    files = {'mp3': [], 'wav': [], 'tagged': []}
+    for i in range(count):
+        path = os.path.join(root, f"silent_{i}.mp3")
+        write_mp3(path, seconds)
+        files['mp3'].append(path)
+
+        path = os.path.join(root, f"noise_{i}.wav")
+        write_noise(path, seconds, i)
+        files['wav'].append(path)
+
+        path = os.path.join(root, f"tagged_{i}.mp3")
+        write_mp3(path, seconds)
+        tag_file(path, f"Tagged {i}")
+        write_replaygain_tags(path)
+        files['tagged'].append(path)
+    return files
+
+
+def run_pool(cache_dir, paths, workers):
+    # Seconds for a pool of `workers` processes to analyze every path
+    analyzer = LoudnessAnalyzer(MetadataCache(cache_dir), workers=workers)
+    done = threading.Semaphore(0)
+    analyzer.on_result = lambda path, result: done.release()
+    # Start the workers first, so their startup is not counted
+    warmup = os.path.join(cache_dir, 'warmup.wav')
+    write_noise(warmup, 1, 0)
+    analyzer.request(warmup)
+    done.acquire()
+
+    start = time.perf_counter()
+    analyzer.queue_paths(paths)
+    for _ in paths:
+        done.acquire()
+    elapsed = time.perf_counter() - start
+    analyzer.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure loudness analysis throughput")
+    parser.add_argument('--tracks', type=int, default=8, help="files of each kind")
+    parser.add_argument('--seconds', type=float, default=180)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Reference level, in-process
+        reference = os.path.join(tmp, 'reference.wav')
+        t = np.arange(20 * ANALYSIS_RATE) / ANALYSIS_RATE
+        sine = 10 ** (-23 / 20) * np.sin(2 * math.pi * 997 * t)
+        write_pcm(reference, np.stack((sine, sine), axis=1))
+        print(f"997 Hz sine at -23 dBFS: {analyze_file(reference).integrated:.2f} LUFS")
+
+        files = make_fixtures(tmp, args.tracks, args.seconds)
+        print(f"\n{args.tracks} files of {args.seconds:.0f} s per kind")
+        print(f"{'kind':<8} {'workers':>7} {'tracks/min':>11} {'per core':>9} {'x realtime':>11}")
+        for workers in sorted({1, args.workers}):
+            for kind, paths in files.items():
+                cache_dir = tempfile.mkdtemp(dir=tmp)
+                elapsed = run_pool(cache_dir, paths, workers)
+                per_minute = len(paths) / elapsed * 60
+                print(f"{kind:<8} {workers:7d} {per_minute:11.1f} {per_minute / workers:9.1f} "
+                      f"{len(paths) * args.seconds / elapsed / workers:11.1f}")
+
+
+if __name__ == '__main__':
+    main()
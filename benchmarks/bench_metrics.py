@@ -0,0 +1,51 @@
+"""Cost of the instrumentation hooks, disabled and enabled.
+
+Run from the repository root:
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+
+def per_call(action, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        action()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure instrumentation overhead")
+    parser.add_argument('--iterations', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    def empty():
+        pass
+
+    def with_span():
+        with metrics.span('bench'):
+            pass
+
+    def with_count():
+        metrics.count('bench')
+
+    baseline = per_call(empty, args.iterations)
+    print(f"{'hook':<10} {'disabled':>12} {'enabled':>12}   (ns per call over an empty call)")
+    for name, action in (('span', with_span), ('count', with_count)):
+        metrics.enable(False)
+        disabled = per_call(action, args.iterations) - baseline
+        metrics.enable(True)
+        enabled = per_call(action, args.iterations) - baseline
+        print(f"{name:<10} {disabled * 1e9:12.0f} {enabled * 1e9:12.0f}")
+    metrics.enable(False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Play queue: correctness checks and the cost of each step.
+
+Checks, on small playlists, that a shuffle plays every track once per
+cycle, that previous retraces it and next replays it, the repeat modes,
+the up-next queue, and that sorting, filtering and removing tracks keeps
+the current track, the history and the queue. Then times, on a playlist
+of --tracks tracks:
+
+    shuffle on  turning shuffle on, against shuffling a list of every row
+    next        next in playlist order and shuffled
+    previous    previous as far back as the history goes, then next
+                over the same tracks again
+    enqueue     play_next and enqueue of one row
+    changed     playlist_changed after that many shuffled nexts
+
+Run from the repository root:
+
+    python benchmarks/bench_play_queue.py --tracks 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from play_queue import PlayQueue, HISTORY_SIZE
+from playback_engine import PathList
+from track_store import TrackStore
+
+
+class View:
+    """A sorted and filtered view over a TrackStore, as PlaylistModel
+    presents one (without Qt)."""
+
+    def __init__(self, count):
+        self.store = TrackStore()
+        self.store.extend((f"/music/{i}.mp3", None, None, None, 0.0) for i in range(count))
+        self.order = list(range(count))
+
+    def __len__(self):
+        return len(self.order)
+
+    def track_id(self, row):
+        return self.store.ids[self.order[row]]
+
+    def row_of_id(self, track_id):
+        store_row = self.store.row_of_id(track_id)
+        try:
+            return self.order.index(store_row)
+        except ValueError:
+            return -1
+
+    def remove(self, rows):
+        self.store.remove(rows)
+        self.order = list(range(len(self.store)))
+
+
+def check():
+    queue = PlayQueue(PathList(range(50)), seed=1)
+    queue.set_shuffle(True)
+    queue.jump(0)
+    for cycle in range(3):
+        # Each cycle starts with the track the last one ended on
+        played = [queue.current_row()] + [queue.advance() for _ in range(49)]
+        assert sorted(played) == list(range(50)), "a shuffle cycle plays every track once"
+    order = [queue.advance() for _ in range(10)]
+    back = [queue.previous() for _ in range(9)]
+    assert back == order[-2::-1], "previous retraces the shuffle"
+    assert [queue.advance() for _ in range(9)] == order[1:], "next replays it"
+
+    queue = PlayQueue(PathList(range(5)))
+    queue.jump(3)
+    assert [queue.advance() for _ in range(3)] == [4, 0, 1], "repeat all wraps"
+    queue.set_repeat('one')
+    assert queue.advance(auto=True) == 1 and queue.advance() == 2, "repeat one"
+    queue.set_repeat('off')
+    queue.jump(4)
+    assert queue.advance() is None and queue.peek() is None, "repeat off stops"
+    queue.jump(1)
+    queue.enqueue([3, 4])
+    queue.play_next([0])
+    assert [queue.advance() for _ in range(4)] == [0, 3, 4, 2], "up next comes first"
+
+    view = View(10)
+    queue = PlayQueue(view, seed=2)
+    queue.set_shuffle(True)
+    queue.jump(0)
+    played = [view.order[queue.advance()] for _ in range(4)]
+    current = queue.current_id
+    queue.enqueue([9])
+    view.order.reverse()
+    queue.playlist_changed()
+    assert queue.current_id == current and queue.current_row() == view.order.index(
+        view.store.row_of_id(current)), "sorting keeps the current track"
+    view.remove([view.order[queue.peek()]])
+    queue.playlist_changed()
+    queue.jump(view.order.index(0))
+    rest = [view.order[queue.advance()] for _ in range(5)]
+    assert not set(rest) & set(played), "the cycle goes on after removals"
+    assert queue.previous() is not None, "history survives removals"
+
+
+def timed(label, count, step):
+    start = time.perf_counter()
+    for _ in range(count):
+        step()
+    print(f"{label:<22} {(time.perf_counter() - start) / count * 1e9:10.0f} ns")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the play queue")
+    parser.add_argument('--tracks', type=int, default=1000000)
+    parser.add_argument('--steps', type=int, default=100000, help="steps timed of each kind")
+    args = parser.parse_args()
+
+    check()
+    print(f"checks passed\n\n{args.tracks} tracks, {args.steps} steps\n")
+
+    playlist = PathList(range(args.tracks))
+    rows = list(range(args.tracks))
+    start = time.perf_counter()
+    random.shuffle(rows)
+    print(f"{'shuffle every row':<22} {(time.perf_counter() - start) * 1e3:10.1f} ms")
+    del rows
+
+    queue = PlayQueue(playlist, seed=0)
+    queue.jump(0)
+    start = time.perf_counter()
+    queue.set_shuffle(True)
+    queue.advance()
+    print(f"{'shuffle on + next':<22} {(time.perf_counter() - start) * 1e6:10.1f} us\n")
+
+    queue.set_shuffle(False)
+    timed('next (in order)', args.steps, queue.advance)
+    queue.set_shuffle(True)
+    timed('next (shuffled)', args.steps, queue.advance)
+    print(f"{'':<22} {len(queue._swaps):10d} positions held")
+    # previous() can go back as far as the history reaches
+    back = min(args.steps, HISTORY_SIZE)
+    timed('previous (shuffled)', back, queue.previous)
+    timed('next (replayed)', back, queue.advance)
+    timed('play_next', args.steps, lambda: queue.play_next([1]))
+    timed('enqueue', args.steps, lambda: queue.enqueue([2]))
+    queue.clear_up_next()
+    start = time.perf_counter()
+    queue.playlist_changed()
+    print(f"{'playlist_changed':<22} {(time.perf_counter() - start) * 1e3:10.1f} ms  "
+          f"after {len(queue._played)} shuffled tracks")
+
+
+if __name__ == '__main__':
+    main()
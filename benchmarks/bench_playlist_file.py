@@ -0,0 +1,95 @@
+"""Save and restore times of large playlists.
+
+Builds a synthetic playlist and reports, per format, the write time, the
+open time and the file size, plus the autosave cost on the calling (GUI)
+thread and the restore time of a snapshot with a journal behind it.
+
+Run from the repository root:
+
+    python benchmarks/bench_playlist_file.py --tracks 500000
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from track_store import TrackStore
+import playlist_file
+
+
+def synthetic_tracks(count, first=0):
+    return [(f"/music/Artist {i // 200}/Album {i // 20}/{i:07d} Track {i}.mp3",
+             f"Track {i}", f"Artist {i // 200}", f"Album {i // 20}", 180.0 + i % 120)
+            for i in range(first, first + count)]
+
+
+def timed(action):
+    start = time.perf_counter()
+    result = action()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure playlist save and restore times")
+    parser.add_argument('--tracks', type=int, default=500_000)
+    parser.add_argument('--batch', type=int, default=500, help="tracks per autosaved change")
+    args = parser.parse_args()
+
+    tracks = synthetic_tracks(args.tracks)
+    store = TrackStore()
+    store.extend(tracks)
+    # The player never holds the tracks as tuples; keep the garbage collector
+    # from charging the timings below for walking them
+    gc.freeze()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{args.tracks} tracks")
+        print(f"{'format':<8} {'write ms':>10} {'open ms':>10} {'size MB':>9}")
+        for extension in ('.mpl', '.m3u8'):
+            path = os.path.join(tmp, f"playlist{extension}")
+            if extension == '.mpl':
+                write_time, _ = timed(lambda: playlist_file.write_native(
+                    path, playlist_file.snapshot_store(store)))
+                open_time, _ = timed(lambda: playlist_file.read_native(path))
+            else:
+                write_time, _ = timed(lambda: playlist_file.write_m3u(path, tracks))
+                open_time, _ = timed(lambda: playlist_file.read_m3u(path))
+            print(f"{extension:<8} {write_time * 1000:10.1f} {open_time * 1000:10.1f} "
+                  f"{os.path.getsize(path) / 1e6:9.1f}")
+
+        # Autosave: what an import costs the GUI thread, batch by batch
+        path = os.path.join(tmp, 'autosave.mpl')
+        saver = playlist_file.PlaylistAutosaver(path)
+        saved, _ = saver.restore()
+        calls = []
+        for first in range(0, args.tracks, args.batch):
+            batch = tracks[first:first + args.batch]
+            row = len(saved)
+            saved.extend(batch)
+            start = time.perf_counter()
+            saver.tracks_appended(row, batch)
+            calls.append(time.perf_counter() - start)
+        close_time, _ = timed(saver.close)
+        calls.sort()
+        print(f"\nautosave of {len(calls)} batches on the calling thread: "
+              f"median {calls[len(calls) // 2] * 1e3:.3f} ms, max {calls[-1] * 1e3:.1f} ms "
+              f"(max includes snapshot copies); background flush on close {close_time * 1e3:.0f} ms")
+
+        # A snapshot plus one batch of journal records
+        extra = synthetic_tracks(args.batch, args.tracks)
+        saver = playlist_file.PlaylistAutosaver(path)
+        restored, _ = saver.restore()
+        row = len(restored)
+        restored.extend(extra)
+        saver.tracks_appended(row, extra)
+        saver.close()
+        restore_time, (restored, _) = timed(playlist_file.PlaylistAutosaver(path).restore)
+        print(f"restore (snapshot + journal) of {len(restored)} tracks: {restore_time * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
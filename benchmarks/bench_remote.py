@@ -0,0 +1,251 @@
+"""Remote control load test against a loopback server.
+
+Starts the remote control server with a stand-in player on a Qt event
+loop (the GUI thread): commands change its state and it publishes a new
+state at --publish Hz, as a dragged volume slider would. A second
+process then connects --subscribers WebSocket clients and runs --clients
+HTTP clients sending commands back to back for --seconds, and reports:
+
+    connect     time until every WebSocket client got its first state
+    requests    HTTP requests per second and latency by kind: GET /state
+                (answered off the GUI thread), POST /volume (a command run
+                on it) and GET /library (a page of a --tracks playlist)
+    pushes      states received per client per second, against states
+                published, and delay from publish to receipt
+    GUI thread  how late a 1 ms timer fires on the GUI thread, idle and
+                under load, and the time spent in remote commands and
+                publishing per second
+
+Run from the repository root:
+
+    python benchmarks/bench_remote.py --subscribers 500 --clients 50 --seconds 10
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else float('nan')
+
+
+# Clients, in their own process
+
+async def websocket_client(port, received, first_states, stop):
+    from remote_control import encode_frame, read_frame
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b"GET /ws HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\n"
+                 b"Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                 b"Sec-WebSocket-Version: 13\r\n\r\n")
+    await reader.readuntil(b'\r\n\r\n')
+    first = True
+    while not stop.is_set():
+        try:
+            _, _, payload, _ = await asyncio.wait_for(read_frame(reader, 1 << 20), 0.5)
+        except asyncio.TimeoutError:
+            continue
+        message = json.loads(payload)
+        now = time.time()
+        if first:
+            first_states.append(now)
+            first = False
+        else:
+            received.append(now - message['state']['time'])
+    writer.write(encode_frame(b'', 0x8, mask=b'abcd'))
+    writer.close()
+
+
+async def http_client(port, kind, latencies, stop):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    requests = {
+        'state': b"GET /state HTTP/1.1\r\nHost: x\r\n\r\n",
+        'volume': b"POST /volume HTTP/1.1\r\nHost: x\r\nContent-Length: 15\r\n\r\n"
+                  b'{"volume": 0.5}',
+        'library': b"GET /library?offset=1000&limit=50 HTTP/1.1\r\nHost: x\r\n\r\n",
+    }
+    request = requests[kind]
+    while not stop.is_set():
+        start = time.perf_counter()
+        writer.write(request)
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        await reader.readexactly(length)
+        assert head.startswith(b'HTTP/1.1 200'), head
+        latencies[kind].append(time.perf_counter() - start)
+    writer.close()
+
+
+async def run_clients(port, subscribers, clients, seconds):
+    stop = asyncio.Event()
+    received = [[] for _ in range(subscribers)]
+    first_states = []
+    start = time.time()
+    tasks = [asyncio.ensure_future(websocket_client(port, received[i], first_states, stop))
+             for i in range(subscribers)]
+    while len(first_states) < subscribers and time.time() - start < 30:
+        await asyncio.sleep(0.01)
+    connected = max(first_states) - start if first_states else float('nan')
+
+    latencies = {'state': [], 'volume': [], 'library': []}
+    kinds = list(latencies)
+    load_start = time.time()
+    tasks += [asyncio.ensure_future(http_client(port, kinds[i % len(kinds)], latencies, stop))
+              for i in range(clients)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.time() - load_start
+    return {
+        'connected': connected,
+        'elapsed': elapsed,
+        'latencies': latencies,
+        'pushes': [len(delays) for delays in received],
+        'push_delays': [delay for delays in received for delay in delays],
+    }
+
+
+def client_process(port, subscribers, clients, seconds, results):
+    import resource
+    # Every client is a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 4096)), hard))
+    results.put(asyncio.run(run_clients(port, subscribers, clients, seconds)))
+
+
+# The player, in this process
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the remote control server")
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=50, help="HTTP clients")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--publish', type=float, default=60, help="states published per second")
+    parser.add_argument('--tracks', type=int, default=100000)
+    args = parser.parse_args()
+
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 4096)), hard))
+
+    from PyQt6.QtCore import Qt, QCoreApplication, QTimer, QEventLoop
+    from remote_control import RemoteControlServer, QtDispatcher
+    from track_store import TrackStore
+
+    app = QCoreApplication(sys.argv)
+    store = TrackStore()
+    store.extend((f"/music/artist{i % 500}/track{i}.mp3", f"Track {i}", f"Artist {i % 500}",
+                  f"Album {i % 2000}", 180.0) for i in range(args.tracks))
+    state = {'state': 'playing', 'volume': 0.5, 'position': 0.0}
+    gui_time = [0.0]
+    published = [0]
+
+    def current_state():
+        return dict(state, time=time.time())
+
+    def handler(command, arguments):
+        start = time.perf_counter()
+        if command == 'volume':
+            state['volume'] = float(arguments['volume'])
+            server.publish(current_state())
+            result = current_state()
+        elif command == 'library':
+            offset, limit = int(arguments.get('offset', 0)), int(arguments.get('limit', 50))
+            result = {'total': len(store), 'offset': offset, 'tracks': [
+                dict(zip(('path', 'title', 'artist', 'album', 'duration'), store.track(row)),
+                     id=store.ids[row])
+                for row in range(offset, min(offset + limit, len(store)))]}
+        else:
+            raise LookupError(command)
+        gui_time[0] += time.perf_counter() - start
+        return result
+
+    def publish():
+        start = time.perf_counter()
+        state['position'] += 1 / args.publish
+        server.publish(current_state())
+        published[0] += 1
+        gui_time[0] += time.perf_counter() - start
+
+    server = RemoteControlServer(QtDispatcher(handler), port=0).start()
+    server.publish(current_state())
+
+    lateness = []
+    last = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        lateness.append(now - last[0] - 0.001)
+        last[0] = now
+
+    probe = QTimer()
+    probe.setTimerType(Qt.TimerType.PreciseTimer)
+    probe.setInterval(1)
+    probe.timeout.connect(tick)
+
+    def spin(seconds):
+        loop = QEventLoop()
+        QTimer.singleShot(int(seconds * 1000), loop.quit)
+        loop.exec()
+
+    probe.start()
+    spin(1)
+    idle = lateness[:]
+    lateness.clear()
+
+    publisher = QTimer()
+    publisher.setInterval(int(1000 / args.publish))
+    publisher.timeout.connect(publish)
+    publisher.start()
+
+    results = multiprocessing.Queue()
+    clients = multiprocessing.Process(target=client_process, args=(
+        server.port, args.subscribers, args.clients, args.seconds, results))
+    clients.start()
+    gui_time[0] = 0.0
+    published[0] = 0
+    load_start = time.time()
+    result = None
+    while result is None:
+        spin(0.1)
+        if not results.empty():
+            result = results.get()
+    load_seconds = time.time() - load_start
+    publisher.stop()
+    probe.stop()
+    clients.join()
+    server.close()
+
+    print(f"{args.subscribers} WebSocket subscribers, {args.clients} HTTP clients, "
+          f"{args.seconds:g} s, {args.tracks} tracks\n")
+    print(f"connect      {result['connected'] * 1e3:8.0f} ms until every subscriber had a state")
+    print(f"\n{'request':<10} {'per s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, values in result['latencies'].items():
+        print(f"{kind:<10} {len(values) / result['elapsed']:8.0f} "
+              f"{percentile(values, 0.5) * 1e3:8.2f} {percentile(values, 0.99) * 1e3:8.2f} "
+              f"{max(values, default=float('nan')) * 1e3:8.2f}")
+    pushes = result['pushes']
+    delays = result['push_delays']
+    print(f"\npushes       {published[0] / load_seconds:6.0f} states/s published, "
+          f"{sum(pushes) / len(pushes) / result['elapsed']:5.1f} received per client per s "
+          f"(min {min(pushes) / result['elapsed']:.1f})")
+    print(f"push delay   p50 {percentile(delays, 0.5) * 1e3:.1f} ms, "
+          f"p99 {percentile(delays, 0.99) * 1e3:.1f} ms (includes coalescing)")
+    print(f"\nGUI thread   1 ms timer late by p99 {percentile(idle, 0.99) * 1e3:.2f} ms idle, "
+          f"{percentile(lateness, 0.99) * 1e3:.2f} ms under load "
+          f"(max {max(idle) * 1e3:.2f} / {max(lateness) * 1e3:.2f} ms)")
+    print(f"             {gui_time[0] / load_seconds * 1e3:.1f} ms per second in remote "
+          f"commands and publishing")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Search latency on a large playlist.
+
+Indexes a synthetic playlist and reports the build time, the latency of
+typical queries (one letter, a word prefix, several words, no match),
+the cost of adding, retagging and removing tracks on the calling (GUI)
+thread, and the save and load times of the index. After the removals the
+index must answer at once, and the same as one built from scratch.
+
+Run from the repository root:
+
+    python benchmarks/bench_search.py --tracks 500000
+"""
+import os
+import sys
+import gc
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from track_store import TrackStore
+from search_index import SearchIndex
+
+WORDS = ('love', 'night', 'blue', 'dance', 'heart', 'fire', 'dream', 'river', 'gold',
+         'shadow', 'summer', 'électrique', 'Mädchen', 'corazón', 'sky', 'road')
+
+QUERIES = ('l', 'da', 'heart', 'electr', 'madchen', 'artist 12', 'blue night gold', 'zzz')
+
+
+def synthetic_tracks(count, first=0, seed=0):
+    rng = random.Random(seed)
+    return [(f"/music/Artist {i // 200}/Album {i // 20}/{i:07d} {rng.choice(WORDS)}.mp3",
+             ' '.join(rng.choice(WORDS).title() for _ in range(3)),
+             f"Artist {i // 200}", f"Album {i // 20}", 180.0)
+            for i in range(first, first + count)]
+
+
+def wait_until_idle(index):
+    # Until the background build, sort and merge work is done
+    while not index.ready or index.pending():
+        time.sleep(0.01)
+
+
+def timed(action, repeats=1):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = action()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure search index latency")
+    parser.add_argument('--tracks', type=int, default=500_000)
+    parser.add_argument('--batch', type=int, default=500, help="tracks per added batch")
+    parser.add_argument('--removals', type=int, default=1000, help="tracks removed at once")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    store = TrackStore()
+    store.extend(synthetic_tracks(args.tracks))
+    gc.freeze()
+
+    index = SearchIndex(store)
+    build_time, _ = timed(lambda: (index.build(), wait_until_idle(index)))
+    print(f"{args.tracks} tracks; background build {build_time:.2f} s, "
+          f"{index.segment_count()} segment(s)")
+
+    print(f"\n{'query':<18} {'ms':>8} {'matches':>9}")
+    for query in QUERIES:
+        elapsed, mask = timed(lambda: index.search(query), args.repeats)
+        print(f"{query!r:<18} {elapsed * 1e3:8.2f} {int(mask.sum()):9d}")
+
+    # Additions and retags as the GUI thread reports them
+    append_calls = []
+    extra = synthetic_tracks(args.tracks // 10, args.tracks, seed=1)
+    for first in range(0, len(extra), args.batch):
+        batch = extra[first:first + args.batch]
+        row = len(store)
+        store.extend(batch)
+        start = time.perf_counter()
+        index.tracks_appended(row, batch)
+        append_calls.append(time.perf_counter() - start)
+    update_calls = []
+    rng = random.Random(2)
+    for _ in range(2000):
+        row = rng.randrange(len(store))
+        store.update(row, 'Retagged Title', 'Someone Else', None, 180.0)
+        start = time.perf_counter()
+        index.track_updated(row, 'Retagged Title', 'Someone Else', None, 180.0)
+        update_calls.append(time.perf_counter() - start)
+    append_calls.sort()
+    update_calls.sort()
+    print(f"\nadd {len(append_calls)} batches of {args.batch}: median "
+          f"{append_calls[len(append_calls) // 2] * 1e3:.2f} ms, max {append_calls[-1] * 1e3:.2f} ms")
+    print(f"retag {len(update_calls)} tracks: median "
+          f"{update_calls[len(update_calls) // 2] * 1e3:.3f} ms, max {update_calls[-1] * 1e3:.2f} ms")
+    elapsed, mask = timed(lambda: index.search('retagged'), args.repeats)
+    print(f"'retagged' before merging: {elapsed * 1e3:.2f} ms, {int(mask.sum())} matches, "
+          f"{index.segment_count()} segment(s)")
+    wait_until_idle(index)
+    elapsed, mask = timed(lambda: index.search('retagged'), args.repeats)
+    print(f"'retagged' after merging:  {elapsed * 1e3:.2f} ms, {int(mask.sum())} matches, "
+          f"{index.segment_count()} segment(s)")
+
+    # Removals, as the duplicate finder and the folder watcher make them;
+    # the last track too, so the index holds an id past the store's last
+    rng = random.Random(3)
+    removed = rng.sample(range(len(store) - 1), args.removals - 1) + [len(store) - 1]
+    store.remove(removed)
+    remove_time, _ = timed(lambda: index.tracks_removed(removed))
+    assert index.ready, "the index answers while tracks are removed"
+    elapsed, mask = timed(lambda: index.search('retagged'), args.repeats)
+    print(f"\nremove {len(removed)} tracks: {remove_time * 1e3:.3f} ms; 'retagged' "
+          f"{elapsed * 1e3:.2f} ms, {int(mask.sum())} matches")
+    fresh = SearchIndex(store)
+    fresh.build()
+    wait_until_idle(fresh)
+    queries = QUERIES + ('retagged',)
+    assert all((index.search(query) == fresh.search(query)).all() for query in queries), \
+        "after removals the index matches a new one"
+    # Merging drops the removed tracks from the segments
+    batch = synthetic_tracks(args.tracks // 2, 2 * args.tracks, seed=4)
+    row = len(store)
+    store.extend(batch)
+    index.tracks_appended(row, batch)
+    fresh.tracks_appended(row, batch)
+    wait_until_idle(index)
+    wait_until_idle(fresh)
+    assert all((index.search(query) == fresh.search(query)).all() for query in queries), \
+        "and still does once merged"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'search_index.npz')
+        save_time, _ = timed(lambda: index.save(path))
+        start = time.perf_counter()
+        loaded = SearchIndex.open(store, path)
+        wait_until_idle(loaded)
+        load_time = time.perf_counter() - start
+        # A rebuilt index would be dirty; a loaded one must answer the same
+        assert not loaded.dirty
+        assert all((loaded.search(query) == index.search(query)).all() for query in QUERIES)
+        print(f"\nsave {save_time * 1e3:.0f} ms, background load {load_time * 1e3:.0f} ms "
+              f"(fingerprint included), {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
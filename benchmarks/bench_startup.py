@@ -0,0 +1,128 @@
+"""Cold and warm startup benchmark.
+
+Each run starts a fresh interpreter (offscreen Qt, dummy SDL audio) that
+creates the player window and exits at its first paint. Reported per run:
+time to first paint measured from process launch, and cumulative import
+time per module (from python -X importtime).
+
+"cold" runs start with the player's bytecode caches removed; "warm" runs
+reuse them. The OS page cache is not dropped, as that needs root.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py [--runs 5] [--json results.json]
+"""
+import os
+import sys
+import json
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import sys, time
+sys.path.insert(0, {root!r})
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import QObject, QEvent
+
+app = QApplication(sys.argv)
+import music_player
+
+class FirstPaint(QObject):
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint:
+            print("FIRST_PAINT", time.time(), flush=True)
+            app.quit()
+        return False
+
+player = music_player.MusicPlayer()
+paint_filter = FirstPaint()
+player.installEventFilter(paint_filter)
+player.show()
+app.exec()
+print("AUDIO_LOADED", "pygame" in sys.modules, flush=True)
+'''
+
+
+def clear_bytecode():
+    for cache in glob.glob(os.path.join(ROOT, '__pycache__')):
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time: <self us> | <cumulative us> | <indented name>";
+    # nested imports are indented, so a module's cumulative time includes them
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative_us)
+    return modules
+
+
+def run_once(cache_home):
+    env = dict(os.environ,
+               QT_QPA_PLATFORM='offscreen',
+               SDL_AUDIODRIVER='dummy',
+               XDG_CACHE_HOME=cache_home)
+    launched = time.time()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD.format(root=ROOT)],
+        env=env, capture_output=True, text=True, timeout=60
+    )
+    first_paint = audio_loaded = None
+    for line in result.stdout.splitlines():
+        if line.startswith('FIRST_PAINT'):
+            first_paint = float(line.split()[1]) - launched
+        elif line.startswith('AUDIO_LOADED'):
+            audio_loaded = line.split()[1] == 'True'
+    if first_paint is None:
+        raise RuntimeError(f"startup run failed:\n{result.stderr[-2000:]}")
+    return {
+        'first_paint_s': first_paint,
+        'audio_imported_before_paint': audio_loaded,
+        'imports_us': parse_importtime(result.stderr),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="modules to print per mode")
+    parser.add_argument('--json', help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    results = {'cold': [], 'warm': []}
+    with tempfile.TemporaryDirectory() as cache_home:
+        for mode in ('cold', 'warm'):
+            for _ in range(args.runs):
+                if mode == 'cold':
+                    clear_bytecode()
+                results[mode].append(run_once(cache_home))
+
+    for mode, runs in results.items():
+        paints = sorted(run['first_paint_s'] for run in runs)
+        median = paints[len(paints) // 2]
+        print(f"{mode}: time to first paint median {median * 1000:.1f} ms "
+              f"(min {paints[0] * 1000:.1f}, max {paints[-1] * 1000:.1f}); "
+              f"pygame imported before paint: {any(r['audio_imported_before_paint'] for r in runs)}")
+        totals = {}
+        for run in runs:
+            for name, us in run['imports_us'].items():
+                totals.setdefault(name, []).append(us)
+        ranked = sorted(totals.items(), key=lambda item: -sorted(item[1])[len(item[1]) // 2])
+        for name, values in ranked[:args.top]:
+            print(f"    {name:<30} {sorted(values)[len(values) // 2] / 1000:8.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
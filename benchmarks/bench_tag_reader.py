@@ -0,0 +1,130 @@
+"""Tag reading: bytes read and time per file, mutagen against tag_reader.
+
+Generates the standard fixture set (see fixtures.build_library) plus ID3v2.3
+and ID3v1-only files in a temporary directory, then reads every file both
+ways and reports, per file:
+
+    mutagen     the reader the metadata cache used before: mutagen.File,
+                with embedded covers copied into the art directory
+    single      read_metadata through tag_reader, covers only located
+
+with the bytes the process read (from /proc/self/io, so buffering and
+seeks are counted as they happen) and the time per file. Titles, artists,
+albums, years, durations and cover bytes are checked to agree, and two
+files with the same cover to share its hash once it is read. The page
+cache is not dropped, so times are those of a warm cache.
+
+Run from the repository root:
+
+    python benchmarks/bench_tag_reader.py --repeat 20
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import build_library, make_cover, write_mp3, tag_file
+from metadata_cache import MetadataCache, read_metadata, store_art
+from tag_reader import _read_with_mutagen
+import metrics
+
+
+def bytes_read():
+    # Bytes read by this process so far, or None off Linux
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def read_with_mutagen(path, art_dir):
+    tags = _read_with_mutagen(path)
+    art_ref = store_art(tags.cover, art_dir) if tags.cover else None
+    return tags, art_ref
+
+
+def measure(read, path, repeat):
+    # (bytes per read, seconds per read); /proc reads are counted too, so
+    # the cost of reading it is taken off
+    before = bytes_read()
+    overhead = bytes_read() - before if before is not None else 0
+    before = bytes_read()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        read(path)
+    elapsed = time.perf_counter() - start
+    after = bytes_read()
+    read_bytes = (after - before - overhead) / repeat if before is not None else float('nan')
+    return read_bytes, elapsed / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure tag reading")
+    parser.add_argument('--repeat', type=int, default=20, help="reads of each file")
+    args = parser.parse_args()
+
+    metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        covers = {size: make_cover(size) for size in (50 * 1024, 3 * 1024 * 1024)}
+        files = build_library(os.path.join(tmp, 'library'), covers)
+        path = os.path.join(tmp, 'library', 'id3v23_art_cbr.mp3')
+        write_mp3(path, 180)
+        tag_file(path, "Id3v23 Art Cbr", cover=covers[50 * 1024], version=3)
+        files['id3v23_art_cbr'] = path
+        path = os.path.join(tmp, 'library', 'id3v1_cbr.mp3')
+        write_mp3(path, 180)
+        with open(path, 'ab') as f:
+            f.write(b'TAG' + b'Id3v1 Cbr'.ljust(30, b'\0') + b'\0' * 95)
+        files['id3v1_cbr'] = path
+
+        old_art = os.path.join(tmp, 'old_art')
+        os.makedirs(old_art)
+        cache = MetadataCache(os.path.join(tmp, 'cache'))
+
+        print(f"{'file':<16} {'MB':>6} {'mutagen KB':>10} {'single KB':>10} "
+              f"{'mutagen ms':>10} {'single ms':>10} {'speedup':>8}")
+        totals = [0, 0, 0, 0]
+        art_refs = {}
+        for name, path in files.items():
+            old, old_ref = read_with_mutagen(path, old_art)
+            new = read_metadata(path, cache.art_dir)
+            assert (new.title, new.artist, new.album, new.year) == old[:4], name
+            assert abs(new.duration - old.duration) < 0.05, name
+            if old.cover:
+                cache.store_many([(new, os.stat(path))])
+                assert cache.load_art(new.art_ref) == old.cover, name
+                art_refs[name] = new.art_ref
+
+            old_bytes, old_time = measure(lambda p: read_with_mutagen(p, old_art), path,
+                                          args.repeat)
+            new_bytes, new_time = measure(lambda p: read_metadata(p, cache.art_dir), path,
+                                          args.repeat)
+            for i, value in enumerate((old_bytes, new_bytes, old_time, new_time)):
+                totals[i] += value
+            print(f"{name:<16} {os.path.getsize(path) / 1e6:6.1f} {old_bytes / 1024:10.1f} "
+                  f"{new_bytes / 1024:10.1f} {old_time * 1e3:10.3f} {new_time * 1e3:10.3f} "
+                  f"{old_time / new_time:7.1f}x")
+        print(f"{'total':<16} {'':>6} {totals[0] / 1024:10.1f} {totals[1] / 1024:10.1f} "
+              f"{totals[2] * 1e3:10.3f} {totals[3] * 1e3:10.3f} {totals[2] / totals[3]:7.1f}x")
+        # Keyed by where they are, the same cover is one hash
+        shared = art_refs['small_art_cbr'], art_refs['id3v23_art_cbr']
+        assert shared[0] != shared[1]
+        assert cache.art_hash(shared[0]) == cache.art_hash(shared[1]) is not None, \
+            "a shared cover has one hash"
+        counters = metrics.snapshot()['counters']
+        print(f"\n{counters.get('tag_mutagen_fallbacks', 0)} mutagen fallbacks, "
+              f"{counters.get('art_source_reads', 0)} covers read from their files")
+        cache.close()
+        shutil.rmtree(old_art, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
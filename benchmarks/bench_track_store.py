@@ -0,0 +1,105 @@
+"""Memory and insert-time benchmark for the playlist track store.
+
+Run from the repository root:
+    python benchmarks/bench_track_store.py [--sizes 10000 100000 1000000] [--baseline]
+
+--baseline also measures the previous QListWidget + Python list playlist
+(skipped above 100k tracks, where it takes minutes).
+"""
+import os
+import sys
+import time
+import argparse
+import gc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt6.QtWidgets import QApplication, QListWidget
+from PyQt6.QtCore import Qt
+
+from playlist_model import PlaylistModel
+from track_store import TITLE, ARTIST
+
+BATCH = 500
+
+
+def synthetic_tracks(count):
+    # Library-shaped data: 20 tracks per album, 10 albums per artist
+    for i in range(count):
+        album = i // 20
+        artist = album // 10
+        yield (f"/music/Artist {artist}/Album {album}/{i % 20:02d} Track {i}.mp3",
+               f"Track {i}", f"Artist {artist}", f"Album {album}", 180.0 + i % 120)
+
+
+def batches(tracks):
+    batch = []
+    for track in tracks:
+        batch.append(track)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rss_bytes():
+    # Resident set size, which also covers memory owned by Qt's C++ side
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(label, count, fill):
+    gc.collect()
+    before = rss_bytes()
+    start = time.perf_counter()
+    result = fill(count)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    used = rss_bytes() - before
+    print(f"{label:<12} {count:>9} tracks  insert {elapsed:8.3f} s  "
+          f"{count / elapsed:>10.0f} tracks/s  memory {used / 2**20:8.1f} MiB  "
+          f"({used / count:6.1f} B/track)")
+    return result
+
+
+def fill_model(count):
+    model = PlaylistModel()
+    for batch in batches(synthetic_tracks(count)):
+        model.append_tracks(batch)
+    return model
+
+
+def fill_list_widget(count):
+    widget = QListWidget()
+    files = []
+    for batch in batches(synthetic_tracks(count)):
+        for track in batch:
+            widget.addItem(os.path.basename(track[0]))
+            files.append(track[0])
+    return widget, files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    for count in args.sizes:
+        model = measure("table model", count, fill_model)
+        for column in (TITLE, ARTIST):
+            start = time.perf_counter()
+            model.sort(column, Qt.SortOrder.AscendingOrder)
+            print(f"{'':<12} sort by column {column}: {time.perf_counter() - start:.3f} s")
+        del model
+        if args.baseline and count <= 100_000:
+            # QListWidgetItems live in C++, so only the Python side is traced
+            measure("QListWidget", count, fill_list_widget)
+    app.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Watched folder sync: event storms and the startup reconciliation.
+
+Watches a library of tagged MP3 files in a temporary directory, with a
+playlist holding them, then reports:
+
+    startup     the sync when the player starts and nothing changed
+    storm       files copied into the library as fast as a background
+                thread can, 100 to a folder: filesystem events, sync
+                batches, time spent on the GUI thread and how long after
+                the last copy every file was in the playlist
+    rename      the folder the storm went into, renamed: every track moves
+    delete      that folder deleted
+    trickle     --trickle files of the library deleted one at a time over
+                a few sync batches: their tracks are removed in one go,
+                once the storm is over
+    offline     the startup sync after 1% of the files got new tags and
+                1% were deleted while the player was closed
+
+with the files compared and tags read by the syncs. The page cache is not
+dropped, so startup numbers are those of a warm start.
+
+Run from the repository root:
+
+    python benchmarks/bench_watcher.py --files 10000 --copy 10000 --trickle 5000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt6.QtCore import QEventLoop, QTimer
+from PyQt6.QtWidgets import QApplication
+
+from fixtures import write_mp3, tag_file
+from metadata_cache import MetadataCache
+from playlist_model import PlaylistModel
+from library_watcher import FolderWatcher, MAX_DELAY_MS
+import metrics
+
+FOLDER_SIZE = 100
+
+
+def copy_files(template, root, count):
+    for i in range(count):
+        folder = os.path.join(root, f"folder{i // FOLDER_SIZE:04d}")
+        if i % FOLDER_SIZE == 0:
+            os.makedirs(folder)
+        shutil.copyfile(template, os.path.join(folder, f"track{i:06d}.mp3"))
+
+
+class Run:
+    """Times one step, from `start` until the watcher's sync is done and
+    the playlist has `rows` tracks."""
+
+    def __init__(self, watcher, model):
+        self.watcher = watcher
+        self.model = model
+        self.done = False
+        watcher.synced.connect(self._synced)
+
+    def _synced(self, added, removed, moved, updated, done):
+        self.done = done
+        self.totals = (added, removed, moved, updated)
+
+    def wait(self, rows, busy=lambda: False, timeout=600):
+        loop = QEventLoop()
+        deadline = time.monotonic() + timeout
+
+        def check():
+            if (self.done and len(self.model.store) == rows and not busy()) \
+                    or time.monotonic() > deadline:
+                loop.quit()
+            else:
+                QTimer.singleShot(5, check)
+
+        self.done = False
+        check()
+        loop.exec()
+        return time.perf_counter()
+
+
+def delete_files(paths, seconds):
+    # Spread over `seconds`, so that the storm spans several batches
+    start = time.monotonic()
+    for i, path in enumerate(paths):
+        os.remove(path)
+        delay = start + seconds * (i + 1) / len(paths) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def report(label, seconds, extra=''):
+    counters = metrics.snapshot()['counters']
+    spans = metrics.snapshot()['spans']
+    gui = [spans.get(name, {}) for name in ('library_watch_read', 'library_sync_apply')]
+    print(f"{label:<8} {seconds:8.2f} {counters.get('library_watch_events', 0):7d} "
+          f"{counters.get('library_sync_batches', 0):7d} "
+          f"{counters.get('library_sync_files', 0):8d} "
+          f"{counters.get('library_sync_tags_read', 0):6d} "
+          f"{sum(span.get('total', 0) for span in gui) * 1e3:8.0f} "
+          f"{max(span.get('max', 0) for span in gui) * 1e3:8.1f}  {extra}")
+    metrics.reset()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure watched folder syncing")
+    parser.add_argument('--files', type=int, default=10000, help="files in the library")
+    parser.add_argument('--copy', type=int, default=10000, help="files copied in the storm")
+    parser.add_argument('--trickle', type=int, default=5000,
+                        help="files deleted one at a time over several batches")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    metrics.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        library = os.path.join(tmp, 'library')
+        template = os.path.join(tmp, 'template.mp3')
+        write_mp3(template, 1)
+        tag_file(template, "Template")
+        copy_files(template, os.path.join(library, 'albums'), args.files)
+        cache = MetadataCache(os.path.join(tmp, 'cache'))
+        settings = os.path.join(tmp, 'watched_folders.json')
+
+        model = PlaylistModel()
+        watcher = FolderWatcher(model, cache, file_path=settings)
+        run = Run(watcher, model)
+        watcher.watch_folder(library)
+        run.wait(args.files)
+        metrics.reset()
+        watcher.close()
+
+        print(f"{args.files} files watched, {args.copy} copied\n")
+        print(f"{'step':<8} {'seconds':>8} {'events':>7} {'batches':>7} {'compared':>8} "
+              f"{'tags':>6} {'GUI ms':>8} {'max ms':>8}")
+
+        watcher = FolderWatcher(model, cache, file_path=settings)
+        run = Run(watcher, model)
+        start = time.perf_counter()
+        watcher.start()
+        report('startup', run.wait(args.files) - start)
+
+        storm = os.path.join(library, 'storm')
+        copier = threading.Thread(target=copy_files, args=(template, storm, args.copy))
+        start = time.perf_counter()
+        copier.start()
+        end = run.wait(args.files + args.copy, busy=copier.is_alive)
+        synced = time.time()
+        copied = os.path.getmtime(max(
+            (os.path.join(root, name) for root, _, names in os.walk(storm) for name in names),
+            key=os.path.getmtime))
+        report('storm', end - start, f"synced {synced - copied:.2f} s after the last copy")
+
+        renamed = os.path.join(library, 'storm renamed')
+        start = time.perf_counter()
+        os.rename(storm, renamed)
+        report('rename', run.wait(args.files + args.copy) - start, f"{run.totals[2]} moved")
+
+        start = time.perf_counter()
+        shutil.rmtree(renamed)
+        report('delete', run.wait(args.files) - start, f"{run.totals[1]} removed")
+
+        doomed = sorted(model.store.path(row) for row in range(len(model.store)))
+        doomed = doomed[::max(len(doomed) // max(args.trickle, 1), 1)][:args.trickle]
+        deleter = threading.Thread(target=delete_files,
+                                   args=(doomed, 2.5 * MAX_DELAY_MS / 1000))
+        start = time.perf_counter()
+        deleter.start()
+        end = run.wait(args.files - len(doomed), busy=deleter.is_alive)
+        removals = metrics.snapshot()['counters'].get('library_sync_removals', 0)
+        report('trickle', end - start, f"{len(doomed)} removed in {removals} removals")
+
+        watcher.close()
+        paths = sorted(model.store.path(row) for row in range(len(model.store)))
+        for path in paths[::100]:
+            tag_file(path, "Retagged")
+        for path in paths[50::100]:
+            os.remove(path)
+        rows = len(paths) - len(paths[50::100])
+        watcher = FolderWatcher(model, cache, file_path=settings)
+        run = Run(watcher, model)
+        start = time.perf_counter()
+        watcher.start()
+        end = run.wait(rows)
+        report('offline', end - start, f"{run.totals[3]} updated, {run.totals[1]} removed")
+        watcher.close()
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
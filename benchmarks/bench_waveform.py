@@ -0,0 +1,123 @@
+"""Waveform seek bar: peak generation, cache and drawing costs.
+
+Generates a long silent MP3 mix and a shorter PCM noise track in a
+temporary directory, then reports for each:
+
+    compute     decoding and peak extraction, as the worker process does it
+    cache       size of the cached peak file
+    open        request() to waveform_ready for a track already cached,
+                i.e. what opening a cached track costs before it is drawn
+    envelope    peaks for a seek bar 800 and 1920 pixels wide
+    paint       paint of the seek bar at a new size (the envelope is drawn
+                into pixmaps) and a repaint after a position update
+
+Run from the repository root:
+
+    python benchmarks/bench_waveform.py --minutes 60
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt6.QtCore import QEventLoop, QTimer
+from PyQt6.QtWidgets import QApplication
+
+from fixtures import write_mp3
+from bench_loudness import write_noise
+import waveform
+from waveform import WaveformService, compute_waveform, waveform_path, save_waveform
+
+
+def best_of(action, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def open_cached(service, file_path):
+    # Seconds from request() to waveform_ready, through the event loop
+    loop = QEventLoop()
+    service.waveform_ready.connect(loop.quit)
+    start = time.perf_counter()
+    if service.request(file_path) is None:
+        QTimer.singleShot(10000, loop.quit)
+        loop.exec()
+    elapsed = time.perf_counter() - start
+    service.waveform_ready.disconnect(loop.quit)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure waveform seek bar costs")
+    parser.add_argument('--minutes', type=float, default=60, help="length of the MP3 mix")
+    parser.add_argument('--wav-minutes', type=float, default=5)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    from music_player import WaveformSlider
+
+    waveform._init_worker()
+    with tempfile.TemporaryDirectory() as tmp:
+        mix = os.path.join(tmp, 'mix.mp3')
+        write_mp3(mix, args.minutes * 60)
+        song = os.path.join(tmp, 'song.wav')
+        write_noise(song, args.wav_minutes * 60, 0)
+        service = WaveformService(tmp)
+
+        for label, path, minutes in (('mp3 mix', mix, args.minutes),
+                                     ('wav song', song, args.wav_minutes)):
+            start = time.perf_counter()
+            peaks = compute_waveform(path)
+            compute = time.perf_counter() - start
+            cache_path = waveform_path(service.waveform_dir, path)
+            save_waveform(cache_path, peaks, os.stat(path))
+
+            opened = []
+            for _ in range(args.repeats):
+                service._waveforms.clear()
+                opened.append(open_cached(service, path))
+            opened.sort()
+
+            envelopes = [best_of(lambda: peaks.envelope(width), args.repeats) for width in (800, 1920)]
+
+            slider = WaveformSlider()
+            slider.resize(800, 56)
+            slider.show_waveform(True)
+            slider.set_length(minutes * 60)
+            slider.set_waveform(peaks)
+            # The first grab of a widget also polishes it; a new width then
+            # makes the next one draw the envelope again
+            slider.grab()
+            slider.resize(801, 56)
+            start = time.perf_counter()
+            slider.grab()
+            first_paint = time.perf_counter() - start
+            slider.setValue(slider.maximum() // 3)
+            repaint = best_of(slider.grab, args.repeats)
+
+            print(f"{label} ({minutes:g} min, {len(peaks.levels)} levels)")
+            print(f"  compute   {compute:6.2f} s   ({minutes * 60 / compute:.0f}x realtime)")
+            print(f"  cache     {os.path.getsize(cache_path) / 1024:6.1f} KB")
+            print(f"  open      {opened[len(opened) // 2] * 1e3:6.2f} ms median, "
+                  f"{opened[-1] * 1e3:.2f} ms max")
+            print(f"  envelope  {envelopes[0] * 1e3:6.3f} ms at 800 px, "
+                  f"{envelopes[1] * 1e3:.3f} ms at 1920 px")
+            print(f"  paint     {first_paint * 1e3:6.2f} ms resized, {repaint * 1e3:.2f} ms after a move")
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
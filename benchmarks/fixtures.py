@@ -0,0 +1,159 @@
+"""Synthetic audio fixtures for the benchmarks.
+
+Files are generated locally, so no sample music has to be shipped. MP3
+frames carry all-zero bodies, which is valid Layer III data that decodes
+to silence; tags and cover art are real.
+"""
+import os
+import wave
+import random
+import struct
+
+# MPEG-1 Layer III, 44.1 kHz, stereo, no CRC
+MP3_FRAME_SAMPLES = 1152
+MP3_SAMPLE_RATE = 44100
+# Bitrate index -> kbit/s for MPEG-1 Layer III
+MP3_BITRATES = {1: 32, 2: 40, 3: 48, 4: 56, 5: 64, 6: 80, 7: 96, 8: 112,
+                9: 128, 10: 160, 11: 192, 12: 224, 13: 256, 14: 320}
+CBR_BITRATE_INDEX = 9
+# Where the Xing tag sits in a stereo MPEG-1 frame (header + side info)
+XING_OFFSET = 36
+
+
+def _frame(bitrate_index):
+    size = 144 * MP3_BITRATES[bitrate_index] * 1000 // MP3_SAMPLE_RATE
+    header = bytes([0xFF, 0xFB, (bitrate_index << 4), 0x00])
+    return header + bytes(size - 4)
+
+
+def _xing_frame(frame_count, stream_bytes, offsets):
+    # An Info/Xing frame: frame count, byte count and a 100-entry TOC
+    frame = bytearray(_frame(CBR_BITRATE_INDEX))
+    toc = bytes(min(255, offsets[int(i / 100 * len(offsets))] * 256 // max(stream_bytes, 1))
+                for i in range(100))
+    frame[XING_OFFSET:XING_OFFSET + 4] = b'Xing'
+    frame[XING_OFFSET + 4:XING_OFFSET + 8] = struct.pack('>I', 0x7)
+    frame[XING_OFFSET + 8:XING_OFFSET + 16] = struct.pack('>II', frame_count, stream_bytes)
+    frame[XING_OFFSET + 16:XING_OFFSET + 116] = toc
+    return bytes(frame)
+
+
+def write_mp3(path, seconds, vbr=False, seed=0):
+    """Write an MP3 of silent frames lasting about `seconds`.
+
+    CBR files are plain 128 kbit/s frames. VBR files pick a random bitrate
+    per frame and start with a Xing header carrying the frame count and
+    TOC, like LAME's output. Returns the exact duration of the stream.
+    """
+    frames = max(1, round(seconds * MP3_SAMPLE_RATE / MP3_FRAME_SAMPLES))
+    if not vbr:
+        with open(path, 'wb') as f:
+            f.write(_frame(CBR_BITRATE_INDEX) * frames)
+        return frames * MP3_FRAME_SAMPLES / MP3_SAMPLE_RATE
+
+    rng = random.Random(seed)
+    bodies = {index: _frame(index) for index in MP3_BITRATES}
+    choices = [rng.choice((5, 7, 9, 11, 13, 14)) for _ in range(frames)]
+    offsets = []
+    position = 0
+    for index in choices:
+        offsets.append(position)
+        position += len(bodies[index])
+    with open(path, 'wb') as f:
+        f.write(_xing_frame(frames, position, offsets))
+        for index in choices:
+            f.write(bodies[index])
+    return frames * MP3_FRAME_SAMPLES / MP3_SAMPLE_RATE
+
+
+def write_wav(path, seconds, sample_rate=44100, channels=2):
+    frames = int(seconds * sample_rate)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        chunk = bytes(4096 * channels * 2)
+        remaining = frames
+        while remaining > 0:
+            count = min(remaining, 4096)
+            w.writeframes(chunk[:count * channels * 2])
+            remaining -= count
+    return frames / sample_rate
+
+
+def make_cover(size_bytes, seed=0):
+    """Return JPEG bytes of roughly `size_bytes` (needs Qt's image plugins).
+
+    Noise does not compress, so the pixel count drives the file size.
+    """
+    from PyQt6.QtCore import QBuffer, QByteArray, QIODevice
+    from PyQt6.QtGui import QImage
+
+    # JPEG noise at quality 90 costs roughly one byte per pixel
+    side = max(16, int(size_bytes ** 0.5))
+    rng = random.Random(seed)
+    pixels = rng.randbytes(side * side * 3)
+    image = QImage(pixels, side, side, side * 3, QImage.Format.Format_RGB888)
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, 'JPG', 90)
+    return bytes(data)
+
+
+def tag_file(path, title, artist='Fixture Artist', album='Fixture Album', year='2024',
+             cover=None, padding=0, version=4):
+    """Add ID3v2 tags (v2.4 unless `version` is 3); `padding` extra bytes of
+    comment text grow the tag."""
+    from mutagen.id3 import ID3, TIT2, TPE1, TALB, TDRC, COMM, APIC
+
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=artist))
+    tags.add(TALB(encoding=3, text=album))
+    tags.add(TDRC(encoding=3, text=year))
+    if padding:
+        tags.add(COMM(encoding=3, lang='eng', desc='padding', text='x' * padding))
+    if cover:
+        tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='', data=cover))
+    tags.save(path, v2_version=version)
+
+
+def make_dir(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def build_library(root, covers=None):
+    """Generate the standard fixture set under `root`.
+
+    Returns {name: path} covering small/large tags, small/large covers,
+    CBR/VBR, a 60 minute file and a WAV file. `covers` maps a cover size
+    in bytes to JPEG data (see make_cover).
+    """
+    make_dir(root)
+    covers = covers or {}
+    files = {}
+
+    def mp3(name, seconds, vbr=False, cover_size=None, padding=0, tagged=True):
+        path = os.path.join(root, f"{name}.mp3")
+        write_mp3(path, seconds, vbr=vbr)
+        if tagged:
+            tag_file(path, name.replace('_', ' ').title(), cover=covers.get(cover_size),
+                     padding=padding)
+        files[name] = path
+
+    mp3('untagged_cbr', 180, tagged=False)
+    mp3('small_tag_cbr', 180)
+    mp3('large_tag_cbr', 180, padding=256 * 1024)
+    mp3('small_art_cbr', 180, cover_size=50 * 1024)
+    mp3('large_art_cbr', 180, cover_size=3 * 1024 * 1024)
+    mp3('small_tag_vbr', 180, vbr=True)
+    mp3('large_art_vbr', 180, vbr=True, cover_size=3 * 1024 * 1024)
+    mp3('long_mix_cbr', 60 * 60)
+    mp3('long_mix_vbr', 60 * 60, vbr=True)
+
+    wav_path = os.path.join(root, 'pcm.wav')
+    write_wav(wav_path, 30)
+    files['pcm_wav'] = wav_path
+    return files
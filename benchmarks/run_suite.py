@@ -0,0 +1,244 @@
+"""Headless benchmark suite over synthetic fixtures.
+
+Generates the fixture library (see fixtures.build_library) in a temporary
+directory, then measures:
+
+    metadata        update_metadata latency, cold (tags parsed) and warm (cached)
+    playlist        playlist insertion throughput
+    art             cover decode+scale time, full decode and thumbnail hit
+    seek            engine seek latency, CBR and VBR
+    track_change    engine + window track change latency
+    memory          peak RSS while holding a large playlist
+
+Runs with offscreen Qt and the dummy SDL audio driver. Results are written
+as JSON so two commits can be compared:
+
+    python benchmarks/run_suite.py --output before.json
+    git checkout other-commit
+    python benchmarks/run_suite.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from PyQt6.QtWidgets import QApplication
+
+from fixtures import build_library, make_cover
+
+
+def stats(samples):
+    samples = sorted(samples)
+    return {
+        'mean': sum(samples) / len(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'n': len(samples),
+    }
+
+
+def repeat(action, repeats, setup=None):
+    samples = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        action()
+        samples.append(time.perf_counter() - start)
+    return stats(samples)
+
+
+def bench_metadata(player, files, repeats):
+    # Time what a track change costs the window: fetch the metadata (parsing
+    # the file when cold) and push it into the playlist and labels
+    player.playlist_model.clear()
+    player.playlist_model.append_tracks([(path, None, None, None, 0.0) for path in files.values()])
+    results = {}
+    for row, (name, path) in enumerate(files.items()):
+        def cold():
+            player.metadata_cache.invalidate([path])
+
+        def update():
+            metadata = player.metadata_cache.get(path)
+            player.update_metadata(row, path, metadata)
+
+        results[f"cold/{name}"] = repeat(update, repeats, setup=cold)
+        results[f"warm/{name}"] = repeat(update, repeats)
+    return results
+
+
+def bench_playlist(sizes):
+    from playlist_model import PlaylistModel
+
+    results = {}
+    for count in sizes:
+        tracks = [(f"/music/Artist {i // 200}/Album {i // 20}/{i:07d}.mp3", f"Track {i}",
+                   f"Artist {i // 200}", f"Album {i // 20}", 200.0) for i in range(count)]
+        model = PlaylistModel()
+        start = time.perf_counter()
+        for first in range(0, count, 500):
+            model.append_tracks(tracks[first:first + 500])
+        elapsed = time.perf_counter() - start
+        results[str(count)] = {'seconds': elapsed, 'tracks_per_second': count / elapsed}
+    return results
+
+
+def bench_art(player, files, repeats):
+    cover_art = player.cover_art
+    results = {}
+    for name in ('small_art_cbr', 'large_art_cbr'):
+        art_ref = player.metadata_cache.get(files[name]).art_ref
+        # Thumbnails are named after the cover's hash, learnt on its first read
+        cover_art.decode(art_ref)
+        art_hash = player.metadata_cache.art_hash(art_ref)
+        thumb = os.path.join(cover_art.thumb_dir, f"{art_hash}-{cover_art.size}.jpg")
+
+        def drop_thumbnail():
+            if os.path.exists(thumb):
+                os.remove(thumb)
+
+        results[f"decode/{name}"] = repeat(lambda: cover_art.decode(art_ref), repeats,
+                                           setup=drop_thumbnail)
+        cover_art.decode(art_ref)
+        results[f"thumbnail/{name}"] = repeat(lambda: cover_art.decode(art_ref), repeats)
+    return results
+
+
+def bench_seek(engine, files, repeats):
+    from playback_engine import PathList
+
+    results = {}
+    for name in ('small_tag_cbr', 'small_tag_vbr', 'long_mix_cbr', 'long_mix_vbr'):
+        engine.set_playlist(PathList([files[name]]))
+        engine.play_index(0)
+        engine.seek_index(files[name])
+        length = engine.song_length
+        targets = iter([(i * 0.37 % 1.0) * length * 0.9 for i in range(repeats)])
+        results[name] = repeat(lambda: engine.seek(next(targets)), repeats)
+        engine.stop()
+    return results
+
+
+def bench_track_change(player, files, repeats):
+    names = ['small_tag_cbr', 'small_art_cbr', 'large_art_cbr', 'small_tag_vbr']
+    player.playlist_model.clear()
+    player.playlist_model.append_tracks([(files[name], None, None, None, 0.0) for name in names])
+    player.play_selected(player.playlist_model.index(0, 0))
+    result = {'next': repeat(player.play_next, repeats)}
+    player.stop_music()
+    return result
+
+
+def bench_memory(count):
+    # Run in a child process so the peak RSS belongs to this measurement only
+    code = (
+        "import sys, resource; sys.path.insert(0, {root!r})\n"
+        "from PyQt6.QtWidgets import QApplication\n"
+        "app = QApplication(sys.argv)\n"
+        "from playlist_model import PlaylistModel\n"
+        "model = PlaylistModel()\n"
+        "for first in range(0, {count}, 500):\n"
+        "    model.append_tracks([(f'/music/Artist {{i // 200}}/Album {{i // 20}}/{{i:07d}}.mp3',"
+        " f'Track {{i}}', f'Artist {{i // 200}}', f'Album {{i // 20}}', 200.0)"
+        " for i in range(first, min(first + 500, {count}))])\n"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    ).format(root=ROOT, count=count)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True, env=os.environ).stdout
+    return {'tracks': count, 'peak_rss_kib': int(output.split()[-1])}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    # {'a': {'b': {'mean': 1}}} -> {'a/b/mean': 1}
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = flatten(json.load(f)['results'])
+    current = flatten(current)
+    print(f"\n{'metric':<55} {'before':>12} {'after':>12} {'change':>8}")
+    for name in sorted(current):
+        if name in baseline and baseline[name] and not name.endswith('/n'):
+            change = (current[name] - baseline[name]) / baseline[name] * 100
+            print(f"{name:<55} {baseline[name]:12.6g} {current[name]:12.6g} {change:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output',
+                        default=os.path.join(ROOT, 'benchmarks', 'benchmark_results.json'))
+    parser.add_argument('--compare', help="previous results file to compare against")
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--playlist-sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--memory-tracks', type=int, default=500_000)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Use a private cache so the user's cache neither helps nor suffers
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp, 'cache')
+        import music_player
+
+        covers = {size: make_cover(size, seed=size) for size in (50 * 1024, 3 * 1024 * 1024)}
+        files = build_library(os.path.join(tmp, 'library'), covers)
+
+        player = music_player.MusicPlayer()
+        player.engine.ensure_audio()
+
+        results = {
+            'metadata': bench_metadata(player, files, args.repeats),
+            'playlist': bench_playlist(args.playlist_sizes),
+            'art': bench_art(player, files, args.repeats),
+            'seek': bench_seek(player.engine, files, args.repeats),
+        }
+        player.engine.set_playlist(player.playlist_model)
+        results['track_change'] = bench_track_change(player, files, args.repeats)
+        results['memory'] = bench_memory(args.memory_tracks)
+        player.close()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, value in sorted(flatten(results).items()):
+        if name.endswith(('/mean', '/seconds', '/peak_rss_kib', '/tracks_per_second')):
+            print(f"{name:<55} {value:12.6g}")
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt6.QtGui import QImage
+
+import metrics
+
+ART_SIZE = 280
+
+
+def thumbnail_path(thumb_dir, art_hash, size=ART_SIZE):
+    return os.path.join(thumb_dir, f"{art_hash}-{size}.jpg")
+
+
+class _DecodeTask(QRunnable):
+    def __init__(self, service, art_ref):
+        super().__init__()
+        self.service = service
+        self.art_ref = art_ref
+
+    def run(self):
+        image = self.service.decode(self.art_ref)
+        self.service._finished(self.art_ref, image)
+
+
+class CoverArtService(QObject):
+    """Decode and scale album art off the GUI thread.
+
+    Scaled images are kept in an LRU bounded by byte size and keyed by the
+    cover's content hash (MetadataCache.art_hash of the art_ref, known once
+    the cover has been read), so tracks of one album share a single entry.
+    Scaled covers are also written to a thumbnail directory under the same
+    hash, which makes later sessions skip the full decode.
+    """
+
+    # art_ref, scaled QImage (null when the cover could not be decoded)
+    art_ready = pyqtSignal(str, QImage)
+
+    def __init__(self, metadata_cache, size=ART_SIZE, max_bytes=32 * 1024 * 1024, parent=None):
+        super().__init__(parent)
+        self.metadata_cache = metadata_cache
+        self.size = size
+        self.max_bytes = max_bytes
+        self.thumb_dir = os.path.join(metadata_cache.cache_dir, 'thumbs')
+        os.makedirs(self.thumb_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Content hash of the art_refs seen so far
+        self._hashes = {}
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._pending = set()
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(2)
+
+    def cached(self, art_ref):
+        # Return the scaled image if it is in memory, else None
+        with self._lock:
+            art_hash = self._hashes.get(art_ref)
+            image = self._images.get(art_hash) if art_hash is not None else None
+            if image is not None:
+                self._images.move_to_end(art_hash)
+            return image
+
+    def request(self, art_ref):
+        """Return the scaled image right away when it is cached in memory;
+        otherwise schedule a decode and emit art_ready when it is done."""
+        image = self.cached(art_ref)
+        if image is not None:
+            metrics.count('art_memory_hits')
+            return image
+        metrics.count('art_memory_misses')
+        with self._lock:
+            if art_ref in self._pending:
+                return None
+            self._pending.add(art_ref)
+        self._pool.start(_DecodeTask(self, art_ref))
+        return None
+
+    def decode(self, art_ref):
+        # Runs on a worker thread: thumbnail hit (possibly made for another
+        # track with the same cover), or full decode and scale. A cover
+        # shown for the first time is read to learn its hash
+        data = None
+        art_hash = self.metadata_cache.art_hash(art_ref)
+        if art_hash is None:
+            data = self.metadata_cache.load_art(art_ref)
+            art_hash = self.metadata_cache.art_hash(art_ref)
+            if art_hash is None:
+                return QImage()
+        with self._lock:
+            self._hashes[art_ref] = art_hash
+        thumb = thumbnail_path(self.thumb_dir, art_hash, self.size)
+        with metrics.span('art_thumbnail_load'):
+            image = QImage(thumb)
+        if not image.isNull():
+            metrics.count('art_thumbnail_hits')
+            return image
+        metrics.count('art_thumbnail_misses')
+
+        if data is None:
+            data = self.metadata_cache.load_art(art_ref)
+        image = QImage()
+        with metrics.span('art_decode'):
+            if not data or not image.loadFromData(data):
+                return QImage()
+        with metrics.span('art_scale'):
+            image = image.scaled(self.size, self.size, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+
+        tmp_path = f"{thumb}.{threading.get_ident()}.tmp"
+        if image.save(tmp_path, 'JPG', 90):
+            os.replace(tmp_path, thumb)
+        return image
+
+    def _finished(self, art_ref, image):
+        with self._lock:
+            self._pending.discard(art_ref)
+            art_hash = self._hashes.get(art_ref)
+            if art_hash in self._images:
+                self._images.move_to_end(art_hash)
+            elif not image.isNull():
+                self._images[art_hash] = image
+                self._bytes += image.sizeInBytes()
+                while self._bytes > self.max_bytes and len(self._images) > 1:
+                    _, evicted = self._images.popitem(last=False)
+                    self._bytes -= evicted.sizeInBytes()
+        self.art_ready.emit(art_ref, image)
+
+    def shutdown(self):
+        self._pool.clear()
+        self._pool.waitForDone()
@@ -0,0 +1,360 @@
+"""Real-time DSP for the decoder process pipeline (see audio_pipeline).
+
+    equalizer   parametric bands (peaking, low and high shelf) as biquads in
+                cascade. NumPy has no recursive filter, so the cascade runs as
+                a state-space system a block at a time: each block is cut
+                into sub-blocks, whose outputs (from their input and the
+                state they start in) and states (from the state before and
+                the input between) are matrix products
+    limiter     keeps peaks under a ceiling: a gain per sub-block, ramped
+                between sub-blocks, with one sub-block of lookahead so that
+                it is down before a peak, and a steady release
+    crossfade   mixes the end of a track into the start of the next one
+                (in the decoder process, which decodes both)
+
+The equalizer and the limiter work on blocks of a fixed size in place, in
+buffers allocated once: nothing is allocated per block, and there is no
+loop over samples in Python.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# Frames processed at once, in each sub-block (the limiter's lookahead) and
+# most sub-blocks in a block of the equalizer
+BLOCK_FRAMES = 1024
+SUBBLOCK_FRAMES = 32
+MAX_SUBBLOCKS = 32
+# Where the limiter keeps peaks, in dB below full scale, and how fast it
+# lets go of a gain reduction
+LIMITER_CEILING = -1.0
+RELEASE_DB_PER_SECOND = 30.0
+BAND_KINDS = ('peak', 'low_shelf', 'high_shelf')
+
+# One equalizer band: its kind (BAND_KINDS), center or corner frequency in
+# Hz, gain in dB and Q
+Band = namedtuple('Band', ['kind', 'frequency', 'gain', 'q'], defaults=(math.sqrt(0.5),))
+
+
+def parse_bands(text):
+    """Bands from text such as 'low_shelf:100:4,peak:1000:-3:1.4' (kind,
+    frequency, gain and optionally Q, for each band)."""
+    bands = []
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        kind, *numbers = item.split(':')
+        if kind not in BAND_KINDS or len(numbers) not in (2, 3):
+            raise ValueError(f"bad band '{item}'")
+        band = Band(kind, *map(float, numbers))
+        if not band.frequency > 0 or not band.q > 0:
+            raise ValueError(f"bad band '{item}': frequency and Q must be positive")
+        bands.append(band)
+    return bands
+
+
+def biquad(band, rate):
+    # (b, a) of a band, normalized so that a[0] is 1 (the Audio EQ Cookbook)
+    kind, frequency, gain, q = band
+    a = 10 ** (gain / 40)
+    w0 = 2 * math.pi * min(frequency, rate * 0.49) / rate
+    cos, alpha = math.cos(w0), math.sin(w0) / (2 * q)
+    if kind == 'peak':
+        b = (1 + alpha * a, -2 * cos, 1 - alpha * a)
+        den = (1 + alpha / a, -2 * cos, 1 - alpha / a)
+    else:
+        root = 2 * math.sqrt(a) * alpha
+        sign = 1 if kind == 'low_shelf' else -1
+        b = (a * ((a + 1) - sign * (a - 1) * cos + root),
+             sign * 2 * a * ((a - 1) - sign * (a + 1) * cos),
+             a * ((a + 1) - sign * (a - 1) * cos - root))
+        den = ((a + 1) + sign * (a - 1) * cos + root,
+               -sign * 2 * ((a - 1) + sign * (a + 1) * cos),
+               (a + 1) + sign * (a - 1) * cos - root)
+    return tuple(x / den[0] for x in b), (1.0, den[1] / den[0], den[2] / den[0])
+
+
+def _state_space(sections):
+    # (A, B, C, D) of biquads in cascade, each in transposed direct form II
+    a = np.zeros((0, 0))
+    b = np.zeros(0)
+    c = np.zeros(0)
+    d = 1.0
+    for (b0, b1, b2), (_, a1, a2) in sections:
+        order = len(b)
+        cascade = np.zeros((order + 2, order + 2))
+        cascade[:order, :order] = a
+        cascade[order:, :order] = np.outer((b1 - a1 * b0, b2 - a2 * b0), c)
+        cascade[order:, order:] = ((-a1, 1.0), (-a2, 0.0))
+        a = cascade
+        b = np.concatenate((b, np.multiply((b1 - a1 * b0, b2 - a2 * b0), d)))
+        c = np.concatenate((b0 * c, (1.0, 0.0)))
+        d *= b0
+    return a, b, c, d
+
+
+class Equalizer:
+    """Bands (see Band) applied in place to float blocks of block_frames,
+    shaped (frames, channels); no bands leave the audio as it is."""
+
+    def __init__(self, rate, channels, block_frames=BLOCK_FRAMES, bands=()):
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = block_frames
+        # Larger sub-blocks in larger blocks, as the work on the states
+        # grows with the square of their number
+        self._sub = max(min(SUBBLOCK_FRAMES, block_frames), block_frames // MAX_SUBBLOCKS)
+        if block_frames % self._sub:
+            raise ValueError(f"blocks of {block_frames} frames are not whole sub-blocks")
+        self._count = block_frames // self._sub
+        self.bands = []
+        self._order = None
+        self.set_bands(bands)
+
+    def set_bands(self, bands):
+        # The state carries over when the number of bands stays the same, so
+        # that moving a band does not click
+        self.bands = list(bands)
+        if not self.bands:
+            self._order = 0
+            return
+        a, b, c, d = _state_space(biquad(band, self.rate) for band in self.bands)
+        order, sub, count = len(b), self._sub, self._count
+        powers = [np.eye(order)]
+        for _ in range(sub):
+            powers.append(powers[-1] @ a)
+        # A sub-block's output is its input through the impulse response,
+        # plus what the state it starts in contributes
+        response = np.concatenate(([d], [c @ powers[n - 1] @ b for n in range(1, sub)]))
+        index = np.arange(sub)
+        toeplitz = np.where(index[:, None] >= index, response[index[:, None] - index], 0.0)
+        self._output = np.vstack((toeplitz.T, np.array([c @ p for p in powers[:sub]]).T))
+        # The state after a sub-block, from its input, and from the state
+        # before it over any number of sub-blocks
+        self._input_state = np.array([powers[sub - 1 - n] @ b for n in range(sub)])
+        step = powers[sub]
+        steps = [np.eye(order)]
+        for _ in range(count):
+            steps.append(step @ steps[-1])
+        chain = np.zeros((count + 1, order, count + 1, order))
+        for k in range(count + 1):
+            chain[0, :, k] = steps[k].T
+            for j in range(k):
+                chain[j + 1, :, k] = steps[k - 1 - j].T
+        self._chain = chain.reshape((count + 1) * order, (count + 1) * order)
+        if order != self._order:
+            self._order = order
+            shape = (self.channels, count)
+            self._z = np.zeros(shape + (sub + order,))
+            self._u = np.zeros((self.channels, count + 1, order))
+            self._s = np.zeros((self.channels, count + 1, order))
+            self._y = np.zeros(shape + (sub,))
+
+    def reset(self):
+        if self._order:
+            self._u[:, 0] = 0.0
+
+    def process(self, samples):
+        if not self._order:
+            return
+        sub, count = self._sub, self._count
+        planar = samples.T.reshape(self.channels, count, sub)
+        inputs = self._z[..., :sub]
+        inputs[...] = planar
+        # The states each sub-block starts in: _u holds the state before the
+        # block, then what each sub-block's input adds
+        np.matmul(inputs, self._input_state, out=self._u[:, 1:])
+        np.matmul(self._u.reshape(self.channels, -1), self._chain,
+                  out=self._s.reshape(self.channels, -1))
+        self._z[..., sub:] = self._s[:, :count]
+        np.matmul(self._z, self._output, out=self._y)
+        self._u[:, 0] = self._s[:, count]
+        planar[...] = self._y
+
+
+class Limiter:
+    """Keeps float blocks of block_frames, shaped (frames, channels), under
+    `ceiling` dB in place; the audio comes out SUBBLOCK_FRAMES later."""
+
+    def __init__(self, rate, channels, block_frames=BLOCK_FRAMES, ceiling=LIMITER_CEILING):
+        self.ceiling = ceiling
+        sub = min(SUBBLOCK_FRAMES, block_frames)
+        if block_frames % sub:
+            raise ValueError(f"blocks of {block_frames} frames are not whole sub-blocks")
+        count = block_frames // sub
+        self._sub = sub
+        self._count = count
+        self._delayed = np.zeros((block_frames + sub, channels))
+        self._magnitudes = np.zeros_like(self._delayed)
+        self._levels = np.zeros(count + 1)
+        self._bounds = np.zeros(count + 1)
+        self._gains = np.zeros((count, sub, channels))
+        # Linear gain ramps between sub-blocks, from the gains at both ends
+        # of each (a view of the boundaries' gains) for every channel;
+        # release in dB since the start of the block, per boundary
+        self._ends = np.lib.stride_tricks.sliding_window_view(self._bounds, 2)
+        fraction = np.arange(sub) / sub
+        self._ramps = np.repeat(np.vstack((1 - fraction, fraction)), channels, axis=1)
+        self._release = np.arange(count + 1) * (RELEASE_DB_PER_SECOND * sub / rate)
+        self._gain = 0.0
+
+    def reset(self):
+        self._delayed[:] = 0.0
+        self._gain = 0.0
+
+    def process(self, samples):
+        sub, count = self._sub, self._count
+        delayed, levels, bounds = self._delayed, self._levels, self._bounds
+        delayed[sub:] = samples
+        # Gain in dB that each sub-block needs, the next block's first one
+        # (the lookahead) included
+        np.abs(delayed, out=self._magnitudes)
+        np.max(self._magnitudes.reshape(count + 1, -1), axis=1, out=levels)
+        np.maximum(levels, 1e-9, out=levels)
+        np.log10(levels, out=levels)
+        np.multiply(levels, -20.0, out=levels)
+        levels += self.ceiling
+        np.minimum(levels, 0.0, out=levels)
+        # The gain at each boundary between sub-blocks: low enough for the
+        # sub-blocks on both sides, and rising no faster than the release:
+        # bound[k] = min(bound[k - 1] + release, need[k])
+        np.minimum(levels[:-1], levels[1:], out=bounds[1:])
+        bounds[0] = self._gain
+        bounds -= self._release
+        np.minimum.accumulate(bounds, out=bounds)
+        bounds += self._release
+        np.minimum(bounds, 0.0, out=bounds)
+        self._gain = bounds[count]
+        np.multiply(bounds, 1 / 20, out=bounds)
+        np.power(10.0, bounds, out=bounds)
+        # (Broadcasting ufuncs would allocate buffers; matmul does not)
+        np.matmul(self._ends, self._ramps, out=self._gains.reshape(count, -1))
+        np.multiply(delayed[:-sub].reshape(self._gains.shape), self._gains,
+                    out=samples.reshape(self._gains.shape))
+        delayed[:sub] = delayed[-sub:]
+
+
+class DspChain:
+    """The equalizer, then the limiter, on mixer PCM in place.
+
+    process() takes (frames, channels) arrays of the mixer's sample format,
+    frames a multiple of block_frames. Without bands, nothing is done: the
+    limiter is there to catch what the bands boost.
+    """
+
+    def __init__(self, rate, channels, dtype, block_frames=BLOCK_FRAMES, bands=(),
+                 ceiling=LIMITER_CEILING):
+        self.block_frames = block_frames
+        self.dtype = np.dtype(dtype)
+        # Integer samples are scaled to [-1, 1)
+        self._scale = 2.0 ** (8 * self.dtype.itemsize - 1) if self.dtype.kind == 'i' else 1.0
+        self._work = np.zeros((block_frames, channels))
+        self.equalizer = Equalizer(rate, channels, block_frames, bands)
+        self.limiter = Limiter(rate, channels, block_frames, ceiling)
+
+    @property
+    def active(self):
+        return bool(self.equalizer.bands)
+
+    def set_bands(self, bands):
+        was_active = self.active
+        self.equalizer.set_bands(bands)
+        if not was_active:
+            self.limiter.reset()
+
+    def reset(self):
+        self.equalizer.reset()
+        self.limiter.reset()
+
+    def process(self, pcm):
+        if not self.active:
+            return
+        # Mono arrays are one-dimensional
+        pcm = pcm.reshape(len(pcm), -1)
+        work = self._work
+        for first in range(0, len(pcm), self.block_frames):
+            block = pcm[first:first + self.block_frames]
+            np.copyto(work, block)
+            work *= 1 / self._scale
+            self.equalizer.process(work)
+            self.limiter.process(work)
+            if self.dtype.kind == 'i':
+                np.multiply(work, self._scale, out=work)
+                np.rint(work, out=work)
+                np.clip(work, -self._scale, self._scale - 1, out=work)
+            np.copyto(block, work, casting='unsafe')
+
+
+class Crossfade:
+    """Crossfades consecutive tracks, fed their PCM a piece at a time.
+
+    feed() holds back the last `seconds` of the track being fed; when it
+    ends, next_track() fades that out under the start of the next one
+    (equal power), or flush() returns it as it is.
+    """
+
+    def __init__(self, rate, seconds=0.0):
+        self.rate = rate
+        self.frames = 0
+        self._held = None
+        self._tail = None
+        self._done = 0
+        self._fades = None
+        self.set_seconds(seconds)
+
+    def set_seconds(self, seconds):
+        # From the next track on
+        self._next_frames = max(int(seconds * self.rate), 0)
+
+    def reset(self):
+        self._held = self._tail = None
+
+    @property
+    def holding(self):
+        # Whether flush() has anything to return
+        return (self._held is not None and len(self._held) > 0) or \
+            (self._tail is not None and self._done < len(self._tail))
+
+    def feed(self, piece):
+        if self._held is None:
+            self.frames = self._next_frames
+        if self._tail is not None and self._done < len(self._tail):
+            piece = self._mix(piece)
+        if not self.frames:
+            return piece
+        if self._held is not None:
+            piece = np.concatenate((self._held, piece))
+        self._held = piece[-self.frames:]
+        return piece[:-self.frames]
+
+    def next_track(self):
+        # The track ended and the next one starts
+        self._tail, self._done = self.flush(), 0
+        if self._tail is not None:
+            t = (np.arange(len(self._tail)) + 0.5) / len(self._tail) * (math.pi / 2)
+            self._fades = np.cos(t)[:, None], np.sin(t)[:, None]
+
+    def replace_next(self):
+        # The next track was replaced by another one: fade into that instead
+        self._held, self._done = None, 0
+
+    def flush(self):
+        # The track ended and nothing follows: what was held back, and the
+        # rest of a fade into a track shorter than the fade
+        rest = [self._held] if self._held is not None else []
+        if self._tail is not None and self._done < len(self._tail):
+            rest.append(self._mix(np.zeros_like(self._tail[self._done:])))
+        self._held = self._tail = None
+        return np.concatenate(rest) if rest else None
+
+    def _mix(self, piece):
+        count = min(len(piece), len(self._tail) - self._done)
+        part = slice(self._done, self._done + count)
+        fade_out, fade_in = self._fades
+        mixed = self._tail[part] * fade_out[part] + piece[:count] * fade_in[part]
+        if piece.dtype.kind == 'i':
+            info = np.iinfo(piece.dtype)
+            mixed = np.clip(np.rint(mixed), info.min, info.max)
+        piece = piece.copy()
+        piece[:count] = mixed
+        self._done += count
+        return piece
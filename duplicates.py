@@ -0,0 +1,251 @@
+"""Duplicate detection by audio payload.
+
+Two files are duplicates when their audio bytes are identical, whatever
+their names and tags: an MP3 is compared without its ID3v2, ID3v1 and APE
+tags, a WAV file by its data chunk only.
+
+Finding them in a large library reads as little as possible:
+
+    1. the payload range of every file, from its first and last bytes
+    2. only files whose payload length is shared with another file are
+       hashed, through memory-mapped reads
+    3. ranges and hashes are cached in the metadata cache by size and
+       modification time, so a re-run only opens new or changed files
+
+Both passes run on a thread pool (hashlib and file reads release the GIL),
+sized like the library import for the filesystem the files are on.
+"""
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+import metrics
+import http_stream
+from seek_index import id3v2_size
+from library_scanner import default_workers, iter_audio_files
+
+HASH_CHUNK = 1 << 20
+# Files between two progress reports
+PROGRESS_INTERVAL = 500
+# Pending results handed to the metadata cache at once
+STORE_BATCH = 1000
+
+
+def _wav_data_range(f, size):
+    # (start, end) of the data chunk, or the whole file if there is none
+    position = 12
+    while position + 8 <= size:
+        f.seek(position)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'data':
+            return position + 8, min(position + 8 + chunk_size, size)
+        position += 8 + chunk_size + (chunk_size & 1)
+    return 0, size
+
+
+def payload_range(file_path):
+    """Return (start, end) of the audio bytes of a file: everything but
+    its tags. Only the first and last few bytes are read."""
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(12)
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _wav_data_range(f, size)
+
+        start = min(id3v2_size(head), size)
+        end = size
+        # An ID3v1 tag occupies the last 128 bytes
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+        # An APE tag ends with a 32-byte footer, before any ID3v1 tag
+        if end - start >= 32:
+            f.seek(end - 32)
+            footer = f.read(32)
+            if footer[:8] == b'APETAGEX':
+                tag_size, _, flags = struct.unpack('<III', footer[12:24])
+                # The size counts the footer but not the optional header
+                end -= tag_size + (32 if flags & 0x80000000 else 0)
+        return start, max(end, start)
+
+
+def payload_hash(file_path, start, end):
+    # BLAKE2b of bytes start..end, read through a memory map
+    digest = hashlib.blake2b(digest_size=16)
+    if end > start:
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(data)
+            try:
+                for offset in range(start, end, HASH_CHUNK):
+                    digest.update(view[offset:min(offset + HASH_CHUNK, end)])
+            finally:
+                view.release()
+    return digest.digest()
+
+
+def find_duplicates(paths, metadata_cache, workers=None, progress=None, cancelled=None):
+    """Return groups of files with identical audio, each a sorted list of
+    two or more paths, ordered by their first path.
+
+    progress(stage, done, total) is called from worker threads every few
+    hundred files, with stage 'reading' while payload ranges are read and
+    'hashing' while candidates are hashed. When cancelled (a
+    threading.Event) is set, the scan stops early and returns the groups
+    found so far. URLs are left out: hashing them would download them.
+    """
+    paths = [path for path in dict.fromkeys(paths) if not http_stream.is_url(path)]
+    if workers is None:
+        workers = default_workers(os.path.dirname(paths[0])) if paths else 1
+    cancelled = cancelled or threading.Event()
+    cached = metadata_cache.payload_records()
+    to_store = []
+    store_lock = threading.Lock()
+    stage, done = 'reading', 0
+
+    def report():
+        nonlocal done
+        with store_lock:
+            done += 1
+            if progress is not None and (done % PROGRESS_INTERVAL == 0 or done == total):
+                progress(stage, done, total)
+
+    def stored(record):
+        with store_lock:
+            to_store.append(record)
+            if len(to_store) >= STORE_BATCH:
+                metadata_cache.store_payloads(to_store)
+                to_store.clear()
+
+    def check(path):
+        # (path, size, mtime_ns, start, end, hash or None), or None
+        if cancelled.is_set():
+            return None
+        try:
+            stat = os.stat(path)
+            record = cached.get(path)
+            if record is not None and record[:2] == (stat.st_size, stat.st_mtime_ns):
+                return (path, *record)
+            start, end = payload_range(path)
+            metrics.count('duplicate_ranges_read')
+        except OSError as e:
+            print(f"Error checking {path} for duplicates: {e}")
+            return None
+        finally:
+            report()
+        record = (path, stat.st_size, stat.st_mtime_ns, start, end, None)
+        stored(record)
+        return record
+
+    def hashed(record):
+        path, size, mtime_ns, start, end, digest = record
+        if digest is None and not cancelled.is_set():
+            try:
+                digest = payload_hash(path, start, end)
+            except (OSError, ValueError) as e:
+                print(f"Error hashing {path}: {e}")
+            else:
+                metrics.count('duplicate_files_hashed')
+                metrics.count('duplicate_bytes_hashed', end - start)
+                record = (path, size, mtime_ns, start, end, digest)
+                stored(record)
+        report()
+        return record
+
+    total = len(paths)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        records = [record for record in pool.map(check, paths) if record is not None]
+
+        # Only payloads of the same length can be identical
+        by_length = defaultdict(list)
+        for record in records:
+            if record[4] > record[3]:
+                by_length[record[4] - record[3]].append(record)
+        candidates = [record for group in by_length.values() if len(group) > 1
+                      for record in group]
+        stage, done, total = 'hashing', 0, len(candidates)
+        records = list(pool.map(hashed, candidates))
+
+    if to_store:
+        metadata_cache.store_payloads(to_store)
+
+    by_hash = defaultdict(list)
+    for path, _, _, start, end, digest in records:
+        if digest is not None:
+            by_hash[end - start, digest].append(path)
+    return sorted(sorted(group) for group in by_hash.values() if len(group) > 1)
+
+
+class DuplicateScanThread(QThread):
+    """Find duplicate tracks of a playlist off the GUI thread.
+
+    Reports groups of track ids (TrackStore.ids), each in store order:
+    tracks of files with identical audio, and tracks that hold the same
+    path more than once.
+    """
+
+    progress = pyqtSignal(str, int, int)    # stage, files done, files in this stage
+    scan_finished = pyqtSignal(list, bool)  # groups of track ids, cancelled
+
+    def __init__(self, store, metadata_cache, workers=None, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.metadata_cache = metadata_cache
+        self.workers = workers
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        # Tracks may be removed on the GUI thread while this runs (by the
+        # folder watcher): read a snapshot and report ids, not rows
+        store = self.store.snapshot()
+        rows_by_path = defaultdict(list)
+        for row in range(len(store)):
+            rows_by_path[store.path(row)].append(row)
+
+        groups = find_duplicates(rows_by_path, self.metadata_cache, self.workers,
+                                 progress=self.progress.emit, cancelled=self._cancelled)
+        grouped = set()
+        row_groups = []
+        for paths in groups:
+            grouped.update(paths)
+            row_groups.append(sorted(row for path in paths for row in rows_by_path[path]))
+        row_groups += [rows for path, rows in rows_by_path.items()
+                       if len(rows) > 1 and path not in grouped]
+        row_groups.sort()
+        id_groups = [[store.ids[row] for row in rows] for rows in row_groups]
+        self.scan_finished.emit(id_groups, self._cancelled.is_set())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from metadata_cache import MetadataCache, CACHE_DIR
+
+    parser = argparse.ArgumentParser(description="List audio files with identical audio")
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    cache = MetadataCache(args.cache_dir)
+    files = [path for folder in args.folders for path in iter_audio_files(folder)]
+    groups = find_duplicates(files, cache, args.workers)
+    for group in groups:
+        print('\n'.join(group), end='\n\n')
+    extra = sum(len(group) - 1 for group in groups)
+    print(f"{len(groups)} groups of duplicates, {extra} extra copies among {len(files)} files")
+    cache.close()
+    sys.exit(0)
@@ -0,0 +1,680 @@
+"""HTTP streaming: tracks played and read from an HTTP file server.
+
+A playlist entry may be an http:// or https:// URL instead of a path.
+open_file(), stat() and fstat() stand in for open(), os.stat() and
+os.fstat() wherever tracks are read (tags, the seek index, album art and
+the mixer), so the rest of the player handles URLs like files:
+
+    ranges      bytes are fetched with Range requests on keep-alive
+                connections from a shared pool, so reading the tags or
+                the cover of a track costs a few kilobytes, not the file
+    streaming   the mixer reads a track while it downloads: a download
+                runs ahead of playback from where it reads, and reads only
+                wait for bytes that are not there yet
+    cache       downloaded bytes go into a sparse file per URL, with the
+                ranges it holds in an index; replays read from it, and the
+                least recently used URLs are dropped once the cache holds
+                more than max_bytes (STREAM_CACHE_BYTES by default)
+
+Cached URLs are checked against the server (ETag or Last-Modified) at most
+every VALIDATE_SECONDS; a changed file is downloaded again. When the
+server cannot be reached, what is cached still plays.
+"""
+import io
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import metrics
+
+# Default size limit of the downloaded bytes kept on disk
+STREAM_CACHE_BYTES = 2 * 1024 ** 3
+# Keep-alive connections kept open per server
+POOL_SIZE = 8
+# Bytes read at once from a download
+CHUNK_SIZE = 64 * 1024
+# A read that misses fetches at least this much (tags are read in small
+# windows; one request brings in the next few)
+FETCH_SIZE = 64 * 1024
+# First bytes fetched from a new URL, with its length and validator
+PROBE_SIZE = 16 * 1024
+# Reads this close to the end of a streamed track (ID3v1, APE and Lyrics
+# tags the mixer looks for) are fetched on their own rather than moving
+# the download there
+TAIL_SIZE = 64 * 1024
+# How far ahead of a download a read waits for it rather than moving it
+STREAM_WINDOW = 512 * 1024
+# Seconds to connect, and to wait for data from a connection
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 15.0
+# How long a cached URL is trusted before it is checked again
+VALIDATE_SECONDS = 3600
+
+# What stat() returns for a URL: its length, and a number that changes
+# when its ETag or Last-Modified does
+RemoteStat = namedtuple('RemoteStat', ['st_size', 'st_mtime_ns'])
+
+
+def is_url(path):
+    return path.startswith(('http://', 'https://'))
+
+
+def name_hint(url):
+    # The file name of a URL, which tells decoders its format
+    from urllib.parse import urlsplit
+    return os.path.basename(urlsplit(url).path)
+
+
+class _Ranges:
+    """Sorted, disjoint byte ranges [start, end)."""
+
+    def __init__(self, pairs=()):
+        self.starts = []
+        self.ends = []
+        self.total = 0
+        for start, end in pairs:
+            self.add(start, end)
+
+    def add(self, start, end):
+        # Returns how many bytes were not held before
+        if start >= end:
+            return 0
+        # Ranges that overlap or touch [start, end) are merged into it
+        first = bisect_left(self.ends, start)
+        last = bisect_right(self.starts, end)
+        held = 0
+        if first < last:
+            held = sum(self.ends[i] - self.starts[i] for i in range(first, last))
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        added = end - start - held
+        self.total += added
+        return added
+
+    def end_of(self, position):
+        # End of the range holding `position`, or `position` when missing
+        i = bisect_right(self.starts, position) - 1
+        if i >= 0 and self.ends[i] > position:
+            return self.ends[i]
+        return position
+
+    def gap(self, position, size):
+        # First missing [start, end) at or after `position`, else from the
+        # start; None when all `size` bytes are held
+        for origin in (position, 0):
+            start = self.end_of(origin)
+            if start < size:
+                i = bisect_right(self.starts, start)
+                return start, self.starts[i] if i < len(self.starts) else size
+        return None
+
+    def pairs(self):
+        return list(zip(self.starts, self.ends))
+
+
+class _Entry:
+    # A URL's cached bytes and the readers and download using them
+    def __init__(self, url, path, size, validator):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.validator = validator
+        self.ranges = _Ranges()
+        self.checked = 0.0
+        self.used = 0.0
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.streamers = 0
+        self.file = None
+        self.downloading = False
+        self.cursor = 0
+        self.restart_at = None
+        self.error = None
+
+    @property
+    def mtime_ns(self):
+        if not self.validator:
+            return 0
+        return int.from_bytes(hashlib.sha1(self.validator.encode()).digest()[:7], 'big')
+
+
+def _create_file(path, size):
+    # Sparse: only the downloaded ranges take disk space
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def _validator(response):
+    return response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+
+def _length(response):
+    # Full length of the file a response is (part of), or None
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    return int(length) if response.status_code == 200 and length is not None else None
+
+
+def _offset(response):
+    # Where the body of a response starts in the file: servers that
+    # ignore Range send all of it
+    if response.status_code == 206:
+        return int(response.headers['Content-Range'].split()[1].split('-')[0])
+    return 0
+
+
+class HttpStreams:
+    """URLs opened through a pool of keep-alive connections and an on-disk
+    cache of their bytes in `cache_dir`.
+
+    open() returns a RemoteFile; with stream=True (the mixer) it downloads
+    the whole file in the background, otherwise (tags, art) only the
+    ranges read are fetched.
+    """
+
+    def __init__(self, cache_dir, max_bytes=STREAM_CACHE_BYTES, pool_size=POOL_SIZE):
+        # Imported here: only players with URLs in their playlist pay for it
+        import requests
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._closed = False
+        self._db = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite3'),
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS streams (
+                url TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                validator TEXT,
+                ranges TEXT NOT NULL,
+                held INTEGER NOT NULL,
+                used REAL NOT NULL,
+                checked REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+        self._held = self._db.execute("SELECT COALESCE(SUM(held), 0) FROM streams").fetchone()[0]
+        self._remove_orphans()
+
+    def _data_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def _remove_orphans(self):
+        # Data files left without an index row by a crash
+        known = {os.path.basename(self._data_path(url))
+                 for url, in self._db.execute("SELECT url FROM streams")}
+        for name in os.listdir(self.cache_dir):
+            if len(name) == 40 and name not in known:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    # Opening
+
+    def open(self, url, stream=False):
+        entry = self._entry(url)
+        return RemoteFile(self, entry, stream)
+
+    def stat(self, url, fetch=True):
+        """RemoteStat of a URL. Without `fetch`, only what is cached is
+        used and unknown URLs raise FileNotFoundError."""
+        entry = self._entry(url, fetch)
+        return RemoteStat(entry.size, entry.mtime_ns)
+
+    def cached_bytes(self, url):
+        # Bytes of a URL held in the cache, without any request
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                row = self._db.execute("SELECT held FROM streams WHERE url = ?",
+                                       (url,)).fetchone()
+                return row[0] if row else 0
+        with entry.condition:
+            return entry.ranges.total
+
+    def _entry(self, url, fetch=True):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                entry = self._load_entry(url)
+        if entry is None:
+            if not fetch:
+                raise FileNotFoundError(f"{url} is not cached")
+            entry = self._probe(url)
+        elif fetch and time.time() - entry.checked > VALIDATE_SECONDS:
+            self._validate(entry)
+        return entry
+
+    def _load_entry(self, url):
+        # Called with the lock held
+        row = self._db.execute(
+            "SELECT size, validator, ranges, held, checked FROM streams WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        size, validator, ranges, held, checked = row
+        entry = _Entry(url, self._data_path(url), size, validator)
+        entry.checked = checked
+        if os.path.exists(entry.path):
+            entry.ranges = _Ranges(json.loads(ranges))
+        else:
+            _create_file(entry.path, size)
+            self._held -= held
+        self._entries[url] = entry
+        return entry
+
+    def _probe(self, url):
+        # A new URL: one request brings its length, validator and first bytes
+        with metrics.span('stream_probe'):
+            response = self._get(url, 0, PROBE_SIZE)
+            with response:
+                size = _length(response)
+                if size is None:
+                    raise OSError(f"{url} has no length (live streams are not supported)")
+                entry = _Entry(url, self._data_path(url), size, _validator(response))
+                entry.checked = time.time()
+                with self._lock:
+                    known = self._entries.get(url)
+                    if known is not None:
+                        # Another thread got there first
+                        return known
+                    _create_file(entry.path, size)
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO streams "
+                        "(url, size, validator, ranges, held, used, checked) "
+                        "VALUES (?, ?, ?, '[]', 0, ?, ?)",
+                        (url, size, entry.validator, entry.checked, entry.checked))
+                    self._db.commit()
+                    self._entries[url] = entry
+                self._receive(entry, response, PROBE_SIZE)
+        self._save(entry)
+        return entry
+
+    def _validate(self, entry):
+        # Check a cached URL against the server; a changed file starts over
+        headers = {}
+        if entry.validator:
+            weak_or_strong = entry.validator.startswith(('"', 'W/'))
+            headers['If-None-Match' if weak_or_strong else 'If-Modified-Since'] = entry.validator
+        try:
+            response = self.session.head(url=entry.url, headers=headers, allow_redirects=True,
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            metrics.count('stream_requests')
+            if response.status_code != 304:
+                response.raise_for_status()
+                size = _length(response)
+                validator = _validator(response)
+                if (size, validator) != (entry.size, entry.validator) and size is not None:
+                    self._reset(entry, size, validator)
+        except OSError as e:
+            # Offline: play what is cached, and ask again later
+            print(f"Error checking {entry.url}: {e}")
+        entry.checked = time.time()
+        with self._lock:
+            self._db.execute("UPDATE streams SET checked = ? WHERE url = ?",
+                             (entry.checked, entry.url))
+            self._db.commit()
+
+    def _reset(self, entry, size, validator):
+        with entry.condition:
+            dropped = entry.ranges.total
+            entry.ranges = _Ranges()
+            entry.size = size
+            entry.validator = validator
+            if entry.file is not None:
+                entry.file.truncate(0)
+                entry.file.truncate(size)
+            else:
+                _create_file(entry.path, size)
+        with self._lock:
+            self._held -= dropped
+            self._db.execute(
+                "UPDATE streams SET size = ?, validator = ?, ranges = '[]', held = 0 "
+                "WHERE url = ?", (size, validator, entry.url))
+            self._db.commit()
+
+    # Reading
+
+    def _get(self, url, start, end):
+        # A streamed response for bytes [start, end)
+        response = self.session.get(url, headers={'Range': f"bytes={start}-{end - 1}"},
+                                    stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        metrics.count('stream_requests')
+        if response.status_code not in (200, 206):
+            response.close()
+            response.raise_for_status()
+            raise OSError(f"HTTP {response.status_code} for {url}")
+        return response
+
+    def _receive(self, entry, response, end, download=False):
+        # Store a response's body up to `end`; returns where it stopped.
+        # Downloads also stop when a reader wants them elsewhere, or when
+        # no one plays the track any more
+        offset = _offset(response)
+        start = offset
+        for chunk in response.iter_content(CHUNK_SIZE):
+            chunk = chunk[:entry.size - offset]
+            if chunk:
+                self._write(entry, offset, chunk)
+                offset += len(chunk)
+            if offset >= min(end, entry.size):
+                break
+            if download:
+                entry.cursor = offset
+                if entry.restart_at is not None or not entry.streamers:
+                    break
+        if offset == start and start < min(end, entry.size):
+            raise OSError(f"{entry.url} sent no data at {start}")
+        return offset
+
+    def _write(self, entry, offset, data):
+        with entry.condition:
+            if self._closed:
+                return
+            if entry.file is None:
+                entry.file = open(entry.path, 'r+b', buffering=0)
+            entry.file.seek(offset)
+            entry.file.write(data)
+            added = entry.ranges.add(offset, offset + len(data))
+            entry.condition.notify_all()
+        with self._lock:
+            self._held += added
+        metrics.count('stream_bytes_downloaded', len(data))
+
+    def _read_range(self, entry, start, end, stream):
+        # Block until bytes [start, end) are cached
+        with entry.condition:
+            if entry.ranges.end_of(start) >= end:
+                metrics.count('stream_bytes_cached', end - start)
+                return
+        metrics.count('stream_bytes_fetched', end - start)
+        if stream and start < entry.size - TAIL_SIZE:
+            self._wait_for_download(entry, start, end)
+            return
+        with metrics.span('stream_fetch'):
+            while True:
+                with entry.condition:
+                    first = entry.ranges.end_of(start)
+                if first >= end:
+                    return
+                last = min(entry.size, max(end, first + FETCH_SIZE))
+                with self._get(entry.url, first, last) as response:
+                    self._receive(entry, response, last)
+                self._save(entry)
+
+    def _wait_for_download(self, entry, start, end):
+        with entry.condition:
+            while True:
+                first = entry.ranges.end_of(start)
+                if first >= end:
+                    return
+                if entry.error is not None:
+                    error, entry.error = entry.error, None
+                    raise error
+                if not (entry.downloading and
+                        entry.cursor <= first <= entry.cursor + STREAM_WINDOW):
+                    # Not coming soon: move the download here
+                    self._start_download(entry, start)
+                if not entry.condition.wait(READ_TIMEOUT * 2):
+                    raise TimeoutError(f"{entry.url} stalled at {start}")
+
+    def _start_download(self, entry, position):
+        with entry.condition:
+            entry.restart_at = position
+            if not entry.downloading:
+                entry.downloading = True
+                entry.error = None
+                entry.cursor = position
+                threading.Thread(target=self._download, args=(entry,),
+                                 name='stream-download', daemon=True).start()
+
+    def _download(self, entry):
+        # Fill the gaps of a streamed track, from where it is read on, then
+        # from its start, while someone plays it
+        position = 0
+        try:
+            while True:
+                with entry.condition:
+                    if entry.restart_at is not None:
+                        position, entry.restart_at = entry.restart_at, None
+                    gap = entry.ranges.gap(position, entry.size) if entry.streamers else None
+                    if gap is None:
+                        break
+                    entry.cursor = gap[0]
+                with self._get(entry.url, *gap) as response:
+                    position = self._receive(entry, response, gap[1], download=True)
+        except OSError as e:
+            print(f"Error downloading {entry.url}: {e}")
+            with entry.condition:
+                entry.error = e
+        finally:
+            with entry.condition:
+                entry.downloading = False
+                entry.condition.notify_all()
+            self._save(entry)
+
+    def _opened(self, entry, stream):
+        with entry.condition:
+            entry.readers += 1
+            entry.streamers += stream
+        entry.used = time.time()
+        if stream:
+            self._start_download(entry, 0)
+
+    def _released(self, entry, stream):
+        # May run on the mixer's thread, when it drops a track: no waiting
+        # on the index here
+        with entry.condition:
+            entry.readers -= 1
+            entry.streamers -= stream
+
+    # Index and eviction
+
+    def _save(self, entry):
+        if self._closed:
+            return
+        with entry.condition:
+            ranges = json.dumps(entry.ranges.pairs())
+            held = entry.ranges.total
+        with self._lock:
+            self._db.execute("UPDATE streams SET ranges = ?, held = ?, used = ? WHERE url = ?",
+                             (ranges, held, entry.used, entry.url))
+            self._db.commit()
+        self._evict()
+
+    def _evict(self):
+        # Drop the least recently used URLs until the cache fits; URLs
+        # being read or downloaded are kept
+        with self._lock:
+            if self._held <= self.max_bytes:
+                return
+            rows = self._db.execute("SELECT url, held FROM streams ORDER BY used").fetchall()
+            for url, held in rows:
+                if self._held <= self.max_bytes:
+                    break
+                entry = self._entries.get(url)
+                if entry is not None:
+                    if entry.readers or entry.downloading:
+                        continue
+                    held = entry.ranges.total
+                    if entry.file is not None:
+                        entry.file.close()
+                    del self._entries[url]
+                try:
+                    os.remove(self._data_path(url))
+                except OSError:
+                    pass
+                self._db.execute("DELETE FROM streams WHERE url = ?", (url,))
+                self._held -= held
+                metrics.count('stream_cache_evictions')
+            self._db.commit()
+
+    def clear(self):
+        # Drop every cached URL that is not in use
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        self._evict()
+        self.max_bytes = max_bytes
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            with entry.condition:
+                # Downloads stop at their next chunk
+                entry.streamers = 0
+            self._save(entry)
+        with self._lock:
+            self._closed = True
+            for entry in entries:
+                if entry.file is not None:
+                    entry.file.close()
+                    entry.file = None
+            self._db.close()
+        self.session.close()
+
+
+class RemoteFile(io.RawIOBase):
+    """A URL opened for reading (see HttpStreams.open); reads block until
+    their bytes are downloaded."""
+
+    def __init__(self, streams, entry, stream=False):
+        super().__init__()
+        self._file = None
+        self.name = entry.url
+        self.size = entry.size
+        self._streams = streams
+        self._entry = entry
+        self._stream = stream
+        self._position = 0
+        streams._opened(entry, stream)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        self._streams._read_range(self._entry, self._position, end, self._stream)
+        if self._file is None:
+            self._file = open(self._entry.path, 'rb', buffering=0)
+        self._file.seek(self._position)
+        count = self._file.readinto(memoryview(buffer)[:end - self._position])
+        self._position += count
+        return count
+
+    def stat(self):
+        return RemoteStat(self.size, self._entry.mtime_ns)
+
+    def close(self):
+        if not self.closed:
+            if self._file is not None:
+                self._file.close()
+            self._streams._released(self._entry, self._stream)
+        super().close()
+
+
+# The player's streams, in the metadata cache directory
+
+_streams = None
+_streams_lock = threading.Lock()
+
+
+def configure(cache_dir=None, max_bytes=STREAM_CACHE_BYTES):
+    """Set up where URLs are cached (by default the 'streams' folder of
+    the metadata cache) and how much is kept; returns the HttpStreams."""
+    global _streams
+    if cache_dir is None:
+        from metadata_cache import CACHE_DIR
+        cache_dir = os.path.join(CACHE_DIR, 'streams')
+    with _streams_lock:
+        if _streams is not None:
+            _streams.close()
+        _streams = HttpStreams(cache_dir, max_bytes)
+        return _streams
+
+
+def streams():
+    with _streams_lock:
+        configured = _streams
+    return configured if configured is not None else configure()
+
+
+def close():
+    global _streams
+    with _streams_lock:
+        if _streams is not None:
+            _streams.close()
+            _streams = None
+
+
+def open_file(path, stream=False):
+    """open(path, 'rb', buffering=0), or a RemoteFile for a URL; `stream`
+    downloads all of it in the background, for the mixer."""
+    if is_url(path):
+        return streams().open(path, stream)
+    return open(path, 'rb', buffering=0)
+
+
+def stat(path, fetch=True):
+    # os.stat(), or the RemoteStat of a URL (see HttpStreams.stat)
+    if is_url(path):
+        return streams().stat(path, fetch)
+    return os.stat(path)
+
+
+def fstat(f):
+    # os.fstat() of a file opened with open_file()
+    if isinstance(f, RemoteFile):
+        return f.stat()
+    return os.fstat(f.fileno())
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Fetch URLs into the cache, e.g. to check a server
+    for url in sys.argv[1:]:
+        start = time.perf_counter()
+        with open_file(url, stream=True) as f:
+            while f.read(CHUNK_SIZE):
+                pass
+        print(f"{url}: {f.size} bytes in {time.perf_counter() - start:.2f} s")
+    close()
@@ -0,0 +1,170 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+import http_stream
+from metadata_cache import read_metadata
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav')
+
+# Filesystems where latency, not CPU, bounds tag reading
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb', 'smb2', 'smbfs', 'sshfs',
+                       'fuse.sshfs', 'afpfs', '9p', 'davfs', 'fuse.rclone'}
+
+
+def iter_audio_files(root, recursive=True, extensions=AUDIO_EXTENSIONS):
+    # Stream matching files with os.scandir instead of building the full listing
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                subdirs = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(extensions):
+                            yield entry.path
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+            continue
+        # Visit subdirectories in name order, like a file manager would
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def filesystem_type(path):
+    # Longest mount point prefix from /proc/mounts (Linux only)
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) >= len(best):
+                        best, fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+def default_workers(path):
+    cores = os.cpu_count() or 1
+    if http_stream.is_url(path) or filesystem_type(path) in NETWORK_FILESYSTEMS:
+        # Keep many requests in flight to hide the round-trip latency
+        return max(16, cores * 4)
+    return cores
+
+
+class LibraryImportThread(QThread):
+    """Scan a folder and read tags in a worker pool, off the GUI thread.
+
+    Results are emitted in batches of (path, TrackMetadata) so the playlist
+    can grow progressively while the import runs. Given `paths` (e.g.
+    URLs), those are read instead of scanning a folder.
+    """
+
+    batch_ready = pyqtSignal(list)
+    progress = pyqtSignal(int, int)     # files found, files processed
+    import_finished = pyqtSignal(int, bool)  # files imported, cancelled
+
+    BATCH_SIZE = 500
+    BATCH_INTERVAL = 0.1
+
+    def __init__(self, root, metadata_cache, recursive=True, workers=None, parent=None,
+                 paths=None):
+        super().__init__(parent)
+        self.root = root
+        self.paths = paths
+        self.metadata_cache = metadata_cache
+        self.recursive = recursive
+        self.workers = workers or default_workers(paths[0] if paths else root)
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _read(self, path):
+        try:
+            stat = http_stream.stat(path)
+            metadata = self.metadata_cache.lookup(path, stat)
+            if metadata is not None:
+                return path, metadata, None
+            return path, read_metadata(path, self.metadata_cache.art_dir), stat
+        except Exception as e:
+            print(f"Error reading metadata for {path}: {e}")
+            return path, None, None
+
+    def run(self):
+        found = processed = 0
+        batch = []
+        to_store = []
+        last_emit = time.monotonic()
+        max_in_flight = self.workers * 4
+        pending = set()
+
+        def collect(done):
+            nonlocal processed
+            for future in done:
+                path, metadata, stat = future.result()
+                processed += 1
+                if metadata is None:
+                    continue
+                batch.append((path, metadata))
+                if stat is not None:
+                    to_store.append((metadata, stat))
+
+        def flush(force=False):
+            nonlocal last_emit
+            now = time.monotonic()
+            if batch and (force or len(batch) >= self.BATCH_SIZE
+                          or now - last_emit >= self.BATCH_INTERVAL):
+                if to_store:
+                    self.metadata_cache.store_many(to_store)
+                    to_store.clear()
+                self.batch_ready.emit(list(batch))
+                batch.clear()
+                self.progress.emit(found, processed)
+                last_emit = now
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            paths = self.paths
+            if paths is None:
+                paths = iter_audio_files(self.root, self.recursive)
+            for path in paths:
+                if self._cancelled.is_set():
+                    break
+                pending.add(pool.submit(self._read, path))
+                found += 1
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                    flush()
+
+            if self._cancelled.is_set():
+                for future in pending:
+                    future.cancel()
+                pending = {future for future in pending if not future.cancelled()}
+
+            while pending:
+                done, pending = wait(pending, timeout=self.BATCH_INTERVAL,
+                                     return_when=FIRST_COMPLETED)
+                collect(done)
+                flush()
+
+        if to_store:
+            self.metadata_cache.store_many(to_store)
+            to_store.clear()
+        flush(force=True)
+        self.progress.emit(found, processed)
+        self.import_finished.emit(processed, self._cancelled.is_set())
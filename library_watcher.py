@@ -0,0 +1,599 @@
+"""Watched library folders, kept in sync with the playlist.
+
+Every directory under a watched folder is watched through inotify on
+Linux, or QFileSystemWatcher elsewhere (which may miss files rewritten in
+place, such as tag edits, until the next start). Events only mark
+directories dirty. Once they pause for DEBOUNCE_MS, or at most
+MAX_DELAY_MS into a storm such as a 10k-file copy, the dirty directories
+are synced in one batch on a worker thread and only the difference is
+applied to the playlist:
+
+    added       files no track points to
+    removed     tracks whose file is gone
+    moved       a removed track and an added file with the same size and
+                modification time: the track follows its file and keeps
+                its place, and the cached records are carried over
+    changed     tracks whose file's size or modification time differ from
+                the metadata cache; their tags are read again
+
+Removals are held back until a storm is over (at most REMOVE_DELAY_MS),
+then made at once: removing tracks rebuilds the playlist's columns and
+resets its view, which is worth doing once rather than for every batch.
+
+At startup the same sync runs over every watched folder: a walk that stats
+each file and compares it with the metadata cache, reading the tags of new
+and changed files only. A watched folder that is missing altogether, e.g.
+on an unmounted drive, is left alone rather than emptied.
+"""
+import os
+import sys
+import json
+import time
+import ctypes
+import struct
+import threading
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import (QObject, QThread, QTimer, QSocketNotifier, QFileSystemWatcher,
+                          pyqtSignal)
+
+import metrics
+from metadata_cache import read_metadata
+from library_scanner import AUDIO_EXTENSIONS, default_workers
+from playlist_file import DATA_DIR
+
+WATCHED_FOLDERS_PATH = os.path.join(DATA_DIR, 'watched_folders.json')
+
+# A batch is synced once events pause this long...
+DEBOUNCE_MS = 500
+# ...or this long after the first event it holds, however busy the folder
+MAX_DELAY_MS = 3000
+# Tracks of deleted files are removed when the events stop, or this long
+# after the first of them during a longer storm
+REMOVE_DELAY_MS = 10000
+# New and changed files read between two updates of the playlist
+READ_BATCH = 500
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# IN_CLOSE_WRITE rather than IN_MODIFY: one event per rewritten file, not
+# one per write
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# wd, mask, cookie, length of the name that follows
+_EVENT = struct.Struct('iIII')
+
+# What a sync changes: TrackMetadata of added and changed files, paths of
+# removed ones and (old path, new path) of moved ones
+SyncDelta = namedtuple('SyncDelta', ['added', 'removed', 'moved', 'changed'])
+
+
+def load_watched_folders(file_path=WATCHED_FOLDERS_PATH):
+    # (folders, ignored paths); both empty when nothing was saved
+    try:
+        with open(file_path, encoding='utf-8') as f:
+            data = json.load(f)
+        return list(data.get('folders', [])), set(data.get('ignored', []))
+    except FileNotFoundError:
+        return [], set()
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Error loading watched folders: {e}")
+        return [], set()
+
+
+def save_watched_folders(folders, ignored, file_path=WATCHED_FOLDERS_PATH):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'folders': folders, 'ignored': sorted(ignored)}, f)
+    os.replace(tmp_path, file_path)
+
+
+def _under(path, prefixes):
+    # Whether path is one of the directories or anywhere below them
+    return any(path == prefix or path.startswith(os.path.join(prefix, ''))
+               for prefix in prefixes)
+
+
+def sync(store, metadata_cache, directories, trees, watches, ignored=frozenset(),
+         emit=None, workers=None, cancelled=None):
+    """Compare the tracks of a playlist with the files on disk and report
+    the difference through emit(SyncDelta), from this thread.
+
+    Only the files directly inside `directories` are listed, plus any
+    subdirectory that is not watched yet; `trees` are walked entirely. A
+    directory that no longer exists removes every track under it. Each
+    directory is watched before it is listed, so files created meanwhile
+    are not missed. Removals and moves come first, then added and changed
+    files in batches as their tags are read. Returns the number of files
+    compared.
+    """
+    cancelled = cancelled or threading.Event()
+    disk = {}
+    listed, walked, unreadable = set(), list(trees), []
+    stack = [(directory, False) for directory in directories] + \
+        [(directory, True) for directory in trees]
+    while stack and not cancelled.is_set():
+        directory, walk = stack.pop()
+        if not walk:
+            listed.add(directory)
+        watches.add(directory)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if walk:
+                                stack.append((entry.path, True))
+                            elif not watches.watching(entry.path):
+                                # New here, e.g. copied or moved in
+                                walked.append(entry.path)
+                                stack.append((entry.path, True))
+                        elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                            disk[entry.path] = entry.stat()
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            # Gone: so are the tracks in it
+            continue
+        except OSError as e:
+            # Unreadable for now: its tracks are left alone
+            print(f"Error scanning {directory}: {e}")
+            unreadable.append(directory)
+    if cancelled.is_set():
+        return 0
+    metrics.count('library_sync_files', len(disk))
+
+    # Tracks of the playlist in the same directories, from a snapshot: the
+    # GUI thread may remove tracks meanwhile, so only paths are compared
+    # and the delta is matched to rows again when it is applied
+    store = store.snapshot()
+    prefixes = tuple(os.path.join(directory, '') for directory in walked)
+    listed_dirs = {os.path.join(directory, '') for directory in listed}
+    known = list(store.directory_rows([string for string in list(store.strings)
+                                       if string in listed_dirs or string.startswith(prefixes)]))
+    if unreadable:
+        known = [path for path in known if not _under(os.path.dirname(path), unreadable)]
+    cached = {}
+    for directory in listed:
+        cached.update(metadata_cache.file_stats(directory, recursive=False))
+    for directory in walked:
+        cached.update(metadata_cache.file_stats(directory))
+
+    def key(stat):
+        return stat.st_size, stat.st_mtime_ns
+
+    known_set = set(known)
+    removed = [path for path in known if path not in disk]
+    changed = [path for path in known if path in disk and cached.get(path) != key(disk[path])]
+    added = [path for path in disk if path not in known_set and path not in ignored]
+
+    # A file that disappeared and one that appeared with the same size and
+    # modification time are the same file, renamed or moved
+    gone = defaultdict(list)
+    for path in removed:
+        if path in cached:
+            gone[cached[path]].append(path)
+    moved, new = [], []
+    for path in added:
+        candidates = gone.get(key(disk[path]))
+        if not candidates:
+            new.append(path)
+            continue
+        name = os.path.basename(path)
+        old = next((old for old in candidates if os.path.basename(old) == name), candidates[0])
+        candidates.remove(old)
+        moved.append((old, path))
+    if moved:
+        moved_from = {old for old, _ in moved}
+        removed = [path for path in removed if path not in moved_from]
+        metadata_cache.rename(moved)
+    if emit is not None and (removed or moved):
+        emit(SyncDelta([], removed, moved, []))
+
+    def read(path):
+        stat = disk[path]
+        try:
+            metadata = metadata_cache.lookup(path, stat)
+            if metadata is not None:
+                return metadata, None
+            metrics.count('library_sync_tags_read')
+            return read_metadata(path, metadata_cache.art_dir), stat
+        except Exception as e:
+            # Most likely still being written; its next event retries it
+            print(f"Error reading metadata for {path}: {e}")
+            return None, None
+
+    to_read = [(path, True) for path in new] + [(path, False) for path in changed]
+    if to_read:
+        workers = workers or default_workers(os.path.dirname(to_read[0][0]))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(to_read), READ_BATCH):
+                if cancelled.is_set():
+                    break
+                batch = to_read[start:start + READ_BATCH]
+                results = list(pool.map(read, (path for path, _ in batch)))
+                fresh = [(metadata, stat) for metadata, stat in results if stat is not None]
+                if fresh:
+                    metadata_cache.store_many(fresh)
+                if emit is not None:
+                    emit(SyncDelta(
+                        [metadata for (_, is_new), (metadata, _) in zip(batch, results)
+                         if is_new and metadata is not None],
+                        [], [],
+                        [metadata for (_, is_new), (metadata, _) in zip(batch, results)
+                         if not is_new and metadata is not None]))
+    return len(disk)
+
+
+class _Inotify(QObject):
+    """Directory watches through inotify(7). add() and watching() may be
+    called from any thread; events are read on the GUI thread."""
+
+    def __init__(self, watcher):
+        super().__init__(watcher)
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.watcher = watcher
+        self._lock = threading.Lock()
+        self._paths = {}    # wd: directory
+        self._wds = {}      # directory: wd
+        self._limit_reported = False
+        self._notifier = QSocketNotifier(self.fd, QSocketNotifier.Type.Read, self)
+        self._notifier.activated.connect(self._read)
+
+    def add(self, directory):
+        with self._lock:
+            if directory in self._wds:
+                return
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == 28 and not self._limit_reported:   # ENOSPC
+                self._limit_reported = True
+                print(f"Error watching {directory}: too many watches "
+                      f"(raise fs.inotify.max_user_watches); changes are found at the next start")
+            elif error not in (2, 20, 28):                  # ENOENT, ENOTDIR
+                print(f"Error watching {directory}: {os.strerror(error)}")
+            return
+        with self._lock:
+            # A directory moved within the library keeps its watch
+            self._wds.pop(self._paths.get(wd), None)
+            self._paths[wd] = directory
+            self._wds[directory] = wd
+
+    def watching(self, directory):
+        with self._lock:
+            return directory in self._wds
+
+    def remove_under(self, root):
+        with self._lock:
+            wds = [wd for directory, wd in self._wds.items() if _under(directory, (root,))]
+        for wd in wds:
+            self._rm_watch(self.fd, wd)
+            self._forget(wd)
+
+    def _forget(self, wd):
+        with self._lock:
+            directory = self._paths.pop(wd, None)
+            if directory is not None and self._wds.get(directory) == wd:
+                del self._wds[directory]
+
+    def _read(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print(f"Error reading filesystem events: {e}")
+                return
+            with metrics.span('library_watch_read'):
+                offset = 0
+                while offset + _EVENT.size <= len(data):
+                    wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                    name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                    offset += _EVENT.size + length
+                    self._event(wd, mask, os.fsdecode(name))
+
+    def _event(self, wd, mask, name):
+        metrics.count('library_watch_events')
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped: only a full sync can tell what changed
+            self.watcher._overflowed()
+            return
+        with self._lock:
+            directory = self._paths.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            self._forget(wd)
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Moved directories are watched again under their new path
+            self._rm_watch(self.fd, wd)
+            self._forget(wd)
+            self.watcher._dirty(directory, True)
+        elif mask & IN_ISDIR:
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.watcher._dirty(os.path.join(directory, name), True)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.watcher._dirty(directory, False)
+        elif name.lower().endswith(AUDIO_EXTENSIONS):
+            self.watcher._dirty(directory, False)
+
+    def close(self):
+        self._notifier.setEnabled(False)
+        os.close(self.fd)
+
+
+class _QtWatches(QObject):
+    """Directory watches through QFileSystemWatcher, where inotify is not
+    available. Watches requested from other threads are added on the GUI
+    thread through a queued signal."""
+
+    _add_requested = pyqtSignal(str)
+
+    def __init__(self, watcher):
+        super().__init__(watcher)
+        self.watcher = watcher
+        self._lock = threading.Lock()
+        self._watched = set()
+        self._qt = QFileSystemWatcher(self)
+        self._qt.directoryChanged.connect(self._changed)
+        self._add_requested.connect(self._qt.addPath)
+
+    def add(self, directory):
+        with self._lock:
+            if directory in self._watched:
+                return
+            self._watched.add(directory)
+        self._add_requested.emit(directory)
+
+    def watching(self, directory):
+        with self._lock:
+            return directory in self._watched
+
+    def remove_under(self, root):
+        with self._lock:
+            directories = [directory for directory in self._watched if _under(directory, (root,))]
+            self._watched.difference_update(directories)
+        if directories:
+            self._qt.removePaths(directories)
+
+    def _changed(self, directory):
+        metrics.count('library_watch_events')
+        if os.path.isdir(directory):
+            self.watcher._dirty(directory, False)
+        else:
+            with self._lock:
+                self._watched.discard(directory)
+            self.watcher._dirty(directory, True)
+
+    def close(self):
+        pass
+
+
+class _SyncThread(QThread):
+    delta_ready = pyqtSignal(object)
+
+    def __init__(self, watcher, directories, trees):
+        super().__init__(watcher)
+        self.watcher = watcher
+        self.directories = directories
+        self.trees = trees
+        self.cancelled = threading.Event()
+
+    def run(self):
+        watcher = self.watcher
+        with metrics.span('library_sync'):
+            sync(watcher.model.store, watcher.metadata_cache, self.directories, self.trees,
+                 watcher._watches, frozenset(watcher.ignored), self.delta_ready.emit,
+                 cancelled=self.cancelled)
+
+
+class FolderWatcher(QObject):
+    """Keep the tracks of watched folders in the playlist up to date.
+
+    start() syncs every watched folder once; after that only directories
+    with filesystem events are synced, in debounced batches. Tracks removed
+    from the playlist by hand can be ignore()d, so that syncing does not
+    add them back.
+    """
+
+    # Tracks added, removed, moved and updated so far by the running sync,
+    # and whether it is done
+    synced = pyqtSignal(int, int, int, int, bool)
+
+    def __init__(self, model, metadata_cache, file_path=WATCHED_FOLDERS_PATH, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.metadata_cache = metadata_cache
+        self.file_path = file_path
+        self.folders, self.ignored = load_watched_folders(file_path)
+        try:
+            self._watches = _Inotify(self)
+        except (OSError, AttributeError) as e:
+            print(f"Error starting inotify ({e}); using QFileSystemWatcher")
+            self._watches = _QtWatches(self)
+
+        self._directories = set()
+        self._trees = set()
+        self._first_event = self._last_event = 0.0
+        self._thread = None
+        self._totals = [0, 0, 0, 0]
+        # Paths of deleted files whose tracks are still to be removed
+        self._removed = set()
+        self._removed_since = 0.0
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._flush)
+
+    def start(self):
+        # Catch up with whatever changed while the player was closed
+        self._trees.update(self.folders)
+        self._flush(force=True)
+
+    def watch_folder(self, folder):
+        folder = os.path.abspath(folder)
+        if _under(folder, self.folders):
+            return
+        # A parent of watched folders replaces them
+        self.folders = [root for root in self.folders if not _under(root, (folder,))]
+        self.folders.append(folder)
+        self._save()
+        self._trees.add(folder)
+        self._flush(force=True)
+
+    def unwatch_folder(self, folder):
+        # Its tracks stay in the playlist; they are just no longer synced
+        if folder in self.folders:
+            self.folders.remove(folder)
+            self.ignored = {path for path in self.ignored if not _under(path, (folder,))}
+            self._save()
+            self._watches.remove_under(folder)
+
+    def ignore(self, paths):
+        # Tracks removed by hand: syncs will not add these files back
+        paths = {path for path in paths if _under(os.path.dirname(path), self.folders)}
+        if paths - self.ignored:
+            self.ignored |= paths
+            self._save()
+
+    def _save(self):
+        try:
+            save_watched_folders(self.folders, self.ignored, self.file_path)
+        except OSError as e:
+            print(f"Error saving watched folders: {e}")
+
+    def _dirty(self, directory, tree):
+        # Called for every event: only bookkeeping here
+        now = time.monotonic()
+        if not self._directories and not self._trees:
+            self._first_event = now
+        self._last_event = now
+        (self._trees if tree else self._directories).add(directory)
+        if not self._timer.isActive() and self._thread is None:
+            self._timer.start(DEBOUNCE_MS)
+
+    def _overflowed(self):
+        for folder in self.folders:
+            self._dirty(folder, True)
+
+    def _flush(self, force=False):
+        if self._thread is not None or not (self._directories or self._trees):
+            return
+        if not force:
+            now = time.monotonic()
+            quiet = (now - self._last_event) * 1000
+            waited = (now - self._first_event) * 1000
+            if quiet < DEBOUNCE_MS and waited < MAX_DELAY_MS:
+                # Still busy: wait for a pause, but not past the deadline
+                self._timer.start(int(min(DEBOUNCE_MS - quiet, MAX_DELAY_MS - waited)) + 1)
+                return
+        # Only what is inside watched folders that are there: a folder on an
+        # unmounted drive must not empty the playlist. Trees also cover
+        # their subdirectories
+        roots = [folder for folder in self.folders if os.path.isdir(folder)]
+        trees = {tree for tree in self._trees if _under(tree, roots)}
+        trees = [tree for tree in trees if not _under(os.path.dirname(tree), trees)]
+        directories = [directory for directory in self._directories
+                       if _under(directory, roots) and not _under(directory, trees)]
+        self._directories.clear()
+        self._trees.clear()
+        if not trees and not directories:
+            return
+        metrics.count('library_sync_batches')
+        self._totals = [0, 0, 0, 0]
+        self._thread = _SyncThread(self, directories, trees)
+        self._thread.delta_ready.connect(self._apply)
+        self._thread.finished.connect(self._sync_finished)
+        self._thread.start()
+
+    def _sync_finished(self):
+        self._thread.wait()
+        self._thread = None
+        storm = self._directories or self._trees
+        if not storm or (time.monotonic() - self._removed_since) * 1000 >= REMOVE_DELAY_MS:
+            self._remove_pending()
+        self.synced.emit(*self._totals, True)
+        if storm:
+            # Events that came in while this batch was synced
+            self._timer.start(DEBOUNCE_MS)
+
+    def _apply(self, delta):
+        # Runs on the GUI thread: match paths to the current rows
+        with metrics.span('library_sync_apply'):
+            model = self.model
+            if delta.removed and not self._removed:
+                self._removed_since = time.monotonic()
+            self._removed.update(delta.removed)
+            directories = {os.path.join(os.path.dirname(path), '') for path in
+                           [old for old, _ in delta.moved]
+                           + [metadata.path for metadata in delta.added + delta.changed]}
+            rows = model.store.directory_rows(directories)
+            updated = 0
+            for metadata in delta.changed:
+                for row in rows.get(metadata.path, ()):
+                    model.update_store_track(row, metadata.title, metadata.artist, metadata.album,
+                                             metadata.duration)
+                    updated += 1
+            moved = 0
+            for old, new in delta.moved:
+                for row in rows.get(old, ()):
+                    model.move_track(row, new)
+                    moved += 1
+            added = [(metadata.path, metadata.title, metadata.artist, metadata.album,
+                      metadata.duration) for metadata in delta.added if metadata.path not in rows]
+            model.append_tracks(added)
+            # Files deleted and back again keep their tracks
+            self._removed.difference_update(metadata.path for metadata in delta.added)
+            self._removed.difference_update(new for _, new in delta.moved)
+        totals = (len(added), 0, moved, updated)
+        self._totals = [total + count for total, count in zip(self._totals, totals)]
+        self.synced.emit(*self._totals, False)
+
+    def _remove_pending(self):
+        # The tracks of the files deleted since the last removal, in one go
+        if not self._removed:
+            return
+        with metrics.span('library_sync_apply'):
+            model = self.model
+            rows = model.store.directory_rows(
+                {os.path.join(os.path.dirname(path), '') for path in self._removed})
+            removed = [row for path in self._removed for row in rows.get(path, ())]
+            self._removed.clear()
+            model.remove_tracks(removed)
+        metrics.count('library_sync_removals')
+        self._totals[1] += len(removed)
+
+    def close(self):
+        self._timer.stop()
+        if self._thread is not None:
+            self._thread.cancelled.set()
+            self._thread.wait()
+        self._remove_pending()
+        self._watches.close()
@@ -0,0 +1,445 @@
+"""Loudness analysis (EBU R128 / ITU-R BS.1770) and ReplayGain 2.0 gains.
+
+Tracks are decoded and measured in worker processes; files that already
+carry ReplayGain tags are not decoded at all. The measurement streams the
+audio in chunks of about a minute, so memory stays bounded on long mixes:
+the K-weighting filter is applied as an FFT convolution with its impulse
+response, and the gating blocks are built from 100 ms mean squares.
+
+Results are cached per file in the metadata cache. Gains are relative to
+the ReplayGain 2.0 reference of -18 LUFS.
+"""
+import io
+import os
+import sys
+import math
+import wave
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import numpy as np
+
+import metrics
+import http_stream
+from metadata_cache import Loudness
+from seek_index import build_seek_index
+
+REFERENCE_LOUDNESS = -18.0
+# Rate the workers' mixer decodes to; K-weighting is defined at 48 kHz
+ANALYSIS_RATE = 48000
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+# Gating blocks are 400 ms long and start every 100 ms
+SUBBLOCKS_PER_BLOCK = 4
+
+# The filter's impulse response decays below float precision well before this
+IMPULSE_LENGTH = 8192
+FFT_SIZE = 65536
+# About a minute of MPEG-1 frames per decoded chunk (seek index points
+# are SCAN_STRIDE frames apart)
+CHUNK_POINTS = 60
+WAV_CHUNK_FRAMES = 1 << 21
+
+
+def _biquads(rate):
+    # The two K-weighting stages (high shelf, high pass) for a sample rate,
+    # as (b, a) pairs; these give the BS.1770 coefficients at 48 kHz
+    k = math.tan(math.pi * 1681.974450955533 / rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0), \
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    k = math.tan(math.pi * 38.13547087602444 / rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    return shelf, high_pass
+
+
+@lru_cache(maxsize=4)
+def k_weighting_spectrum(rate):
+    """FFT of the K-weighting filter's impulse response at FFT_SIZE."""
+    signal = [0.0] * IMPULSE_LENGTH
+    signal[0] = 1.0
+    for (b0, b1, b2), (_, a1, a2) in _biquads(rate):
+        x1 = x2 = y1 = y2 = 0.0
+        for n, x in enumerate(signal):
+            y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            x2, x1, y2, y1 = x1, x, y1, y
+            signal[n] = y
+    return np.fft.rfft(np.array(signal), FFT_SIZE)
+
+
+class LoudnessMeter:
+    """Integrated loudness and sample peak of audio fed in chunks.
+
+    feed() takes float samples shaped (frames, channels) in [-1, 1]; all
+    channels are weighted 1.0, as BS.1770 does for mono and stereo.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.peak = 0.0
+        self._spectrum = k_weighting_spectrum(rate)
+        self._segment = FFT_SIZE - IMPULSE_LENGTH + 1
+        self._tail = None
+        self._subblock = rate // 10
+        self._pending = None
+        self._energies = []
+
+    def feed(self, samples):
+        if not len(samples):
+            return
+        self.peak = max(self.peak, float(np.max(np.abs(samples))))
+        filtered = self._filter(np.asarray(samples, dtype=np.float64).T)
+        if self._pending is not None:
+            filtered = np.concatenate((self._pending, filtered), axis=1)
+        whole = filtered.shape[1] // self._subblock * self._subblock
+        self._pending = filtered[:, whole:]
+        squares = filtered[:, :whole].reshape(filtered.shape[0], -1, self._subblock)
+        # Mean square per 100 ms, summed over the channels
+        self._energies.append(np.einsum('cbs,cbs->b', squares, squares) / self._subblock)
+
+    def _filter(self, channels):
+        # Overlap-add convolution with the filter's impulse response; the
+        # part that spills past this chunk is carried into the next one
+        count, frames = channels.shape
+        rows = -(-frames // self._segment)
+        padded = np.zeros((count, rows * self._segment))
+        padded[:, :frames] = channels
+        blocks = np.fft.irfft(
+            np.fft.rfft(padded.reshape(count, rows, self._segment), FFT_SIZE) * self._spectrum,
+            FFT_SIZE)
+        spill = IMPULSE_LENGTH - 1
+        out = np.zeros((count, rows + 1, self._segment))
+        out[:, :rows] = blocks[:, :, :self._segment]
+        out[:, 1:, :spill] += blocks[:, :, self._segment:]
+        out = out.reshape(count, -1)
+        if self._tail is not None:
+            out[:, :spill] += self._tail
+        self._tail = out[:, frames:frames + spill].copy()
+        return out[:, :frames]
+
+    def result(self):
+        """Return (integrated loudness in LUFS or None, gated block count)."""
+        energies = np.concatenate(self._energies) if self._energies else np.zeros(0)
+        if len(energies) < SUBBLOCKS_PER_BLOCK:
+            return None, 0
+        blocks = np.convolve(energies, np.full(SUBBLOCKS_PER_BLOCK, 1 / SUBBLOCKS_PER_BLOCK),
+                             'valid')
+        with np.errstate(divide='ignore'):
+            levels = -0.691 + 10 * np.log10(blocks)
+        gated = blocks[levels > ABSOLUTE_GATE]
+        if not len(gated):
+            return None, 0
+        relative = -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE
+        gated = blocks[(levels > ABSOLUTE_GATE) & (levels > relative)]
+        return -0.691 + 10 * math.log10(gated.mean()), len(gated)
+
+
+def _tag_values(tags):
+    # Lower-cased tag names without the ID3 'TXXX:' prefix, first values
+    values = {}
+    for key in tags.keys():
+        name = key.lower()
+        if name.startswith('txxx:'):
+            name = name[5:]
+        if name.startswith('replaygain_'):
+            value = tags[key]
+            value = getattr(value, 'text', value)
+            if isinstance(value, (list, tuple)):
+                value = value[0] if value else ''
+            values[name] = str(value)
+    return values
+
+
+def _number(text):
+    # '-6.50 dB' -> -6.5; None if it does not parse
+    try:
+        return float(text.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def read_replaygain_tags(file_path):
+    """Return (Loudness or None, channel count) from the file's tags."""
+    from mutagen import File
+
+    audio = File(file_path)
+    if audio is None:
+        return None, 2
+    channels = getattr(audio.info, 'channels', 2) or 2
+    if not audio.tags:
+        return None, channels
+    values = _tag_values(audio.tags)
+    track_gain = _number(values.get('replaygain_track_gain'))
+    if track_gain is None:
+        return None, channels
+    track_peak = _number(values.get('replaygain_track_peak'))
+    return Loudness(track_gain, track_peak if track_peak is not None else 1.0,
+                    _number(values.get('replaygain_album_gain')),
+                    _number(values.get('replaygain_album_peak')),
+                    REFERENCE_LOUDNESS - track_gain, 0), channels
+
+
+def _init_worker():
+    # Worker processes decode through their own mixer, on the dummy driver
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    import pygame
+    pygame.mixer.init(frequency=ANALYSIS_RATE, size=32, channels=2)
+
+
+def _decoded_chunks(file_path, seek_index=None):
+    # Yield (rate, float samples) of a file a chunk at a time; MP3 and other
+    # compressed files are decoded at the rate the mixer was opened with
+    if file_path.lower().endswith('.wav'):
+        with wave.open(file_path, 'rb') as w:
+            width, channels, rate = w.getsampwidth(), w.getnchannels(), w.getframerate()
+            if width not in (1, 2, 4):
+                raise ValueError(f"unsupported sample width {width}")
+            dtype, scale = {1: (np.uint8, 128.0), 2: ('<i2', 32768.0), 4: ('<i4', 2.0 ** 31)}[width]
+            while True:
+                data = w.readframes(WAV_CHUNK_FRAMES)
+                if not data:
+                    break
+                samples = np.frombuffer(data, dtype=dtype).astype(np.float32)
+                if width == 1:
+                    samples -= 128.0
+                yield rate, (samples / scale).reshape(-1, channels)
+        return
+
+    import pygame
+
+    rate = pygame.mixer.get_init()[0]
+    if seek_index is None and file_path.lower().endswith('.mp3'):
+        seek_index = build_seek_index(file_path, scan=True)
+    if seek_index is None or not seek_index.offsets:
+        sound = pygame.mixer.Sound(file_path)
+        yield rate, pygame.sndarray.array(sound)
+        return
+    # Decode about a minute of frames at a time. A chunk's first frame
+    # misses its bit reservoir, which costs at most one frame per minute
+    bounds = list(seek_index.offsets[::CHUNK_POINTS]) + [seek_index.data_end]
+    with open(file_path, 'rb') as f:
+        for start, end in zip(bounds, bounds[1:]):
+            f.seek(start)
+            data = f.read(end - start)
+            if data:
+                sound = pygame.mixer.Sound(file=io.BytesIO(data))
+                yield rate, pygame.sndarray.array(sound)
+
+
+def analyze_file(file_path):
+    """Return the Loudness of a file: from its ReplayGain tags if present,
+    otherwise by decoding and measuring it. Runs in a worker process."""
+    tagged, channels = read_replaygain_tags(file_path)
+    if tagged is not None:
+        return tagged
+    meter = None
+    for rate, samples in _decoded_chunks(file_path):
+        if meter is None:
+            meter = LoudnessMeter(rate)
+        # The mixer decodes mono files to two identical channels
+        meter.feed(samples[:, :1] if channels == 1 else samples)
+    if meter is None:
+        return Loudness(0.0, 0.0, None, None, None, 0)
+    integrated, blocks = meter.result()
+    gain = REFERENCE_LOUDNESS - integrated if integrated is not None else 0.0
+    return Loudness(gain, meter.peak, None, None, integrated, blocks)
+
+
+def album_loudness(results):
+    """Integrated loudness of an album from its tracks' Loudness results.
+
+    Each track's loudness is weighted by its gated block count, which
+    equals gating the album's blocks as a whole except for the relative
+    gate being applied per track. Returns None if nothing was measured.
+    """
+    measured = [(result.integrated, result.blocks) for result in results
+                if result.integrated is not None and result.blocks]
+    if not measured:
+        return None
+    total = sum(blocks for _, blocks in measured)
+    power = sum(10 ** (level / 10) * blocks for level, blocks in measured) / total
+    return 10 * math.log10(power)
+
+
+class LoudnessAnalyzer:
+    """Analyze tracks in a pool of worker processes, in the background.
+
+    Paths are queued through request() (played next, jumps the queue) or
+    as tracks are added to the playlist (the PlaylistModel observer calls).
+    A feeder thread skips cached files and keeps the pool busy without
+    flooding it; results are stored in the metadata cache. gain() is what
+    the playback engine asks for at each track start.
+    """
+
+    def __init__(self, metadata_cache, workers=None):
+        self.metadata_cache = metadata_cache
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        # Called with (file_path, Loudness) on a pool thread after each analysis
+        self.on_result = None
+        self._urgent = deque()
+        self._sources = deque()
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._slots = threading.Semaphore(self.workers * 2)
+        self._pool = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._feed, name='loudness-feeder', daemon=True)
+        self._thread.start()
+
+    # Queueing
+
+    def request(self, file_path):
+        # Analyze this file before anything queued
+        with self._condition:
+            self._urgent.append(file_path)
+            self._condition.notify()
+
+    def queue_paths(self, paths):
+        # Analyze an iterable of paths, consumed lazily
+        with self._condition:
+            self._sources.append(iter(paths))
+            self._condition.notify()
+
+    def tracks_appended(self, first_row, tracks):
+        self.queue_paths(track[0] for track in tracks)
+
+    def track_updated(self, row, title, artist, album, duration):
+        pass
+
+    def track_moved(self, row, path):
+        pass
+
+    def tracks_removed(self, rows):
+        pass
+
+    def cleared(self):
+        with self._condition:
+            self._sources.clear()
+
+    def _next_path(self):
+        # Called with the condition held; None when there is nothing to do
+        if self._urgent:
+            return self._urgent.popleft()
+        while self._sources:
+            path = next(self._sources[0], None)
+            if path is not None:
+                return path
+            self._sources.popleft()
+        return None
+
+    def _feed(self):
+        while True:
+            with self._condition:
+                path = self._next_path()
+                while path is None and not self._closed:
+                    self._condition.wait()
+                    path = self._next_path()
+                if self._closed:
+                    return
+                if path in self._in_flight:
+                    continue
+            # URLs are not analyzed: it would download them whole
+            if http_stream.is_url(path) or self.lookup(path) is not None:
+                continue
+            self._slots.acquire()
+            with self._condition:
+                if self._closed:
+                    return
+                self._in_flight.add(path)
+                future = self._submit(path)
+            future.add_done_callback(lambda future, path=path: self._finished(path, future))
+
+    def _submit(self, path):
+        # Called with the condition held. A worker that died (a decoder
+        # crashing on a corrupt file) fails every pending file of its pool,
+        # and the pool refuses new ones: start over with a new pool
+        if self._pool is not None:
+            try:
+                return self._pool.submit(analyze_file, path)
+            except BrokenProcessPool:
+                self._pool.shutdown(wait=False)
+        # Spawned, not forked: the GUI process runs Qt and threads
+        self._pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker)
+        return self._pool.submit(analyze_file, path)
+
+    def _finished(self, path, future):
+        self._slots.release()
+        with self._condition:
+            self._in_flight.discard(path)
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Error analyzing loudness of {path}: {e}")
+            return
+        try:
+            self.metadata_cache.store_loudness(path, os.stat(path), result)
+        except OSError as e:
+            print(f"Error analyzing loudness of {path}: {e}")
+            return
+        metrics.count('loudness_analyses')
+        if self.on_result is not None:
+            self.on_result(path, result)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            pool = self._pool
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    # Gains
+
+    def lookup(self, file_path):
+        try:
+            return self.metadata_cache.lookup_loudness(file_path)
+        except OSError:
+            return None
+
+    def gain(self, file_path, mode):
+        """Gain in dB to play a file at, or None if it is not analyzed yet
+        (it is then queued first). mode is 'track' or 'album'."""
+        result = self.lookup(file_path)
+        if result is None:
+            self.request(file_path)
+            return None
+        if mode == 'album':
+            if result.album_gain is not None:
+                return result.album_gain
+            metadata = self.metadata_cache.lookup(file_path)
+            if metadata is not None and metadata.album:
+                level = album_loudness(self.metadata_cache.album_loudness(
+                    os.path.dirname(file_path), metadata.album))
+                if level is not None:
+                    return REFERENCE_LOUDNESS - level
+        return result.track_gain
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python loudness.py FILE [FILE ...]")
+        sys.exit(1)
+    _init_worker()
+    for path in sys.argv[1:]:
+        result = analyze_file(path)
+        level = 'silent' if result.integrated is None else f"{result.integrated:.2f} LUFS"
+        print(f"{path}: {level}, gain {result.track_gain:+.2f} dB, peak {result.track_peak:.4f}"
+              + ("" if result.blocks or result.integrated is None else " (from tags)"))
@@ -0,0 +1,497 @@
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+
+import metrics
+import http_stream
+from seek_index import SeekIndex, build_seek_index
+from tag_reader import read_tags, CoverLocation
+
+# Default location of the on-disk cache (metadata database and album art)
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'python_music_player'
+)
+
+SCHEMA_VERSION = 1
+
+# art_source is (offset, length) of embedded art that is read from the
+# track's file when shown; None once cached, and for art kept in art_dir
+TrackMetadata = namedtuple(
+    'TrackMetadata',
+    ['path', 'title', 'artist', 'album', 'year', 'duration', 'art_ref', 'art_source'],
+    defaults=(None,)
+)
+
+# Cached loudness analysis (see loudness.py): gains in dB, peaks as linear
+# sample peaks, integrated loudness in LUFS (None for silence) and the
+# number of gated blocks it was measured over (0 when the values come from
+# ReplayGain tags). The album values are None unless tagged
+Loudness = namedtuple(
+    'Loudness',
+    ['track_gain', 'track_peak', 'album_gain', 'album_peak', 'integrated', 'blocks']
+)
+
+
+def read_metadata(file_path, art_dir):
+    """Read a file once (see tag_reader) and return its TrackMetadata.
+
+    Embedded album art is not read: the TrackMetadata says where it is in
+    the file and load_art() reads it when it is shown, and learns its
+    content hash (see art_hash()). Art that has to be decoded first is
+    stored in art_dir under its content hash, so that tracks sharing a
+    cover share a single file.
+    """
+    with metrics.span('metadata_read'):
+        tags = read_tags(file_path)
+        art_ref = art_source = None
+        if isinstance(tags.cover, CoverLocation):
+            art_ref = tags.cover.key
+            art_source = (tags.cover.offset, tags.cover.length)
+        elif tags.cover:
+            art_ref = store_art(tags.cover, art_dir)
+
+    return TrackMetadata(file_path, tags.title, tags.artist, tags.album, tags.year,
+                         tags.duration, art_ref, art_source)
+
+
+def store_art(data, art_dir):
+    art_ref = hashlib.sha1(data).hexdigest()
+    art_path = os.path.join(art_dir, art_ref)
+    if not os.path.exists(art_path):
+        os.makedirs(art_dir, exist_ok=True)
+        tmp_path = f"{art_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, art_path)
+    return art_ref
+
+
+class MetadataCache:
+    """Persistent track metadata store keyed by (path, size, mtime).
+
+    A lookup only stats the file; the file itself is parsed again only when
+    its size or modification time changed since it was cached.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.art_dir = os.path.join(cache_dir, 'art')
+        os.makedirs(self.art_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, 'metadata.sqlite3'),
+            check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS tracks")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                year TEXT,
+                duration REAL NOT NULL,
+                art_ref TEXT
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS seek_index (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS loudness (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                track_gain REAL NOT NULL,
+                track_peak REAL NOT NULL,
+                album_gain REAL,
+                album_peak REAL,
+                integrated REAL,
+                blocks INTEGER NOT NULL
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS payload (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                payload_start INTEGER NOT NULL,
+                payload_end INTEGER NOT NULL,
+                hash BLOB
+            )
+        """)
+        # Where covers that were never copied out of their files are
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS art_source (
+                art_ref TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                art_offset INTEGER NOT NULL,
+                art_length INTEGER NOT NULL,
+                PRIMARY KEY (art_ref, path)
+            )
+        """)
+        # Content hash of the cover behind an art_ref, once it has been read
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS art_hash (
+                art_ref TEXT PRIMARY KEY,
+                hash TEXT NOT NULL
+            )
+        """)
+        self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self._db.commit()
+
+    def lookup(self, file_path, stat=None):
+        # Return the cached record if it is still valid, without reading the
+        # file (or sending a request for a URL)
+        if stat is None:
+            try:
+                stat = http_stream.stat(file_path, fetch=False)
+            except OSError:
+                return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT title, artist, album, year, duration, art_ref FROM tracks "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        if row is None:
+            return None
+        return TrackMetadata(file_path, *row)
+
+    def get(self, file_path):
+        # Return cached metadata, parsing and storing the file on a miss
+        stat = http_stream.stat(file_path)
+        metadata = self.lookup(file_path, stat)
+        if metadata is None:
+            metrics.count('metadata_cache_misses')
+            metadata = read_metadata(file_path, self.art_dir)
+            self.store(metadata, stat)
+        else:
+            metrics.count('metadata_cache_hits')
+        return metadata
+
+    def store(self, metadata, stat):
+        self.store_many([(metadata, stat)])
+
+    def store_many(self, items):
+        # Store (metadata, stat) pairs in a single transaction
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tracks "
+                "(path, size, mtime_ns, title, artist, album, year, duration, art_ref) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((metadata.path, stat.st_size, stat.st_mtime_ns, metadata.title,
+                  metadata.artist, metadata.album, metadata.year,
+                  metadata.duration, metadata.art_ref)
+                 for metadata, stat in items)
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO art_source "
+                "(art_ref, path, size, mtime_ns, art_offset, art_length) VALUES (?, ?, ?, ?, ?, ?)",
+                ((metadata.art_ref, metadata.path, stat.st_size, stat.st_mtime_ns,
+                  *metadata.art_source)
+                 for metadata, stat in items if metadata.art_source is not None)
+            )
+            # Art stored in art_dir is named after its hash
+            self._db.executemany(
+                "INSERT OR IGNORE INTO art_hash (art_ref, hash) VALUES (?, ?)",
+                ((metadata.art_ref, metadata.art_ref) for metadata, _ in items
+                 if metadata.art_ref and metadata.art_source is None)
+            )
+            self._db.commit()
+
+    def file_stats(self, directory, recursive=True):
+        """Return {path: (size, mtime_ns)} of every cached track under
+        directory (or directly inside it), to compare against the disk."""
+        prefix = os.path.join(directory, '')
+        query = "SELECT path, size, mtime_ns FROM tracks WHERE substr(path, 1, ?) = ?"
+        params = (len(prefix), prefix)
+        if not recursive:
+            query += " AND instr(substr(path, ? + 1), ?) = 0"
+            params += (len(prefix), os.sep)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def rename(self, moves):
+        # Carry the cached records of renamed or moved files, as (old path,
+        # new path) pairs, over to their new paths; a rename keeps the size
+        # and modification time they are checked against
+        moves = list(moves)
+        with self._lock:
+            for table in ('tracks', 'seek_index', 'loudness', 'payload', 'art_source'):
+                self._db.executemany(f"UPDATE OR REPLACE {table} SET path = ? WHERE path = ?",
+                                     ((new, old) for old, new in moves))
+            self._db.commit()
+
+    def get_seek_index(self, file_path):
+        """Return the SeekIndex of an MP3 file, building and caching it on a
+        miss. Returns None for files without MPEG audio frames."""
+        if not file_path.lower().endswith('.mp3'):
+            return None
+        stat = http_stream.stat(file_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM seek_index WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        if row is not None:
+            metrics.count('seek_index_cache_hits')
+            return SeekIndex.from_bytes(row[0])
+
+        metrics.count('seek_index_cache_misses')
+        # Walks the frame headers (or reads the Xing header): the exact length probe
+        with metrics.span('length_probe'):
+            seek_index = build_seek_index(file_path)
+        if seek_index is not None:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO seek_index (path, size, mtime_ns, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    (file_path, stat.st_size, stat.st_mtime_ns, seek_index.to_bytes())
+                )
+                self._db.commit()
+        return seek_index
+
+    def lookup_loudness(self, file_path):
+        # Return the cached Loudness if the file is unchanged, else None
+        stat = os.stat(file_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT track_gain, track_peak, album_gain, album_peak, integrated, blocks "
+                "FROM loudness WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return Loudness(*row) if row is not None else None
+
+    def store_loudness(self, file_path, stat, loudness):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO loudness (path, size, mtime_ns, track_gain, track_peak, "
+                "album_gain, album_peak, integrated, blocks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_path, stat.st_size, stat.st_mtime_ns, *loudness)
+            )
+            self._db.commit()
+
+    def album_loudness(self, directory, album):
+        """Return the cached Loudness of every analyzed track tagged with
+        `album` directly inside `directory`."""
+        prefix = os.path.join(directory, '')
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT l.track_gain, l.track_peak, l.album_gain, l.album_peak, l.integrated, "
+                "l.blocks FROM loudness l JOIN tracks t ON t.path = l.path "
+                "WHERE t.album = ? AND substr(l.path, 1, ?) = ? "
+                "AND instr(substr(l.path, ? + 1), ?) = 0",
+                (album, len(prefix), prefix, len(prefix), os.sep)
+            ).fetchall()
+        return [Loudness(*row) for row in rows]
+
+    def payload_records(self):
+        """Return {path: (size, mtime_ns, start, end, hash)} of every file
+        checked for duplicates; hash is None for files never hashed."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns, payload_start, payload_end, hash FROM payload"
+            ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def store_payloads(self, records):
+        # Store (path, size, mtime_ns, start, end, hash) records in one transaction
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO payload "
+                "(path, size, mtime_ns, payload_start, payload_end, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)", records)
+            self._db.commit()
+
+    def art_hash(self, art_ref):
+        """Return the content hash of the cover behind an art_ref, or None
+        until load_art() has read it: covers located in their files are
+        keyed by where they are, so tracks sharing one only share its hash."""
+        with self._lock:
+            row = self._db.execute("SELECT hash FROM art_hash WHERE art_ref = ?",
+                                   (art_ref,)).fetchone()
+        return row[0] if row else None
+
+    def _learn_art_hash(self, art_ref, art_hash):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO art_hash (art_ref, hash) VALUES (?, ?)",
+                             (art_ref, art_hash))
+            self._db.commit()
+
+    def load_art(self, art_ref):
+        if not art_ref:
+            return None
+        try:
+            with open(os.path.join(self.art_dir, art_ref), 'rb') as f:
+                data = f.read()
+        except OSError:
+            pass
+        else:
+            self._learn_art_hash(art_ref, art_ref)
+            return data
+        # Still in the track files: read it from the first one unchanged
+        # since it was located
+        with self._lock:
+            sources = self._db.execute(
+                "SELECT path, size, mtime_ns, art_offset, art_length FROM art_source "
+                "WHERE art_ref = ?", (art_ref,)
+            ).fetchall()
+        for path, size, mtime_ns, offset, length in sources:
+            try:
+                with http_stream.open_file(path) as f:
+                    stat = http_stream.fstat(f)
+                    if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                        continue
+                    f.seek(offset)
+                    data = f.read(length)
+            except OSError:
+                continue
+            if len(data) == length:
+                metrics.count('art_source_reads')
+                self._learn_art_hash(art_ref, hashlib.sha1(data).hexdigest())
+                return data
+        return None
+
+    def invalidate(self, paths=None):
+        # Drop the given paths, or every cached record when paths is None
+        if paths is not None:
+            paths = list(paths)
+        with self._lock:
+            for table in ('tracks', 'seek_index', 'loudness', 'payload', 'art_source'):
+                if paths is None:
+                    self._db.execute(f"DELETE FROM {table}")
+                else:
+                    self._db.executemany(
+                        f"DELETE FROM {table} WHERE path = ?",
+                        ((path,) for path in paths)
+                    )
+            self._db.commit()
+
+    def rebuild(self, force=False):
+        """Re-validate every cached record.
+
+        Records of missing files are removed, stale ones are re-read (all of
+        them when force is True) and unreferenced album art is deleted.
+        Returns a (refreshed, removed) tuple.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT path, size, mtime_ns FROM tracks").fetchall()
+
+        refreshed = removed = 0
+        gone = []
+        for path, size, mtime_ns in rows:
+            try:
+                stat = http_stream.stat(path)
+            except OSError:
+                gone.append(path)
+                continue
+            if force or stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                try:
+                    self.store(read_metadata(path, self.art_dir), stat)
+                    refreshed += 1
+                except Exception as e:
+                    print(f"Error reading metadata for {path}: {e}")
+                    gone.append(path)
+
+        if gone:
+            self.invalidate(gone)
+            removed = len(gone)
+
+        self._prune_art()
+        return refreshed, removed
+
+    def _prune_art(self):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM art_source WHERE NOT EXISTS (SELECT 1 FROM tracks t "
+                "WHERE t.path = art_source.path AND t.art_ref = art_source.art_ref)")
+            self._db.commit()
+            self._db.execute(
+                "DELETE FROM art_hash WHERE art_ref NOT IN "
+                "(SELECT art_ref FROM tracks WHERE art_ref IS NOT NULL)")
+            self._db.commit()
+            used = {row[0] for row in self._db.execute(
+                "SELECT DISTINCT art_ref FROM tracks WHERE art_ref IS NOT NULL")}
+            hashes = {row[0] for row in self._db.execute("SELECT hash FROM art_hash")}
+            paths = [row[0] for row in self._db.execute("SELECT path FROM tracks")]
+        for name in os.listdir(self.art_dir):
+            if name not in used:
+                try:
+                    os.remove(os.path.join(self.art_dir, name))
+                except OSError:
+                    pass
+
+        # Scaled thumbnails are named '<content hash>-<size>.jpg'
+        thumb_dir = os.path.join(self.cache_dir, 'thumbs')
+        if os.path.isdir(thumb_dir):
+            for name in os.listdir(thumb_dir):
+                if name.split('-', 1)[0] not in hashes:
+                    try:
+                        os.remove(os.path.join(thumb_dir, name))
+                    except OSError:
+                        pass
+
+        # Waveforms are named '<sha1 of the track path>.npz'
+        waveform_dir = os.path.join(self.cache_dir, 'waveforms')
+        if os.path.isdir(waveform_dir):
+            known = {hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+                     for path in paths}
+            for name in os.listdir(waveform_dir):
+                if name.split('.', 1)[0] not in known:
+                    try:
+                        os.remove(os.path.join(waveform_dir, name))
+                    except OSError:
+                        pass
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the music player metadata cache")
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--clear', action='store_true',
+                       help="invalidate every cached record")
+    group.add_argument('--rebuild', action='store_true',
+                       help="re-read stale records and drop missing files")
+    group.add_argument('--force-rebuild', action='store_true',
+                       help="re-read every cached file")
+    args = parser.parse_args()
+
+    cache = MetadataCache(args.cache_dir)
+    if args.clear:
+        cache.invalidate()
+        cache._prune_art()
+        print("Metadata cache cleared")
+    else:
+        refreshed, removed = cache.rebuild(force=args.force_rebuild)
+        print(f"Refreshed {refreshed} records, removed {removed}")
+    cache.close()
+    sys.exit(0)
@@ -0,0 +1,225 @@
+"""Timing spans and counters for the player's hot paths.
+
+Instrumentation is off by default; span() then returns a shared no-op
+context manager and count() returns after a single flag check, so the
+instrumented code pays next to nothing. It is switched on with
+enable(), or from the environment by configure_from_environment():
+
+    MUSIC_PLAYER_METRICS=1            collect spans and counters
+    MUSIC_PLAYER_METRICS_PORT=9464    also serve them on 127.0.0.1
+    MUSIC_PLAYER_METRICS_FILE=path    write a JSON snapshot on exit
+
+The endpoint serves Prometheus text on /metrics and the JSON snapshot on
+/metrics.json. It only ever binds to the loopback interface.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+
+# Spans on the GUI thread longer than this count as a stall
+STALL_THRESHOLD = 0.1
+
+# Histogram bucket upper bounds in seconds (Prometheus "le" labels)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+PREFIX = 'music_player'
+
+_enabled = False
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_main_thread_id = threading.main_thread().ident
+_server = None
+
+
+class _SpanStats:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # One slot per bucket plus the +Inf overflow
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def span(name):
+    """Time the enclosed block under `name`:
+
+        with metrics.span('mixer_load'):
+            pygame.mixer.music.load(path)
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def record(name, seconds):
+    # Add one timing to a span; exposed for timings measured elsewhere
+    if not _enabled:
+        return
+    stalled = seconds > STALL_THRESHOLD and threading.get_ident() == _main_thread_id
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = _SpanStats()
+        stats.add(seconds)
+        if stalled:
+            _counters['gui_stalls'] = _counters.get('gui_stalls', 0) + 1
+
+
+def count(name, amount=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """Return every span and counter as a JSON-serialisable dict."""
+    with _lock:
+        spans = {
+            name: {
+                'count': stats.count,
+                'total': stats.total,
+                'mean': stats.total / stats.count,
+                'max': stats.max,
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                                    stats.buckets)),
+            }
+            for name, stats in _spans.items()
+        }
+        counters = dict(_counters)
+    return {
+        'timestamp': time.time(),
+        'stall_threshold': STALL_THRESHOLD,
+        'spans': spans,
+        'counters': counters,
+    }
+
+
+def write_snapshot(file_path):
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+def prometheus_text():
+    """Render the snapshot in the Prometheus text exposition format."""
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    metric = f"{PREFIX}_span_seconds"
+    if data['spans']:
+        lines.append(f"# TYPE {metric} histogram")
+    for name, stats in sorted(data['spans'].items()):
+        cumulative = 0
+        for bound, hits in stats['buckets'].items():
+            cumulative += hits
+            lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{span="{name}"}} {stats["total"]}')
+        lines.append(f'{metric}_count{{span="{name}"}} {stats["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics and /metrics.json from a daemon thread."""
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = prometheus_text().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(snapshot()).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    return _server
+
+
+def configure_from_environment():
+    # Opt-in switches; see the module docstring
+    port = os.environ.get('MUSIC_PLAYER_METRICS_PORT')
+    snapshot_file = os.environ.get('MUSIC_PLAYER_METRICS_FILE')
+    if not (os.environ.get('MUSIC_PLAYER_METRICS') or port or snapshot_file):
+        return
+    enable()
+    if port:
+        try:
+            serve(int(port))
+        except (OSError, ValueError) as e:
+            print(f"Error starting metrics endpoint on port {port}: {e}")
+    if snapshot_file:
+        atexit.register(write_snapshot, snapshot_file)
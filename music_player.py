@@ -1,16 +1,22 @@
 import sys
 import os
+import time
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QFileDialog, 
-                            QListWidget, QSlider, QStyle, QFrame, QSizePolicy)
-from PyQt6.QtCore import Qt, QTimer, QUrl, QSize
-from PyQt6.QtGui import QIcon, QFont, QPixmap, QImage, QColor
-import pygame
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC
-from mutagen import File
-import requests
-from io import BytesIO
+                            QTableView, QHeaderView, QAbstractItemView, QSlider, QCheckBox, QStyle, QFrame, QSizePolicy,
+                            QLineEdit, QComboBox, QMessageBox, QMenu, QInputDialog)
+from PyQt6.QtCore import Qt, QTimer, QEvent, QLineF
+from PyQt6.QtGui import QPixmap, QColor, QKeySequence, QShortcut, QPainter
+from metadata_cache import MetadataCache
+from library_scanner import LibraryImportThread
+from cover_art import CoverArtService
+from playlist_model import PlaylistModel
+from track_store import TITLE, DURATION
+from playback_engine import PlaybackEngine, PlaybackState, NORMALIZATION_MODES
+from play_queue import REPEAT_MODES
+from playlist_file import PlaylistAutosaver, load_playlist, save_playlist
+import metrics
+import http_stream
 
 # Catppuccin Mocha Color Palette
 COLORS = {
@@ -25,6 +31,127 @@ COLORS = {
     'red': '#f38ba8',       # Alerts/Errors
 }
 
+# Longest page of tracks a remote library query returns
+REMOTE_PAGE_LIMIT = 200
+
+# Fastest position refresh, used when the slider handle moves quickly
+MIN_REFRESH_MS = 50
+# How long after the predicted end of a track the end event is checked
+END_MARGIN_MS = 20
+# The end is predicted again this long before it is due, since the sound
+# card's clock and the timer's clock drift apart over a long track
+END_RECHECK_MS = 1000
+# Fallback check interval for tracks of unknown length
+UNKNOWN_LENGTH_POLL_MS = 1000
+# How often the playback position is autosaved while playing
+STATE_SAVE_INTERVAL_MS = 30000
+# How often a search is retried while the search index is being built
+SEARCH_RETRY_MS = 250
+
+# Height of the time slider while it shows the waveform
+WAVEFORM_HEIGHT = 56
+
+
+class WaveformSlider(QSlider):
+    """The time slider, optionally drawn as the waveform of the track.
+
+    Only the cached peak envelope is used (see waveform.py). It is drawn
+    into a played and an unplayed pixmap when the waveform, the size or
+    the length changes; position updates just copy the two pixmaps on
+    either side of the playhead. Clicking or dragging seeks anywhere.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(Qt.Orientation.Horizontal, parent)
+        self.waveform_shown = False
+        self.waveform = None
+        # Seconds the slider spans, 0 when unknown
+        self.length = 0
+        self._pixmaps = None
+
+    def show_waveform(self, shown):
+        self.waveform_shown = shown
+        if shown:
+            self.setFixedHeight(WAVEFORM_HEIGHT)
+        else:
+            self.setMinimumHeight(0)
+            self.setMaximumHeight(16777215)
+        self.update()
+
+    def set_waveform(self, waveform):
+        self.waveform = waveform
+        self.update()
+
+    def set_length(self, seconds):
+        # The range is in milliseconds
+        self.length = seconds
+        self.setMaximum(int(seconds * 1000) if seconds > 0 else 100)
+
+    def _rendered(self):
+        key = (self.width(), self.height(), self.length, id(self.waveform))
+        if self._pixmaps is not None and self._pixmaps[0] == key:
+            return self._pixmaps[1:]
+        width, height = self.width(), self.height()
+        if self.waveform is not None:
+            mins, maxs = self.waveform.envelope(width, self.length or None)
+            mins, maxs = mins.tolist(), maxs.tolist()
+        else:
+            mins = maxs = [0.0] * width
+        middle, scale = height / 2, height / 2 - 2
+        lines = [QLineF(x + 0.5, middle - high * scale, x + 0.5, middle - low * scale + 1)
+                 for x, (low, high) in enumerate(zip(mins, maxs))]
+        pixmaps = []
+        for color in (COLORS['blue'], COLORS['overlay0']):
+            pixmap = QPixmap(width, height)
+            pixmap.fill(QColor(COLORS['surface0']))
+            painter = QPainter(pixmap)
+            painter.setPen(QColor(color))
+            painter.drawLines(lines)
+            painter.end()
+            pixmaps.append(pixmap)
+        self._pixmaps = (key, *pixmaps)
+        return pixmaps
+
+    def paintEvent(self, event):
+        if not self.waveform_shown:
+            super().paintEvent(event)
+            return
+        played, unplayed = self._rendered()
+        x = QStyle.sliderPositionFromValue(self.minimum(), self.maximum(), self.value(), self.width())
+        painter = QPainter(self)
+        # A source width of 0 would mean the whole pixmap
+        if x > 0:
+            painter.drawPixmap(0, 0, played, 0, 0, x, -1)
+        if x < self.width():
+            painter.drawPixmap(x, 0, unplayed, x, 0, -1, -1)
+        painter.fillRect(max(x - 1, 0), 0, 2, self.height(), QColor(COLORS['lavender']))
+        painter.end()
+
+    def _drag_to(self, event):
+        self.setSliderPosition(QStyle.sliderValueFromPosition(
+            self.minimum(), self.maximum(), int(event.position().x()), self.width()))
+
+    def mousePressEvent(self, event):
+        if not self.waveform_shown or event.button() != Qt.MouseButton.LeftButton:
+            super().mousePressEvent(event)
+            return
+        self.setSliderDown(True)
+        self._drag_to(event)
+
+    def mouseMoveEvent(self, event):
+        if not self.waveform_shown or not self.isSliderDown():
+            super().mouseMoveEvent(event)
+            return
+        self._drag_to(event)
+
+    def mouseReleaseEvent(self, event):
+        if not self.waveform_shown or not self.isSliderDown():
+            super().mouseReleaseEvent(event)
+            return
+        self._drag_to(event)
+        self.setSliderDown(False)
+
+
 class MusicPlayer(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -51,7 +178,7 @@ class MusicPlayer(QMainWindow):
             QPushButton:hover {{
                 background-color: {COLORS['surface1']};
             }}
-            QListWidget {{
+            QTableView {{
                 background-color: {COLORS['surface0']};
                 color: {COLORS['text']};
                 border: none;
@@ -59,10 +186,16 @@ class MusicPlayer(QMainWindow):
                 font-size: 14px;
                 padding: 5px;
             }}
-            QListWidget::item:selected {{
+            QTableView::item:selected {{
                 background-color: {COLORS['surface1']};
                 color: {COLORS['lavender']};
             }}
+            QHeaderView::section {{
+                background-color: {COLORS['surface0']};
+                color: {COLORS['subtext0']};
+                border: none;
+                padding: 4px;
+            }}
             QSlider::groove:horizontal {{
                 border: 1px solid {COLORS['overlay0']};
                 height: 8px;
@@ -84,9 +217,13 @@ class MusicPlayer(QMainWindow):
             }}
         """)
 
-        # Initialize pygame mixer
-        pygame.mixer.init()
-        pygame.mixer.music.set_volume(0.5)
+        # Persistent metadata store, so repeat plays never re-parse tags
+        self.metadata_cache = MetadataCache()
+
+        # Album art is decoded and scaled on worker threads
+        self.cover_art = CoverArtService(self.metadata_cache, size=280, parent=self)
+        self.cover_art.art_ready.connect(self.album_art_ready)
+        self.current_art_ref = None
 
         # Create central widget and layout
         central_widget = QWidget()
@@ -113,9 +250,9 @@ class MusicPlayer(QMainWindow):
         self.album_art_label.setStyleSheet("border-radius: 4px;")
         
         # Set default album art
-        default_art = QPixmap(280, 280)
-        default_art.fill(QColor(COLORS['surface1']))
-        self.album_art_label.setPixmap(default_art)
+        self.default_art = QPixmap(280, 280)
+        self.default_art.fill(QColor(COLORS['surface1']))
+        self.album_art_label.setPixmap(self.default_art)
         
         album_art_layout.addWidget(self.album_art_label)
         top_section.addWidget(self.album_art_frame)
@@ -144,13 +281,50 @@ class MusicPlayer(QMainWindow):
         top_section.addWidget(metadata_frame)
         main_layout.addLayout(top_section)
 
-        # Create playlist
-        self.playlist = QListWidget()
-        self.playlist.itemDoubleClicked.connect(self.play_selected)
+        # Search box: filters the playlist as you type
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("Search title, artist, album or file name")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.apply_search)
+        QShortcut(QKeySequence(Qt.Key.Key_Escape), self.search_box, self.search_box.clear,
+                  context=Qt.ShortcutContext.WidgetShortcut)
+        main_layout.addWidget(self.search_box)
+
+        # Create playlist: a table view over a compact track store, so only
+        # the visible rows are ever rendered
+        self.playlist_model = PlaylistModel()
+        self.playlist_model.layoutChanged.connect(self.playlist_sorted)
+        self.playlist = QTableView()
+        self.playlist.setModel(self.playlist_model)
+        self.playlist.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.playlist.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.playlist.setShowGrid(False)
+        self.playlist.setWordWrap(False)
+        self.playlist.verticalHeader().hide()
+        # Fixed row heights let the view skip measuring every row
+        self.playlist.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.playlist.verticalHeader().setDefaultSectionSize(28)
+        header = self.playlist.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        header.setSectionResizeMode(TITLE, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(DURATION, QHeaderView.ResizeMode.ResizeToContents)
+        # Start unsorted (insertion order); clicking a header sorts
+        header.setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
+        self.playlist.setSortingEnabled(True)
+        self.playlist.doubleClicked.connect(self.play_selected)
+        # Right click: play the track next, or add it to the up-next queue
+        self.playlist.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.playlist.customContextMenuRequested.connect(self.show_playlist_menu)
         main_layout.addWidget(self.playlist)
 
-        # Create time slider
-        self.time_slider = QSlider(Qt.Orientation.Horizontal)
+        # Library import progress
+        self.import_status = QLabel("")
+        self.import_status.setStyleSheet(f"color: {COLORS['subtext0']};")
+        self.import_status.hide()
+        main_layout.addWidget(self.import_status)
+
+        # Create time slider (in milliseconds)
+        self.time_slider = WaveformSlider()
         self.time_slider.setMaximum(100)
         self.time_slider.sliderPressed.connect(self.slider_pressed)
         self.time_slider.sliderReleased.connect(self.slider_released)
@@ -203,32 +377,127 @@ class MusicPlayer(QMainWindow):
         self.add_button = QPushButton("Add Music")
         self.add_button.clicked.connect(self.add_music)
 
+        # Tracks on an HTTP server, played while they download
+        self.add_url_button = QPushButton("Add URL")
+        self.add_url_button.clicked.connect(self.add_urls)
+
+        # Add folder button (doubles as the cancel button during an import)
+        self.add_folder_button = QPushButton("Add Folder")
+        self.add_folder_button.clicked.connect(self.add_folder)
+
+        # Watched folders, kept in sync with the playlist once it is restored
+        self.watch_button = QPushButton("Watched Folders")
+        self.watch_menu = QMenu(self)
+        self.watch_menu.aboutToShow.connect(self.update_watch_menu)
+        self.watch_button.setMenu(self.watch_menu)
+        self.watch_button.setEnabled(False)
+
+        # Playlist files (M3U/M3U8 and the native format)
+        self.open_playlist_button = QPushButton("Open Playlist")
+        self.open_playlist_button.clicked.connect(self.open_playlist)
+        self.save_playlist_button = QPushButton("Save Playlist")
+        self.save_playlist_button.clicked.connect(self.save_playlist)
+
+        # Duplicate search (doubles as the cancel button while it runs)
+        self.duplicates_button = QPushButton("Find Duplicates")
+        self.duplicates_button.clicked.connect(self.find_duplicates)
+
         controls_layout.addWidget(self.prev_button)
         controls_layout.addWidget(self.stop_button)
         controls_layout.addWidget(self.play_button)
         controls_layout.addWidget(self.next_button)
         controls_layout.addWidget(self.add_button)
+        controls_layout.addWidget(self.add_url_button)
+        controls_layout.addWidget(self.add_folder_button)
+        controls_layout.addWidget(self.watch_button)
+        controls_layout.addWidget(self.open_playlist_button)
+        controls_layout.addWidget(self.save_playlist_button)
+        controls_layout.addWidget(self.duplicates_button)
+
+        # Gapless playback: the next track is queued on the mixer ahead of time
+        self.gapless_checkbox = QCheckBox("Gapless")
+        self.gapless_checkbox.setChecked(True)
+        self.gapless_checkbox.toggled.connect(self.set_gapless)
+        controls_layout.addWidget(self.gapless_checkbox)
+
+        # Play order: shuffled or in playlist order, and what happens at the end
+        self.shuffle_checkbox = QCheckBox("Shuffle")
+        self.shuffle_checkbox.toggled.connect(self.set_shuffle)
+        controls_layout.addWidget(self.shuffle_checkbox)
+        self.repeat_box = QComboBox()
+        self.repeat_box.addItems(["Repeat: Off", "Repeat: All", "Repeat: One"])
+        self.repeat_box.setCurrentIndex(REPEAT_MODES.index('all'))
+        self.repeat_box.currentIndexChanged.connect(
+            lambda index: self.set_repeat(REPEAT_MODES[index]))
+        controls_layout.addWidget(self.repeat_box)
+
+        # Loudness normalization with ReplayGain-style track or album gain
+        self.normalization_box = QComboBox()
+        self.normalization_box.addItems(["Normalize: Off", "Normalize: Track", "Normalize: Album"])
+        self.normalization_box.setCurrentIndex(NORMALIZATION_MODES.index('track'))
+        self.normalization_box.currentIndexChanged.connect(
+            lambda index: self.set_normalization(NORMALIZATION_MODES[index]))
+        controls_layout.addWidget(self.normalization_box)
+
+        # Waveform seek bar, drawn from peaks computed once per track
+        self.waveform_checkbox = QCheckBox("Waveform")
+        self.waveform_checkbox.setChecked(True)
+        self.waveform_checkbox.toggled.connect(self.set_waveform_shown)
+        controls_layout.addWidget(self.waveform_checkbox)
+        self.time_slider.show_waveform(True)
         
         main_layout.addLayout(controls_layout)
 
         # Initialize variables
-        self.current_file = None
-        self.is_playing = False
-        self.is_paused = False
-        self.playlist_files = []
-        self.current_index = 0
         self.slider_is_pressed = False
-        self.just_seeked = False
-        self.seek_position = 0
-        self.song_length = 0
-        self.current_position = 0
-        self.last_update_time = 0
+        self.import_thread = None
+        self.duplicate_thread = None
+        # Created by restore_playlist(), once the window is up
+        self.autosaver = None
+        self.search_index = None
+        self.loudness = None
+        self.waveforms = None
+        self.waveform_path = None
+        # The checkbox's state, for the prefetch thread, which must not
+        # touch widgets
+        self.waveform_shown = True
+        self.watcher = None
+        self.remote = None
 
-        # Set up timer for updating the slider
+        # All playback state lives in the engine; the window is one client.
+        # The audio device is opened in the background (start_audio) or on
+        # first play, never before the window is shown
+        self.engine = PlaybackEngine(self.playlist_model, self.metadata_cache)
+        self.engine.subscribe('state_changed', self.playback_state_changed)
+        self.engine.subscribe('track_changed', self.track_changed)
+        self.engine.subscribe('track_prefetched', self.track_prefetched)
+        self.engine.subscribe('seeked', self.seeked)
+
+        # Position refresh: re-armed after every tick with the time until the
+        # display next changes, and stopped while hidden, paused or stopped
         self.timer = QTimer()
-        self.timer.setInterval(1000)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
         self.timer.timeout.connect(self.update_slider)
 
+        # Fires when the current track is due to end, so the mixer's end
+        # event is handled right away instead of on the next poll
+        self.end_timer = QTimer()
+        self.end_timer.setSingleShot(True)
+        self.end_timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.end_timer.timeout.connect(self.track_end_due)
+
+        # Saves the position now and then while playing, for crash recovery
+        self.state_save_timer = QTimer()
+        self.state_save_timer.setInterval(STATE_SAVE_INTERVAL_MS)
+        self.state_save_timer.timeout.connect(self.save_playback_state)
+
+        # Searches typed before the search index is ready are run again
+        self.search_retry_timer = QTimer()
+        self.search_retry_timer.setSingleShot(True)
+        self.search_retry_timer.setInterval(SEARCH_RETRY_MS)
+        self.search_retry_timer.timeout.connect(self.apply_search)
+
     def add_music(self):
         files, _ = QFileDialog.getOpenFileNames(
             self,
@@ -236,339 +505,671 @@ class MusicPlayer(QMainWindow):
             "",
             "Audio Files (*.mp3 *.wav)"
         )
-        for file in files:
-            self.playlist.addItem(os.path.basename(file))
-            self.playlist_files.append(file)
-
-    def play_selected(self, item):
-        index = self.playlist.row(item)
-        if 0 <= index < len(self.playlist_files):
-            self.current_index = index
-            self.current_file = self.playlist_files[index]
-            pygame.mixer.music.load(self.current_file)
-            pygame.mixer.music.play()
-            self.is_playing = True
-            self.is_paused = False
-            self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause))
-            self.timer.start()
-            
-            # Update song metadata and artwork
-            self.update_metadata(self.current_file)
-            
-            # Update song length
-            try:
-                audio = MP3(self.current_file)
-                self.song_length = audio.info.length
-                self.time_slider.setMaximum(int(self.song_length))
-                self.total_time.setText(self.format_time(self.song_length))
-            except:
-                self.song_length = 0
-                self.time_slider.setMaximum(100)
-                self.total_time.setText("0:00")
-
-    def update_metadata(self, file_path):
+        self.playlist_model.append_tracks([self.cached_track(file) for file in files])
+
+    def cached_track(self, file, fallback=None):
+        # Use cached tags when available; the rest are filled in on play
+        metadata = self.metadata_cache.lookup(file)
+        if metadata is not None:
+            return (file, metadata.title, metadata.artist, metadata.album, metadata.duration)
+        return fallback or (file, None, None, None, 0.0)
+
+    def open_playlist(self):
+        file, _ = QFileDialog.getOpenFileName(
+            self,
+            "Open Playlist",
+            "",
+            "Playlists (*.m3u *.m3u8 *.mpl)"
+        )
+        if not file:
+            return
         try:
-            # Try to load ID3 tags directly
+            tracks = load_playlist(file)
+        except (OSError, ValueError) as e:
+            print(f"Error opening playlist: {e}")
+            return
+        # Tags cached from earlier plays beat the playlist's #EXTINF lines
+        self.playlist_model.append_tracks([self.cached_track(track[0], track) for track in tracks])
+
+    def save_playlist(self):
+        file, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save Playlist",
+            "playlist.m3u8",
+            "M3U8 Playlist (*.m3u8);;M3U Playlist (*.m3u);;Music Player Playlist (*.mpl)"
+        )
+        if not file:
+            return
+        try:
+            save_playlist(file, self.playlist_model.tracks())
+        except OSError as e:
+            print(f"Error saving playlist: {e}")
+
+    def restore_playlist(self):
+        """Reopen the autosaved playlist and playback state, and keep saving
+        changes from now on. Also opens the search index of the playlist."""
+        # Imported here: NumPy takes a while to load and is not needed to paint
+        from search_index import SearchIndex
+        from loudness import LoudnessAnalyzer
+        from waveform import WaveformService
+        from library_watcher import FolderWatcher
+
+        self.waveforms = WaveformService(self.metadata_cache.cache_dir, parent=self)
+        self.waveforms.waveform_ready.connect(self.waveform_ready)
+        self.autosaver = PlaylistAutosaver()
+        store, state = self.autosaver.restore()
+        # The autosaver snapshots this store object, so the model must use it
+        # even when it is empty
+        self.playlist_model.set_store(store)
+        if len(store):
+            column = state.get('sort_column', -1)
+            if column >= 0:
+                order = Qt.SortOrder.DescendingOrder if state.get('sort_descending') \
+                    else Qt.SortOrder.AscendingOrder
+                self.playlist.horizontalHeader().setSortIndicator(column, order)
+            row = state.get('current_row', -1)
+            if 0 <= row < len(store):
+                position = state.get('position', 0.0)
+                self.engine.cue(self.playlist_model.view_row(row), position)
+                self.time_slider.setValue(int(position * 1000))
+                self.current_time.setText(self.format_time(position))
+        self.search_index = SearchIndex.open(self.playlist_model.store)
+        self.playlist_model.observers += [self.autosaver, self.search_index]
+        self.apply_search()
+
+        self.loudness = LoudnessAnalyzer(self.metadata_cache)
+        self.engine.loudness = self.loudness
+        self.set_normalization(NORMALIZATION_MODES[self.normalization_box.currentIndex()])
+
+        # Last, so that every observer sees what changed while we were closed
+        self.watcher = FolderWatcher(self.playlist_model, self.metadata_cache, parent=self)
+        self.watcher.synced.connect(self.library_synced)
+        self.watcher.start()
+        self.watch_button.setEnabled(True)
+
+        # Remote control API, only when enabled from the environment
+        if os.environ.get('MUSIC_PLAYER_REMOTE_PORT'):
+            import remote_control
+            self.remote = remote_control.configure_from_environment(
+                remote_control.QtDispatcher(self.remote_command, parent=self))
+            self.publish_state()
+
+    def set_normalization(self, mode):
+        self.engine.set_normalization(mode)
+        if self.loudness is not None:
+            # Analyze the whole playlist in the background while enabled
+            analyzing = self.loudness in self.playlist_model.observers
+            if mode != 'off' and not analyzing:
+                store = self.playlist_model.store
+                self.playlist_model.observers.append(self.loudness)
+                self.loudness.queue_paths(store.path(row) for row in range(len(store)))
+            elif mode == 'off' and analyzing:
+                self.playlist_model.observers.remove(self.loudness)
+                self.loudness.cleared()
+
+    def apply_search(self):
+        query = self.search_box.text()
+        if not query.strip():
+            mask = None
+        elif self.search_index is None or not self.search_index.ready:
+            self.search_retry_timer.start()
+            return
+        else:
+            mask = self.search_index.search(query)
+        if mask is None and self.playlist_model.rowCount() == len(self.playlist_model.store):
+            return
+        self.playlist_model.set_filter(mask)
+        # Filtering moves rows around like sorting does
+        playing_row = self.playlist_model.playing_row()
+        self.engine.follow_current(playing_row)
+        if playing_row >= 0:
+            self.playlist.selectRow(playing_row)
+
+    def save_playback_state(self):
+        if self.autosaver is None:
+            return
+        column, descending = self.playlist_model.sort_state()
+        self.autosaver.state_changed({
+            'current_row': self.playlist_model.playing_store_row(),
+            'position': self.engine.position(),
+            'sort_column': -1 if column is None else column,
+            'sort_descending': descending,
+        })
+
+    def add_folder(self):
+        if self.import_thread is not None:
+            # An import is running: the button acts as cancel
+            self.import_thread.cancel()
+            self.add_folder_button.setEnabled(False)
+            return
+
+        folder = QFileDialog.getExistingDirectory(self, "Add Music Folder")
+        if not folder:
+            return
+        self.start_import(LibraryImportThread(folder, self.metadata_cache, recursive=True))
+
+    def add_urls(self):
+        text, accepted = QInputDialog.getMultiLineText(
+            self,
+            "Add URLs",
+            "Track URLs (http:// or https://), one per line:"
+        )
+        urls = [line.strip() for line in text.splitlines() if http_stream.is_url(line.strip())]
+        if not accepted or not urls or self.import_thread is not None:
+            return
+        # Read like a folder import: tags come from a few small requests
+        # per track, many tracks at a time
+        self.start_import(LibraryImportThread(None, self.metadata_cache, paths=urls))
+
+    def start_import(self, thread):
+        self.import_thread = thread
+        self.import_thread.batch_ready.connect(self.import_batch)
+        self.import_thread.progress.connect(self.import_progress)
+        self.import_thread.import_finished.connect(self.import_finished)
+        self.add_folder_button.setText("Cancel Import")
+        self.add_url_button.setEnabled(False)
+        self.import_status.setText("Scanning...")
+        self.import_status.show()
+        self.import_thread.start()
+
+    def import_batch(self, batch):
+        # Rows arrive in batches so the playlist grows while the import runs
+        self.playlist_model.append_tracks([
+            (path, metadata.title, metadata.artist, metadata.album, metadata.duration)
+            for path, metadata in batch
+        ])
+        self.publish_state()
+
+    def playlist_sorted(self):
+        # Sorting moves rows around; follow the playing (or cued) track
+        if self.playlist_model.playing_row() >= 0:
+            self.engine.follow_current(self.playlist_model.playing_row())
+        self.save_playback_state()
+
+    def import_progress(self, found, processed):
+        self.import_status.setText(f"Importing: {processed} of {found} files found so far")
+
+    def import_finished(self, imported, cancelled):
+        self.import_thread.wait()
+        self.import_thread = None
+        self.add_folder_button.setText("Add Folder")
+        self.add_folder_button.setEnabled(True)
+        self.add_url_button.setEnabled(True)
+        if cancelled:
+            self.import_status.setText(f"Import cancelled after {imported} files")
+        else:
+            self.import_status.setText(f"Imported {imported} files")
+        QTimer.singleShot(5000, self.import_status.hide)
+
+    def update_watch_menu(self):
+        self.watch_menu.clear()
+        self.watch_menu.addAction("Watch a Folder...", self.watch_folder)
+        if self.watcher.folders:
+            self.watch_menu.addSeparator()
+        for folder in self.watcher.folders:
+            self.watch_menu.addAction(
+                f"Stop Watching {folder}",
+                lambda checked=False, folder=folder: self.watcher.unwatch_folder(folder))
+
+    def watch_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Watch Music Folder")
+        if not folder:
+            return
+        self.import_status.setText("Syncing watched folders...")
+        self.import_status.show()
+        self.watcher.watch_folder(folder)
+
+    def library_synced(self, added, removed, moved, updated, done):
+        # Rows may have been added, moved up or dropped, the playing one too
+        self.engine.follow_current(self.playlist_model.playing_row())
+        self.publish_state()
+        if not (added or removed or moved or updated):
+            if done and self.import_thread is None and self.duplicate_thread is None:
+                self.import_status.hide()
+            return
+        self.import_status.setText(
+            f"{'Synced' if done else 'Syncing'} watched folders: {added} added, "
+            f"{removed} removed, {moved} moved, {updated} updated")
+        self.import_status.show()
+        if done:
+            self.save_playback_state()
+            QTimer.singleShot(5000, self.import_status.hide)
+
+    def find_duplicates(self):
+        if self.duplicate_thread is not None:
+            # A search is running: the button acts as cancel
+            self.duplicate_thread.cancel()
+            self.duplicates_button.setEnabled(False)
+            return
+
+        from duplicates import DuplicateScanThread
+
+        self.duplicate_thread = DuplicateScanThread(self.playlist_model.store, self.metadata_cache)
+        self.duplicate_thread.progress.connect(self.duplicate_progress)
+        self.duplicate_thread.scan_finished.connect(self.duplicates_found)
+        self.duplicates_button.setText("Cancel Search")
+        self.import_status.setText("Looking for duplicates...")
+        self.import_status.show()
+        self.duplicate_thread.start()
+
+    def duplicate_progress(self, stage, done, total):
+        if stage == 'reading':
+            self.import_status.setText(f"Looking for duplicates: {done} of {total} files checked")
+        else:
+            self.import_status.setText(f"Looking for duplicates: {done} of {total} candidates hashed")
+
+    def duplicates_found(self, groups, cancelled):
+        thread = self.duplicate_thread
+        thread.wait()
+        self.duplicate_thread = None
+        self.duplicates_button.setText("Find Duplicates")
+        self.duplicates_button.setEnabled(True)
+        QTimer.singleShot(5000, self.import_status.hide)
+        if cancelled:
+            self.import_status.setText("Duplicate search cancelled")
+            return
+        if thread.store is not self.playlist_model.store:
+            # The playlist was replaced meanwhile
+            self.import_status.setText("The playlist changed; search again")
+            return
+        rows = self._duplicate_rows(groups)
+        if not rows:
+            self.import_status.setText("No duplicates found")
+            return
+
+        store = self.playlist_model.store
+        extra = sum(len(group) - 1 for group, _ in rows)
+        report = ['\n'.join(('  ' if row != keep else '* ') + store.path(row) for row in group)
+                  for group, keep in rows[:1000]]
+        if len(report) < len(rows):
+            report.append(f"... and {len(rows) - len(report)} more groups")
+        self.import_status.setText(f"Found {extra} duplicate tracks")
+
+        box = QMessageBox(self)
+        box.setWindowTitle("Duplicates")
+        box.setText(f"Found {extra} duplicate tracks in {len(rows)} groups.")
+        box.setInformativeText("Remove the extra copies from the playlist? "
+                               "The files themselves are not deleted.")
+        box.setDetailedText("Copies marked * are kept.\n\n" + '\n\n'.join(report))
+        box.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+        if box.exec() != QMessageBox.StandardButton.Yes:
+            return
+        if thread.store is not self.playlist_model.store:
+            self.import_status.setText("The playlist changed; search again")
+            return
+        # The watcher may have removed tracks while the dialog was open:
+        # the rows are looked up again
+        extra = [row for group, keep in self._duplicate_rows(groups)
+                 for row in group if row != keep]
+        if self.watcher is not None:
+            # Syncing the watched folders must not bring them back
+            self.watcher.ignore([store.path(row) for row in extra])
+        self.playlist_model.remove_tracks(extra)
+        # Rows moved up like after sorting
+        self.engine.follow_current(self.playlist_model.playing_row())
+        self.save_playback_state()
+        self.publish_state()
+        self.import_status.setText(f"Removed {len(extra)} duplicate tracks")
+
+    def _duplicate_rows(self, groups):
+        # (store rows, row to keep) of each group of duplicate track ids, for
+        # the tracks still in the playlist: the playing track is kept, else
+        # the first copy
+        store = self.playlist_model.store
+        playing = self.playlist_model.playing_store_row()
+        rows = []
+        for group in groups:
+            group = [row for row in map(store.row_of_id, group) if row >= 0]
+            if len(group) > 1:
+                rows.append((group, playing if playing in group else group[0]))
+        return rows
+
+    def closeEvent(self, event):
+        if self.import_thread is not None:
+            self.import_thread.cancel()
+            self.import_thread.wait()
+        if self.duplicate_thread is not None:
+            self.duplicate_thread.cancel()
+            self.duplicate_thread.wait()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.remote is not None:
+            self.remote.close()
+        self.save_playback_state()
+        if self.autosaver is not None:
+            self.autosaver.close()
+        if self.loudness is not None:
+            self.loudness.close()
+        if self.waveforms is not None:
+            self.waveforms.shutdown()
+        if self.search_index is not None and self.search_index.dirty:
             try:
-                audio = ID3(file_path)
-                has_id3 = True
-            except:
-                audio = File(file_path)
-                has_id3 = False
-            
-            # Extract metadata
-            if has_id3:
-                # Get title
-                if 'TIT2' in audio:
-                    title = str(audio['TIT2'])
-                    self.song_title_label.setText(title)
-                else:
-                    self.song_title_label.setText(os.path.basename(file_path))
-                
-                # Get artist
-                if 'TPE1' in audio:
-                    artist = str(audio['TPE1'])
-                    self.artist_label.setText(artist)
-                else:
-                    self.artist_label.setText("Unknown Artist")
-                
-                # Get album
-                if 'TALB' in audio:
-                    album = str(audio['TALB'])
-                    self.album_label.setText(album)
-                else:
-                    self.album_label.setText("Unknown Album")
-                
-                # Get year
-                if 'TDRC' in audio:
-                    year = str(audio['TDRC'])
-                    self.year_label.setText(f"Year: {year}")
-                else:
-                    self.year_label.setText("")
-                
-                # Get album art
-                if 'APIC:' in audio:
-                    apic = audio['APIC:'].data
-                    image = QImage()
-                    image.loadFromData(apic)
-                    pixmap = QPixmap.fromImage(image)
-                    scaled_pixmap = pixmap.scaled(280, 280, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-                    self.album_art_label.setPixmap(scaled_pixmap)
-                    print("Album art loaded from ID3 tags")
-                else:
-                    # Try alternative APIC tag
-                    for key in audio.keys():
-                        if key.startswith('APIC'):
-                            apic = audio[key].data
-                            image = QImage()
-                            image.loadFromData(apic)
-                            pixmap = QPixmap.fromImage(image)
-                            scaled_pixmap = pixmap.scaled(280, 280, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-                            self.album_art_label.setPixmap(scaled_pixmap)
-                            print(f"Album art loaded from {key}")
-                            break
-                    else:
-                        # No album art found
-                        default_art = QPixmap(280, 280)
-                        default_art.fill(QColor(COLORS['surface1']))
-                        self.album_art_label.setPixmap(default_art)
-                        print("No album art found in ID3 tags")
-            else:
-                # No ID3 tags, try to get basic metadata
-                if hasattr(audio, 'tags') and audio.tags:
-                    if 'TIT2' in audio.tags:
-                        title = str(audio.tags['TIT2'])
-                        self.song_title_label.setText(title)
-                    else:
-                        self.song_title_label.setText(os.path.basename(file_path))
-                    
-                    if 'TPE1' in audio.tags:
-                        artist = str(audio.tags['TPE1'])
-                        self.artist_label.setText(artist)
-                    else:
-                        self.artist_label.setText("Unknown Artist")
-                    
-                    if 'TALB' in audio.tags:
-                        album = str(audio.tags['TALB'])
-                        self.album_label.setText(album)
-                    else:
-                        self.album_label.setText("Unknown Album")
-                    
-                    if 'TDRC' in audio.tags:
-                        year = str(audio.tags['TDRC'])
-                        self.year_label.setText(f"Year: {year}")
-                    else:
-                        self.year_label.setText("")
-                    
-                    # Try to get album art from tags
-                    if 'APIC:' in audio.tags:
-                        apic = audio.tags['APIC:'].data
-                        image = QImage()
-                        image.loadFromData(apic)
-                        pixmap = QPixmap.fromImage(image)
-                        scaled_pixmap = pixmap.scaled(280, 280, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-                        self.album_art_label.setPixmap(scaled_pixmap)
-                        print("Album art loaded from tags")
-                    else:
-                        # No album art found
-                        default_art = QPixmap(280, 280)
-                        default_art.fill(QColor(COLORS['surface1']))
-                        self.album_art_label.setPixmap(default_art)
-                        print("No album art found in tags")
-                else:
-                    # No tags found
-                    self.song_title_label.setText(os.path.basename(file_path))
-                    self.artist_label.setText("Unknown Artist")
-                    self.album_label.setText("Unknown Album")
-                    self.year_label.setText("")
-                    default_art = QPixmap(280, 280)
-                    default_art.fill(QColor(COLORS['surface1']))
-                    self.album_art_label.setPixmap(default_art)
-                    print("No tags found")
-        except Exception as e:
-            print(f"Error updating metadata: {e}")
-            self.song_title_label.setText(os.path.basename(file_path))
-            self.artist_label.setText("Unknown Artist")
-            self.album_label.setText("Unknown Album")
-            self.year_label.setText("")
-            default_art = QPixmap(280, 280)
-            default_art.fill(QColor(COLORS['surface1']))
-            self.album_art_label.setPixmap(default_art)
+                self.search_index.save()
+            except OSError as e:
+                print(f"Error saving search index: {e}")
+        self.cover_art.shutdown()
+        self.engine.shutdown()
+        super().closeEvent(event)
 
-    def play_pause(self):
-        if not self.playlist_files:
+    def start_audio(self):
+        # Open the audio device on a worker thread while the window paints
+        self.engine.open_audio()
+
+    def play_selected(self, model_index):
+        self.engine.play_index(model_index.row())
+
+    def show_playlist_menu(self, position):
+        row = self.playlist.indexAt(position).row()
+        if row < 0:
             return
+        menu = QMenu(self)
+        menu.addAction("Play Next", lambda: self.queue_rows([row], play_next=True))
+        menu.addAction("Add to Queue", lambda: self.queue_rows([row]))
+        if self.engine.queue.up_next:
+            menu.addSeparator()
+            menu.addAction(f"Clear Queue ({len(self.engine.queue.up_next)})", self.clear_queue)
+        menu.exec(self.playlist.viewport().mapToGlobal(position))
+
+    def queue_rows(self, rows, play_next=False):
+        if play_next:
+            self.engine.play_next(rows)
+        else:
+            self.engine.enqueue(rows)
+        self.publish_state()
+
+    def clear_queue(self):
+        self.engine.clear_up_next()
+        self.publish_state()
 
-        if not self.is_playing:
-            if not self.current_file:
-                self.current_file = self.playlist_files[0]
-                pygame.mixer.music.load(self.current_file)
-                # Update song metadata and artwork
-                self.update_metadata(self.current_file)
-                # Update song length
-                try:
-                    audio = MP3(self.current_file)
-                    self.song_length = audio.info.length
-                    self.time_slider.setMaximum(int(self.song_length))
-                    self.total_time.setText(self.format_time(self.song_length))
-                except:
-                    self.song_length = 0
-                    self.time_slider.setMaximum(100)
-                    self.total_time.setText("0:00")
-            
-            # If paused, resume from the current position
-            if self.is_paused:
-                pygame.mixer.music.unpause()
-            else:
-                # Start from the beginning or the current position
-                pygame.mixer.music.play(start=self.current_position)
-            
-            self.is_playing = True
-            self.is_paused = False
+    def set_shuffle(self, enabled):
+        self.engine.set_shuffle(enabled)
+        self.publish_state()
+
+    def set_repeat(self, mode):
+        self.engine.set_repeat(mode)
+        self.publish_state()
+
+    def playback_state_changed(self, state):
+        if state == PlaybackState.PLAYING:
             self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause))
-            self.timer.start()
         else:
-            # Pause the music and store the current position
-            pygame.mixer.music.pause()
-            self.current_position = pygame.mixer.music.get_pos() / 1000
-            self.is_playing = False
-            self.is_paused = True
             self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPlay))
-            self.timer.stop()
+            if state == PlaybackState.STOPPED:
+                self.time_slider.setValue(0)
+                self.current_time.setText("0:00")
+        if state == PlaybackState.PLAYING:
+            self.state_save_timer.start()
+        else:
+            self.state_save_timer.stop()
+        self.save_playback_state()
+        self.publish_state()
+        self.schedule_track_end()
+        self.update_refresh()
 
-    def stop_music(self):
-        if self.current_file:
-            pygame.mixer.music.stop()
-            self.is_playing = False
-            self.is_paused = False
-            self.current_position = 0
-            self.time_slider.setValue(0)
-            self.current_time.setText("0:00")
-            self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPlay))
-            self.timer.stop()
+    def track_changed(self, index, file_path, metadata):
+        self.playlist.selectRow(index)
+        self.playlist_model.set_playing_row(index)
+        self.time_slider.setValue(0)
+        self.current_time.setText("0:00")
+        self.update_metadata(index, file_path, metadata)
+        self.show_waveform(file_path)
+        self.save_playback_state()
+        self.publish_state()
+        self.schedule_track_end()
+        self.update_refresh()
 
-    def play_next(self):
-        if not self.playlist_files:
+    def seeked(self, position):
+        self.save_playback_state()
+        self.publish_state()
+        self.schedule_track_end()
+        self.update_refresh()
+
+    def schedule_track_end(self):
+        if not self.engine.is_playing:
+            self.end_timer.stop()
             return
+        remaining = self.engine.time_until_end()
+        if remaining is None:
+            self.end_timer.start(UNKNOWN_LENGTH_POLL_MS)
+        elif remaining * 1000 > 2 * END_RECHECK_MS:
+            self.end_timer.start(int(remaining * 1000) - END_RECHECK_MS)
+        else:
+            self.end_timer.start(int(remaining * 1000) + END_MARGIN_MS)
 
-        self.current_index = (self.current_index + 1) % len(self.playlist_files)
-        self.current_file = self.playlist_files[self.current_index]
-        self.playlist.setCurrentRow(self.current_index)
-        pygame.mixer.music.load(self.current_file)
-        pygame.mixer.music.play()
-        self.is_playing = True
-        self.is_paused = False
-        self.current_position = 0
-        self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause))
-        self.timer.start()
-        
-        # Update song metadata and artwork
-        self.update_metadata(self.current_file)
-        
-        # Update song length
-        try:
-            audio = MP3(self.current_file)
-            self.song_length = audio.info.length
-            self.time_slider.setMaximum(int(self.song_length))
-            self.total_time.setText(self.format_time(self.song_length))
-        except:
-            self.song_length = 0
-            self.time_slider.setMaximum(100)
-            self.total_time.setText("0:00")
+    def track_end_due(self):
+        # Handles the end event; a track change re-arms the timer through
+        # track_changed, otherwise (re-check, or length slightly off) this does
+        self.engine.poll()
+        self.schedule_track_end()
 
-    def play_previous(self):
-        if not self.playlist_files:
+    def track_prefetched(self, file_path, metadata):
+        # Runs on the engine's prefetch thread; decoding is already async
+        if metadata.art_ref:
+            self.cover_art.request(metadata.art_ref)
+        if self.waveforms is not None and self.waveform_shown:
+            self.waveforms.request(file_path, prefetch=True)
+
+    def update_metadata(self, index, file_path, metadata):
+        if metadata is None:
+            self.song_title_label.setText(os.path.basename(file_path))
+            self.artist_label.setText("Unknown Artist")
+            self.album_label.setText("Unknown Album")
+            self.year_label.setText("")
+            self.show_album_art(None)
+            self.update_song_length(0)
             return
 
-        self.current_index = (self.current_index - 1) % len(self.playlist_files)
-        self.current_file = self.playlist_files[self.current_index]
-        self.playlist.setCurrentRow(self.current_index)
-        pygame.mixer.music.load(self.current_file)
-        pygame.mixer.music.play()
-        self.is_playing = True
-        self.is_paused = False
-        self.current_position = 0
-        self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause))
-        self.timer.start()
-        
-        # Update song metadata and artwork
-        self.update_metadata(self.current_file)
-        
-        # Update song length
-        try:
-            audio = MP3(self.current_file)
-            self.song_length = audio.info.length
-            self.time_slider.setMaximum(int(self.song_length))
-            self.total_time.setText(self.format_time(self.song_length))
-        except:
-            self.song_length = 0
-            self.time_slider.setMaximum(100)
-            self.total_time.setText("0:00")
+        # Fill in tags for tracks that were added before they were cached
+        self.playlist_model.update_track(index, metadata.title, metadata.artist,
+                                         metadata.album, metadata.duration)
+
+        self.song_title_label.setText(metadata.title or os.path.basename(file_path))
+        self.artist_label.setText(metadata.artist or "Unknown Artist")
+        self.album_label.setText(metadata.album or "Unknown Album")
+        self.year_label.setText(f"Year: {metadata.year}" if metadata.year else "")
+        self.show_album_art(metadata.art_ref)
+        self.update_song_length(metadata.duration)
+
+    def show_album_art(self, art_ref):
+        self.current_art_ref = art_ref
+        image = self.cover_art.request(art_ref) if art_ref else None
+        if image is not None:
+            self.album_art_label.setPixmap(QPixmap.fromImage(image))
+        else:
+            # No album art, or it is still being decoded (see album_art_ready)
+            self.album_art_label.setPixmap(self.default_art)
+
+    def album_art_ready(self, art_ref, image):
+        # Ignore covers of tracks that are no longer current
+        if art_ref == self.current_art_ref and not image.isNull():
+            self.album_art_label.setPixmap(QPixmap.fromImage(image))
+
+    def show_waveform(self, file_path):
+        self.waveform_path = file_path
+        waveform = None
+        if self.waveforms is not None and self.waveform_checkbox.isChecked():
+            # Drawn flat until the waveform is loaded (see waveform_ready)
+            waveform = self.waveforms.request(file_path)
+        self.time_slider.set_waveform(waveform)
+
+    def waveform_ready(self, file_path, waveform):
+        # Ignore waveforms of tracks that are no longer current
+        if file_path == self.waveform_path and self.waveform_checkbox.isChecked():
+            self.time_slider.set_waveform(waveform)
+
+    def set_waveform_shown(self, shown):
+        self.waveform_shown = shown
+        self.time_slider.show_waveform(shown)
+        if self.waveform_path is not None:
+            self.show_waveform(self.waveform_path)
+
+    def update_song_length(self, length):
+        self.time_slider.set_length(length)
+        self.total_time.setText(self.format_time(length) if length > 0 else "0:00")
+
+    def play_pause(self):
+        self.engine.toggle()
+
+    def stop_music(self):
+        self.engine.stop()
+
+    def play_next(self):
+        self.engine.next()
+
+    def play_previous(self):
+        self.engine.previous()
 
     def slider_pressed(self):
         self.slider_is_pressed = True
-        # Store the current position when slider is pressed
-        if pygame.mixer.music.get_busy():
-            self.current_position = pygame.mixer.music.get_pos() / 1000
 
     def slider_released(self):
-        if self.current_file and self.song_length > 0:
-            position = self.time_slider.value()
-            self.current_position = position
-            
-            # Stop current playback
-            pygame.mixer.music.stop()
-            
-            # Start playing from the new position
-            pygame.mixer.music.load(self.current_file)
-            pygame.mixer.music.play(start=position)
-            
-            # Update the current time display
-            self.current_time.setText(self.format_time(position))
-            
-            # Set a flag to prevent the timer from resetting the slider immediately
-            self.just_seeked = True
-            self.seek_position = position
-            self.last_update_time = pygame.mixer.music.get_pos() / 1000
-            
-            self.is_playing = True
-            self.is_paused = False
-            self.play_button.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause))
-            self.timer.start()
+        if self.engine.current_file and self.engine.song_length > 0:
+            position = self.time_slider.value() / 1000.0
+            self.engine.seek(position)
+            self.time_slider.setValue(int(self.engine.position() * 1000))
+            self.current_time.setText(self.format_time(self.engine.position()))
         self.slider_is_pressed = False
 
+    def set_gapless(self, enabled):
+        self.engine.set_gapless(enabled)
+
     def change_volume(self, value):
-        volume = value / 100.0
-        pygame.mixer.music.set_volume(volume)
+        self.engine.set_volume(value / 100.0)
+        self.publish_state()
+
+    # Remote control (see remote_control)
+
+    def publish_state(self):
+        if self.remote is not None:
+            self.remote.publish(self.remote_state())
+
+    def remote_state(self):
+        # Clients move the position on by themselves from `time` while playing
+        queue = self.engine.queue
+        store_row = self.playlist_model.store.row_of_id(queue.current_id) \
+            if queue.current_id is not None else -1
+        return {
+            'state': self.engine.state.value,
+            'track': self.remote_track(store_row) if store_row >= 0 else None,
+            'position': self.engine.position(),
+            'time': time.time(),
+            'volume': self.engine.volume,
+            'shuffle': queue.shuffle,
+            'repeat': queue.repeat,
+            'up_next': len(queue.up_next),
+            'tracks': len(self.playlist_model.store),
+        }
+
+    def remote_track(self, store_row):
+        path, title, artist, album, duration = self.playlist_model.store.track(store_row)
+        return {'id': self.playlist_model.store.ids[store_row], 'path': path,
+                'title': title or os.path.basename(path), 'artist': artist, 'album': album,
+                'duration': duration}
+
+    def remote_row(self, track_id):
+        # View row of a track id sent by a client
+        row = self.playlist_model.row_of_id(int(track_id))
+        if row < 0:
+            raise LookupError(f"Track {track_id} is not in the playlist")
+        return row
+
+    def remote_command(self, command, args):
+        """Run a remote control command on the GUI thread; returns its
+        JSON result, the player's state for commands that change it."""
+        engine = self.engine
+        if command == 'library':
+            return self.remote_library(args.get('query', ''), int(args.get('offset', 0)),
+                                       int(args.get('limit', 50)))
+        if command == 'queue':
+            store = self.playlist_model.store
+            rows = (store.row_of_id(track_id) for track_id in engine.queue.up_next)
+            return [self.remote_track(row) for row in rows if row >= 0][:REMOTE_PAGE_LIMIT]
+
+        if command == 'play' and 'id' in args:
+            engine.play_index(self.remote_row(args['id']))
+        elif command in ('play', 'pause', 'toggle', 'stop', 'next', 'previous'):
+            getattr(engine, command)()
+        elif command == 'seek':
+            engine.seek(max(float(args['position']), 0.0))
+        elif command == 'volume':
+            volume = float(args['volume'])
+            if not 0 <= volume <= 1:
+                raise ValueError("volume must be between 0 and 1")
+            self.volume_slider.setValue(round(volume * 100))
+        elif command == 'shuffle':
+            self.shuffle_checkbox.setChecked(bool(args['enabled']))
+        elif command == 'repeat':
+            if args['mode'] not in REPEAT_MODES:
+                raise ValueError(f"mode must be one of {', '.join(REPEAT_MODES)}")
+            self.repeat_box.setCurrentIndex(REPEAT_MODES.index(args['mode']))
+        elif command == 'enqueue':
+            self.queue_rows([self.remote_row(track_id) for track_id in args['ids']],
+                            play_next=bool(args.get('next')))
+        elif command == 'clear_queue':
+            self.clear_queue()
+        else:
+            raise LookupError(f"Unknown command {command}")
+        return self.remote_state()
+
+    def remote_library(self, query, offset, limit):
+        # A page of the tracks matching a search (all of them for an empty
+        # query), in playlist order
+        limit = max(0, min(limit, REMOTE_PAGE_LIMIT))
+        offset = max(offset, 0)
+        store = self.playlist_model.store
+        if query.strip():
+            if self.search_index is None or not self.search_index.ready:
+                raise ValueError("The search index is still loading")
+            import numpy as np
+            rows = np.flatnonzero(self.search_index.search(query))
+        else:
+            rows = range(len(store))
+        return {'total': len(rows), 'offset': offset,
+                'tracks': [self.remote_track(int(row)) for row in rows[offset:offset + limit]]}
 
     def update_slider(self):
-        if pygame.mixer.music.get_busy() and not self.slider_is_pressed:
-            # Get the current time from pygame
-            current_time = pygame.mixer.music.get_pos() / 1000
-            
-            # If we just seeked, use our tracked position instead of pygame's position
-            if self.just_seeked:
-                # Calculate elapsed time since seeking
-                elapsed = current_time - self.last_update_time
-                if elapsed > 0:
-                    # Update our tracked position
-                    self.seek_position += elapsed
-                    self.last_update_time = current_time
-                
-                # Use our tracked position for display
-                self.time_slider.setValue(int(self.seek_position))
-                self.current_time.setText(self.format_time(self.seek_position))
-                
-                # Never switch back to normal tracking - keep using our tracked position
-                # This ensures the slider stays synchronized throughout playback
-            else:
-                # Normal update
-                self.time_slider.setValue(int(current_time))
-                self.current_time.setText(self.format_time(current_time))
-                self.current_position = current_time
-                self.last_update_time = current_time
-        elif not pygame.mixer.music.get_busy() and self.is_playing and not self.is_paused:
-            self.play_next()
+        with metrics.span('ui_tick'):
+            if self.engine.is_playing and not self.slider_is_pressed:
+                position = self.engine.position()
+                self.time_slider.setValue(int(position * 1000))
+                self.current_time.setText(self.format_time(position))
+        self.update_refresh()
+
+    def refresh_interval(self):
+        # Milliseconds until the position display next changes, or None when
+        # nobody can see it move
+        if not self.engine.is_playing or not self.isVisible() or self.isMinimized():
+            return None
+        position_ms = int(self.engine.position() * 1000)
+        # The time label changes on whole seconds (a few ms late, so that a
+        # timer firing slightly early does not find the old second)
+        interval = 1000 - position_ms % 1000 + 5
+        if self.isActiveWindow() and self.engine.song_length > 0:
+            # In the foreground, also follow the slider handle pixel by pixel
+            pixel_ms = self.engine.song_length * 1000 / max(self.time_slider.width(), 1)
+            interval = min(interval, max(int(pixel_ms), MIN_REFRESH_MS))
+        return interval
+
+    def update_refresh(self):
+        interval = self.refresh_interval()
+        if interval is None:
+            self.timer.stop()
+        else:
+            self.timer.start(interval)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.update_slider()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.timer.stop()
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() in (QEvent.Type.WindowStateChange, QEvent.Type.ActivationChange):
+            # Minimized, restored, focused or sent to the background
+            self.update_slider()
 
     def format_time(self, seconds):
         minutes = int(seconds // 60)
@@ -576,7 +1177,12 @@ class MusicPlayer(QMainWindow):
         return f"{minutes}:{seconds:02d}"
 
 if __name__ == '__main__':
+    metrics.configure_from_environment()
     app = QApplication(sys.argv)
     player = MusicPlayer()
     player.show()
+    # Open the audio device and the saved playlist once the event loop has
+    # painted the window
+    QTimer.singleShot(0, player.start_audio)
+    QTimer.singleShot(0, player.restore_playlist)
     sys.exit(app.exec()) 
\ No newline at end of file
@@ -0,0 +1,269 @@
+"""Play queue: what plays after (and before) the current track.
+
+Tracks are remembered by their stable id (TrackStore.ids, or the index of
+a PathList), never by row, so sorting, filtering or removing tracks does
+not lose the current track, the history or the up-next queue; rows are
+looked up from ids when needed.
+
+Every step is O(1):
+
+    shuffle     a lazy Fisher-Yates shuffle: each step swaps one random
+                undrawn position into place, in a dict holding only the
+                positions touched so far, so shuffling a million tracks
+                costs nothing up front and every track plays once per cycle
+    history     ids of the tracks played before the current one, so
+                previous retraces a shuffle (and next then replays it)
+    up next     a deque of ids, played before the playlist continues;
+                play_next() puts tracks in front, enqueue() at the back
+"""
+import random
+from collections import deque
+
+# Repeat modes (see PlayQueue.set_repeat)
+REPEAT_MODES = ('off', 'all', 'one')
+
+# Tracks kept for previous()
+HISTORY_SIZE = 10000
+
+_UNSET = object()
+
+
+class PlayQueue:
+    """Order of play over a playlist: len(playlist), playlist.track_id(row)
+    and playlist.row_of_id(track_id) (-1 when it is not shown).
+
+    peek() says which row plays next without moving; advance() moves there,
+    and previous() back. Hosts call jump() when a row is played directly,
+    and playlist_changed() when rows were sorted, filtered or removed
+    (appended rows are picked up by themselves).
+    """
+
+    def __init__(self, playlist, seed=None):
+        self.playlist = playlist
+        self.shuffle = False
+        self.repeat = 'all'
+        self.current_id = None
+        # The last track played in playlist order: up-next tracks are
+        # played in between, and the playlist goes on after this one
+        self._anchor_id = None
+        self.history = deque(maxlen=HISTORY_SIZE)
+        # Ids that previous() stepped back over, most recent last
+        self.forward = []
+        self.up_next = deque()
+        self._random = random.Random(seed)
+        self._reset_shuffle()
+        # What peek() found: (source, track id, row) or None, until it is
+        # taken or something changes
+        self._peeked = _UNSET
+        self._peeked_auto = True
+
+    # Position
+
+    def current_row(self):
+        if self.current_id is None:
+            return -1
+        return self.playlist.row_of_id(self.current_id)
+
+    def jump(self, row):
+        # The host plays `row` directly, e.g. on a double click; a shuffle
+        # then does not play it again this cycle
+        self._peeked = _UNSET
+        self.forward.clear()
+        self._move_to(self.playlist.track_id(row))
+        if self.shuffle:
+            self._place(row, self.current_id)
+
+    def peek(self, auto=True):
+        """Row that advance() would play, or None at the end of the
+        playlist without repeat. `auto` is for tracks that ended by
+        themselves: only those repeat with repeat 'one'."""
+        if self._peeked is _UNSET or (self.repeat == 'one' and auto != self._peeked_auto):
+            self._peeked = self._find_next(auto)
+            self._peeked_auto = auto
+        return self._peeked[2] if self._peeked is not None else None
+
+    def advance(self, auto=False):
+        # Move to the next track; returns its row, or None
+        row = self.peek(auto)
+        if row is None:
+            return None
+        source, track_id, _ = self._peeked
+        self._peeked = _UNSET
+        if source == 'repeat':
+            return row
+        if source == 'forward':
+            self.forward.pop()
+        elif source == 'up_next':
+            self.up_next.popleft()
+        elif source == 'shuffle':
+            self._take(track_id)
+        self._move_to(track_id, anchor=source != 'up_next')
+        return row
+
+    def previous(self):
+        """Move back to the track played before; returns its row, or None.
+
+        In shuffle mode that is the previous track of the history; in
+        playlist order it is the previous row.
+        """
+        self._peeked = _UNSET
+        if self.shuffle:
+            while self.history:
+                track_id = self.history.pop()
+                row = self.playlist.row_of_id(track_id)
+                if row >= 0:
+                    if self.current_id is not None:
+                        self.forward.append(self.current_id)
+                    self.current_id = self._anchor_id = track_id
+                    return row
+            return None
+        size = len(self.playlist)
+        if not size:
+            return None
+        row = self.current_row()
+        if row <= 0 and self.repeat == 'off':
+            return None
+        row = (row - 1) % size if row >= 0 else size - 1
+        self.forward.clear()
+        self._move_to(self.playlist.track_id(row))
+        return row
+
+    # Up next
+
+    def play_next(self, rows):
+        # Play these rows, in order, right after the current track
+        self.up_next.extendleft(self.playlist.track_id(row) for row in reversed(rows))
+        self._peeked = _UNSET
+
+    def enqueue(self, rows):
+        # Play these rows after everything already queued
+        self.up_next.extend(self.playlist.track_id(row) for row in rows)
+        self._peeked = _UNSET
+
+    def clear_up_next(self):
+        self.up_next.clear()
+        self._peeked = _UNSET
+
+    # Modes
+
+    def set_shuffle(self, enabled):
+        if enabled != self.shuffle:
+            self.shuffle = enabled
+            self.forward.clear()
+            self._reset_shuffle()
+            self._peeked = _UNSET
+            row = self.current_row()
+            if enabled and row >= 0:
+                # The shuffle starts with what is playing
+                self._place(row, self.current_id)
+
+    def set_repeat(self, mode):
+        # One of REPEAT_MODES
+        if mode not in REPEAT_MODES:
+            raise ValueError(f"Unknown repeat mode {mode!r}")
+        self.repeat = mode
+        self._peeked = _UNSET
+
+    def playlist_changed(self):
+        """Rows were sorted, filtered or removed: the shuffle starts over
+        on the new rows, leaving out the tracks it already played this
+        cycle (O(tracks played))."""
+        self._peeked = _UNSET
+        played = self._played
+        self._reset_shuffle()
+        for track_id in played:
+            row = self.playlist.row_of_id(track_id)
+            if row >= 0:
+                self._place(row, track_id)
+
+    # Internals
+
+    def _move_to(self, track_id, anchor=True):
+        if self.current_id is not None and self.current_id != track_id:
+            self.history.append(self.current_id)
+        self.current_id = track_id
+        if anchor:
+            self._anchor_id = track_id
+
+    def _find_next(self, auto):
+        # (source, track id, row) of the next track, or None
+        if auto and self.repeat == 'one':
+            row = self.current_row()
+            if row >= 0:
+                return 'repeat', self.current_id, row
+        while self.forward:
+            row = self.playlist.row_of_id(self.forward[-1])
+            if row >= 0:
+                return 'forward', self.forward[-1], row
+            # Removed or hidden since
+            self.forward.pop()
+        while self.up_next:
+            row = self.playlist.row_of_id(self.up_next[0])
+            if row >= 0:
+                return 'up_next', self.up_next[0], row
+            self.up_next.popleft()
+        if not len(self.playlist):
+            return None
+        if self.shuffle:
+            row = self._draw()
+            return None if row is None else ('shuffle', self.playlist.track_id(row), row)
+
+        anchor = self.playlist.row_of_id(self._anchor_id) if self._anchor_id is not None else -1
+        row = anchor + 1
+        if row >= len(self.playlist):
+            if self.repeat == 'off':
+                return None
+            row = 0
+        return 'order', self.playlist.track_id(row), row
+
+    def _reset_shuffle(self):
+        # Position -> row for the positions touched so far, and row ->
+        # position for the rows they moved; untouched positions hold their
+        # own row. Positions below _drawn are played this cycle
+        self._swaps = {}
+        self._positions = {}
+        self._drawn = 0
+        self._size = 0
+        self._played = set()
+
+    def _draw(self):
+        # Row at the next shuffle position: a random undrawn row is swapped
+        # there (a peek that is dropped leaves another undrawn row there)
+        size = len(self.playlist)
+        if size > self._size:
+            # Appended rows join the undrawn part
+            self._size = size
+        if self._drawn >= self._size:
+            if self.repeat == 'off':
+                return None
+            # A new cycle, which the current track starts
+            self._reset_shuffle()
+            self._size = size
+            current = self.current_row()
+            if current >= 0 and size > 1:
+                self._place(current, self.current_id)
+        position = self._drawn
+        self._swap(position, self._random.randrange(position, self._size))
+        return self._swaps.get(position, position)
+
+    def _swap(self, first, second):
+        swaps, positions = self._swaps, self._positions
+        a, b = swaps.get(first, first), swaps.get(second, second)
+        swaps[first], swaps[second] = b, a
+        positions[b], positions[a] = first, second
+
+    def _take(self, track_id):
+        # The row at the next position leaves the undrawn part; drawn
+        # positions are never read again
+        row = self._swaps.pop(self._drawn, self._drawn)
+        self._positions.pop(row, None)
+        self._drawn += 1
+        self._played.add(track_id)
+
+    def _place(self, row, track_id):
+        # Mark a row as drawn by swapping it into the next position
+        if track_id in self._played:
+            return
+        self._size = max(self._size, len(self.playlist))
+        self._swap(self._drawn, self._positions.get(row, row))
+        self._take(track_id)
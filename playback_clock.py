@@ -0,0 +1,52 @@
+class PlaybackClock:
+    """Single source of truth for the playback position.
+
+    The position is derived from an audio-driven millisecond counter
+    (pygame.mixer.music.get_pos by default), which only advances while
+    samples are actually played. It therefore stops during pause and
+    cannot drift from the audio the way a wall-clock timer does. Seeks and
+    resumes re-anchor the clock instead of restarting it.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._base = 0.0
+        self._anchor = 0
+        self._running = False
+
+    def _counter(self):
+        # get_pos() returns -1 when nothing is loaded
+        return max(self._source(), 0)
+
+    def start(self, position=0.0, anchor=None):
+        # anchor: counter value that corresponds to `position` (defaults to now)
+        self._base = position
+        self._anchor = self._counter() if anchor is None else anchor
+        self._running = True
+
+    def seek(self, position):
+        self._base = position
+        self._anchor = self._counter()
+
+    def pause(self):
+        if self._running:
+            self._base = self.position()
+            self._running = False
+
+    def resume(self):
+        if not self._running:
+            self._anchor = self._counter()
+            self._running = True
+
+    def stop(self):
+        self._base = 0.0
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def position(self):
+        if not self._running:
+            return self._base
+        return self._base + max(self._counter() - self._anchor, 0) / 1000.0
@@ -0,0 +1,574 @@
+import os
+import sys
+import time
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import http_stream
+from metadata_cache import MetadataCache
+from playback_clock import PlaybackClock
+from play_queue import PlayQueue
+
+# pygame is imported on a worker thread by open_audio(), so neither the
+# engine nor the window pays for it at import time
+pygame = None
+
+
+def decoder_buffer_from_environment(dsp_settings=None):
+    """Buffer depth in ms of the decoder process, or 0 when it is off:
+    MUSIC_PLAYER_DECODER=1 turns it on (as do equalizer bands and a
+    crossfade, which need it; dsp_settings as from dsp_from_environment,
+    read if not given), MUSIC_PLAYER_BUFFER_MS sets the depth
+    (audio_pipeline.DEFAULT_BUFFER_MS by default)."""
+    bands, crossfade = dsp_settings if dsp_settings is not None else dsp_from_environment()
+    if not (os.environ.get('MUSIC_PLAYER_DECODER') or bands or crossfade):
+        return 0
+    import audio_pipeline
+    try:
+        buffer_ms = int(os.environ.get('MUSIC_PLAYER_BUFFER_MS', 0) or 0)
+    except ValueError as e:
+        print(f"Error in MUSIC_PLAYER_BUFFER_MS: {e}")
+        buffer_ms = 0
+    return buffer_ms if buffer_ms > 0 else audio_pipeline.DEFAULT_BUFFER_MS
+
+
+def dsp_from_environment():
+    """Equalizer bands and crossfade seconds: MUSIC_PLAYER_EQ as in
+    dsp.parse_bands, MUSIC_PLAYER_CROSSFADE in seconds."""
+    bands = []
+    if os.environ.get('MUSIC_PLAYER_EQ'):
+        import dsp
+        try:
+            bands = dsp.parse_bands(os.environ['MUSIC_PLAYER_EQ'])
+        except ValueError as e:
+            print(f"Error in MUSIC_PLAYER_EQ: {e}")
+    try:
+        crossfade = max(float(os.environ.get('MUSIC_PLAYER_CROSSFADE', 0) or 0), 0.0)
+    except ValueError as e:
+        print(f"Error in MUSIC_PLAYER_CROSSFADE: {e}")
+        crossfade = 0.0
+    return bands, crossfade
+
+
+def _open_audio_device(decoder_buffer_ms=0):
+    # Returns what plays tracks: pygame's music stream, or a decoder
+    # process feeding a mixer channel (see audio_pipeline)
+    global pygame
+    import pygame as pygame_module
+    pygame_module.mixer.init()
+    pygame = pygame_module
+    if decoder_buffer_ms:
+        import audio_pipeline
+        return audio_pipeline.DecodedMusic(decoder_buffer_ms)
+    return pygame_module.mixer.music
+
+
+class PlaybackState(Enum):
+    STOPPED = 'stopped'
+    PLAYING = 'playing'
+    PAUSED = 'paused'
+
+
+# Allowed state transitions; PLAYING -> PLAYING is a track change or seek
+TRANSITIONS = {
+    PlaybackState.STOPPED: {PlaybackState.STOPPED, PlaybackState.PLAYING},
+    PlaybackState.PLAYING: {PlaybackState.PLAYING, PlaybackState.PAUSED, PlaybackState.STOPPED},
+    PlaybackState.PAUSED: {PlaybackState.PAUSED, PlaybackState.PLAYING, PlaybackState.STOPPED},
+}
+
+
+# Loudness normalization modes (see PlaybackEngine.set_normalization)
+NORMALIZATION_MODES = ('off', 'track', 'album')
+
+
+class PathList(list):
+    """Minimal playlist for headless use: a list of paths.
+
+    The engine only needs len(playlist), playlist.path(index) and the track
+    ids of the play queue, which the GUI's PlaylistModel provides as well.
+    Here a track's id is its index.
+    """
+
+    def path(self, index):
+        return self[index]
+
+    def track_id(self, index):
+        return index
+
+    def row_of_id(self, track_id):
+        return track_id if 0 <= track_id < len(self) else -1
+
+
+class PlaybackEngine:
+    """Qt-free playback engine around pygame's music stream (or a decoder
+    process with the same interface, given decoder_buffer_ms; by default
+    from the environment, see decoder_buffer_from_environment).
+
+    Owns the playback state machine (stopped/playing/paused), the current
+    track, the play queue (shuffle, repeat, up next; see play_queue), the
+    position clock, gapless queueing and prefetching. Hosts
+    drive it by calling its commands, and poll() once time_until_end() has
+    elapsed, and observe it through callbacks registered with subscribe():
+
+        state_changed(state)
+        track_changed(index, file_path, metadata)   metadata may be None
+        track_prefetched(file_path, metadata)       called on the prefetch thread
+        seeked(position)
+    """
+
+    EVENTS = ('state_changed', 'track_changed', 'track_prefetched', 'seeked')
+
+    def __init__(self, playlist, metadata_cache=None, decoder_buffer_ms=None):
+        self.playlist = playlist
+        self.metadata_cache = metadata_cache if metadata_cache is not None else MetadataCache()
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.queue = PlayQueue(playlist)
+        self._listeners = {event: [] for event in self.EVENTS}
+
+        self.state = PlaybackState.STOPPED
+        self.current_index = 0
+        self.current_file = None
+        self.metadata = None
+        self.song_length = 0
+        self.gapless = True
+        self.queued_index = None
+        self.volume = 0.5
+        # Loudness normalization: 'off', 'track' or 'album' gain from the
+        # gain provider (see loudness.LoudnessAnalyzer), applied per track
+        self.normalization = 'off'
+        self.loudness = None
+        self.track_gain = 0.0
+        # Where play() starts a cued track (see cue)
+        self.cue_position = 0.0
+        # Equalizer bands (dsp.Band) and crossfade seconds, played through
+        # the decoder process only
+        self.equalizer, self.crossfade = dsp_from_environment()
+
+        # Authoritative playback position, driven by the mixer's sample count
+        self.clock = PlaybackClock(self._mixer_position)
+
+        if decoder_buffer_ms is None:
+            decoder_buffer_ms = decoder_buffer_from_environment((self.equalizer, self.crossfade))
+        self.decoder_buffer_ms = decoder_buffer_ms
+        # pygame.mixer.music, or an audio_pipeline.DecodedMusic
+        self.music = None
+        self._audio_future = None
+        self.audio_ready = False
+        self.track_end_event = None
+
+    # Events
+
+    def subscribe(self, event, callback):
+        self._listeners[event].append(callback)
+
+    def _emit(self, event, *args):
+        for callback in self._listeners[event]:
+            callback(*args)
+
+    def _set_state(self, state):
+        if state not in TRANSITIONS[self.state]:
+            raise RuntimeError(f"Invalid playback transition {self.state.value} -> {state.value}")
+        changed = state != self.state
+        self.state = state
+        if changed:
+            self._emit('state_changed', state)
+
+    @property
+    def is_playing(self):
+        return self.state == PlaybackState.PLAYING
+
+    @property
+    def is_paused(self):
+        return self.state == PlaybackState.PAUSED
+
+    # Audio device
+
+    def open_audio(self):
+        # Import pygame and open the audio device on the prefetch thread
+        if self._audio_future is None:
+            self._audio_future = self.prefetcher.submit(_open_audio_device,
+                                                        self.decoder_buffer_ms)
+
+    def ensure_audio(self):
+        # Finish audio setup on the calling (main) thread; blocks only if the
+        # device is still being opened
+        if self.audio_ready:
+            return
+        self.open_audio()
+        self.music = self._audio_future.result()
+
+        # The end-of-track event needs pygame's event queue, which lives in
+        # the video subsystem; the dummy driver never opens a window
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        pygame.display.init()
+        # Posted whenever a track finishes (including when a queued track takes over)
+        self.track_end_event = pygame.USEREVENT + 1
+        self.music.set_endevent(self.track_end_event)
+        self.music.set_volume(self._mixer_volume())
+        if self.decoder_buffer_ms:
+            self.music.set_equalizer(self.equalizer)
+            self.music.set_crossfade(self.crossfade)
+        self.audio_ready = True
+
+    def _mixer_position(self):
+        return self.music.get_pos() if self.audio_ready else -1
+
+    def shutdown(self):
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        if self.audio_ready:
+            self.music.stop()
+            if self.decoder_buffer_ms:
+                self.music.close()
+        http_stream.close()
+
+    # Commands
+
+    def set_playlist(self, playlist):
+        # Play from another playlist: the play queue starts over on it,
+        # shuffled and repeating as before
+        queue = PlayQueue(playlist)
+        queue.set_shuffle(self.queue.shuffle)
+        queue.set_repeat(self.queue.repeat)
+        self.playlist, self.queue = playlist, queue
+        self.queued_index = None
+
+    def play_index(self, index, start=0.0):
+        if not 0 <= index < len(self.playlist):
+            return
+        self.queue.jump(index)
+        self._play_row(index, start)
+
+    def _play_row(self, index, start=0.0):
+        self.ensure_audio()
+        self.cue_position = 0.0
+        with metrics.span('track_change'):
+            self.current_index = index
+            self.current_file = self.playlist.path(index)
+            self._update_gain()
+            with metrics.span('mixer_load'):
+                self.music.load(*self._music_file(self.current_file))
+            with metrics.span('mixer_play'):
+                self.music.play(start=start)
+            self.clock.start(start)
+            self._set_state(PlaybackState.PLAYING)
+            self._track_started()
+
+    def cue(self, index, position=0.0):
+        """Make a track current without playing it, e.g. when restoring a
+        session; play() then starts it at `position`."""
+        if not 0 <= index < len(self.playlist) or self.state != PlaybackState.STOPPED:
+            return
+        self.queue.jump(index)
+        self.current_index = index
+        self.current_file = None
+        self.cue_position = position
+        file_path = self.playlist.path(index)
+        self.metadata = self._read_metadata(file_path)
+        self.song_length = self.metadata.duration if self.metadata else 0
+        self._emit('track_changed', index, file_path, self.metadata)
+
+    def toggle(self):
+        if self.is_playing:
+            self.pause()
+        else:
+            self.play()
+
+    def play(self):
+        # Resume when paused, otherwise start the current track
+        if not len(self.playlist):
+            return
+        self.ensure_audio()
+        if self.is_paused:
+            self.music.unpause()
+            self.clock.resume()
+            self._set_state(PlaybackState.PLAYING)
+        elif self.state == PlaybackState.STOPPED:
+            if self.current_file is None:
+                if 0 <= self.current_index < len(self.playlist):
+                    self.play_index(self.current_index, self.cue_position)
+                else:
+                    # The cued track was filtered out of the playlist
+                    self.play_index(0)
+            else:
+                # Restart the stopped track from where the clock stands
+                start = self.clock.position()
+                self.music.play(start=start)
+                self.clock.start(start)
+                self._set_state(PlaybackState.PLAYING)
+                self._prepare_next_track()
+
+    def pause(self):
+        if self.is_playing:
+            self.music.pause()
+            self.clock.pause()
+            self._set_state(PlaybackState.PAUSED)
+
+    def stop(self):
+        if self.current_file:
+            self.music.stop()
+            self.clock.stop()
+            self._set_state(PlaybackState.STOPPED)
+
+    def next(self):
+        index = self.queue.advance()
+        if index is not None:
+            self._play_row(index)
+
+    def previous(self):
+        index = self.queue.previous()
+        if index is not None:
+            self._play_row(index)
+
+    def seek(self, position):
+        if not self.current_file:
+            return
+        with metrics.span('seek'):
+            self._seek(position)
+        self._emit('seeked', self.position())
+
+    def _seek(self, position):
+        # Land exactly on a frame boundary, so the clock matches the audio
+        seek_index = self.seek_index(self.current_file)
+        if seek_index is not None:
+            position = seek_index.frame_time(position)
+
+        if self.state == PlaybackState.STOPPED:
+            self.music.play(start=position)
+            self.clock.start(position)
+            self._prepare_next_track()
+        else:
+            try:
+                # Seeks within the open stream: no reload, no re-decode from 0
+                self.music.set_pos(position)
+                self.clock.seek(position)
+            except pygame.error:
+                self.music.load(*self._music_file(self.current_file))
+                self.music.play(start=position)
+                self.clock.start(position)
+                # Loading drops the mixer queue
+                self._prepare_next_track()
+            if self.is_paused:
+                self.music.unpause()
+                self.clock.resume()
+        self._set_state(PlaybackState.PLAYING)
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self.audio_ready:
+            self.music.set_volume(self._mixer_volume())
+
+    def set_normalization(self, mode):
+        # One of NORMALIZATION_MODES; applies to the current track right away
+        self.normalization = mode
+        self._update_gain()
+
+    def set_equalizer(self, bands):
+        # dsp.Band values, applied right away; none turn the equalizer off
+        self.equalizer = list(bands)
+        if self.audio_ready and self.decoder_buffer_ms:
+            self.music.set_equalizer(self.equalizer)
+
+    def set_crossfade(self, seconds):
+        # From the next track queued on
+        self.crossfade = max(seconds, 0.0)
+        if self.audio_ready and self.decoder_buffer_ms:
+            self.music.set_crossfade(self.crossfade)
+
+    def set_gapless(self, enabled):
+        # Takes effect from the next track start; the mixer queue cannot be
+        # emptied without interrupting the current track
+        self.gapless = enabled
+        if enabled and self.is_playing:
+            self._prepare_next_track()
+
+    def set_shuffle(self, enabled):
+        self.queue.set_shuffle(enabled)
+        self._queue_changed()
+
+    def set_repeat(self, mode):
+        # One of play_queue.REPEAT_MODES
+        self.queue.set_repeat(mode)
+        self._queue_changed()
+
+    def play_next(self, indexes):
+        # Play these rows right after the current track
+        self.queue.play_next(indexes)
+        self._queue_changed()
+
+    def enqueue(self, indexes):
+        # Play these rows after the tracks already queued
+        self.queue.enqueue(indexes)
+        self._queue_changed()
+
+    def clear_up_next(self):
+        self.queue.clear_up_next()
+        self._queue_changed()
+
+    def _queue_changed(self):
+        # The track after this one may have changed: queue it instead
+        if self.state != PlaybackState.STOPPED:
+            self._prepare_next_track()
+
+    def follow_current(self, index):
+        # The playlist was reordered, filtered or had tracks removed: the
+        # current track now sits at `index` (-1 if hidden; next() then
+        # starts from the top)
+        self.current_index = index
+        self.queue.playlist_changed()
+        if self.state != PlaybackState.STOPPED:
+            self._prepare_next_track()
+
+    def position(self):
+        if self.current_file is None:
+            return self.cue_position
+        return self.clock.position()
+
+    def time_until_end(self):
+        """Seconds until the current track ends, per the sample clock.
+
+        Returns None when nothing is playing or the track length is unknown.
+        """
+        if not self.is_playing or self.song_length <= 0:
+            return None
+        # A queued track takes over where the crossfade into it starts
+        fade = self.crossfade if self.decoder_buffer_ms and self.queued_index is not None else 0.0
+        return max(self.song_length - fade - self.clock.position(), 0.0)
+
+    def poll(self):
+        """Handle the mixer's end-of-track event.
+
+        Detects when a queued track took over (gapless) and advances to the
+        next track when playback ran out. Hosts call it when
+        time_until_end() has elapsed, or periodically if the length is
+        unknown; calling it early is harmless.
+        """
+        if not self.audio_ready:
+            return
+        for _ in pygame.event.get(self.track_end_event):
+            if self.queued_index is not None and self.music.get_busy():
+                self._queued_track_started()
+
+        if self.is_playing and not self.music.get_busy():
+            index = self.queue.advance(auto=True)
+            if index is None:
+                # The end of the playlist, without repeat
+                self.stop()
+            else:
+                self._play_row(index)
+
+    # Internals
+
+    def _track_started(self):
+        self.metadata = self._read_metadata(self.current_file)
+        self.song_length = self.metadata.duration if self.metadata else 0
+        # Have the seek index ready before the first seek
+        self.prefetcher.submit(self.seek_index, self.current_file)
+        self._prepare_next_track()
+        self._emit('track_changed', self.current_index, self.current_file, self.metadata)
+
+    def _update_gain(self):
+        # Look up the current track's gain; unanalyzed tracks play unchanged
+        gain = None
+        if self.loudness is not None and self.normalization != 'off' and self.current_file:
+            gain = self.loudness.gain(self.current_file, self.normalization)
+        self.track_gain = gain or 0.0
+        if self.audio_ready:
+            self.music.set_volume(self._mixer_volume())
+
+    def _mixer_volume(self):
+        # The mixer cannot amplify, so gains above unity are capped at full volume
+        return min(1.0, self.volume * 10 ** (self.track_gain / 20))
+
+    def _music_file(self, file_path):
+        # What the mixer loads: a path, or a URL that it reads while it
+        # downloads (see http_stream); the decoder process opens URLs itself
+        if http_stream.is_url(file_path) and not self.decoder_buffer_ms:
+            return http_stream.open_file(file_path, stream=True), http_stream.name_hint(file_path)
+        return (file_path,)
+
+    def _read_metadata(self, file_path):
+        try:
+            return self.metadata_cache.get(file_path)
+        except Exception as e:
+            print(f"Error updating metadata: {e}")
+            return None
+
+    def seek_index(self, file_path):
+        try:
+            return self.metadata_cache.get_seek_index(file_path)
+        except Exception as e:
+            print(f"Error indexing {file_path}: {e}")
+            return None
+
+    def _prepare_next_track(self):
+        # Queue the next track on the mixer so it starts without a gap, and
+        # warm its metadata in the background
+        self.queued_index = None
+        if not self.gapless:
+            return
+        next_index = self.queue.peek()
+        if next_index is None:
+            return
+        next_file = self.playlist.path(next_index)
+        try:
+            self.music.queue(*self._music_file(next_file))
+        except (pygame.error, OSError) as e:
+            print(f"Error queueing {next_file}: {e}")
+            return
+        self.queued_index = next_index
+        self.prefetcher.submit(self._prefetch_track, next_file)
+
+    def _prefetch_track(self, file_path):
+        try:
+            metadata = self.metadata_cache.get(file_path)
+            self.metadata_cache.get_seek_index(file_path)
+            if self.loudness is not None and self.normalization != 'off':
+                # Have its gain ready when it starts
+                self.loudness.request(file_path)
+            self._emit('track_prefetched', file_path, metadata)
+        except Exception as e:
+            print(f"Error prefetching {file_path}: {e}")
+
+    def _queued_track_started(self):
+        # The mixer already switched to the queued track; catch up
+        if self.queue.peek() == self.queued_index:
+            self.queue.advance(auto=True)
+        else:
+            self.queue.jump(self.queued_index)
+        self.current_index = self.queued_index
+        self.current_file = self.playlist.path(self.current_index)
+        self._update_gain()
+        # get_pos() restarted from zero when the queued track took over
+        self.clock.start(0, anchor=0)
+        self._track_started()
+
+
+def run_headless(paths, poll_interval=1.0):
+    # Play files from the command line without Qt
+    metrics.configure_from_environment()
+    engine = PlaybackEngine(PathList(paths))
+
+    def announce(index, file_path, metadata):
+        title = metadata.title if metadata and metadata.title else os.path.basename(file_path)
+        print(f"[{index + 1}/{len(paths)}] {title}", flush=True)
+
+    engine.subscribe('track_changed', announce)
+    engine.play()
+    try:
+        while engine.state != PlaybackState.STOPPED:
+            engine.poll()
+            # Sleep until the track is due to end rather than polling
+            remaining = engine.time_until_end()
+            time.sleep(poll_interval if remaining is None else min(remaining + 0.01, poll_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.shutdown()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python playback_engine.py FILE [FILE ...]")
+        sys.exit(1)
+    run_headless(sys.argv[1:])
@@ -0,0 +1,478 @@
+"""Playlist files: M3U/M3U8 import and export, a compact native format
+and a crash-safe autosave.
+
+The native format (.mpl) is a TrackStore written out as is: a fixed
+header, the interned strings as one string table, the UTF-8 heap of file
+names and titles, and one fixed-width array per column (directory id,
+file name offset/length, title offset/length, artist id, album id,
+duration). Opening a file memory-maps it and copies each section in a
+single call, so no per-track parsing happens until rows are displayed.
+
+Autosave writes a snapshot in that format plus an append-only journal of
+the changes made since. Journal records carry a length and CRC, so a
+record cut short by a crash is simply dropped on the next start; snapshots
+are written to a temporary file and renamed over the old one.
+"""
+import os
+import sys
+import json
+import mmap
+import queue
+import struct
+import threading
+import zlib
+from array import array
+
+import http_stream
+from track_store import TrackStore
+
+# Playlists are user data rather than cache
+DATA_DIR = os.path.join(
+    os.environ.get('XDG_DATA_HOME', os.path.join(os.path.expanduser('~'), '.local', 'share')),
+    'python_music_player'
+)
+AUTOSAVE_PATH = os.path.join(DATA_DIR, 'autosave.mpl')
+
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8', '.mpl')
+
+# Native format: magic, version, byte order, track count, journal
+# generation, saved playback state, then (offset, length) of each section
+MAGIC = b'MPPL'
+VERSION = 1
+_HEADER = struct.Struct('<4sHcxIQiidB7x')
+# String table offsets, string table, heap, then one section per column
+_SECTIONS = 3 + len(TrackStore.COLUMNS)
+_SECTION = struct.Struct('<QQ')
+_BYTE_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+JOURNAL_MAGIC = b'MPJL'
+_JOURNAL_HEADER = struct.Struct('<4sHxxQ')
+# Record: payload length, CRC32 of the payload, then the payload (JSON)
+_RECORD = struct.Struct('<II')
+
+# Compact the journal into a new snapshot once it holds this many track
+# changes, or a quarter of the playlist, whichever is more
+COMPACT_MIN_CHANGES = 20000
+# Changes arriving within this many seconds are written together
+AUTOSAVE_DELAY = 0.5
+
+
+class PlaylistFormatError(ValueError):
+    pass
+
+
+# M3U
+
+def read_m3u(file_path):
+    """Return the tracks of an M3U/M3U8 playlist as (path, title, artist,
+    album, duration) tuples.
+
+    Titles, artists and durations come from #EXTINF lines when present;
+    relative paths are resolved against the playlist's directory.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # Plain .m3u files are often in a legacy 8-bit encoding
+        text = data.decode('latin-1')
+
+    base = os.path.dirname(os.path.abspath(file_path))
+    tracks = []
+    title = artist = None
+    duration = 0.0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line.startswith('#EXTINF:'):
+                info, _, name = line[8:].partition(',')
+                try:
+                    duration = max(float(info.split()[0]), 0.0) if info.split() else 0.0
+                except ValueError:
+                    duration = 0.0
+                artist, separator, title = name.partition(' - ')
+                if not separator:
+                    artist, title = '', name
+                title = title.strip() or None
+                artist = artist.strip() or None
+            continue
+        if line.startswith('file://'):
+            from urllib.parse import unquote, urlparse
+            line = unquote(urlparse(line).path)
+        if http_stream.is_url(line):
+            path = line
+        else:
+            path = os.path.normpath(os.path.join(base, os.path.expanduser(line)))
+        tracks.append((path, title, artist, None, duration))
+        title = artist = None
+        duration = 0.0
+    return tracks
+
+
+def write_m3u(file_path, tracks):
+    """Write (path, title, artist, album, duration) tuples as an extended
+    M3U playlist; .m3u8 files are UTF-8, .m3u files use the locale's
+    encoding where it can represent every path."""
+    lines = ['#EXTM3U']
+    for path, title, artist, album, duration in tracks:
+        if title:
+            name = f"{artist} - {title}" if artist else title
+            lines.append(f"#EXTINF:{int(duration) if duration > 0 else -1},{name}")
+        lines.append(path)
+    text = '\n'.join(lines) + '\n'
+
+    encoding = 'utf-8'
+    if not file_path.lower().endswith('.m3u8'):
+        encoding = sys.getfilesystemencoding()
+    _write_atomic(file_path, text.encode(encoding, 'surrogateescape'))
+
+
+# Native format
+
+def _write_atomic(file_path, data_or_chunks):
+    # Write to a temporary file, flush it to disk and rename it into place
+    chunks = [data_or_chunks] if isinstance(data_or_chunks, (bytes, bytearray)) else data_or_chunks
+    directory = os.path.dirname(os.path.abspath(file_path))
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    try:
+        # Make the rename itself durable
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def snapshot_store(store):
+    """Copy a store's contents for writing on another thread.
+
+    Only flat copies are made (one per array), so this is cheap enough for
+    the GUI thread even with hundreds of thousands of tracks.
+    """
+    # Slicing copies an array's buffer at once; array(typecode, other) would
+    # copy element by element
+    return (list(store.strings), bytes(store.heap.data),
+            [getattr(store, name)[:] for name in TrackStore.COLUMNS])
+
+
+def write_native(file_path, snapshot, state=None, generation=0):
+    """Write a store snapshot (see snapshot_store) in the native format.
+
+    state: dict with 'current_row' (store row or -1), 'position' (seconds)
+    and 'sort_column'/'sort_descending' (column or -1).
+    """
+    strings, heap, columns = snapshot
+    state = state or {}
+
+    encoded = [value.encode('utf-8', 'surrogateescape') for value in strings]
+    string_offsets = array('Q', [0])
+    total = 0
+    for value in encoded:
+        total += len(value)
+        string_offsets.append(total)
+    sections = [string_offsets.tobytes(), b''.join(encoded), heap]
+    sections += [column.tobytes() for column in columns]
+
+    header = _HEADER.pack(MAGIC, VERSION, _BYTE_ORDER, len(columns[0]), generation,
+                          state.get('current_row', -1), state.get('sort_column', -1),
+                          state.get('position', 0.0), bool(state.get('sort_descending')))
+    table_size = _SECTIONS * _SECTION.size
+    offset = _HEADER.size + table_size
+    table = []
+    padded = []
+    for section in sections:
+        # 8-byte aligned, so every column could be viewed in place
+        padding = -offset % 8
+        offset += padding
+        table.append(_SECTION.pack(offset, len(section)))
+        padded.append(b'\0' * padding)
+        padded.append(section)
+        offset += len(section)
+    _write_atomic(file_path, [header, b''.join(table)] + padded)
+
+
+def read_native(file_path):
+    """Open a native playlist file; returns (store, state, generation)."""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise PlaylistFormatError(f"{file_path} is not a playlist file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            sections = []
+            try:
+                return _read_native(view, sections, file_path)
+            finally:
+                # The map cannot close while views into it exist
+                for section in sections:
+                    section.release()
+                view.release()
+
+
+def _read_native(view, sections, file_path):
+    (magic, version, byte_order, count, generation, current_row, sort_column, position,
+     sort_descending) = _HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise PlaylistFormatError(f"{file_path} is not a version {VERSION} playlist file")
+
+    for index in range(_SECTIONS):
+        offset, length = _SECTION.unpack_from(view, _HEADER.size + index * _SECTION.size)
+        if offset + length > len(view):
+            raise PlaylistFormatError(f"{file_path} is truncated")
+        sections.append(view[offset:offset + length])
+    swap = byte_order != _BYTE_ORDER
+
+    string_offsets = array('Q')
+    string_offsets.frombytes(sections[0])
+    if swap:
+        string_offsets.byteswap()
+    table = bytes(sections[1])
+    strings = [table[string_offsets[i]:string_offsets[i + 1]].decode('utf-8', 'surrogateescape')
+               for i in range(len(string_offsets) - 1)]
+
+    columns = {}
+    template = TrackStore()
+    for name, section in zip(TrackStore.COLUMNS, sections[3:]):
+        column = array(getattr(template, name).typecode)
+        column.frombytes(section)
+        if swap:
+            column.byteswap()
+        if len(column) != count:
+            raise PlaylistFormatError(f"{file_path} is corrupt")
+        columns[name] = column
+
+    store = TrackStore.from_columns(strings, bytearray(sections[2]), columns)
+    state = {
+        'current_row': current_row,
+        'position': position,
+        'sort_column': sort_column,
+        'sort_descending': bool(sort_descending),
+    }
+    return store, state, generation
+
+
+def load_playlist(file_path):
+    # Tracks of a playlist file in any supported format
+    if file_path.lower().endswith('.mpl'):
+        store = read_native(file_path)[0]
+        return [store.track(row) for row in range(len(store))]
+    return read_m3u(file_path)
+
+
+def save_playlist(file_path, tracks):
+    # Save (path, title, artist, album, duration) tuples; format by extension
+    if file_path.lower().endswith('.mpl'):
+        store = TrackStore()
+        store.extend(tracks)
+        write_native(file_path, snapshot_store(store))
+    else:
+        write_m3u(file_path, tracks)
+
+
+# Autosave
+
+def _read_journal(file_path, generation):
+    # Return (records, valid_length); records of another generation are stale
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return [], 0
+    if len(data) < _JOURNAL_HEADER.size:
+        return [], 0
+    magic, version, journal_generation = _JOURNAL_HEADER.unpack_from(data)
+    if magic != JOURNAL_MAGIC or version != VERSION or journal_generation != generation:
+        return [], 0
+
+    records = []
+    position = _JOURNAL_HEADER.size
+    while position + _RECORD.size <= len(data):
+        length, crc = _RECORD.unpack_from(data, position)
+        payload = data[position + _RECORD.size:position + _RECORD.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            # Torn write from a crash: everything after it is lost
+            break
+        records.append(json.loads(payload))
+        position += _RECORD.size + length
+    return records, position
+
+
+def _apply_record(store, state, record):
+    kind = record[0]
+    if kind == 'append':
+        store.extend(record[1])
+    elif kind == 'update':
+        row, title, artist, album, duration = record[1]
+        if row < len(store):
+            store.update(row, title, artist, album, duration)
+    elif kind == 'move':
+        row, path = record[1]
+        if row < len(store):
+            store.set_path(row, path)
+    elif kind == 'state':
+        state.update(record[1])
+    elif kind == 'remove':
+        store.remove(record[1])
+    elif kind == 'clear':
+        store.clear()
+
+
+class PlaylistAutosaver:
+    """Keep a playlist file up to date as the playlist changes.
+
+    Changes are reported through tracks_appended(), track_updated(),
+    track_moved(), tracks_removed(), cleared() and state_changed()
+    (PlaylistModel calls the first five once the autosaver is one of its
+    observers). They are appended to the
+    journal by a background thread; the GUI thread only queues them. Once the
+    journal grows large, the next change also queues a fresh snapshot,
+    which replaces the snapshot file and starts an empty journal.
+    """
+
+    def __init__(self, file_path=AUTOSAVE_PATH):
+        self.file_path = file_path
+        self.journal_path = file_path + '.journal'
+        self.store = None
+        self._generation = 0
+        self._state = {}
+        self._changes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def restore(self):
+        """Load the snapshot and replay the journal.
+
+        Returns (store, state); the store is empty when nothing was saved.
+        Must be called once, before any change is reported.
+        """
+        store, state, generation = TrackStore(), {}, 0
+        if os.path.exists(self.file_path):
+            try:
+                store, state, generation = read_native(self.file_path)
+            except (OSError, PlaylistFormatError) as e:
+                print(f"Error restoring playlist: {e}")
+        records, valid_length = _read_journal(self.journal_path, generation)
+        for record in records:
+            _apply_record(store, state, record)
+
+        self.store = store
+        self._generation = generation
+        self._state = state
+        self._changes = sum(len(record[1]) if record[0] == 'append' else 1 for record in records)
+
+        # Continue the journal after its last intact record
+        if valid_length:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid_length)
+        else:
+            self._queue.put(('reset', generation))
+        self._thread = threading.Thread(target=self._run, name='playlist-autosave', daemon=True)
+        self._thread.start()
+        return store, dict(state)
+
+    def tracks_appended(self, first_row, tracks):
+        # The list is queued as is (and must not be changed afterwards):
+        # copying it would only give the garbage collector more to walk
+        self._queue.put(('record', ['append', tracks]))
+        self._changed(len(tracks))
+
+    def track_updated(self, row, title, artist, album, duration):
+        self._queue.put(('record', ['update', [row, title, artist, album, duration]]))
+        self._changed(1)
+
+    def track_moved(self, row, path):
+        self._queue.put(('record', ['move', [row, path]]))
+        self._changed(1)
+
+    def tracks_removed(self, rows):
+        self._queue.put(('record', ['remove', rows]))
+        self._changed(len(rows))
+
+    def cleared(self):
+        self._queue.put(('record', ['clear']))
+        self._changed(1)
+
+    def state_changed(self, state):
+        if state != self._state:
+            self._state = dict(state)
+            self._queue.put(('record', ['state', self._state]))
+
+    def _changed(self, count):
+        self._changes += count
+        if self._changes >= max(COMPACT_MIN_CHANGES, len(self.store) // 4):
+            self.compact()
+
+    def compact(self):
+        # Queue a snapshot of the store as it is now; later changes go to
+        # the new journal
+        self._generation += 1
+        self._changes = 0
+        self._queue.put(('snapshot', (snapshot_store(self.store), dict(self._state),
+                                      self._generation)))
+
+    def close(self):
+        # Write out everything queued so far; the next start then reads one
+        # snapshot instead of replaying the journal
+        if self._thread is not None:
+            if self._changes:
+                self.compact()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        journal = None
+        stopping = False
+        while not stopping:
+            tasks = [self._queue.get()]
+            # Gather what arrives shortly after, so it is written and synced once
+            while tasks[-1] is not None:
+                try:
+                    tasks.append(self._queue.get(timeout=AUTOSAVE_DELAY))
+                except queue.Empty:
+                    break
+            try:
+                for task in tasks:
+                    if task is None:
+                        stopping = True
+                        break
+                    kind, value = task
+                    if kind == 'record':
+                        if journal is None:
+                            journal = open(self.journal_path, 'ab')
+                        payload = json.dumps(value, separators=(',', ':')).encode()
+                        journal.write(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+                    else:
+                        if journal is not None:
+                            journal.close()
+                            journal = None
+                        if kind == 'snapshot':
+                            snapshot, state, generation = value
+                            os.makedirs(os.path.dirname(os.path.abspath(self.file_path)),
+                                        exist_ok=True)
+                            write_native(self.file_path, snapshot, state, generation)
+                        else:
+                            generation = value
+                        # An empty journal of the new generation; a crash
+                        # before this leaves an old journal, which is ignored
+                        os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)),
+                                    exist_ok=True)
+                        _write_atomic(self.journal_path,
+                                      _JOURNAL_HEADER.pack(JOURNAL_MAGIC, VERSION, generation))
+                if journal is not None:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            except OSError as e:
+                print(f"Error saving playlist: {e}")
+        if journal is not None:
+            journal.close()
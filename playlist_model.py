@@ -0,0 +1,280 @@
+from bisect import bisect_left
+
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt6.QtGui import QFont
+
+from track_store import TrackStore, TITLE, ARTIST, ALBUM, DURATION
+
+HEADERS = {TITLE: "Title", ARTIST: "Artist", ALBUM: "Album", DURATION: "Duration"}
+
+
+def _numpy():
+    # NumPy costs over 100 ms to import; only sorted or filtered views need it
+    import numpy
+    return numpy
+
+
+def format_duration(seconds):
+    if seconds <= 0:
+        return ""
+    minutes = int(seconds // 60)
+    return f"{minutes}:{int(seconds % 60):02d}"
+
+
+class PlaylistModel(QAbstractTableModel):
+    """Table model over a TrackStore.
+
+    Views only ask for the rows they display, so nothing is created per
+    track. Rows of the model are view rows; when the playlist is sorted or
+    filtered they are mapped to store rows through compact NumPy arrays
+    (imported on first use, to keep it off the startup path).
+
+    Every change to the tracks is also reported to the observers, e.g.
+    the autosaver (playlist_file.PlaylistAutosaver) and the search index
+    (search_index.SearchIndex), through tracks_appended(first_row, tracks),
+    track_updated(row, title, artist, album, duration), track_moved(row, path),
+    tracks_removed(rows) and cleared(), with store rows.
+    """
+
+    def __init__(self, store=None, parent=None):
+        super().__init__(parent)
+        self.store = store if store is not None else TrackStore()
+        self.observers = []
+        # Store rows in sort order, and the rows the filter lets through
+        self._sort_order = None
+        self._filter = None
+        # Derived from the two above: store row of each view row, and view
+        # row of each store row (-1 when filtered out); None when both are
+        self._order = None
+        self._inverse = None
+        self._sort_column = None
+        self._sort_descending = False
+        self._playing_store_row = -1
+        self._bold = QFont()
+        self._bold.setBold(True)
+
+    def __len__(self):
+        # Lets the playback engine use the model as its playlist
+        return len(self.store) if self._order is None else len(self._order)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return HEADERS.get(section)
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            value = self.store.value(self.store_row(index.row()), column)
+            return format_duration(value) if column == DURATION else value
+        if role == Qt.ItemDataRole.TextAlignmentRole and column == DURATION:
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        if role == Qt.ItemDataRole.FontRole and index.row() == self.playing_row():
+            return self._bold
+        return None
+
+    def store_row(self, row):
+        return int(self._order[row]) if self._order is not None else row
+
+    def view_row(self, store_row):
+        # -1 when the track is filtered out
+        if self._order is None:
+            return store_row
+        return int(self._inverse[store_row])
+
+    def playing_row(self):
+        # View row of the playing (or cued) track, -1 if none or hidden
+        if self._playing_store_row < 0:
+            return -1
+        return self.view_row(self._playing_store_row)
+
+    def playing_store_row(self):
+        return self._playing_store_row
+
+    def path(self, row):
+        return self.store.path(self.store_row(row))
+
+    def track_id(self, row):
+        # Stable id of a view row's track (see play_queue)
+        return self.store.ids[self.store_row(row)]
+
+    def row_of_id(self, track_id):
+        # View row of a track id, -1 when removed or filtered out
+        store_row = self.store.row_of_id(track_id)
+        return self.view_row(store_row) if store_row >= 0 else -1
+
+    def tracks(self):
+        # Every shown track as (path, title, artist, album, duration), in view order
+        track = self.store.track
+        return [track(self.store_row(row)) for row in range(len(self))]
+
+    def append_tracks(self, tracks):
+        # tracks: list of (path, title, artist, album, duration)
+        if not tracks:
+            return
+        first_view_row = len(self)
+        first = len(self.store)
+        self.beginInsertRows(QModelIndex(), first_view_row, first_view_row + len(tracks) - 1)
+        self.store.extend(tracks)
+        for observer in self.observers:
+            observer.tracks_appended(first, tracks)
+        if self._order is not None:
+            # New rows go to the end until the next sort or search
+            np = _numpy()
+            rows = np.arange(first, len(self.store), dtype=np.uint32)
+            if self._sort_order is not None:
+                self._sort_order = np.concatenate((self._sort_order, rows))
+            if self._filter is not None:
+                self._filter = np.concatenate((self._filter, np.ones(len(rows), dtype=bool)))
+            self._order = np.concatenate((self._order, rows))
+            self._inverse = np.concatenate((
+                self._inverse, np.arange(first_view_row, len(self._order), dtype=np.int32)))
+        self.endInsertRows()
+
+    def update_track(self, row, title=None, artist=None, album=None, duration=0.0):
+        self.update_store_track(self.store_row(row), title, artist, album, duration)
+
+    def update_store_track(self, store_row, title=None, artist=None, album=None, duration=0.0):
+        if not self.store.update(store_row, title, artist, album, duration):
+            return
+        for observer in self.observers:
+            observer.track_updated(store_row, title, artist, album, duration)
+        self._store_row_changed(store_row)
+
+    def move_track(self, store_row, path):
+        # The file of a track was renamed or moved; the track keeps its place
+        self.store.set_path(store_row, path)
+        for observer in self.observers:
+            observer.track_moved(store_row, path)
+        self._store_row_changed(store_row)
+
+    def _store_row_changed(self, store_row):
+        row = self.view_row(store_row)
+        if row >= 0:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(HEADERS) - 1))
+
+    def remove_tracks(self, store_rows):
+        """Remove tracks by store row; later rows move up. The sort order
+        and the filter are kept for the remaining tracks."""
+        rows = sorted(set(store_rows))
+        if not rows:
+            return
+        self.beginResetModel()
+        if self._sort_order is not None or self._filter is not None:
+            np = _numpy()
+            keep = np.ones(len(self.store), dtype=bool)
+            keep[rows] = False
+            # New store row of every kept row
+            moved = (np.cumsum(keep) - 1).astype(np.uint32)
+            if self._sort_order is not None:
+                self._sort_order = moved[self._sort_order[keep[self._sort_order]]]
+            if self._filter is not None:
+                self._filter = self._filter[keep[:len(self._filter)]]
+        self.store.remove(rows)
+        for observer in self.observers:
+            observer.tracks_removed(rows)
+        playing = self._playing_store_row
+        if playing >= 0:
+            # Moved up by the rows removed before it
+            before = bisect_left(rows, playing)
+            gone = before < len(rows) and rows[before] == playing
+            self._playing_store_row = -1 if gone else playing - before
+        self._update_view()
+        self.endResetModel()
+
+    def set_playing_row(self, row):
+        previous = self.playing_row()
+        self._playing_store_row = self.store_row(row) if row >= 0 else -1
+        for changed in (previous, row):
+            if 0 <= changed < len(self):
+                self.dataChanged.emit(self.index(changed, 0),
+                                      self.index(changed, len(HEADERS) - 1),
+                                      [Qt.ItemDataRole.FontRole])
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        if column not in HEADERS:
+            return
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        persistent_rows = [self.store_row(index.row()) for index in persistent]
+
+        self._sort_column = column
+        self._sort_descending = order == Qt.SortOrder.DescendingOrder
+        np = _numpy()
+        self._sort_order = np.frombuffer(
+            self.store.sort_order(column, self._sort_descending), dtype=np.uint32)
+        self._update_view()
+
+        # Keep selections and the current row on the same tracks
+        self.changePersistentIndexList(
+            persistent,
+            [self.index(self.view_row(row), index.column())
+             for row, index in zip(persistent_rows, persistent)]
+        )
+        self.layoutChanged.emit()
+
+    def set_filter(self, mask):
+        """Show only the store rows where the boolean NumPy mask is set
+        (rows past its end stay shown); None shows every track."""
+        self.beginResetModel()
+        if mask is not None and len(mask) != len(self.store):
+            np = _numpy()
+            mask = np.concatenate((mask[:len(self.store)],
+                                   np.ones(max(len(self.store) - len(mask), 0), dtype=bool)))
+        self._filter = mask
+        self._update_view()
+        self.endResetModel()
+
+    def _update_view(self):
+        if self._sort_order is None and self._filter is None:
+            self._order = self._inverse = None
+            return
+        np = _numpy()
+        order = self._sort_order
+        if order is None:
+            order = np.arange(len(self.store), dtype=np.uint32)
+        if self._filter is not None:
+            order = order[self._filter[order]]
+        inverse = np.full(len(self.store), -1, dtype=np.int32)
+        inverse[order] = np.arange(len(order), dtype=np.int32)
+        self._order = order
+        self._inverse = inverse
+
+    def sort_state(self):
+        # (column, descending) of the current sort, or (None, False)
+        return self._sort_column, self._sort_descending
+
+    def set_store(self, store):
+        # Replace every track at once, e.g. with a restored playlist
+        self.beginResetModel()
+        self.store = store
+        self._reset_view()
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.store.clear()
+        for observer in self.observers:
+            observer.cleared()
+        self._reset_view()
+        self.endResetModel()
+
+    def _reset_view(self):
+        self._sort_order = self._filter = None
+        self._order = self._inverse = None
+        self._sort_column = None
+        self._sort_descending = False
+        self._playing_store_row = -1
+
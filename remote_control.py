@@ -0,0 +1,434 @@
+"""Remote control: a local HTTP and WebSocket API for the player.
+
+Opt-in, from the environment (see configure_from_environment):
+
+    MUSIC_PLAYER_REMOTE_PORT=8765         serve the API on 127.0.0.1
+    MUSIC_PLAYER_REMOTE_TOKEN=secret      require the token on every request
+    MUSIC_PLAYER_REMOTE_HOST=0.0.0.0      listen elsewhere (needs a token)
+
+Commands are JSON objects; over HTTP the path names the command and the
+body (or, for the read-only commands, the query string) holds its
+arguments, e.g. POST /seek {"position": 30}. The player's state is
+pushed to WebSocket clients (/ws) whenever it changes, and they send
+commands as {"command": "seek", "args": {"position": 30}, "id": 1}.
+
+The server runs an asyncio loop on a thread of its own, so clients never
+wait on the GUI and the GUI never waits on clients:
+
+    - commands run on the GUI thread through a queued Qt signal, a few at
+      a time however many clients send them
+    - GET /state and new subscribers are answered from the last published
+      state, without the GUI thread
+    - the GUI thread publishes states by handing over a dict; they are
+      coalesced, encoded once and sent to every subscriber, and a slow
+      subscriber only ever gets the latest one
+
+With a token, requests carry it as "Authorization: Bearer <token>" or a
+token=<token> query argument. Without one, only this machine can connect
+and requests sent by web pages (which carry an Origin header) are
+refused, so a page in a browser cannot drive the player.
+"""
+import os
+import hmac
+import json
+import base64
+import struct
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit, parse_qs
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+DEFAULT_PORT = 8765
+# Published states are sent at most this often
+COALESCE_SECONDS = 0.05
+# Remote commands waiting for or running on the GUI thread at once
+MAX_GUI_COMMANDS = 4
+COMMAND_TIMEOUT = 5.0
+# Request heads, bodies and WebSocket messages are refused beyond these
+MAX_HEADER = 16 * 1024
+MAX_BODY = 64 * 1024
+MAX_MESSAGE = 64 * 1024
+BACKLOG = 1024
+# States are written straight to a subscriber's socket while less than
+# this is waiting to be sent to it; beyond, only the latest one is kept
+SEND_BUFFER = 64 * 1024
+
+# Commands that may also be sent as GET requests
+READ_COMMANDS = ('state', 'library', 'queue')
+
+_WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
+OP_CLOSE, OP_PING, OP_PONG = 0x8, 0x9, 0xA
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+            404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 504: 'Gateway Timeout'}
+
+
+def _apply_mask(data, mask):
+    repeated = (mask * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(
+        len(data), 'big')
+
+
+def encode_frame(payload, opcode=OP_TEXT, mask=None):
+    """One final WebSocket frame; clients pass a 4-byte mask."""
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, mask_bit | length)
+    elif length < 1 << 16:
+        header = struct.pack('>BBH', 0x80 | opcode, mask_bit | 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, mask_bit | 127, length)
+    if mask:
+        return header + mask + _apply_mask(payload, mask)
+    return header + payload
+
+
+async def read_frame(reader, max_size=MAX_MESSAGE):
+    # (final, opcode, unmasked payload, whether it was masked)
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('>H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', await reader.readexactly(8))[0]
+    if length > max_size:
+        raise ValueError(f"WebSocket frame of {length} bytes")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = _apply_mask(payload, mask)
+    return bool(first & 0x80), first & 0x0F, payload, mask is not None
+
+
+def websocket_accept(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + _WEBSOCKET_GUID).digest()).decode()
+
+
+class QtDispatcher(QObject):
+    """Runs commands on the thread it lives on (the GUI thread).
+
+    Called from any thread with (command, args); returns a
+    concurrent.futures.Future of handler(command, args).
+    """
+
+    _call = pyqtSignal(object, object, object)
+
+    def __init__(self, handler, parent=None):
+        super().__init__(parent)
+        self.handler = handler
+        # Emitted from the server thread, so delivered through the event loop
+        self._call.connect(self._run)
+
+    def __call__(self, command, args):
+        future = Future()
+        self._call.emit(command, args, future)
+        return future
+
+    def _run(self, command, args, future):
+        if not future.set_running_or_notify_cancel():
+            # The client gave up waiting
+            return
+        try:
+            future.set_result(self.handler(command, args))
+        except Exception as e:
+            future.set_exception(e)
+
+
+class _Subscriber:
+    # A WebSocket client, and the latest state it could not be sent yet
+    __slots__ = ('writer', 'frame', 'ready')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.frame = None
+        self.ready = asyncio.Event()
+
+    def offer(self, frame):
+        if self.frame is None and self.writer.transport.get_write_buffer_size() < SEND_BUFFER:
+            self.writer.write(frame)
+        else:
+            # A slow client: its sender catches up with the latest state
+            self.frame = frame
+            self.ready.set()
+
+    async def send(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                await self.writer.drain()
+                frame, self.frame = self.frame, None
+                self.writer.write(frame)
+        except ConnectionError:
+            pass
+
+
+class RemoteControlServer:
+    """HTTP and WebSocket server on a thread with its own event loop.
+
+    dispatch(command, args) runs a command where it is safe to (see
+    QtDispatcher) and returns a Future of its JSON result; it fails with
+    LookupError for unknown commands or tracks, and ValueError, TypeError
+    or KeyError for bad arguments. publish(state) may be called from any
+    thread; the state dict must not be changed afterwards.
+    """
+
+    def __init__(self, dispatch, host='127.0.0.1', port=DEFAULT_PORT, token=None):
+        self.dispatch = dispatch
+        self.host = host
+        self.port = port
+        self.token = token
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._state = None
+        self._state_frame = None
+        self._publish_pending = False
+        self._subscribers = set()
+        self._gui_slots = None
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def start(self):
+        # Returns once listening (self.port is then the bound port, for
+        # port 0); raises OSError when the port cannot be bound
+        started = Future()
+        self._thread = threading.Thread(target=self._run, args=(started,),
+                                        name='remote-control', daemon=True)
+        self._thread.start()
+        started.result()
+        return self
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(self._shutdown, loop)
+            self._thread.join(timeout=2)
+
+    def publish(self, state):
+        with self._lock:
+            self._state = state
+            if self._publish_pending or self._loop is None:
+                return
+            self._publish_pending = True
+            self._loop.call_soon_threadsafe(self._loop.call_later, COALESCE_SECONDS,
+                                            self._broadcast)
+
+    # Server thread
+
+    def _run(self, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self._server = loop.run_until_complete(asyncio.start_server(
+                self._connection, self.host, self.port, limit=MAX_HEADER, backlog=BACKLOG))
+        except OSError as e:
+            loop.close()
+            started.set_exception(e)
+            return
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._gui_slots = asyncio.Semaphore(MAX_GUI_COMMANDS)
+        with self._lock:
+            self._loop = loop
+        started.set_result(None)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def _shutdown(self, loop):
+        self._server.close()
+        for task in asyncio.all_tasks(loop):
+            task.cancel()
+        loop.call_soon(loop.stop)
+
+    def _broadcast(self):
+        with self._lock:
+            state = self._state
+            self._publish_pending = False
+        self._state_frame = encode_frame(json.dumps({'type': 'state', 'state': state}).encode())
+        for subscriber in self._subscribers:
+            subscriber.offer(self._state_frame)
+
+    def _allowed(self, headers, query):
+        if self.token is not None:
+            supplied = headers.get('authorization', '')
+            supplied = supplied[7:] if supplied.startswith('Bearer ') else ''
+            supplied = supplied or query.get('token', [''])[-1]
+            return hmac.compare_digest(supplied.encode(), self.token.encode())
+        return 'origin' not in headers
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if not self._allowed(headers, query):
+                    status, result = (401 if self.token else 403), {'error': "Not allowed"}
+                elif path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                    await self._websocket(reader, writer, headers)
+                    break
+                else:
+                    status, result = await self._http(method, path.strip('/'), query, body)
+                self._respond(writer, status, result, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        # (method, path, query, headers, body), or None at the end
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            self._respond(writer, 413, {'error': "Request too large"}, False)
+            return None
+        body = await reader.readexactly(length) if length else b''
+        target = urlsplit(target)
+        return method, target.path, parse_qs(target.query), headers, body
+
+    def _respond(self, writer, status, result, keep_alive):
+        body = json.dumps(result).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+
+    async def _http(self, method, command, query, body):
+        if method == 'GET' and command in READ_COMMANDS:
+            args = {name: values[-1] for name, values in query.items() if name != 'token'}
+        elif method == 'POST':
+            try:
+                args = json.loads(body) if body.strip() else {}
+            except ValueError:
+                return 400, {'error': "The body is not JSON"}
+            if not isinstance(args, dict):
+                return 400, {'error': "The body is not a JSON object"}
+        else:
+            return 405, {'error': f"{method} /{command} is not supported"}
+        return await self._call(command, args)
+
+    async def _call(self, command, args):
+        # (HTTP status, JSON result) of a command
+        if command == 'state':
+            return 200, self._state
+        async with self._gui_slots:
+            try:
+                result = await asyncio.wait_for(asyncio.wrap_future(self.dispatch(command, args)),
+                                                COMMAND_TIMEOUT)
+            except asyncio.TimeoutError:
+                return 504, {'error': "The player did not answer in time"}
+            except KeyError as e:
+                return 400, {'error': f"Missing argument {e}"}
+            except LookupError as e:
+                return 404, {'error': str(e)}
+            except (ValueError, TypeError) as e:
+                return 400, {'error': str(e)}
+            except Exception as e:
+                print(f"Error running remote command {command}: {e}")
+                return 500, {'error': str(e)}
+        return 200, result
+
+    async def _websocket(self, reader, writer, headers):
+        key = headers.get('sec-websocket-key')
+        if not key:
+            self._respond(writer, 400, {'error': "Not a WebSocket handshake"}, False)
+            return
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {websocket_accept(key)}\r\n\r\n".encode())
+        subscriber = _Subscriber(writer)
+        if self._state is not None:
+            subscriber.offer(self._state_frame or encode_frame(
+                json.dumps({'type': 'state', 'state': self._state}).encode()))
+        self._subscribers.add(subscriber)
+        sender = asyncio.ensure_future(subscriber.send())
+        try:
+            message = b''
+            while True:
+                final, opcode, payload, masked = await read_frame(reader)
+                if not masked:
+                    # Clients must mask what they send
+                    writer.write(encode_frame(struct.pack('>H', 1002), OP_CLOSE))
+                    break
+                if opcode == OP_CLOSE:
+                    writer.write(encode_frame(payload[:2], OP_CLOSE))
+                    break
+                if opcode == OP_PING:
+                    writer.write(encode_frame(payload, OP_PONG))
+                    continue
+                if opcode == OP_PONG:
+                    continue
+                message += payload
+                if len(message) > MAX_MESSAGE:
+                    raise ValueError("WebSocket message too large")
+                if final:
+                    writer.write(encode_frame(json.dumps(await self._message(message)).encode()))
+                    message = b''
+            await writer.drain()
+        finally:
+            self._subscribers.discard(subscriber)
+            sender.cancel()
+
+    async def _message(self, message):
+        # The reply to a command sent over a WebSocket
+        try:
+            request = json.loads(message)
+            command, args = request['command'], request.get('args') or {}
+        except (ValueError, TypeError, KeyError):
+            return {'type': 'error', 'id': None, 'error': "Not a command"}
+        request_id = request.get('id')
+        if not isinstance(args, dict):
+            return {'type': 'error', 'id': request_id, 'error': "args is not an object"}
+        status, result = await self._call(command, args)
+        if status != 200:
+            return {'type': 'error', 'id': request_id, 'error': result['error']}
+        return {'type': 'result', 'id': request_id, 'result': result}
+
+
+def configure_from_environment(dispatch):
+    """Start a server from the environment (see the module docstring);
+    returns it, or None when not enabled or it cannot start."""
+    port = os.environ.get('MUSIC_PLAYER_REMOTE_PORT')
+    if not port:
+        return None
+    host = os.environ.get('MUSIC_PLAYER_REMOTE_HOST', '127.0.0.1')
+    token = os.environ.get('MUSIC_PLAYER_REMOTE_TOKEN') or None
+    if token is None and host not in ('127.0.0.1', 'localhost', '::1'):
+        print(f"Error starting remote control on {host}: MUSIC_PLAYER_REMOTE_TOKEN is required "
+              f"beyond this machine")
+        return None
+    try:
+        return RemoteControlServer(dispatch, host, int(port), token).start()
+    except (OSError, ValueError) as e:
+        print(f"Error starting remote control on port {port}: {e}")
+        return None
@@ -0,0 +1,483 @@
+"""Incremental prefix search over the playlist's titles, artists, albums
+and file names.
+
+Every track is split into words, folded to lower case without
+diacritics ('Beyoncé' matches 'beyonce'). A query matches the tracks in
+which each of its words is the prefix of some word of the track.
+
+The index is log-structured: new tracks go into a small open segment,
+which is sealed and sorted once full; a background thread merges
+segments of similar size, so there are only ever a handful. A sorted
+segment keeps its words in a sorted list and the tracks of each word in
+one NumPy array, grouped by word, so the tracks of every word sharing a
+prefix are a single slice. Changed tracks are marked stale in the older
+segments and indexed again in the open one.
+
+Tracks are indexed by id (TrackStore.ids) rather than by row, and ids are
+mapped back to rows once per query. Removing tracks moves the later rows
+up but leaves every id alone, so the index has nothing to change: the
+removed ids are no longer in the store, so no row is found for them, and
+they are dropped when their segment is next sorted or merged.
+"""
+import os
+import re
+import zlib
+import threading
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+
+from metadata_cache import CACHE_DIR
+
+INDEX_PATH = os.path.join(CACHE_DIR, 'search_index.npz')
+INDEX_VERSION = 2
+
+# Words: runs of letters and digits (underscores split file names too)
+_WORD = re.compile(r'[^\W_]+')
+# Combining marks left over once NFKD has split accented letters
+_MARKS = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+# Sorts after every word that starts with a given prefix
+_PREFIX_END = '\U0010ffff'
+
+# Word/track id pairs held by the open segment before it is sealed; it is
+# scanned on every query, so it stays small
+OPEN_SEGMENT_SIZE = 2048
+# Adjacent segments are merged once the newer one is this fraction of
+# the older one's size, which keeps the number of segments logarithmic
+MERGE_RATIO = 0.5
+
+
+def fold(text):
+    # Case- and diacritic-insensitive form of a string
+    if text.isascii():
+        return text.lower()
+    return _MARKS.sub('', unicodedata.normalize('NFKD', text.casefold()))
+
+
+def words(text):
+    return _WORD.findall(fold(text)) if text else []
+
+
+def track_words(path, title, artist, album):
+    filename = os.path.splitext(os.path.basename(path))[0]
+    return set(words(f"{filename} {title or ''} {artist or ''} {album or ''}"))
+
+
+def store_fingerprint(store):
+    # Changes whenever a search-relevant field of any track changes
+    crc = zlib.crc32(str(len(store)).encode())
+    crc = zlib.crc32('\0'.join(store.strings).encode('utf-8', 'surrogateescape'), crc)
+    crc = zlib.crc32(store.heap.data, crc)
+    for column in (store.ids, store.filename_offsets, store.filename_lengths,
+                   store.title_offsets, store.title_lengths, store.artists, store.albums):
+        crc = zlib.crc32(column, crc)
+    return crc
+
+
+class _OpenSegment:
+    """Unsorted word/track id pairs; matched by a linear scan."""
+
+    def __init__(self):
+        self.words = []
+        self.ids = []
+        self.stale = set()
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, track_id, track_words):
+        self.words.extend(track_words)
+        self.ids.extend([track_id] * len(track_words))
+
+    def remove(self, track_id):
+        if track_id in self.ids:
+            pairs = [(word, other) for word, other in zip(self.words, self.ids)
+                     if other != track_id]
+            self.words = [word for word, _ in pairs]
+            self.ids = [other for _, other in pairs]
+
+    def sorted(self, stale, live=None):
+        # The pairs as a sorted segment, without the given stale ids (nor,
+        # given the ids in the store, those of removed tracks)
+        pairs = [(word, track_id) for word, track_id in zip(self.words, self.ids)
+                 if track_id not in stale]
+        return _Segment.build([word for word, _ in pairs], [track_id for _, track_id in pairs],
+                              live)
+
+    def match(self, prefix, mask):
+        stale = self.stale
+        for word, track_id in zip(self.words, self.ids):
+            if word.startswith(prefix) and track_id not in stale:
+                mask[track_id] = True
+
+
+class _Segment:
+    """Sorted, immutable word/track id pairs (except for the stale set)."""
+
+    def __init__(self, terms, starts, ids):
+        self.terms = terms      # sorted list of distinct words
+        self.starts = starts    # ids[starts[i]:starts[i + 1]] belong to terms[i]
+        self.ids = ids
+        self.stale = set()
+        self._stale_ids = None
+        self._stale_count = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, pair_words, pair_ids, live=None):
+        terms = sorted(set(pair_words))
+        positions = {term: i for i, term in enumerate(terms)}
+        term_ids = np.fromiter((positions[word] for word in pair_words), np.int64,
+                               len(pair_words))
+        ids = np.asarray(pair_ids, dtype=np.uint32)
+        return cls._from_pairs(terms, term_ids, ids, live)
+
+    @classmethod
+    def _from_pairs(cls, terms, term_ids, ids, live=None):
+        if live is not None:
+            kept = _alive(ids, live)
+            if not kept.all():
+                term_ids, ids = term_ids[kept], ids[kept]
+        counts = np.bincount(term_ids, minlength=len(terms))
+        if len(terms) and not counts.all():
+            # Words left only to removed tracks
+            used = np.flatnonzero(counts)
+            remap = np.zeros(len(terms), dtype=np.int64)
+            remap[used] = np.arange(len(used))
+            terms, term_ids, counts = [terms[i] for i in used], remap[term_ids], counts[used]
+        order = np.lexsort((ids, term_ids))
+        starts = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=starts[1:])
+        return cls(terms, starts, ids[order])
+
+    def pairs(self, stale):
+        # (term ids, track ids) without the given stale ids
+        term_ids = np.repeat(np.arange(len(self.terms)), np.diff(self.starts))
+        if stale:
+            keep = ~np.isin(self.ids, np.fromiter(stale, np.uint32, len(stale)))
+            return term_ids[keep], self.ids[keep]
+        return term_ids, self.ids
+
+    @classmethod
+    def merge(cls, older, newer, older_stale, newer_stale, live=None):
+        terms = sorted(set(older.terms).union(newer.terms))
+        positions = {term: i for i, term in enumerate(terms)}
+        parts_terms, parts_ids = [], []
+        for segment, stale in ((older, older_stale), (newer, newer_stale)):
+            remap = np.fromiter((positions[term] for term in segment.terms), np.int64,
+                                len(segment.terms))
+            term_ids, ids = segment.pairs(stale)
+            parts_terms.append(remap[term_ids])
+            parts_ids.append(ids)
+        return cls._from_pairs(terms, np.concatenate(parts_terms), np.concatenate(parts_ids),
+                               live)
+
+    def match(self, prefix, mask):
+        low = bisect_left(self.terms, prefix)
+        high = bisect_left(self.terms, prefix + _PREFIX_END, low)
+        if low == high:
+            return
+        ids = self.ids[self.starts[low]:self.starts[high]]
+        if self.stale:
+            if self._stale_count != len(self.stale):
+                # The stale set only grows, so its size tells if it changed
+                self._stale_ids = np.fromiter(self.stale, np.uint32, len(self.stale))
+                self._stale_count = len(self.stale)
+            ids = ids[~np.isin(ids, self._stale_ids)]
+        mask[ids] = True
+
+
+def _alive(ids, live):
+    # Which of the ids are in `live`, the sorted ids of the store
+    if not len(live):
+        return np.zeros(len(ids), dtype=bool)
+    found = np.minimum(np.searchsorted(live, ids), len(live) - 1)
+    return live[found] == ids
+
+
+class SearchIndex:
+    """Prefix index over the tracks of a TrackStore, by track id.
+
+    Kept up to date through the playlist model's observer calls
+    (tracks_appended, track_updated, tracks_removed, cleared); search()
+    returns a boolean mask over the store rows.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._segments = []
+        self._open = _OpenSegment()
+        # One past the largest track id indexed
+        self._end = 0
+        self._generation = 0
+        self._wakeup = threading.Event()
+        self._building = None
+        self.dirty = False
+        self._worker = threading.Thread(target=self._run, name='search-index', daemon=True)
+        self._worker.start()
+
+    @property
+    def ready(self):
+        # False while the initial build of a large playlist is running
+        return self._building is None
+
+    def __len__(self):
+        return len(self.store)
+
+    def segment_count(self):
+        return len(self._segments) + 1
+
+    def pending(self):
+        # Whether the worker has segments left to sort or merge
+        with self._lock:
+            segments = list(self._segments)
+        return (any(isinstance(segment, _OpenSegment) for segment in segments)
+                or any(len(newer) >= len(older) * MERGE_RATIO
+                       for older, newer in zip(segments, segments[1:])))
+
+    # Updates (GUI thread)
+
+    def tracks_appended(self, first_row, tracks):
+        ids = self.store.ids
+        if tracks:
+            with self._lock:
+                self._end = max(self._end, ids[first_row + len(tracks) - 1] + 1)
+        for row, (path, title, artist, album, _) in enumerate(tracks, first_row):
+            self._open.add(ids[row], track_words(path, title, artist, album))
+            self._seal_if_full()
+        self.dirty = True
+
+    def track_updated(self, row, title, artist, album, duration):
+        # Everything indexed so far has the old words of the track
+        track_id = self.store.ids[row]
+        with self._lock:
+            for segment in self._segments:
+                segment.stale.add(track_id)
+            if self._building is not None:
+                self._building.add(track_id)
+        self._open.remove(track_id)
+        self._open.add(track_id, track_words(self.store.path(row), title, artist, album))
+        self.dirty = True
+        self._seal_if_full()
+
+    def track_moved(self, row, path):
+        # File names are indexed too
+        _, title, artist, album, duration = self.store.track(row)
+        self.track_updated(row, title, artist, album, duration)
+
+    def tracks_removed(self, rows):
+        # Later rows move up but keep their ids, and search() only maps the
+        # ids still in the store to rows: nothing to do until the segments
+        # holding the removed ids are sorted or merged
+        self.dirty = True
+
+    def cleared(self):
+        with self._lock:
+            self._generation += 1
+            self._segments = []
+            self._building = None
+            self._end = 0
+        self._open = _OpenSegment()
+        self.dirty = True
+
+    def _seal_if_full(self):
+        if len(self._open) >= OPEN_SEGMENT_SIZE:
+            self._seal()
+
+    def _seal(self):
+        # Hand the open segment to the worker, which sorts it
+        sealed, self._open = self._open, _OpenSegment()
+        with self._lock:
+            self._segments.append(sealed)
+        self._wakeup.set()
+
+    # Queries
+
+    def search(self, query):
+        """Return a boolean NumPy mask of the rows matching every word of
+        the query, or None for an empty query."""
+        terms = set(words(query))
+        if not terms:
+            return None
+        with self._lock:
+            segments = list(self._segments)
+            end = self._end
+        result = None
+        # Longer words usually match fewer tracks; start with those
+        for term in sorted(terms, key=len, reverse=True):
+            mask = np.zeros(end, dtype=bool)
+            for segment in segments:
+                segment.match(term, mask)
+            self._open.match(term, mask)
+            if result is None:
+                result = mask
+            else:
+                result &= mask
+            if not result.any():
+                break
+        # From track ids to store rows
+        return result[np.frombuffer(self.store.ids, dtype=np.int64)]
+
+    # Building from an existing store
+
+    def build(self, file_path=None):
+        """Index every track of the store in the background, or load the
+        index saved at file_path if it was saved for these exact tracks.
+        Changes reported meanwhile are not lost."""
+        # Rows may be removed while this runs; a copy keeps them in place
+        store = self.store.snapshot()
+        with self._lock:
+            self._building = set()
+            generation = self._generation
+            if len(store):
+                self._end = max(self._end, store.ids[-1] + 1)
+
+        def run():
+            saved = _read_segments(file_path, store) if file_path else None
+            loaded = saved is not None
+            if loaded:
+                end, segments = saved
+            else:
+                end, segments = 0, [_index_store(store)]
+            with self._lock:
+                if generation != self._generation:
+                    return
+                # The saved index may hold ids removed before it was saved
+                self._end = max(self._end, end)
+                for segment in segments:
+                    segment.stale |= self._building
+                self._building = None
+                # Older than anything indexed since the build started
+                self._segments[0:0] = segments
+            if not loaded:
+                self.dirty = True
+            self._wakeup.set()
+
+        threading.Thread(target=run, name='search-index-build', daemon=True).start()
+
+    @classmethod
+    def open(cls, store, file_path=INDEX_PATH):
+        """Return an index of the store right away; the saved one is loaded,
+        or a new one built, in the background (see ready)."""
+        index = cls(store)
+        if len(store):
+            index.build(file_path)
+        return index
+
+    # Background sorting and merging
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._step():
+                pass
+
+    def _step(self):
+        # Sort one sealed segment or merge one pair; False when idle
+        with self._lock:
+            generation = self._generation
+            segments = self._segments
+            replaced = next(((segment,) for segment in segments
+                             if isinstance(segment, _OpenSegment)), None)
+            if replaced is None:
+                replaced = next(((older, newer) for older, newer in zip(segments, segments[1:])
+                                 if len(newer) >= len(older) * MERGE_RATIO), None)
+                if replaced is None:
+                    return False
+            # Stale ids seen now are dropped from the result
+            dropped = [set(segment.stale) for segment in replaced]
+        # And so are the ids of tracks removed by now (a copy: the store's
+        # array cannot grow while NumPy reads it)
+        live = np.frombuffer(self.store.ids[:], dtype=np.int64)
+
+        if len(replaced) == 1:
+            replacement = replaced[0].sorted(dropped[0], live)
+        else:
+            replacement = _Segment.merge(*replaced, *dropped, live)
+        dropped = set().union(*dropped)
+
+        with self._lock:
+            if generation != self._generation:
+                return True
+            position = self._segments.index(replaced[0])
+            # Ids marked stale while this ran still apply to the result
+            replacement.stale = set().union(*(old.stale for old in replaced)) - dropped
+            self._segments[position:position + len(replaced)] = [replacement]
+        return True
+
+    # Persistence
+
+    def save(self, file_path=INDEX_PATH):
+        """Write the index, tagged with a fingerprint of the store; build()
+        only loads it back for a store with the same tracks."""
+        if not self.ready:
+            return
+        fingerprint = store_fingerprint(self.store)
+        if len(self._open):
+            self._seal()
+        with self._lock:
+            segments = list(self._segments)
+        arrays = {
+            'meta': np.array([INDEX_VERSION, fingerprint, self._end, len(segments)],
+                             dtype=np.int64),
+        }
+        for i, segment in enumerate(segments):
+            if isinstance(segment, _OpenSegment):
+                segment = segment.sorted(segment.stale)
+            arrays[f'terms{i}'] = np.frombuffer(
+                '\0'.join(segment.terms).encode('utf-8', 'surrogateescape'), dtype=np.uint8)
+            arrays[f'starts{i}'] = segment.starts
+            arrays[f'ids{i}'] = segment.ids
+            arrays[f'stale{i}'] = np.fromiter(segment.stale, np.uint32, len(segment.stale))
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        tmp_path = f"{file_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, file_path)
+        self.dirty = False
+
+
+def _index_store(store):
+    # One sorted segment of the tracks of the store
+    strings = store.strings
+    # Artists and albums are shared by many tracks; split each once
+    pooled = {}
+    pair_words, pair_ids = [], []
+    for row, track_id in enumerate(store.ids):
+        row_words = set(words(f"{os.path.splitext(store.filename(row))[0]} "
+                              f"{store.title(row) or ''}"))
+        for string_id in (store.artists[row], store.albums[row]):
+            found = pooled.get(string_id)
+            if found is None:
+                found = pooled[string_id] = words(strings[string_id])
+            row_words.update(found)
+        pair_words.extend(row_words)
+        pair_ids.extend([track_id] * len(row_words))
+    return _Segment.build(pair_words, pair_ids)
+
+
+def _read_segments(file_path, store):
+    # (one past the largest id, segments) saved at file_path if saved for
+    # these exact tracks, else None
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with np.load(file_path) as data:
+            version, fingerprint, end, count = (int(value) for value in data['meta'])
+            if version != INDEX_VERSION or fingerprint != store_fingerprint(store):
+                return None
+            segments = []
+            for i in range(count):
+                blob = data[f'terms{i}'].tobytes()
+                terms = blob.decode('utf-8', 'surrogateescape').split('\0') if blob else []
+                segment = _Segment(terms, data[f'starts{i}'], data[f'ids{i}'])
+                segment.stale = set(data[f'stale{i}'].tolist())
+                segments.append(segment)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Error loading search index: {e}")
+        return None
+    return (end, segments) if segments else None
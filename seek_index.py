@@ -0,0 +1,245 @@
+import struct
+from array import array
+
+import http_stream
+
+# Bitrates in kbit/s, indexed by [MPEG-1?][layer][bitrate index]
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# One index point per this many frames (about one second of MPEG-1 audio)
+SCAN_STRIDE = 38
+
+
+def parse_frame_header(header):
+    """Decode a 4-byte MPEG audio frame header.
+
+    Returns (frame_size, samples_per_frame, sample_rate, mpeg1, mono) or
+    None if the bytes are not a valid header.
+    """
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 0x01
+    mono = (header[3] >> 6) == 3
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate, mpeg1, mono
+    samples = 1152 if (layer == 2 or mpeg1) else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate, mpeg1, mono
+
+
+def id3v2_size(head):
+    # Total size of a leading ID3v2 tag (header, body and footer), or 0
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+class SeekIndex:
+    """Map playback times to frame-exact times and byte offsets of an MP3.
+
+    Built either from the Xing/Info or VBRI header of the first frame, or by
+    scanning frame headers. Scanned indexes keep the byte offset of every
+    `stride`-th frame, which is exact for VBR files too.
+    """
+
+    def __init__(self, sample_rate, frame_samples, frame_count, data_start, data_end,
+                 stride=0, offsets=None, toc=None):
+        self.sample_rate = sample_rate
+        self.frame_samples = frame_samples
+        self.frame_count = frame_count
+        self.data_start = data_start
+        self.data_end = data_end
+        self.stride = stride
+        self.offsets = offsets if offsets is not None else array('Q')
+        self.toc = toc
+
+    @property
+    def frame_duration(self):
+        return self.frame_samples / self.sample_rate
+
+    @property
+    def duration(self):
+        return self.frame_count * self.frame_duration
+
+    def frame_time(self, seconds):
+        # Start time of the frame boundary nearest to `seconds`
+        frame = int(max(0.0, seconds) / self.frame_duration + 0.5)
+        frame = min(frame, max(0, self.frame_count - 1))
+        return frame * self.frame_duration
+
+    def byte_offset(self, seconds):
+        seconds = min(max(0.0, seconds), self.duration)
+        if self.offsets:
+            # Exact offset of the nearest indexed frame at or before the time
+            point = min(int(seconds / self.frame_duration) // self.stride, len(self.offsets) - 1)
+            return self.offsets[point]
+        if self.toc:
+            # Xing TOC: 100 entries of the byte position (0-255) per percent
+            percent = seconds * 100.0 / self.duration if self.duration else 0.0
+            index = min(int(percent), 99)
+            low = self.toc[index]
+            high = self.toc[index + 1] if index < 99 else 256
+            position = low + (high - low) * (percent - index)
+            return self.data_start + int(position / 256.0 * (self.data_end - self.data_start))
+        return self.data_start + int(seconds / self.duration * (self.data_end - self.data_start)) \
+            if self.duration else self.data_start
+
+    def to_bytes(self):
+        toc = bytes(self.toc) if self.toc else b''
+        header = struct.pack('<IIIQQIB', self.sample_rate, self.frame_samples, self.frame_count,
+                             self.data_start, self.data_end, self.stride, len(toc))
+        return header + toc + self.offsets.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        fmt = '<IIIQQIB'
+        size = struct.calcsize(fmt)
+        sample_rate, frame_samples, frame_count, data_start, data_end, stride, toc_len = \
+            struct.unpack_from(fmt, data)
+        toc = list(data[size:size + toc_len]) or None
+        offsets = array('Q')
+        offsets.frombytes(data[size + toc_len:])
+        return cls(sample_rate, frame_samples, frame_count, data_start, data_end,
+                   stride, offsets, toc)
+
+
+def _xing_offset(mpeg1, mono):
+    # Side info size: where a Xing/Info tag sits inside the first frame
+    if mpeg1:
+        return 4 + (17 if mono else 32)
+    return 4 + (9 if mono else 17)
+
+
+def _parse_vbr_header(frame, info):
+    _, frame_samples, sample_rate, mpeg1, mono = info
+    offset = _xing_offset(mpeg1, mono)
+    tag = frame[offset:offset + 4]
+    if tag in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', frame[offset + 4:offset + 8])[0]
+        position = offset + 8
+        frames = data_bytes = None
+        toc = None
+        if flags & 0x1:
+            frames = struct.unpack('>I', frame[position:position + 4])[0]
+            position += 4
+        if flags & 0x2:
+            data_bytes = struct.unpack('>I', frame[position:position + 4])[0]
+            position += 4
+        if flags & 0x4:
+            toc = list(frame[position:position + 100])
+        return frames, data_bytes, toc
+    # VBRI always sits 32 bytes after the header
+    if frame[36:40] == b'VBRI':
+        data_bytes, frames = struct.unpack('>II', frame[46:54])
+        return frames, data_bytes, None
+    return None
+
+
+def build_seek_index(file_path, scan=False):
+    """Build a SeekIndex for an MP3 file, or return None if it has no
+    MPEG audio frames.
+
+    The Xing/VBRI header is used when present (reading only the first
+    frame); otherwise, or when scan is True, every frame header is read.
+    URLs are not scanned unless asked to, as that would download them
+    whole: their frames are counted from the first one's size, which is
+    exact for constant bitrate files.
+    """
+    with http_stream.open_file(file_path) as f:
+        head = f.read(10)
+        start = id3v2_size(head)
+        f.seek(0, 2)
+        end = f.tell()
+        # An ID3v1 tag occupies the last 128 bytes
+        if end >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+
+        # Find the first frame, tolerating a little junk after the tag
+        f.seek(start)
+        probe = f.read(64 * 1024)
+        info = None
+        for position in range(len(probe) - 3):
+            if probe[position] == 0xFF:
+                info = parse_frame_header(probe[position:position + 4])
+                if info is not None:
+                    start += position
+                    break
+        if info is None:
+            return None
+
+        f.seek(start)
+        first_frame = f.read(info[0])
+        vbr = _parse_vbr_header(first_frame, info)
+        frame_samples, sample_rate = info[1], info[2]
+
+        if vbr is not None and not scan:
+            frames, data_bytes, toc = vbr
+            if frames:
+                data_end = start + data_bytes if data_bytes else end
+                # The header frame itself carries no audio
+                return SeekIndex(sample_rate, frame_samples, frames,
+                                 start + info[0], data_end, toc=toc)
+
+        if vbr is None and not scan and http_stream.is_url(file_path):
+            frames = (end - start) // info[0]
+            return SeekIndex(sample_rate, frame_samples, frames, start, start + frames * info[0])
+
+        if vbr is not None:
+            start += info[0]
+
+        return _scan_frames(f, start, end, sample_rate, frame_samples)
+
+
+def _scan_frames(f, start, end, sample_rate, frame_samples):
+    offsets = array('Q')
+    frame_count = 0
+    position = start
+    f.seek(start)
+    buffer = b''
+    buffer_start = start
+    while position + 4 <= end:
+        relative = position - buffer_start
+        if relative + 4 > len(buffer):
+            f.seek(position)
+            buffer = f.read(256 * 1024)
+            buffer_start = position
+            relative = 0
+            if len(buffer) < 4:
+                break
+        info = parse_frame_header(buffer[relative:relative + 4])
+        if info is None:
+            # Lost sync (junk or a trailing tag): stop at the last good frame
+            break
+        if frame_count % SCAN_STRIDE == 0:
+            offsets.append(position)
+        frame_count += 1
+        position += info[0]
+
+    return SeekIndex(sample_rate, frame_samples, frame_count, start, min(position, end),
+                     SCAN_STRIDE, offsets)
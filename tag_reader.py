@@ -0,0 +1,400 @@
+"""Single-pass tag and stream info reader.
+
+A file is opened once and only the regions that describe it are read:
+
+    MP3     the ID3v2 tag, frame by frame (the frames that are not needed,
+            cover bytes included, are skipped), the first MPEG frame with
+            its Xing/Info or VBRI header, and the ID3v1 tag at the end only
+            when the ID3v2 tag lacks a title, artist or album
+    WAV     the RIFF chunk headers, the fmt chunk, and LIST/INFO and id3
+            chunks when there are any
+
+Other formats are read through mutagen. Reads go through one small
+window, so a tag and the first frame after it usually cost a single read.
+
+Embedded covers are not read either: the record says where their bytes
+are, with a key made of that place (the file, its size and modification
+time, the offset and the length), and they are read when shown, when the
+metadata cache learns the content hash that tracks of an album share.
+Covers stored unsynchronised or compressed are the exception: their bytes
+are only usable once decoded, so they are returned as is.
+"""
+import zlib
+import struct
+import hashlib
+from collections import namedtuple
+
+import metrics
+import http_stream
+from seek_index import parse_frame_header, _parse_vbr_header, _BITRATES
+
+# What a file says about itself. cover is None, the cover's bytes, or a
+# CoverLocation when its bytes can be read from the file as they are
+Tags = namedtuple('Tags', ['title', 'artist', 'album', 'year', 'duration', 'cover'])
+CoverLocation = namedtuple('CoverLocation', ['offset', 'length', 'key'])
+
+# Bytes read at once around a position
+READ_SIZE = 8 * 1024
+# How far past the ID3v2 tag the first MPEG frame is looked for: a short
+# look, usually still in the window the tag was read through, then a long one
+FRAME_PROBE = 2 * 1024
+FRAME_SEARCH = 64 * 1024
+# Enough of a cover frame for its MIME type and description
+COVER_HEADER = 1024
+# Longest LIST/INFO chunk of a WAV file that is read
+INFO_LIMIT = 64 * 1024
+
+_ID3_FIELDS = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'TDRC': 'year', 'TYER': 'year',
+    # ID3v2.2
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'TYE': 'year',
+}
+_ID3_COVERS = ('APIC', 'PIC')
+_ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+_INFO_FIELDS = {b'INAM': 'title', b'IART': 'artist', b'IPRD': 'album', b'ICRD': 'year'}
+_FIELDS = ('title', 'artist', 'album', 'year')
+
+
+class _Reader:
+    """Positioned reads from an unbuffered file, through one cached window."""
+
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+        self.stat = http_stream.fstat(f)
+        self.size = self.stat.st_size
+        self.bytes_read = 0
+        self._start = 0
+        self._window = b''
+
+    def read(self, offset, length, ahead=READ_SIZE):
+        # Up to `length` bytes at `offset`; a miss reads `ahead` bytes
+        # (at least `length`) into the window
+        start = offset - self._start
+        if 0 <= start and start + length <= len(self._window):
+            return self._window[start:start + length]
+        self.f.seek(offset)
+        data = self.f.read(max(length, ahead))
+        self.bytes_read += len(data)
+        if ahead:
+            self._start, self._window = offset, data
+        return data[:length]
+
+
+class _Buffer:
+    # The _Reader interface over bytes already in memory
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+
+    def read(self, offset, length, ahead=0):
+        return self.data[offset:offset + length]
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _unsynchronised(data):
+    return data.replace(b'\xff\x00', b'\xff')
+
+
+def _id3_text(data):
+    # First value of an ID3 text frame, or None
+    if not data or data[0] >= len(_ID3_ENCODINGS):
+        return None
+    text = data[1:].decode(_ID3_ENCODINGS[data[0]], 'replace')
+    return text.split('\0', 1)[0] or None
+
+
+def _cover_data_offset(frame_id, body):
+    # Where the picture starts in an APIC/PIC frame body, or None
+    if len(body) < 2:
+        return None
+    encoding = body[0]
+    if frame_id == 'PIC':
+        position = 5     # encoding, image format, picture type
+    else:
+        mime_end = body.find(b'\0', 1)
+        if mime_end < 0:
+            return None
+        position = mime_end + 2     # the picture type follows the MIME type
+    if encoding in (1, 2):
+        # UTF-16 descriptions end with two zero bytes on a character boundary
+        end = position
+        while end + 1 < len(body) and body[end:end + 2] != b'\0\0':
+            end += 2
+        end += 2
+    else:
+        end = body.find(b'\0', position) + 1
+        if end == 0:
+            return None
+    return end if end <= len(body) else None
+
+
+def _cover_key(reader, offset, length):
+    # Where the cover is, in this version of the file: none of its bytes
+    # are read before it is shown (see MetadataCache.load_art)
+    stat = reader.stat
+    where = f"{reader.path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{offset}\0{length}"
+    return hashlib.sha1(where.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def _read_id3(reader, offset, fields):
+    """Read the ID3v2 tag at offset into fields (first value of each
+    wins). Returns (cover, offset past the tag); the offset is unchanged
+    when there is no tag."""
+    header = reader.read(offset, 10)
+    if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (2, 3, 4):
+        return None, offset
+    major, flags = header[3], header[5]
+    size = _syncsafe(header[6:10])
+    tag_end = offset + 10 + size + (10 if flags & 0x10 else 0)
+    source, position, end = reader, offset + 10, offset + 10 + size
+    if flags & 0x80 and major < 4:
+        # Unsynchronised as a whole: the frames only make sense once the
+        # whole tag is decoded
+        source = _Buffer(_unsynchronised(reader.read(position, size)))
+        position, end = 0, source.size
+    if flags & 0x40 and major > 2:
+        extended = source.read(position, 4)
+        if len(extended) < 4:
+            return None, tag_end
+        position += _syncsafe(extended) if major == 4 else 4 + struct.unpack('>I', extended)[0]
+
+    cover = None
+    header_size = 6 if major == 2 else 10
+    while position + header_size <= end:
+        frame = source.read(position, header_size)
+        if major == 2:
+            frame_id, frame_size, frame_flags = frame[:3], int.from_bytes(frame[3:6], 'big'), 0
+        else:
+            frame_id, frame_flags = frame[:4], frame[9]
+            frame_size = _syncsafe(frame[4:8]) if major == 4 else struct.unpack('>I', frame[4:8])[0]
+        if not frame_id.isalnum():
+            # Padding
+            break
+        body, position = position + header_size, position + header_size + frame_size
+        if position > end:
+            break
+        frame_id = frame_id.decode('latin-1')
+        field = _ID3_FIELDS.get(frame_id)
+        if field is None and (frame_id not in _ID3_COVERS or cover is not None):
+            continue
+        if field is not None and fields.get(field) is not None:
+            continue
+
+        if major == 4:
+            compressed, encrypted = frame_flags & 0x08, frame_flags & 0x04
+            unsynchronised = frame_flags & 0x02 or flags & 0x80
+            skip = (1 if frame_flags & 0x40 else 0) + (4 if frame_flags & 0x01 else 0)
+        elif major == 3:
+            compressed, encrypted, unsynchronised = frame_flags & 0x80, frame_flags & 0x40, 0
+            skip = (4 if compressed else 0) + (1 if frame_flags & 0x20 else 0)
+        else:
+            compressed = encrypted = unsynchronised = skip = 0
+        if encrypted or skip > frame_size:
+            continue
+        body += skip
+        length = frame_size - skip
+
+        if field is None and source is reader and not (compressed or unsynchronised):
+            # A cover that can be read from the file as it is: only locate it
+            data_offset = _cover_data_offset(frame_id, reader.read(body, min(length, COVER_HEADER)))
+            if data_offset is not None and data_offset < length:
+                cover_offset, cover_length = body + data_offset, length - data_offset
+                cover = CoverLocation(cover_offset, cover_length,
+                                      _cover_key(reader, cover_offset, cover_length))
+            continue
+
+        data = source.read(body, length, ahead=0)
+        if unsynchronised:
+            data = _unsynchronised(data)
+        if compressed:
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                continue
+        if field is not None:
+            fields[field] = _id3_text(data)
+        else:
+            data_offset = _cover_data_offset(frame_id, data[:COVER_HEADER])
+            if data_offset is not None and data_offset < len(data):
+                cover = data[data_offset:]
+    return cover, tag_end
+
+
+def _read_id3v1(reader, end, fields):
+    # Fill fields the ID3v2 tag did not have; returns where the audio ends
+    if end < 128:
+        return end
+    tail = reader.read(end - 128, 128, ahead=0)
+    if tail[:3] != b'TAG':
+        return end
+    for field, start, stop in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93),
+                               ('year', 93, 97)):
+        if fields.get(field) is None:
+            value = tail[start:stop].split(b'\0', 1)[0].decode('latin-1').strip()
+            fields[field] = value or None
+    return end - 128
+
+
+def _read_mpeg(reader):
+    # Tags of an MP3 file, or None when it has no MPEG audio frames
+    fields = {}
+    cover, start = _read_id3(reader, 0, fields)
+    end = reader.size
+    if any(fields.get(field) is None for field in ('title', 'artist', 'album')):
+        end = _read_id3v1(reader, end, fields)
+
+    # The first frame, tolerating a little junk after the tag
+    info = position = None
+    for size in (FRAME_PROBE, FRAME_SEARCH):
+        probe = reader.read(start, size)
+        for position in range(len(probe) - 3):
+            if probe[position] == 0xFF:
+                info = parse_frame_header(probe[position:position + 4])
+                if info is not None:
+                    break
+        if info is not None or len(probe) < size:
+            break
+    if info is None:
+        return None
+
+    start += position
+    frame = reader.read(start, info[0])
+    frame_size, frame_samples, sample_rate, mpeg1 = info[:4]
+    vbr = _parse_vbr_header(frame, info)
+    if vbr is not None and vbr[0]:
+        duration = vbr[0] * frame_samples / sample_rate
+    else:
+        # Constant bitrate: the stream's length at the first frame's bitrate
+        layer = 4 - ((frame[1] >> 1) & 0x03)
+        bitrate = _BITRATES[mpeg1][layer][frame[2] >> 4] * 1000
+        duration = max(end - start, 0) * 8 / bitrate
+    return Tags(fields.get('title'), fields.get('artist'), fields.get('album'),
+                fields.get('year'), duration, cover)
+
+
+def _read_wav(reader):
+    fields, info = {}, {}
+    cover = None
+    byte_rate = data_size = 0
+    position = 12
+    while position + 8 <= reader.size:
+        chunk_id, size = struct.unpack('<4sI', reader.read(position, 8))
+        body = position + 8
+        if chunk_id == b'fmt ':
+            fmt = reader.read(body, 16)
+            if len(fmt) == 16:
+                byte_rate = struct.unpack('<I', fmt[8:12])[0]
+        elif chunk_id == b'data':
+            # Streamed files may leave the size unset
+            data_size = min(size, reader.size - body) if size else reader.size - body
+        elif chunk_id == b'LIST' and size <= INFO_LIMIT and reader.read(body, 4) == b'INFO':
+            chunk = reader.read(body + 4, size - 4)
+            offset = 0
+            while offset + 8 <= len(chunk):
+                sub_id, sub_size = struct.unpack('<4sI', chunk[offset:offset + 8])
+                field = _INFO_FIELDS.get(sub_id)
+                if field is not None:
+                    value = chunk[offset + 8:offset + 8 + sub_size].split(b'\0', 1)[0]
+                    try:
+                        info[field] = value.decode('utf-8').strip() or None
+                    except UnicodeDecodeError:
+                        info[field] = value.decode('latin-1').strip() or None
+                offset += 8 + sub_size + (sub_size & 1)
+        elif chunk_id in (b'id3 ', b'ID3 '):
+            cover, _ = _read_id3(reader, body, fields)
+        position = body + size + (size & 1)
+
+    # ID3 tags win over RIFF INFO ones
+    for field in _FIELDS:
+        if fields.get(field) is None:
+            fields[field] = info.get(field)
+    duration = data_size / byte_rate if byte_rate else 0.0
+    return Tags(fields['title'], fields['artist'], fields['album'], fields['year'],
+                duration, cover)
+
+
+def _first_text(tags, key):
+    # Return the first value of a tag as a string, or None if it is missing
+    try:
+        if key not in tags:
+            return None
+        value = tags[key]
+    except Exception:
+        return None
+    if hasattr(value, 'text'):
+        value = value.text
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return str(value) if value is not None else None
+
+
+def _find_cover(tags):
+    # ID3 stores covers as APIC frames ('APIC:' or 'APIC:<description>')
+    if hasattr(tags, 'getall'):
+        frames = tags.getall('APIC')
+        if frames:
+            return frames[0].data
+    return None
+
+
+def _read_with_mutagen(file_path):
+    # Imported lazily: only formats without a reader of their own need it
+    from mutagen import File
+
+    if http_stream.is_url(file_path):
+        with http_stream.open_file(file_path) as f:
+            audio = File(f)
+    else:
+        audio = File(file_path)
+    title = artist = album = year = cover = None
+    duration = 0.0
+    if audio is not None:
+        if audio.info is not None:
+            duration = float(getattr(audio.info, 'length', 0.0) or 0.0)
+        tags = audio.tags
+        if tags:
+            title = _first_text(tags, 'TIT2')
+            artist = _first_text(tags, 'TPE1')
+            album = _first_text(tags, 'TALB')
+            year = _first_text(tags, 'TDRC')
+            cover = _find_cover(tags)
+    return Tags(title, artist, album, year, duration, cover)
+
+
+def read_tags(file_path):
+    """Return the Tags of a file, opening it once.
+
+    MP3 and WAV files are read here; anything else, including files named
+    .mp3 without MPEG audio frames, goes through mutagen.
+    """
+    if file_path.lower().endswith(('.mp3', '.wav')):
+        with http_stream.open_file(file_path) as f:
+            reader = _Reader(f, file_path)
+            head = reader.read(0, 12)
+            if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+                tags = _read_wav(reader)
+            else:
+                tags = _read_mpeg(reader)
+        metrics.count('tag_bytes_read', reader.bytes_read)
+        if tags is not None:
+            return tags
+    metrics.count('tag_mutagen_fallbacks')
+    return _read_with_mutagen(file_path)
+
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        tags = read_tags(path)
+        cover = tags.cover
+        if isinstance(cover, CoverLocation):
+            cover = f"{cover.length} bytes at {cover.offset}"
+        elif cover:
+            cover = f"{len(cover)} bytes"
+        print(f"{path}\n  title: {tags.title}\n  artist: {tags.artist}\n  album: {tags.album}\n"
+              f"  year: {tags.year}\n  duration: {tags.duration:.3f} s\n  cover: {cover}")
@@ -0,0 +1,299 @@
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import compress
+
+# Column identifiers shared by the store and the playlist model
+TITLE, ARTIST, ALBUM, DURATION = range(4)
+
+
+class StringPool:
+    """Interned string table: each distinct string is stored once and
+    referenced by a small integer id. Id 0 is the empty string."""
+
+    def __init__(self):
+        self._ids = {'': 0}
+        self._strings = ['']
+        self._ranks = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        # Rebuild a pool from its strings in id order (strings[0] is '')
+        pool = cls()
+        pool._strings = list(strings)
+        pool._ids = dict(zip(pool._strings, range(len(pool._strings))))
+        return pool
+
+    def intern(self, value):
+        if not value:
+            return 0
+        string_id = self._ids.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            value = sys.intern(value)
+            self._ids[value] = string_id
+            self._strings.append(value)
+            self._ranks = None
+        return string_id
+
+    def find(self, value):
+        # Id of a string already in the pool, or None
+        return self._ids.get(value)
+
+    def __getitem__(self, string_id):
+        return self._strings[string_id]
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __iter__(self):
+        return iter(self._strings)
+
+    def ranks(self):
+        # Case-insensitive sort rank of every id, computed once per pool change
+        if self._ranks is None:
+            order = sorted(range(len(self._strings)),
+                           key=lambda i: self._strings[i].casefold())
+            ranks = array('I', bytes(4 * len(order)))
+            for rank, string_id in enumerate(order):
+                ranks[string_id] = rank
+            self._ranks = ranks
+        return self._ranks
+
+
+class StringHeap:
+    """Append-only UTF-8 byte buffer for strings that are mostly unique
+    (titles, file names). A string is referenced by its offset and length,
+    so no Python object exists until the string is read back."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, value):
+        encoded = value.encode('utf-8', 'surrogateescape')
+        offset = len(self.data)
+        self.data += encoded
+        return offset, len(encoded)
+
+    def get(self, offset, length):
+        return self.data[offset:offset + length].decode('utf-8', 'surrogateescape')
+
+
+class TrackStore:
+    """Column-oriented track table.
+
+    Every column is a flat array of ids, offsets or numbers, so a track
+    costs well under a hundred bytes instead of a row object. Strings
+    shared between tracks (directories, artists, albums) are interned
+    once; unique ones live in a byte heap.
+    """
+
+    # The per-track arrays, in the order playlist files store them
+    COLUMNS = ('ids', 'directories', 'filename_offsets', 'filename_lengths', 'title_offsets',
+               'title_lengths', 'artists', 'albums', 'durations')
+
+    def __init__(self):
+        self.strings = StringPool()
+        self.heap = StringHeap()
+        self.ids = array('q')
+        self.directories = array('I')
+        self.filename_offsets = array('Q')
+        self.filename_lengths = array('I')
+        # Untagged tracks have a zero-length title and show their file name
+        self.title_offsets = array('Q')
+        self.title_lengths = array('I')
+        self.artists = array('I')
+        self.albums = array('I')
+        self.durations = array('d')
+        self._next_id = 1
+        # Held while rows are added, changed, moved or removed, so that
+        # snapshot() can copy the columns from another thread
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_columns(cls, strings, heap, columns):
+        """Rebuild a store from its pool strings, heap bytes and a dict of
+        column arrays, as saved by playlist_file."""
+        store = cls()
+        store.strings = StringPool.from_strings(strings)
+        store.heap.data = heap
+        for name in cls.COLUMNS:
+            setattr(store, name, columns[name])
+        # Ids are handed out in row order, so the last one is the largest
+        store._next_id = store.ids[-1] + 1 if store.ids else 1
+        return store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, path, title=None, artist=None, album=None, duration=0.0):
+        self.extend(((path, title, artist, album, duration),))
+        return len(self.ids) - 1
+
+    def extend(self, tracks):
+        # tracks: iterable of (path, title, artist, album, duration)
+        with self._lock:
+            first = len(self.ids)
+            intern = self.strings.intern
+            add = self.heap.add
+            next_id = self._next_id
+            for path, title, artist, album, duration in tracks:
+                # The directory keeps its trailing separator so paths rejoin exactly
+                split = path.rfind(os.sep) + 1
+                offset, length = add(path[split:])
+                self.filename_offsets.append(offset)
+                self.filename_lengths.append(length)
+                offset, length = add(title) if title else (0, 0)
+                self.title_offsets.append(offset)
+                self.title_lengths.append(length)
+                self.directories.append(intern(path[:split]))
+                self.artists.append(intern(artist))
+                self.albums.append(intern(album))
+                self.durations.append(duration or 0.0)
+                self.ids.append(next_id)
+                next_id += 1
+            self._next_id = next_id
+            return first, len(self.ids) - 1
+
+    def update(self, row, title=None, artist=None, album=None, duration=0.0):
+        # Returns whether anything changed
+        title_changed = (title or None) != self.title(row)
+        if title_changed:
+            # The heap is append-only; the old title bytes are simply orphaned
+            offset, length = self.heap.add(title) if title else (0, 0)
+        intern = self.strings.intern
+        artist, album, duration = intern(artist), intern(album), duration or 0.0
+        with self._lock:
+            if title_changed:
+                self.title_offsets[row] = offset
+                self.title_lengths[row] = length
+            tags_changed = (artist, album, duration) != (self.artists[row], self.albums[row],
+                                                         self.durations[row])
+            if tags_changed:
+                self.artists[row] = artist
+                self.albums[row] = album
+                self.durations[row] = duration
+        return title_changed or tags_changed
+
+    def set_path(self, row, path):
+        # Point a track at a renamed or moved file; like update(), the old
+        # file name bytes are orphaned
+        split = path.rfind(os.sep) + 1
+        offset, length = self.heap.add(path[split:])
+        with self._lock:
+            self.filename_offsets[row] = offset
+            self.filename_lengths[row] = length
+            self.directories[row] = self.strings.intern(path[:split])
+
+    def remove(self, rows):
+        # Drop the given rows; the rows after them move up. The heap and the
+        # pool keep the strings of removed tracks, as update() does
+        removed = sorted(set(rows))
+        with self._lock:
+            # The runs of rows kept between removed ones: a few removals from
+            # a large store copy a few slices, many go through a mask
+            starts = [0] + [row + 1 for row in removed]
+            stops = removed + [len(self.ids)]
+            runs = [(start, stop) for start, stop in zip(starts, stops) if start < stop]
+            if len(runs) * 16 < len(self.ids):
+                for name in self.COLUMNS:
+                    column = getattr(self, name)
+                    kept = array(column.typecode)
+                    for start, stop in runs:
+                        kept += column[start:stop]
+                    setattr(self, name, kept)
+                return
+            removed = set(removed)
+            keep = [row not in removed for row in range(len(self.ids))]
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                setattr(self, name, array(column.typecode, compress(column, keep)))
+
+    def snapshot(self):
+        """A copy to read from another thread while tracks are added,
+        changed, moved or removed on this one: the columns are copied, the
+        pool and the heap (append-only) are shared."""
+        copy = TrackStore()
+        with self._lock:
+            copy.strings, copy.heap, copy._next_id = self.strings, self.heap, self._next_id
+            for name in self.COLUMNS:
+                setattr(copy, name, getattr(self, name)[:])
+        return copy
+
+    def filename(self, row):
+        return self.heap.get(self.filename_offsets[row], self.filename_lengths[row])
+
+    def path(self, row):
+        return self.strings[self.directories[row]] + self.filename(row)
+
+    def row_of_id(self, track_id):
+        # Store row of a track id, or -1; ids only ever grow with the row
+        row = bisect_left(self.ids, track_id)
+        return row if row < len(self.ids) and self.ids[row] == track_id else -1
+
+    def directory_rows(self, directories):
+        """Return {path: [rows]} of the tracks directly inside any of the
+        given directories (each with its trailing separator)."""
+        ids = {self.strings.find(directory) for directory in directories}
+        ids.discard(None)
+        rows = defaultdict(list)
+        if ids:
+            # One mask over the column rather than a Python loop over every
+            # track; NumPy is imported on first use, as playlist_model does
+            import numpy as np
+
+            wanted = np.zeros(len(self.strings), dtype=bool)
+            wanted[list(ids)] = True
+            found = wanted[np.frombuffer(self.directories, dtype=np.uint32)]
+            for row in np.flatnonzero(found).tolist():
+                rows[self.path(row)].append(row)
+        return rows
+
+    def track(self, row):
+        # (path, title, artist, album, duration), as accepted by extend()
+        return (self.path(row), self.title(row), self.strings[self.artists[row]] or None,
+                self.strings[self.albums[row]] or None, self.durations[row])
+
+    def title(self, row):
+        # Tagged title, or None for untagged tracks
+        length = self.title_lengths[row]
+        return self.heap.get(self.title_offsets[row], length) if length else None
+
+    def value(self, row, column):
+        if column == TITLE:
+            return self.title(row) or self.filename(row)
+        if column == ARTIST:
+            return self.strings[self.artists[row]]
+        if column == ALBUM:
+            return self.strings[self.albums[row]]
+        if column == DURATION:
+            return self.durations[row]
+        raise IndexError(column)
+
+    def sort_order(self, column, descending=False):
+        """Return an array of rows ordered by the given column.
+
+        Artist and album are compared through the pool's precomputed ranks;
+        titles are decoded one at a time as sort keys, never stored.
+        """
+        if column == DURATION:
+            key = self.durations.__getitem__
+        elif column == TITLE:
+            value = self.value
+            key = lambda row: value(row, TITLE).casefold()
+        else:
+            ranks = self.strings.ranks()
+            column_ids = self.artists if column == ARTIST else self.albums
+            key = lambda row: ranks[column_ids[row]]
+        return array('I', sorted(range(len(self.ids)), key=key, reverse=descending))
+
+    def clear(self):
+        # Ids go on from where they were: those of the cleared tracks are
+        # not handed out again
+        with self._lock:
+            lock, next_id = self._lock, self._next_id
+            self.__init__()
+            self._lock, self._next_id = lock, next_id
@@ -0,0 +1,312 @@
+"""Peak envelopes for the waveform seek bar.
+
+A track is decoded once, in a worker process, into min/max peaks at
+several resolutions: level 0 has one (min, max) pair per BUCKET_FRAMES
+frames, and each next level merges LEVEL_FACTOR buckets of the one
+before. Any width of seek bar is then drawn from the coarsest level that
+still has a bucket per pixel, so a one-hour mix costs no more to draw
+than a short song.
+
+Waveforms are cached in the cache directory as small int8 .npz files,
+named after a hash of the track's path and checked against its size and
+modification time.
+"""
+import os
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+import metrics
+import loudness
+import http_stream
+from seek_index import build_seek_index
+
+WAVEFORM_VERSION = 1
+# About 46 ms at 44.1 kHz; finer than a pixel for songs a few minutes long
+BUCKET_FRAMES = 2048
+LEVEL_FACTOR = 8
+# Levels stop once they are this short
+MIN_LEVEL_BUCKETS = 256
+# Rate compressed files other than MP3 are decoded at
+DEFAULT_RATE = 44100
+
+
+def waveform_path(waveform_dir, file_path):
+    name = hashlib.sha1(file_path.encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(waveform_dir, f"{name}.npz")
+
+
+class Waveform:
+    """Peak levels of a track; each level is an int8 array of (min, max)
+    rows scaled to +-127."""
+
+    def __init__(self, rate, levels):
+        self.rate = rate
+        self.levels = levels
+
+    @property
+    def duration(self):
+        return len(self.levels[0]) * BUCKET_FRAMES / self.rate
+
+    def envelope(self, columns, duration=None):
+        """Return (mins, maxs) as float arrays in [-1, 1], one value per
+        column for `columns` equal slices of the first `duration` seconds
+        (the whole track by default)."""
+        if duration is None:
+            duration = self.duration
+        column_frames = duration * self.rate / max(columns, 1)
+        level = 0
+        while level + 1 < len(self.levels) and \
+                BUCKET_FRAMES * LEVEL_FACTOR ** (level + 1) <= column_frames:
+            level += 1
+        peaks = self.levels[level]
+        step = column_frames / (BUCKET_FRAMES * LEVEL_FACTOR ** level)
+
+        mins = np.zeros(columns, dtype=np.float32)
+        maxs = np.zeros(columns, dtype=np.float32)
+        starts = (np.arange(columns) * step).astype(np.int64)
+        shown = starts < len(peaks)
+        starts = starts[shown]
+        if len(starts):
+            # Columns narrower than a bucket repeat it; the last one ends
+            # where the duration does
+            end = max(min(int(np.ceil(columns * step)), len(peaks)), starts[-1] + 1)
+            mins[shown] = np.minimum.reduceat(peaks[:end, 0], starts) / 127.0
+            maxs[shown] = np.maximum.reduceat(peaks[:end, 1], starts) / 127.0
+        return mins, maxs
+
+
+def _levels(mins, maxs):
+    levels = [np.stack((mins, maxs), axis=1)]
+    while len(levels[-1]) > MIN_LEVEL_BUCKETS:
+        previous = levels[-1]
+        starts = np.arange(0, len(previous), LEVEL_FACTOR)
+        levels.append(np.stack((np.minimum.reduceat(previous[:, 0], starts),
+                                np.maximum.reduceat(previous[:, 1], starts)), axis=1))
+    return levels
+
+
+def _quantize(values):
+    return np.clip(np.round(values * 127), -127, 127).astype(np.int8)
+
+
+def _init_worker():
+    loudness._init_worker()
+
+
+def _open_mixer(rate):
+    # Decoding at the file's own rate skips resampling, which costs several
+    # times more than the decode itself
+    import pygame
+
+    if pygame.mixer.get_init()[0] != rate:
+        pygame.mixer.quit()
+        pygame.mixer.init(frequency=rate, size=32, channels=2)
+
+
+def compute_waveform(file_path):
+    """Decode a file and return its Waveform. Runs in a worker process."""
+    seek_index = build_seek_index(file_path, scan=True) \
+        if file_path.lower().endswith('.mp3') else None
+    if not file_path.lower().endswith('.wav'):
+        _open_mixer(seek_index.sample_rate if seek_index is not None else DEFAULT_RATE)
+
+    rate = DEFAULT_RATE
+    mins, maxs = [], []
+    carry_low = carry_high = np.zeros(0, dtype=np.float32)
+    for rate, samples in loudness._decoded_chunks(file_path, seek_index):
+        # Min and max over channels, then over each bucket; reductions
+        # along contiguous rows, which are many times faster than across
+        # the interleaved channels
+        low, high = samples[:, 0].copy(), samples[:, 0].copy()
+        for channel in range(1, samples.shape[1]):
+            np.minimum(low, samples[:, channel], out=low)
+            np.maximum(high, samples[:, channel], out=high)
+        low = np.concatenate((carry_low, low))
+        high = np.concatenate((carry_high, high))
+        whole = len(low) // BUCKET_FRAMES * BUCKET_FRAMES
+        mins.append(_quantize(low[:whole].reshape(-1, BUCKET_FRAMES).min(axis=1)))
+        maxs.append(_quantize(high[:whole].reshape(-1, BUCKET_FRAMES).max(axis=1)))
+        carry_low, carry_high = low[whole:], high[whole:]
+    if len(carry_low):
+        mins.append(_quantize(carry_low.min(keepdims=True)))
+        maxs.append(_quantize(carry_high.max(keepdims=True)))
+    if not mins:
+        mins = maxs = [np.zeros(1, dtype=np.int8)]
+    return Waveform(rate, _levels(np.concatenate(mins), np.concatenate(maxs)))
+
+
+def save_waveform(cache_path, waveform, stat):
+    arrays = {
+        'meta': np.array([WAVEFORM_VERSION, stat.st_size, stat.st_mtime_ns, waveform.rate],
+                         dtype=np.int64),
+    }
+    for i, level in enumerate(waveform.levels):
+        arrays[f'level{i}'] = level
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def load_waveform(cache_path, stat):
+    # The cached Waveform if it was made from this version of the file
+    try:
+        with np.load(cache_path) as data:
+            version, size, mtime_ns, rate = (int(value) for value in data['meta'])
+            if version != WAVEFORM_VERSION or size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                return None
+            levels = [data[f'level{i}'] for i in range(len(data.files) - 1)]
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Error loading waveform {cache_path}: {e}")
+        return None
+    return Waveform(rate, levels)
+
+
+def _compute_and_save(file_path, cache_path):
+    # Runs in the worker process, so the GUI process only ever loads
+    stat = os.stat(file_path)
+    waveform = compute_waveform(file_path)
+    save_waveform(cache_path, waveform, stat)
+    return waveform
+
+
+class _LoadTask(QRunnable):
+    def __init__(self, service, file_path):
+        super().__init__()
+        self.service = service
+        self.file_path = file_path
+
+    def run(self):
+        self.service._load(self.file_path)
+
+
+class WaveformService(QObject):
+    """Load waveforms from the disk cache, or compute them in a worker
+    process, off the GUI thread.
+
+    The last few waveforms are also kept in memory. request() favors the
+    latest track: computations queued for other tracks are dropped.
+    """
+
+    # file path, Waveform (None when the file could not be decoded)
+    waveform_ready = pyqtSignal(str, object)
+
+    def __init__(self, cache_dir, max_memory=8, parent=None):
+        super().__init__(parent)
+        self.waveform_dir = os.path.join(cache_dir, 'waveforms')
+        os.makedirs(self.waveform_dir, exist_ok=True)
+        self.max_memory = max_memory
+
+        self._lock = threading.Lock()
+        self._waveforms = OrderedDict()
+        self._pending = set()
+        self._queued = {}
+        self._process_pool = None
+        self._closed = False
+        self._loaders = QThreadPool(self)
+        self._loaders.setMaxThreadCount(1)
+
+    def cached(self, file_path):
+        # Return the waveform if it is in memory, else None
+        with self._lock:
+            waveform = self._waveforms.get(file_path)
+            if waveform is not None:
+                self._waveforms.move_to_end(file_path)
+            return waveform
+
+    def request(self, file_path, prefetch=False):
+        """Return the waveform right away when it is in memory; otherwise
+        schedule a load or computation and emit waveform_ready when done.
+        Unless prefetching, computations still queued for other tracks are
+        cancelled."""
+        waveform = self.cached(file_path)
+        if waveform is not None or http_stream.is_url(file_path):
+            # URLs have no waveform: it would download them whole
+            return waveform
+        with self._lock:
+            if not prefetch:
+                for path, future in list(self._queued.items()):
+                    if path != file_path and future.cancel():
+                        del self._queued[path]
+                        self._pending.discard(path)
+            if file_path in self._pending:
+                return None
+            self._pending.add(file_path)
+        self._loaders.start(_LoadTask(self, file_path))
+        return None
+
+    def _load(self, file_path):
+        # Runs on the loader thread: disk cache hit, or a computation
+        cache_path = waveform_path(self.waveform_dir, file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            print(f"Error loading waveform of {file_path}: {e}")
+            self._finished(file_path, None)
+            return
+        with metrics.span('waveform_load'):
+            waveform = load_waveform(cache_path, stat)
+        if waveform is not None:
+            metrics.count('waveform_cache_hits')
+            self._finished(file_path, waveform)
+            return
+        metrics.count('waveform_cache_misses')
+
+        with self._lock:
+            if self._closed:
+                return
+            future = None
+            if self._process_pool is not None:
+                try:
+                    future = self._process_pool.submit(_compute_and_save, file_path, cache_path)
+                except BrokenProcessPool:
+                    # A decoder crashed on some file; start over with a new worker
+                    self._process_pool.shutdown(wait=False)
+            if future is None:
+                # Spawned, not forked: this process runs Qt and threads
+                self._process_pool = ProcessPoolExecutor(
+                    1, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+                future = self._process_pool.submit(_compute_and_save, file_path, cache_path)
+            self._queued[file_path] = future
+        future.add_done_callback(lambda future: self._computed(file_path, future))
+
+    def _computed(self, file_path, future):
+        with self._lock:
+            if self._queued.get(file_path) is future:
+                del self._queued[file_path]
+        if future.cancelled():
+            return
+        try:
+            waveform = future.result()
+        except Exception as e:
+            print(f"Error computing waveform of {file_path}: {e}")
+            waveform = None
+        else:
+            metrics.count('waveforms_computed')
+        self._finished(file_path, waveform)
+
+    def _finished(self, file_path, waveform):
+        with self._lock:
+            self._pending.discard(file_path)
+            if waveform is not None:
+                self._waveforms[file_path] = waveform
+                while len(self._waveforms) > self.max_memory:
+                    self._waveforms.popitem(last=False)
+        self.waveform_ready.emit(file_path, waveform)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            pool = self._process_pool
+        self._loaders.clear()
+        self._loaders.waitForDone()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)